@@ -14,6 +14,7 @@ from django_filters import rest_framework as filters
 from django_filters.rest_framework import DjangoFilterBackend
 
 from apps.users.models import Branch, Company
+from apps.users.tenancy import get_tenancy, query_branch
 from .models import Service, Client, Appointment, AppointmentService, Document, Folder, ServiceCategory, Payout, PayoutSale, ProductSalePayout, OnlineBooking
 
 from .serializers import (
@@ -114,20 +115,14 @@ class CompanyQuerysetMixin:
         return getattr(self.request, "user", None)
 
     def _user_company(self):
-        user = self._user()
-        if not user or not getattr(user, "is_authenticated", False):
+        """
+        Компания пользователя (owned_company / company / компания филиала) —
+        из контекста арендатора (apps.users.tenancy), без запросов на каждый вызов.
+        """
+        u = self._user()
+        if not u or not getattr(u, "is_authenticated", False):
             return None
-
-        company = getattr(user, "owned_company", None) or getattr(user, "company", None)
-        if company:
-            return company
-
-        # fallback: если вдруг company хранится через user.branch
-        branch = getattr(user, "branch", None)
-        if branch is not None:
-            return getattr(branch, "company", None)
-
-        return None
+        return get_tenancy(self.request).company
 
     def _model_has_field(self, field_name: str) -> bool:
         qs = getattr(self, "queryset", None)
@@ -181,8 +176,6 @@ class CompanyQuerysetMixin:
             setattr(request, "branch", None)
             return None
 
-        company_id = getattr(company, "id", None)
-
         # 1) жёстко назначенный филиал
         fixed = self._fixed_branch_from_user(company)
         if fixed is not None:
@@ -190,20 +183,10 @@ class CompanyQuerysetMixin:
             return fixed
 
         # 2) если жёсткого филиала нет — позволяем выбирать через ?branch
-        branch_id = None
-        if hasattr(request, "query_params"):
-            branch_id = request.query_params.get("branch")
-        elif hasattr(request, "GET"):
-            branch_id = request.GET.get("branch")
-
-        if branch_id:
-            try:
-                br = Branch.objects.get(id=branch_id, company_id=company_id)
-                setattr(request, "branch", br)
-                return br
-            except (Branch.DoesNotExist, ValueError):
-                # чужой/битый UUID — игнорируем
-                pass
+        br = query_branch(request, get_tenancy(request))
+        if br is not None:
+            setattr(request, "branch", br)
+            return br
 
         # 3) никакого филиала → None (работаем по всей компании)
         setattr(request, "branch", None)
@@ -15,7 +15,7 @@ from .serializers import (
     BookingClientSerializer, BookingHistorySerializer
 )
 from .permissions import IsAdminOrReadOnly, IsManagerOrAdmin
-from apps.users.models import Branch
+from apps.users.tenancy import get_tenancy, query_branch
 
 
 # ---- Кастомные фильтры ----
@@ -77,21 +77,14 @@ class CompanyBranchQuerysetMixin:
         return getattr(self.request, "user", None)
 
     def _user_company(self):
-        user = self._user()
-        if not user or not getattr(user, "is_authenticated", False):
+        """
+        Компания пользователя (owned_company / company / компания филиала) —
+        из контекста арендатора (apps.users.tenancy), без запросов на каждый вызов.
+        """
+        u = self._user()
+        if not u or not getattr(u, "is_authenticated", False):
             return None
-
-        # обычный случай
-        company = getattr(user, "owned_company", None) or getattr(user, "company", None)
-        if company:
-            return company
-
-        # fallback: если компания хранится только через филиал пользователя
-        br = getattr(user, "branch", None)
-        if br is not None:
-            return getattr(br, "company", None)
-
-        return None
+        return get_tenancy(self.request).company
 
     def _model_has_field(self, field_name: str) -> bool:
         qs = getattr(self, "queryset", None)
@@ -102,51 +95,17 @@ class CompanyBranchQuerysetMixin:
 
     def _fixed_branch_from_user(self, company):
         """
-        «Жёстко» назначенный филиал сотрудника (который нельзя сменить ?branch):
-
-          - user.primary_branch() / user.primary_branch (если принадлежит company)
-          - user.branch (если принадлежит company)
-          - единственный филиал из user.branch_ids (если он один и относится к company)
+        «Жёсткий» филиал сотрудника (который нельзя менять ?branch):
+        основной филиал (primary), если он принадлежит company.
         """
-        user = self._user()
-        if not user or not company:
+        tenancy = get_tenancy(self.request)
+        if not company or tenancy.company_id != getattr(company, "id", None):
             return None
-
-        company_id = getattr(company, "id", None)
-
-        # 1) primary_branch: метод или поле
-        primary = getattr(user, "primary_branch", None)
-        if callable(primary):
-            try:
-                val = primary()
-                if val and getattr(val, "company_id", None) == company_id:
-                    return val
-            except Exception:
-                pass
-
-        if primary and not callable(primary) and getattr(primary, "company_id", None) == company_id:
-            return primary
-
-        # 2) user.branch
-        if hasattr(user, "branch"):
-            b = getattr(user, "branch")
-            if b and getattr(b, "company_id", None) == company_id:
-                return b
-
-        # 3) branch_ids: если ровно один филиал — считаем его фиксированным
-        branch_ids = getattr(user, "branch_ids", None)
-        if isinstance(branch_ids, (list, tuple)) and len(branch_ids) == 1:
-            try:
-                br = Branch.objects.get(id=branch_ids[0], company_id=company_id)
-                return br
-            except Branch.DoesNotExist:
-                pass
-
-        return None
+        return tenancy.primary_branch
 
     def _active_branch(self):
         """
-        1) жёсткий филиал (primary / user.branch / единственный из branch_ids)
+        1) жёсткий филиал (primary)
         2) если жёсткого нет — ?branch=<uuid>, если филиал принадлежит компании
         3) иначе None (вся компания)
         """
@@ -156,8 +115,6 @@ class CompanyBranchQuerysetMixin:
             setattr(request, "branch", None)
             return None
 
-        company_id = getattr(company, "id", None)
-
         # 1) жёстко назначенный филиал
         fixed = self._fixed_branch_from_user(company)
         if fixed is not None:
@@ -165,20 +122,10 @@ class CompanyBranchQuerysetMixin:
             return fixed
 
         # 2) если жёсткого филиала нет — позволяем выбирать через ?branch
-        branch_id = None
-        if hasattr(request, "query_params"):
-            branch_id = request.query_params.get("branch")
-        elif hasattr(request, "GET"):
-            branch_id = request.GET.get("branch")
-
-        if branch_id:
-            try:
-                br = Branch.objects.get(id=branch_id, company_id=company_id)
-                setattr(request, "branch", br)
-                return br
-            except (Branch.DoesNotExist, ValueError):
-                # чужой/битый uuid — игнорируем
-                pass
+        br = query_branch(request, get_tenancy(request))
+        if br is not None:
+            setattr(request, "branch", br)
+            return br
 
         # 3) никакого филиала → None (работаем по всей компании)
         setattr(request, "branch", None)
@@ -7,7 +7,7 @@ from django.utils import timezone
 from .models import (
     CafeClient, Order, OrderItem, Table, MenuItem,
     OrderHistory, OrderItemHistory,
-    Zone,  Warehouse,
+    Zone,  Warehouse, IngredientMove,
     KitchenTask, NotificationCafe,
     InventorySession, InventoryItem,
     Equipment, EquipmentInventorySession, EquipmentInventoryItem, Kitchen,
@@ -437,4 +437,13 @@ class WarehouseAdmin(admin.ModelAdmin):
     list_display = ("title", "company", "branch", "unit", "remainder", "minimum")
     list_filter = ("company", "branch", "unit")
     search_fields = ("title", "unit")     # <- обязательно для автокомплита
-    ordering = ("company", "branch", "title")
\ No newline at end of file
+    ordering = ("company", "branch", "title")
+
+
+@admin.register(IngredientMove)
+class IngredientMoveAdmin(admin.ModelAdmin):
+    list_display = ("warehouse", "kind", "delta", "company", "branch", "order", "created_at")
+    list_filter = ("company", "branch", "kind")
+    search_fields = ("warehouse__title",)
+    list_select_related = ("warehouse", "company", "branch")
+    readonly_fields = [f.name for f in IngredientMove._meta.fields]
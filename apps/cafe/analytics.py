@@ -456,8 +456,7 @@ class PurchasesBySupplierView(CompanyBranchQuerysetMixin, APIView):
 # ==========================
 class WarehouseLowStockView(CompanyBranchQuerysetMixin, APIView):
     """
-    Позиции склада ниже минимума.
-    remainder/minimum CharField -> сравнение python-side.
+    Позиции склада ниже минимума (числовые остатки — фильтр и сортировка в БД).
     """
     permission_classes = [permissions.IsAuthenticated]
 
@@ -481,21 +480,21 @@ class WarehouseLowStockView(CompanyBranchQuerysetMixin, APIView):
         if branch is not None:
             qs = qs.filter(branch=branch)
 
-        out = []
-        for w in qs.only("id", "title", "unit", "remainder", "minimum"):
-            rem = _to_decimal(w.remainder)
-            mn = _to_decimal(w.minimum)
-            if mn > 0 and rem < mn:
-                out.append({
-                    "id": str(w.id),
-                    "title": w.title,
-                    "unit": w.unit,
-                    "remainder": str(w.remainder or ""),
-                    "minimum": str(w.minimum or ""),
-                })
-
-        # сортируем “самые проблемные сверху”
-        out.sort(key=lambda x: (_to_decimal(x["remainder"]) - _to_decimal(x["minimum"])))
+        qs = (
+            qs.filter(minimum__gt=0, remainder__lt=F("minimum"))
+            # сортируем “самые проблемные сверху”
+            .order_by(F("remainder") - F("minimum"), "title")
+        )
+        out = [
+            {
+                "id": str(w["id"]),
+                "title": w["title"],
+                "unit": w["unit"],
+                "remainder": str(w["remainder"]),
+                "minimum": str(w["minimum"]),
+            }
+            for w in qs.values("id", "title", "unit", "remainder", "minimum")
+        ]
 
         _cache_set(key, out, _analytics_ttl())
         return Response(out)
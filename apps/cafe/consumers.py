@@ -1,15 +1,53 @@
 # apps/cafe/consumers.py
 import json
 import logging
+from urllib.parse import parse_qs
+
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
-from rest_framework_simplejwt.tokens import AccessToken
-from django.contrib.auth import get_user_model
 
-User = get_user_model()
+from apps.users.ws_auth import ws_tenancy
+
 logger = logging.getLogger(__name__)
 
+OWNER_LIKE_ROLES = ("owner", "admin", "OWNER", "ADMIN", "Владелец", "Администратор")
+
+
+def _is_owner_like(user, tenancy) -> bool:
+    """owner/admin: суперюзер, владелец компании или системная роль"""
+    return bool(
+        getattr(user, "is_superuser", False)
+        or tenancy.owns_company
+        or getattr(user, "is_admin", False)
+        or getattr(user, "role", None) in OWNER_LIKE_ROLES
+    )
+
+
+async def _resolve_company_and_branch(scope):
+    """
+    (company, branch) для подписки. Без запросов, если JWTAuthMiddleware уже положил
+    tenancy в scope; иначе — один database_sync_to_async.
+    Филиал: основной в компании, иначе первый из членств; owner/admin может
+    выбрать филиал своей компании через ?branch_id=<uuid>.
+    """
+    user = scope.get("user")
+    tenancy = scope.get("tenancy")
+    if tenancy is None or tenancy.user_id != getattr(user, "pk", None):
+        tenancy = await database_sync_to_async(ws_tenancy)(scope)
+        scope["tenancy"] = tenancy
+
+    company = tenancy.company
+    if company is None:
+        return None, None
+    branch = tenancy.member_branch
+
+    params = parse_qs(scope.get("query_string", b"").decode())
+    branch_id = (params.get("branch_id") or [None])[0]
+    if branch_id and _is_owner_like(user, tenancy):
+        branch = tenancy.branch(branch_id) or branch
+    return company, branch
+
 
 class CafeOrderConsumer(AsyncWebsocketConsumer):
     """
@@ -27,30 +65,14 @@ class CafeOrderConsumer(AsyncWebsocketConsumer):
             await self.close(code=4003)
             return
         
-        # Получаем company и branch из пользователя
-        company, branch = await self._get_user_company_and_branch(user)
+        # company/branch (+ branch_id из query для owner/admin) — из tenancy, которую положил JWTAuthMiddleware
+        company, branch = await _resolve_company_and_branch(self.scope)
         
         if not company:
             logger.warning(f"[CafeOrderConsumer] Connection rejected: User {user.id} has no company")
             await self.close(code=4004, reason="User has no company")
             return
         
-        # Опционально можно указать branch_id в query для выбора конкретного филиала
-        query_string = self.scope.get("query_string", b"").decode()
-        branch_id_from_query = None
-        if query_string:
-            from urllib.parse import parse_qs
-            parsed = parse_qs(query_string)
-            branch_id_from_query = parsed.get("branch_id", [None])[0]
-        
-        # Если указан branch_id в query и пользователь owner/admin - используем его
-        if branch_id_from_query:
-            is_owner_like = await self._is_owner_like(user)
-            if is_owner_like:
-                branch_from_query = await self._get_branch_by_id(branch_id_from_query, company.id)
-                if branch_from_query:
-                    branch = branch_from_query
-        
         self.company_id = str(company.id)
         self.branch_id = str(branch.id) if branch else None
         
@@ -148,71 +170,13 @@ class CafeOrderConsumer(AsyncWebsocketConsumer):
             logger.info(f"[CafeOrderConsumer] Sent kitchen_task_ready notification to client")
         except Exception as e:
             logger.error(f"[CafeOrderConsumer] Error in kitchen_task_ready: {e}", exc_info=True)
-    
-    @database_sync_to_async
-    def _get_user_company_and_branch(self, user):
-        """Получает company и branch из пользователя"""
-        try:
-            # Получаем компанию
-            company = getattr(user, "owned_company", None) or getattr(user, "company", None)
-            if not company:
-                return None, None
-            
-            # Получаем филиал
-            branch = None
-            
-            # 1) primary_branch (property)
-            primary = getattr(user, "primary_branch", None)
-            if primary and getattr(primary, "company_id", None) == company.id:
-                branch = primary
-            
-            # 2) user.branch
-            if not branch:
-                user_branch = getattr(user, "branch", None)
-                if user_branch and getattr(user_branch, "company_id", None) == company.id:
-                    branch = user_branch
-            
-            # 3) первый филиал из branch_memberships
-            if not branch and hasattr(user, "branch_memberships"):
-                membership = user.branch_memberships.filter(
-                    branch__company_id=company.id
-                ).select_related("branch").first()
-                if membership and membership.branch:
-                    branch = membership.branch
-            
-            return company, branch
-        except Exception:
-            return None, None
-    
-    @database_sync_to_async
-    def _is_owner_like(self, user):
-        """Проверяет, является ли пользователь owner/admin"""
-        try:
-            if getattr(user, "is_superuser", False):
-                return True
-            
-            if getattr(user, "owned_company", None):
-                return True
-            
-            if getattr(user, "is_admin", False):
-                return True
-            
-            role = getattr(user, "role", None)
-            if role in ("owner", "admin", "OWNER", "ADMIN", "Владелец", "Администратор"):
-                return True
-            
-            return False
-        except Exception:
-            return False
-    
-    @database_sync_to_async
-    def _get_branch_by_id(self, branch_id, company_id):
-        """Получает филиал по ID, если он принадлежит компании"""
+
+    async def cafe_batch(self, event):
+        """Готовый кадр от apps.cafe.realtime (одно событие или {"type": "batch", "events": [...]})"""
         try:
-            from apps.users.models import Branch
-            return Branch.objects.get(id=branch_id, company_id=company_id)
-        except Exception:
-            return None
+            await self.send(text_data=event["frame"])
+        except Exception as e:
+            logger.error(f"[CafeOrderConsumer] Error in cafe_batch: {e}", exc_info=True)
 
 
 class CafeTableConsumer(AsyncWebsocketConsumer):
@@ -231,30 +195,14 @@ class CafeTableConsumer(AsyncWebsocketConsumer):
             await self.close(code=4003)
             return
         
-        # Получаем company и branch из пользователя
-        company, branch = await self._get_user_company_and_branch(user)
+        # company/branch (+ branch_id из query для owner/admin) — из tenancy, которую положил JWTAuthMiddleware
+        company, branch = await _resolve_company_and_branch(self.scope)
         
         if not company:
             logger.warning(f"[CafeTableConsumer] Connection rejected: User {user.id} has no company")
             await self.close(code=4004, reason="User has no company")
             return
         
-        # Опционально можно указать branch_id в query для выбора конкретного филиала
-        query_string = self.scope.get("query_string", b"").decode()
-        branch_id_from_query = None
-        if query_string:
-            from urllib.parse import parse_qs
-            parsed = parse_qs(query_string)
-            branch_id_from_query = parsed.get("branch_id", [None])[0]
-        
-        # Если указан branch_id в query и пользователь owner/admin - используем его
-        if branch_id_from_query:
-            is_owner_like = await self._is_owner_like(user)
-            if is_owner_like:
-                branch_from_query = await self._get_branch_by_id(branch_id_from_query, company.id)
-                if branch_from_query:
-                    branch = branch_from_query
-        
         self.company_id = str(company.id)
         self.branch_id = str(branch.id) if branch else None
         
@@ -342,71 +290,13 @@ class CafeTableConsumer(AsyncWebsocketConsumer):
             logger.info(f"[CafeTableConsumer] Sent table_status_changed notification to client")
         except Exception as e:
             logger.error(f"[CafeTableConsumer] Error in table_status_changed: {e}", exc_info=True)
-    
-    @database_sync_to_async
-    def _get_user_company_and_branch(self, user):
-        """Получает company и branch из пользователя"""
-        try:
-            # Получаем компанию
-            company = getattr(user, "owned_company", None) or getattr(user, "company", None)
-            if not company:
-                return None, None
-            
-            # Получаем филиал
-            branch = None
-            
-            # 1) primary_branch (property)
-            primary = getattr(user, "primary_branch", None)
-            if primary and getattr(primary, "company_id", None) == company.id:
-                branch = primary
-            
-            # 2) user.branch
-            if not branch:
-                user_branch = getattr(user, "branch", None)
-                if user_branch and getattr(user_branch, "company_id", None) == company.id:
-                    branch = user_branch
-            
-            # 3) первый филиал из branch_memberships
-            if not branch and hasattr(user, "branch_memberships"):
-                membership = user.branch_memberships.filter(
-                    branch__company_id=company.id
-                ).select_related("branch").first()
-                if membership and membership.branch:
-                    branch = membership.branch
-            
-            return company, branch
-        except Exception:
-            return None, None
-    
-    @database_sync_to_async
-    def _is_owner_like(self, user):
-        """Проверяет, является ли пользователь owner/admin"""
-        try:
-            if getattr(user, "is_superuser", False):
-                return True
-            
-            if getattr(user, "owned_company", None):
-                return True
-            
-            if getattr(user, "is_admin", False):
-                return True
-            
-            role = getattr(user, "role", None)
-            if role in ("owner", "admin", "OWNER", "ADMIN", "Владелец", "Администратор"):
-                return True
-            
-            return False
-        except Exception:
-            return False
-    
-    @database_sync_to_async
-    def _get_branch_by_id(self, branch_id, company_id):
-        """Получает филиал по ID, если он принадлежит компании"""
+
+    async def cafe_batch(self, event):
+        """Готовый кадр от apps.cafe.realtime (одно событие или {"type": "batch", "events": [...]})"""
         try:
-            from apps.users.models import Branch
-            return Branch.objects.get(id=branch_id, company_id=company_id)
-        except Exception:
-            return None
+            await self.send(text_data=event["frame"])
+        except Exception as e:
+            logger.error(f"[CafeTableConsumer] Error in cafe_batch: {e}", exc_info=True)
 
 
 class CafeKitchenConsumer(AsyncWebsocketConsumer):
@@ -424,28 +314,13 @@ class CafeKitchenConsumer(AsyncWebsocketConsumer):
             await self.close(code=4003)
             return
 
-        company, branch = await self._get_user_company_and_branch(user)
+        # company/branch (+ branch_id из query для owner/admin) — из tenancy, которую положил JWTAuthMiddleware
+        company, branch = await _resolve_company_and_branch(self.scope)
         if not company:
             logger.warning(f"[CafeKitchenConsumer] Connection rejected: User {user.id} has no company")
             await self.close(code=4004, reason="User has no company")
             return
 
-        # Опционально можно указать branch_id в query для выбора конкретного филиала
-        query_string = self.scope.get("query_string", b"").decode()
-        branch_id_from_query = None
-        if query_string:
-            from urllib.parse import parse_qs
-            parsed = parse_qs(query_string)
-            branch_id_from_query = parsed.get("branch_id", [None])[0]
-
-        # Если указан branch_id в query и пользователь owner/admin - используем его
-        if branch_id_from_query:
-            is_owner_like = await self._is_owner_like(user)
-            if is_owner_like:
-                branch_from_query = await self._get_branch_by_id(branch_id_from_query, company.id)
-                if branch_from_query:
-                    branch = branch_from_query
-
         self.company_id = str(company.id)
         self.branch_id = str(branch.id) if branch else None
 
@@ -499,59 +374,9 @@ class CafeKitchenConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             logger.error(f"[CafeKitchenConsumer] Error in kitchen_task_ready: {e}", exc_info=True)
 
-    @database_sync_to_async
-    def _get_user_company_and_branch(self, user):
-        """Получает company и branch из пользователя"""
+    async def cafe_batch(self, event):
+        """Готовый кадр от apps.cafe.realtime (одно событие или {"type": "batch", "events": [...]})"""
         try:
-            company = getattr(user, "owned_company", None) or getattr(user, "company", None)
-            if not company:
-                return None, None
-
-            branch = None
-
-            primary = getattr(user, "primary_branch", None)
-            if primary and getattr(primary, "company_id", None) == company.id:
-                branch = primary
-
-            if not branch:
-                user_branch = getattr(user, "branch", None)
-                if user_branch and getattr(user_branch, "company_id", None) == company.id:
-                    branch = user_branch
-
-            if not branch and hasattr(user, "branch_memberships"):
-                membership = user.branch_memberships.filter(
-                    branch__company_id=company.id
-                ).select_related("branch").first()
-                if membership and membership.branch:
-                    branch = membership.branch
-
-            return company, branch
-        except Exception:
-            return None, None
-
-    @database_sync_to_async
-    def _is_owner_like(self, user):
-        """Проверяет, является ли пользователь owner/admin"""
-        try:
-            if getattr(user, "is_superuser", False):
-                return True
-            if getattr(user, "owned_company", None):
-                return True
-            if getattr(user, "is_admin", False):
-                return True
-
-            role = getattr(user, "role", None)
-            if role in ("owner", "admin", "OWNER", "ADMIN", "Владелец", "Администратор"):
-                return True
-            return False
-        except Exception:
-            return False
-
-    @database_sync_to_async
-    def _get_branch_by_id(self, branch_id, company_id):
-        """Получает филиал по ID, если он принадлежит компании"""
-        try:
-            from apps.users.models import Branch
-            return Branch.objects.get(id=branch_id, company_id=company_id)
-        except Exception:
-            return None
+            await self.send(text_data=event["frame"])
+        except Exception as e:
+            logger.error(f"[CafeKitchenConsumer] Error in cafe_batch: {e}", exc_info=True)
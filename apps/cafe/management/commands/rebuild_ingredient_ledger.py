@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.cafe import services_stock
+
+
+class Command(BaseCommand):
+    help = (
+        "Cafe stock ledger (Warehouse.remainder = sum of IngredientMove). "
+        "--normalize-legacy: run BEFORE migrating remainder/minimum to decimal; rewrites old "
+        "strings such as '5 кг', '5,5', '1 200' into numbers by the old parsing rules. "
+        "Default: seed one OPENING move per warehouse created before the ledger, then set "
+        "remainder to the sum of moves where they still differ. Safe to re-run. "
+        "With --verify only compares and exits with an error when balances differ."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--company", default="", help="Filter by company UUID (optional).")
+        parser.add_argument("--verify", action="store_true", help="Compare only, do not rewrite.")
+        parser.add_argument(
+            "--normalize-legacy", action="store_true",
+            help="Normalize legacy string balances (before the column type change).",
+        )
+
+    def handle(self, *args, **opts):
+        company_id = opts["company"] or None
+
+        if opts["normalize_legacy"]:
+            rows = services_stock.normalize_legacy_balances(company_id)
+            self.stdout.write(self.style.SUCCESS(f"Legacy warehouse balances normalized: rows={rows}"))
+            return
+
+        if opts["verify"]:
+            diffs = services_stock.verify_ledger(company_id)
+            for pk, stored, expected in diffs[:50]:
+                self.stdout.write(f"{pk}: stored={stored} expected={expected}")
+            if diffs:
+                raise CommandError(f"{len(diffs)} warehouse balances differ from the ledger")
+            self.stdout.write(self.style.SUCCESS("Ingredient ledger is consistent"))
+            return
+
+        seeded = services_stock.seed_opening_moves(company_id)
+        fixed = services_stock.rebuild_ledger_balances(company_id)
+        self.stdout.write(self.style.SUCCESS(f"Ingredient ledger rebuilt: opening rows={seeded}, fixed={fixed}"))
@@ -414,8 +414,9 @@ class Warehouse(models.Model):
     )
     title = models.CharField(max_length=255, verbose_name="Название")
     unit = models.CharField(max_length=255, verbose_name="Ед. изм.")
-    remainder = models.CharField(max_length=255, verbose_name="Остаток")
-    minimum = models.CharField(max_length=255, verbose_name="Минимум")
+    # текущий остаток = сумма движений IngredientMove; меняется только через apps.cafe.services_stock
+    remainder = models.DecimalField("Остаток", max_digits=14, decimal_places=3, default=Decimal("0"))
+    minimum = models.DecimalField("Минимум", max_digits=14, decimal_places=3, default=Decimal("0"))
     unit_price = models.DecimalField(
         "Цена за единицу", max_digits=12, decimal_places=2,
         default=Decimal("0.00"),
@@ -442,14 +443,120 @@ class Warehouse(models.Model):
             models.Index(fields=['company', 'branch', 'title']),
         ]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_remainder = instance.__dict__.get("remainder")
+        return instance
+
     def clean(self):
         if self.branch_id and self.branch.company_id != self.company_id:
             raise ValidationError({'branch': 'Филиал принадлежит другой компании.'})
 
+    def save(self, *args, **kwargs):
+        """
+        Ручная правка остатка (карточка, админка) применяется как разница
+        к текущему значению в БД под блокировкой строки и пишется в журнал
+        движением ADJUSTMENT. Сам remainder обычным UPDATE не пишется: иначе
+        устаревшее значение из памяти затёрло бы параллельное списание.
+        Новая позиция создаётся с остатком и движением OPENING.
+        """
+        if self._state.adding:
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                if self.remainder:
+                    IngredientMove.objects.create(
+                        company_id=self.company_id,
+                        branch_id=self.branch_id,
+                        warehouse=self,
+                        kind=IngredientMove.Kind.OPENING,
+                        delta=self.remainder,
+                    )
+            self._loaded_remainder = self.remainder
+            return
+
+        update_fields = kwargs.get("update_fields")
+        loaded = getattr(self, "_loaded_remainder", None)
+        delta = None
+        if loaded is not None and (update_fields is None or "remainder" in update_fields):
+            delta = Decimal(self.remainder or 0) - Decimal(loaded)
+        if update_fields is None:
+            update_fields = [
+                f.attname for f in self._meta.concrete_fields
+                if not f.primary_key and f.attname not in self.get_deferred_fields()
+            ]
+        kwargs["update_fields"] = [f for f in update_fields if f != "remainder"]
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if delta:
+                from .services_stock import apply_ingredient_deltas, lock_balances
+
+                lock_balances([self.pk])
+                apply_ingredient_deltas(
+                    {self.pk: delta},
+                    company_id=self.company_id,
+                    branch_id=self.branch_id,
+                    kind=IngredientMove.Kind.ADJUSTMENT,
+                )
+                self.remainder = Warehouse.objects.filter(pk=self.pk).values_list("remainder", flat=True).get()
+        self._loaded_remainder = self.remainder
+
     def __str__(self):
         return f"{self.title} - осталось {self.remainder}"
 
 
+class IngredientMove(models.Model):
+    """
+    Журнал движений склада кафе (только добавление строк).
+    Warehouse.remainder — материализованная сумма delta по позиции.
+    """
+    class Kind(models.TextChoices):
+        OPENING = "opening", "Начальный остаток"
+        ORDER = "order", "Списание по заказу"
+        INVENTORY = "inventory", "Инвентаризация"
+        ADJUSTMENT = "adjustment", "Корректировка"
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    company = models.ForeignKey(
+        Company, on_delete=models.CASCADE, related_name='cafe_ingredient_moves', verbose_name='Компания'
+    )
+    branch = models.ForeignKey(
+        Branch, on_delete=models.CASCADE, related_name='cafe_ingredient_moves',
+        verbose_name='Филиал', null=True, blank=True,
+    )
+    warehouse = models.ForeignKey(
+        Warehouse, on_delete=models.CASCADE, related_name='moves', verbose_name='Позиция склада'
+    )
+    kind = models.CharField("Тип", max_length=16, choices=Kind.choices)
+    delta = models.DecimalField("Изменение", max_digits=14, decimal_places=3)
+    order = models.ForeignKey(
+        "Order", on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='ingredient_moves', verbose_name='Заказ',
+    )
+    inventory_session = models.ForeignKey(
+        "InventorySession", on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='moves', verbose_name='Инвентаризация',
+    )
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='+', verbose_name='Пользователь',
+    )
+    created_at = models.DateTimeField("Создано", auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Движение склада'
+        verbose_name_plural = 'Движения склада'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['warehouse', 'created_at']),
+            models.Index(fields=['company', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.warehouse_id}: {self.delta:+} ({self.kind})"
+
+
 class Purchase(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     company = models.ForeignKey(
@@ -1045,18 +1152,27 @@ class InventorySession(models.Model):
         who = f" / {self.branch}" if self.branch_id else " / GLOBAL"
         return f"Инвентаризация{who} ({self.created_at:%Y-%m-%d %H:%M})"
 
+    @transaction.atomic
     def confirm(self, user=None):
         """
-        Применяет фактические остатки к Warehouse.remainder.
-        ВНИМАНИЕ: у вас remainder=CharField, поэтому пишем строкой Decimal.
+        Применяет фактические остатки к Warehouse.remainder:
+        разница с текущим (заблокированным) остатком пишется движением INVENTORY.
         """
         if self.is_confirmed:
             return
-        for item in self.items.select_related("product"):
-            # фиксируем актуальный остаток в карточке товара
-            # переводим Decimal -> строка (без форматирования единиц)
-            item.product.remainder = str(item.actual_qty)
-            item.product.save(update_fields=["remainder"])
+        from apps.cafe.services_stock import apply_ingredient_deltas, lock_balances
+
+        actual = dict(self.items.values_list("product_id", "actual_qty"))
+        current = lock_balances(actual)
+        deltas = {pid: qty - current[pid] for pid, qty in actual.items() if pid in current}
+        apply_ingredient_deltas(
+            deltas,
+            company_id=self.company_id,
+            branch_id=self.branch_id,
+            kind=IngredientMove.Kind.INVENTORY,
+            inventory_session=self,
+            user=user,
+        )
         self.is_confirmed = True
         self.confirmed_at = timezone.now()
         self.save(update_fields=["is_confirmed", "confirmed_at"])
@@ -0,0 +1,182 @@
+# apps/cafe/realtime.py
+"""
+Исходящие WebSocket-события кафе (заказы, столы, кухня).
+
+publish(group, type, payload) ставит событие в очередь ПОСЛЕ коммита транзакции.
+Фоновый поток собирает события за CAFE_WS_COALESCE_MS миллисекунд, группирует
+по группе каналов и отправляет одним group_send на группу:
+  - одно событие  -> кадр {"type": <type>, "data": payload} (как раньше);
+  - несколько     -> кадр {"type": "batch", "events": [{"type", "data"}, ...]}.
+Повтор события с тем же key в окне (например, два order_updated одного заказа)
+заменяет предыдущее. Каждое событие кодируется orjson один раз, кадр для группы
+собирается из готовых байтов; консьюмер (метод cafe_batch) отправляет его как есть.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+
+from django.conf import settings
+from django.db import transaction
+
+try:
+    import orjson
+except Exception:  # pragma: no cover
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+BATCH_MESSAGE_TYPE = "cafe.batch"  # -> consumer.cafe_batch()
+
+_queue: "queue.Queue" = queue.Queue()
+_worker = None
+_worker_pid = None
+_worker_lock = threading.Lock()
+_seq = count()
+
+
+def _coalesce_seconds() -> float:
+    return max(0, int(getattr(settings, "CAFE_WS_COALESCE_MS", 5))) / 1000.0
+
+
+def _max_batch() -> int:
+    return max(1, int(getattr(settings, "CAFE_WS_MAX_BATCH", 200)))
+
+
+def group_name(prefix: str, company_id, branch_id=None) -> str:
+    """cafe_orders_<company>[_<branch>] и т.п. — те же имена, что у консьюмеров."""
+    if branch_id:
+        return f"cafe_{prefix}_{company_id}_{branch_id}"
+    return f"cafe_{prefix}_{company_id}"
+
+
+def _dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value, default=str)
+    import json
+
+    return json.dumps(value, default=str, ensure_ascii=False).encode()
+
+
+# --------- сборка кадров ---------
+
+def encode_event(event_type: str, payload: dict) -> bytes:
+    return _dumps({"type": event_type, "data": payload})
+
+
+def build_frames(events) -> dict:
+    """
+    events: [(group, key, body_bytes)] в порядке публикации.
+    Возвращает {group: [frame_text, ...]} — кадров больше одного, только если
+    событий больше CAFE_WS_MAX_BATCH.
+    """
+    by_group: dict = {}
+    for group, key, body in events:
+        pending = by_group.setdefault(group, OrderedDict())
+        if key is None:
+            key = ("seq", next(_seq))
+        pending.pop(key, None)  # последнее событие с тем же ключом вытесняет прежнее
+        pending[key] = body
+
+    limit = _max_batch()
+    frames = {}
+    for group, pending in by_group.items():
+        bodies = list(pending.values())
+        out = []
+        for start in range(0, len(bodies), limit):
+            chunk = bodies[start:start + limit]
+            if len(chunk) == 1:
+                out.append(chunk[0].decode())
+            else:
+                out.append((b'{"type":"batch","events":[' + b",".join(chunk) + b"]}").decode())
+        frames[group] = out
+    return frames
+
+
+async def send_frames(channel_layer, frames: dict) -> None:
+    """Один group_send на кадр; группы отправляются параллельно."""
+    sends = [
+        channel_layer.group_send(group, {"type": BATCH_MESSAGE_TYPE, "frame": frame})
+        for group, group_frames in frames.items()
+        for frame in group_frames
+    ]
+    results = await asyncio.gather(*sends, return_exceptions=True)
+    for res in results:
+        if isinstance(res, Exception):
+            logger.error("[cafe.realtime] group_send failed: %s", res, exc_info=res)
+
+
+# --------- фоновый отправитель ---------
+
+def _drain(first) -> list:
+    events = [first]
+    deadline = time.monotonic() + _coalesce_seconds()
+    while True:
+        timeout = deadline - time.monotonic()
+        try:
+            item = _queue.get(timeout=timeout) if timeout > 0 else _queue.get_nowait()
+        except queue.Empty:
+            return events
+        events.append(item)
+
+
+def _run() -> None:
+    from channels.layers import get_channel_layer
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    while True:
+        first = _queue.get()
+        events = _drain(first)
+        try:
+            channel_layer = get_channel_layer()
+            if channel_layer is not None:
+                encoded = [(group, key, encode_event(event_type, payload)) for group, key, event_type, payload in events]
+                loop.run_until_complete(send_frames(channel_layer, build_frames(encoded)))
+        except Exception:
+            logger.error("[cafe.realtime] Failed to publish %s events", len(events), exc_info=True)
+        finally:
+            for _ in events:
+                _queue.task_done()
+
+
+def _ensure_worker() -> None:
+    global _worker, _worker_pid
+    pid = os.getpid()
+    if _worker is not None and _worker_pid == pid and _worker.is_alive():
+        return
+    with _worker_lock:
+        if _worker is not None and _worker_pid == pid and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_run, name="cafe-ws-publisher", daemon=True)
+        _worker_pid = pid
+        _worker.start()
+
+
+def _enqueue(group: str, event_type: str, payload: dict, key) -> None:
+    _ensure_worker()
+    _queue.put((group, key, event_type, payload))
+
+
+def publish(group: str, event_type: str, payload: dict, *, key=None) -> None:
+    """
+    Отправить событие в группу после коммита текущей транзакции
+    (вне транзакции — сразу в очередь). Не блокирует запрос.
+    """
+    transaction.on_commit(lambda: _enqueue(group, event_type, payload, key))
+
+
+def flush(timeout: float = 5.0) -> bool:
+    """Дождаться отправки всего, что уже в очереди (тесты, management-команды)."""
+    deadline = time.monotonic() + timeout
+    while _queue.unfinished_tasks:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.001)
+    return True
@@ -8,7 +8,7 @@ from django.core.exceptions import ValidationError as DjangoValidationError
 from django.db import transaction, IntegrityError
 
 from apps.cafe.models import (
-    Zone, Table, Booking, Warehouse, Purchase,
+    Zone, Table, Booking, Warehouse, IngredientMove, Purchase,
     Category, MenuItem, Ingredient,
     Order, OrderItem, CafeClient,
     OrderHistory, OrderItemHistory, KitchenTask, NotificationCafe, InventorySession, InventoryItem, Equipment, EquipmentInventoryItem, EquipmentInventorySession, Kitchen,
@@ -860,6 +860,13 @@ class OrderPaySerializer(serializers.Serializer):
             raise serializers.ValidationError("discount_amount не может быть отрицательным.")
         return v
 
+class IngredientMoveSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = IngredientMove
+        fields = ["id", "warehouse", "kind", "delta", "order", "inventory_session", "created_by", "created_at"]
+        read_only_fields = fields
+
+
 class InventoryItemSerializer(serializers.ModelSerializer):
     product_title = serializers.CharField(source="product.title", read_only=True)
     product_unit = serializers.CharField(source="product.unit", read_only=True)
@@ -869,6 +876,8 @@ class InventoryItemSerializer(serializers.ModelSerializer):
         fields = ["id", "product", "product_title", "product_unit",
                   "expected_qty", "actual_qty", "difference"]
         read_only_fields = ["id", "product_title", "product_unit", "difference"]
+        # не передан — берётся учётный остаток позиции (Warehouse.remainder)
+        extra_kwargs = {"expected_qty": {"required": False}}
 
     def get_fields(self):
         fields = super().get_fields()
@@ -882,9 +891,9 @@ class InventoryItemSerializer(serializers.ModelSerializer):
     def validate(self, attrs):
         exp = attrs.get("expected_qty")
         act = attrs.get("actual_qty")
-        if exp is None or act is None:
+        if act is None:
             return attrs
-        if exp < 0 or act < 0:
+        if (exp is not None and exp < 0) or act < 0:
             raise serializers.ValidationError({"actual_qty": "Кол-во не может быть отрицательным."})
         return attrs
 
@@ -916,7 +925,9 @@ class InventorySessionSerializer(CompanyBranchReadOnlyMixin):
                             {"items": f"Товар «{product.title}» повторяется в одном акте."}
                         )
                     seen.add(product.pk)
-                    exp = it["expected_qty"]
+                    exp = it.get("expected_qty")
+                    if exp is None:
+                        exp = product.remainder
                     act = it["actual_qty"]
                     bulk.append(InventoryItem(
                         session=obj,
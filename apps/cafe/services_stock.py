@@ -0,0 +1,226 @@
+"""
+Остатки склада кафе (Warehouse.remainder) и журнал движений IngredientMove.
+
+Изменение остатков — одним UPDATE на набор позиций:
+    remainder = remainder + CASE id WHEN ... THEN delta END
+плюс bulk_create движений. Перед UPDATE строки блокируются одним запросом
+с ORDER BY id — одинаковый порядок блокировок у параллельных оплат.
+
+Перевод старых строковых остатков, начальные движения и сверка журнала —
+команда rebuild_ingredient_ledger (--normalize-legacy, --verify).
+"""
+
+from __future__ import annotations
+
+import re
+from decimal import Decimal, InvalidOperation
+
+from django.db import connection, transaction
+from django.db.models import Case, Count, DecimalField, F, Q, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from .models import IngredientMove, Warehouse
+
+_QTY = DecimalField(max_digits=14, decimal_places=3)
+_NUM_RE = re.compile(r"[-+]?\d+(?:[.,]\d+)?")
+
+
+def parse_legacy_qty(raw) -> Decimal:
+    """
+    Остаток/минимум из старого CharField: число строкой, иногда с пробелами
+    и единицами («5 кг», «5,5», «1 200»). Правила прежнего списания по заказу:
+    берём первое число, запятая — десятичный разделитель, иначе 0.
+    """
+    if raw is None:
+        return Decimal("0")
+    if isinstance(raw, Decimal):
+        return raw
+    s = str(raw).strip()
+    if not s:
+        return Decimal("0")
+    m = _NUM_RE.search(s)
+    if not m:
+        return Decimal("0")
+    try:
+        return Decimal(m.group(0).replace(",", "."))
+    except InvalidOperation:
+        return Decimal("0")
+
+
+def normalize_legacy_balances(company_id=None) -> int:
+    """
+    Переписывает remainder/minimum в числовые строки до смены типа колонок
+    (сырой SQL: модель уже описывает DecimalField). Повторный запуск и запуск
+    по уже числовым колонкам ничего не меняют. Возвращает число строк.
+    """
+    table = connection.ops.quote_name(Warehouse._meta.db_table)
+    sql = f"SELECT id, remainder, minimum FROM {table}"
+    params = []
+    if company_id:
+        sql += " WHERE company_id = %s"
+        params.append(str(company_id))
+
+    changed = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        for pk, remainder, minimum in cursor.fetchall():
+            values = [format(parse_legacy_qty(v), "f") for v in (remainder, minimum)]
+            if values == [str(remainder), str(minimum)]:
+                continue
+            cursor.execute(
+                f"UPDATE {table} SET remainder = %s, minimum = %s WHERE id = %s",
+                [*values, pk],
+            )
+            changed += 1
+    return changed
+
+
+def order_ingredient_usage(order) -> dict:
+    """Расход по заказу: {warehouse_id: количество} (по техкартам MenuItem.ingredients)."""
+    usage = {}
+    items = order.items.all()
+    if "items" not in getattr(order, "_prefetched_objects_cache", {}):
+        items = items.select_related("menu_item").prefetch_related("menu_item__ingredients")
+    for it in items:
+        qty = Decimal(str(it.quantity or 0))
+        if qty <= 0:
+            continue
+        for ing in it.menu_item.ingredients.all():
+            need = (ing.amount or Decimal("0")) * qty
+            if need <= 0:
+                continue
+            usage[ing.product_id] = usage.get(ing.product_id, Decimal("0")) + need
+    return usage
+
+
+def lock_balances(warehouse_ids) -> dict:
+    """SELECT ... FOR UPDATE в порядке id; возвращает {id: remainder} найденных позиций."""
+    return dict(
+        Warehouse.objects.select_for_update()
+        .filter(id__in=list(warehouse_ids))
+        .order_by("id")
+        .values_list("id", "remainder")
+    )
+
+
+def apply_ingredient_deltas(
+    deltas: dict,
+    *,
+    company_id,
+    branch_id=None,
+    kind: str,
+    order=None,
+    inventory_session=None,
+    user=None,
+) -> int:
+    """
+    Применяет {warehouse_id: delta} одним UPDATE и пишет движения.
+    Вызывать внутри transaction.atomic(); возвращает число обновлённых позиций.
+    """
+    deltas = {pid: delta for pid, delta in deltas.items() if delta}
+    if not deltas:
+        return 0
+
+    updated = Warehouse.objects.filter(id__in=list(deltas)).update(
+        remainder=F("remainder") + Case(
+            *[When(id=pid, then=Value(delta, output_field=_QTY)) for pid, delta in deltas.items()],
+            default=Value(Decimal("0"), output_field=_QTY),
+            output_field=_QTY,
+        )
+    )
+    IngredientMove.objects.bulk_create([
+        IngredientMove(
+            company_id=company_id,
+            branch_id=branch_id,
+            warehouse_id=pid,
+            kind=kind,
+            delta=delta,
+            order=order,
+            inventory_session=inventory_session,
+            created_by=user if getattr(user, "is_authenticated", False) else None,
+        )
+        for pid, delta in deltas.items()
+    ])
+    return updated
+
+
+def deduct_order_ingredients(order, *, user=None) -> list:
+    """
+    Списывает ингредиенты заказа. Возвращает id позиций склада, которых нет
+    (тогда ничего не списано — вызывающий откатывает транзакцию).
+    """
+    usage = order_ingredient_usage(order)
+    if not usage:
+        return []
+    found = lock_balances(usage)
+    missing = [pid for pid in usage if pid not in found]
+    if missing:
+        return missing
+    apply_ingredient_deltas(
+        {pid: -need for pid, need in usage.items()},
+        company_id=order.company_id,
+        branch_id=order.branch_id,
+        kind=IngredientMove.Kind.ORDER,
+        order=order,
+        user=user,
+    )
+    return []
+
+
+def _ledger_totals(company_id=None):
+    qs = Warehouse.objects.all()
+    if company_id:
+        qs = qs.filter(company_id=company_id)
+    return qs.annotate(
+        moved=Coalesce(Sum("moves__delta"), Value(Decimal("0"), output_field=_QTY)),
+        has_opening=Count("moves", filter=Q(moves__kind=IngredientMove.Kind.OPENING)),
+    )
+
+
+def seed_opening_moves(company_id=None) -> int:
+    """
+    Позициям без движения OPENING (заведены до журнала) пишет начальный
+    остаток = remainder − Σ движений, чтобы журнал сошёлся с балансом.
+    Повторный запуск ничего не добавляет. Возвращает число движений.
+    """
+    with transaction.atomic():
+        rows = list(
+            _ledger_totals(company_id).filter(has_opening=0)
+            .values_list("id", "company_id", "branch_id", "moved")
+        )
+        balances = lock_balances([r[0] for r in rows])
+        moves = [
+            IngredientMove(
+                company_id=company, branch_id=branch, warehouse_id=pk,
+                kind=IngredientMove.Kind.OPENING, delta=balances[pk] - moved,
+            )
+            for pk, company, branch, moved in rows
+            if pk in balances and balances[pk] != moved
+        ]
+        IngredientMove.objects.bulk_create(moves, batch_size=1000)
+    return len(moves)
+
+
+def verify_ledger(company_id=None) -> list:
+    """Расхождения [(id позиции, remainder, Σ движений)]."""
+    return [
+        (pk, remainder, moved)
+        for pk, remainder, moved in _ledger_totals(company_id).values_list("id", "remainder", "moved")
+        if remainder != moved
+    ]
+
+
+def rebuild_ledger_balances(company_id=None) -> int:
+    """
+    Журнал — источник истины: remainder расходящихся позиций переписывается
+    в Σ движений под блокировкой. Возвращает число исправленных позиций.
+    """
+    with transaction.atomic():
+        ids = [pk for pk, _, _ in verify_ledger(company_id)]
+        lock_balances(ids)
+        fixed = 0
+        for pk in ids:
+            # сумма читается уже под блокировкой — параллельное списание не потеряется
+            moved = IngredientMove.objects.filter(warehouse_id=pk).aggregate(s=Sum("delta"))["s"] or Decimal("0")
+            fixed += Warehouse.objects.filter(pk=pk).update(remainder=moved)
+    return fixed
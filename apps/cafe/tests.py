@@ -1,14 +1,27 @@
 # apps/cafe/tests.py
+import asyncio
+import json
+import logging
+import time
 from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase, TransactionTestCase
 from django.contrib.auth import get_user_model
-from django.db import transaction
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from rest_framework.test import APIRequestFactory, force_authenticate
 
 from apps.users.models import Company, Branch
 from apps.cafe.models import (
-    Zone, Table, Order, OrderItem, MenuItem, Category, CafeClient, Kitchen
+    Zone, Table, Order, OrderItem, MenuItem, Category, CafeClient, Kitchen, KitchenTask,
+    Warehouse, Ingredient, IngredientMove, InventorySession,
 )
 from apps.cafe.views import (
     send_order_created_notification,
@@ -16,7 +29,15 @@ from apps.cafe.views import (
     send_table_status_changed_notification,
     OrderPayView,
     OrderRetrieveUpdateDestroyView,
+    deduct_ingredients_for_order,
+    InventorySessionListCreateView,
+    _mark_task_ready,
 )
+from apps.cafe.serializers import KitchenTaskSerializer
+from apps.cafe.analytics import WarehouseLowStockView
+from apps.cafe.services_stock import apply_ingredient_deltas, parse_legacy_qty
+from apps.cafe import realtime
+from apps.cafe.consumers import CafeKitchenConsumer
 
 User = get_user_model()
 
@@ -438,6 +459,25 @@ class CafeWebSocketNotificationsTestCase(TestCase):
         
         self.assertTrue(notification_sent)
     
+    def test_mark_task_ready_serializes_task_once(self):
+        order = Order.objects.create(
+            company=self.company, branch=self.branch, table=self.table, waiter=self.user, guests=1,
+        )
+        item = OrderItem.objects.create(order=order, menu_item=self.menu_item, quantity=1)
+        task = KitchenTask.objects.get(order_item=item)
+        request = APIRequestFactory().post("/")
+
+        with mock.patch.object(
+            KitchenTaskSerializer, "to_representation", autospec=True,
+            side_effect=KitchenTaskSerializer.to_representation,
+        ) as serialize, mock.patch.object(realtime, "publish") as publish:
+            data = _mark_task_ready(task, request)
+
+        self.assertEqual(serialize.call_count, 1)
+        self.assertEqual(publish.call_count, 2)
+        self.assertTrue(all(call.args[2]["task"] is data for call in publish.call_args_list))
+        self.assertEqual(data["status"], KitchenTask.Status.READY)
+
     def test_send_table_status_changed_notification(self):
         """Тест: отправка уведомления об изменении статуса стола"""
         # Изменяем статус стола
@@ -706,3 +746,205 @@ class CafeOrderIntegrationTestCase(TransactionTestCase):
         
         self.table.refresh_from_db()
         self.assertEqual(self.table.status, Table.Status.FREE)
+
+
+class CafeIngredientLedgerTestCase(TestCase):
+    """Остатки склада: числовой баланс + журнал IngredientMove."""
+
+    def setUp(self):
+        self.owner = User.objects.create_user(email="owner-stock@test.com", password="testpass123")
+        self.company = Company.objects.create(name="Stock Cafe", owner=self.owner)
+        self.category = Category.objects.create(company=self.company, title="Кофе")
+        self.beans = Warehouse.objects.create(
+            company=self.company, title="Зерно", unit="г", remainder=Decimal("1000"), minimum=Decimal("100"),
+        )
+        self.milk = Warehouse.objects.create(
+            company=self.company, title="Молоко", unit="мл", remainder=Decimal("500"), minimum=Decimal("400"),
+        )
+        self.latte = MenuItem.objects.create(
+            company=self.company, category=self.category, title="Латте", price=Decimal("200"),
+        )
+        Ingredient.objects.create(menu_item=self.latte, product=self.beans, amount=Decimal("18"))
+        Ingredient.objects.create(menu_item=self.latte, product=self.milk, amount=Decimal("150"))
+
+    def _order(self, qty):
+        order = Order.objects.create(company=self.company)
+        OrderItem.objects.create(company=self.company, order=order, menu_item=self.latte, quantity=qty)
+        return order
+
+    def test_order_deduction_is_set_based_and_logged(self):
+        order = self._order(2)
+        with CaptureQueriesContext(connection) as ctx, transaction.atomic():
+            deduct_ingredients_for_order(order)
+        writes = [q["sql"] for q in ctx.captured_queries if q["sql"].startswith(("UPDATE", "INSERT"))]
+
+        # один UPDATE остатков и один INSERT журнала на весь заказ
+        self.assertEqual(len(writes), 2)
+        self.beans.refresh_from_db()
+        self.milk.refresh_from_db()
+        self.assertEqual((self.beans.remainder, self.milk.remainder), (Decimal("964"), Decimal("200")))
+        moves = dict(IngredientMove.objects.filter(order=order).values_list("warehouse_id", "delta"))
+        self.assertEqual(moves, {self.beans.id: Decimal("-36"), self.milk.id: Decimal("-300")})
+
+        # журнал сходится с остатком (начальный остаток + списания)
+        for w in (self.beans, self.milk):
+            total = sum(w.moves.values_list("delta", flat=True))
+            self.assertEqual(total, w.remainder)
+
+    def test_inventory_defaults_expected_and_writes_difference(self):
+        request = APIRequestFactory().post(
+            "/cafe/inventory/sessions/",
+            {"items": [{"product": str(self.milk.id), "actual_qty": "350"}]},
+            format="json",
+        )
+        force_authenticate(request, user=self.owner)
+        response = InventorySessionListCreateView.as_view()(request)
+        self.assertEqual(response.status_code, 201, response.data)
+
+        session = InventorySession.objects.get(pk=response.data["id"])
+        item = session.items.get()
+        self.assertEqual((item.expected_qty, item.difference), (Decimal("500"), Decimal("-150")))
+        session.confirm(user=self.owner)
+
+        self.milk.refresh_from_db()
+        self.assertEqual(self.milk.remainder, Decimal("350"))
+        move = IngredientMove.objects.get(inventory_session=session)
+        self.assertEqual((move.kind, move.delta), (IngredientMove.Kind.INVENTORY, Decimal("-150")))
+
+        request = APIRequestFactory().get("/cafe/analytics/warehouse/low-stock/")
+        force_authenticate(request, user=self.owner)
+        data = WarehouseLowStockView.as_view()(request).data
+        self.assertEqual([row["title"] for row in data], ["Молоко"])
+
+    def test_card_save_keeps_concurrent_deduction(self):
+        card = Warehouse.objects.get(pk=self.milk.pk)
+        # параллельный заказ списал молоко между загрузкой карточки и сохранением
+        with transaction.atomic():
+            apply_ingredient_deltas(
+                {self.milk.pk: Decimal("-150")}, company_id=self.company.id, kind=IngredientMove.Kind.ORDER,
+            )
+
+        card.title = "Молоко 3.2%"
+        card.save()
+        self.milk.refresh_from_db()
+        self.assertEqual((self.milk.title, self.milk.remainder), ("Молоко 3.2%", Decimal("350")))
+
+        # ручная правка остатка — разница поверх текущего значения
+        card.remainder = Decimal("600")
+        card.save()
+        self.milk.refresh_from_db()
+        self.assertEqual(self.milk.remainder, Decimal("450"))
+        self.assertEqual(sum(self.milk.moves.values_list("delta", flat=True)), self.milk.remainder)
+
+    def test_legacy_values_parse_like_old_deduction(self):
+        cases = {"5 кг": "5", "5,5": "5.5", "1 200": "1", "": "0", "нет": "0", None: "0", "-2.25л": "-2.25"}
+        for raw, expected in cases.items():
+            self.assertEqual(parse_legacy_qty(raw), Decimal(expected), raw)
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {Warehouse._meta.db_table} SET remainder = %s, minimum = %s WHERE id = %s",
+                ["5,5 кг", "1 200", self.milk.pk.hex],
+            )
+        out = StringIO()
+        call_command("rebuild_ingredient_ledger", normalize_legacy=True, stdout=out)
+        self.assertIn("rows=1", out.getvalue())
+        self.milk.refresh_from_db()
+        self.assertEqual((self.milk.remainder, self.milk.minimum), (Decimal("5.5"), Decimal("1")))
+
+    def test_rebuild_command_seeds_opening_for_existing_rows(self):
+        # позиции, заведённые до журнала: остаток есть, движений нет
+        IngredientMove.objects.all().delete()
+        with transaction.atomic():
+            apply_ingredient_deltas(
+                {self.milk.pk: Decimal("-100")}, company_id=self.company.id, kind=IngredientMove.Kind.ORDER,
+            )
+        with self.assertRaises(CommandError):
+            call_command("rebuild_ingredient_ledger", verify=True, stdout=StringIO())
+
+        out = StringIO()
+        call_command("rebuild_ingredient_ledger", company=str(self.company.id), stdout=out)
+        self.assertIn("opening rows=2", out.getvalue())
+        openings = dict(
+            IngredientMove.objects.filter(kind=IngredientMove.Kind.OPENING).values_list("warehouse_id", "delta")
+        )
+        self.assertEqual(openings, {self.beans.id: Decimal("1000"), self.milk.id: Decimal("500")})
+        call_command("rebuild_ingredient_ledger", verify=True, stdout=StringIO())
+
+        # повторный запуск ничего не добавляет
+        call_command("rebuild_ingredient_ledger", stdout=StringIO())
+        self.assertEqual(IngredientMove.objects.filter(kind=IngredientMove.Kind.OPENING).count(), 2)
+
+        # журнал — источник истины для позиций с начальным остатком
+        Warehouse.objects.filter(pk=self.beans.pk).update(remainder=Decimal("7"))
+        call_command("rebuild_ingredient_ledger", stdout=StringIO())
+        self.beans.refresh_from_db()
+        self.assertEqual(self.beans.remainder, Decimal("1000"))
+
+
+class CafeRealtimeBroadcastTestCase(TestCase):
+    """Исходящие WebSocket-события: после коммита, склейка по группе, один кадр на группу."""
+
+    CONSUMERS = 200
+    EVENTS = 50
+
+    def setUp(self):
+        self.owner = User.objects.create_user(email="owner-ws@test.com", password="testpass123")
+        self.company = Company.objects.create(name="WS Cafe", owner=self.owner)
+        self.order = Order.objects.create(company=self.company)
+
+    def test_events_are_published_after_commit_and_coalesced(self):
+        sent = []
+
+        async def capture(channel_layer, frames):
+            sent.append(frames)
+
+        with mock.patch.object(realtime, "send_frames", capture):
+            with self.captureOnCommitCallbacks(execute=True):
+                send_order_updated_notification(self.order)
+                self.order.guests = 3
+                send_order_updated_notification(self.order)
+                send_order_created_notification(Order.objects.create(company=self.company))
+                self.assertEqual(sent, [])  # до коммита ничего не уходит
+            self.assertTrue(realtime.flush())
+
+        group = realtime.group_name("orders", self.company.id)
+        frames = [frame for batch in sent for frame in batch[group]]
+        events = [e for frame in frames for e in (json.loads(frame).get("events") or [json.loads(frame)])]
+        self.assertEqual([e["type"] for e in events], ["order_updated", "order_created"])
+        self.assertEqual(events[0]["data"]["order"]["guests"], 3)
+
+    async def test_bulk_ready_load_one_frame_per_group(self):
+        """Нагрузочный: EVENTS событий кухни -> CONSUMERS подключённых поваров."""
+        logging.disable(logging.INFO)  # консьюмеры пишут INFO на каждое подключение
+        self.addCleanup(logging.disable, logging.NOTSET)
+        communicators = []
+        for _ in range(self.CONSUMERS):
+            communicator = WebsocketCommunicator(CafeKitchenConsumer.as_asgi(), "/ws/cafe/kitchen/")
+            communicator.scope["user"] = self.owner
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_from()  # connection_established
+            communicators.append(communicator)
+
+        group = realtime.group_name("kitchen", self.company.id)
+        events = [
+            (group, ("kitchen_task_ready", str(i)), realtime.encode_event("kitchen_task_ready", {"task_id": str(i)}))
+            for i in range(self.EVENTS)
+        ]
+        channel_layer = get_channel_layer()
+        started = time.monotonic()
+        with mock.patch.object(channel_layer, "group_send", wraps=channel_layer.group_send) as group_send:
+            await realtime.send_frames(channel_layer, realtime.build_frames(events))
+            frames = await asyncio.gather(*(c.receive_from() for c in communicators))
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(group_send.call_count, 1)  # раньше — по одному publish на задачу
+        for frame in frames:
+            data = json.loads(frame)
+            self.assertEqual(data["type"], "batch")
+            self.assertEqual([e["data"]["task_id"] for e in data["events"]], [str(i) for i in range(self.EVENTS)])
+        self.assertLess(elapsed, 10)
+
+        for communicator in communicators:
+            await communicator.disconnect()
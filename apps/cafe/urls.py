@@ -12,7 +12,7 @@ from .views import (
     ZoneListCreateView, ZoneRetrieveUpdateDestroyView,
     TableListCreateView, TableRetrieveUpdateDestroyView,
     BookingListCreateView, BookingRetrieveUpdateDestroyView,
-    WarehouseListCreateView, WarehouseRetrieveUpdateDestroyView,
+    WarehouseListCreateView, WarehouseRetrieveUpdateDestroyView, WarehouseMoveListView,
     PurchaseListCreateView, PurchaseRetrieveUpdateDestroyView,
     CategoryListCreateView, CategoryRetrieveUpdateDestroyView,
     MenuItemListCreateView, MenuItemRetrieveUpdateDestroyView,
@@ -68,6 +68,7 @@ urlpatterns = [
     # === Warehouse ===
     path("warehouse/", WarehouseListCreateView.as_view(), name="warehouse-list"),
     path("warehouse/<uuid:pk>/", WarehouseRetrieveUpdateDestroyView.as_view(), name="warehouse-detail"),
+    path("warehouse/<uuid:pk>/moves/", WarehouseMoveListView.as_view(), name="warehouse-moves"),
 
     # === Purchases ===
     path("purchases/", PurchaseListCreateView.as_view(), name="purchase-list"),
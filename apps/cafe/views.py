@@ -1,8 +1,6 @@
 # apps/cafe/views.py
-from decimal import Decimal, InvalidOperation
-import json
+from decimal import Decimal
 import uuid
-import re
 
 from django.db import transaction, IntegrityError
 from django.db.models import Q, Count, Avg, ExpressionWrapper, DurationField, F
@@ -13,15 +11,13 @@ from rest_framework import filters, generics, permissions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.exceptions import ValidationError
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 import logging
 
 logger = logging.getLogger(__name__)
 
-from apps.users.models import Branch
+from apps.users.tenancy import get_tenancy, query_branch
 from .models import (
-    Zone, Table, Booking, Warehouse, Purchase,
+    Zone, Table, Booking, Warehouse, IngredientMove, Purchase,
     Category, MenuItem, Ingredient,
     Order, OrderItem, CafeClient,
     OrderHistory, OrderItemHistory,
@@ -31,7 +27,7 @@ from .models import (
 )
 from .serializers import (
     ZoneSerializer, TableSerializer, BookingSerializer,
-    WarehouseSerializer, PurchaseSerializer,
+    WarehouseSerializer, IngredientMoveSerializer, PurchaseSerializer,
     CategorySerializer, MenuItemSerializer, IngredientInlineSerializer,
     OrderSerializer, OrderItemInlineSerializer,
     CafeClientSerializer,
@@ -42,81 +38,20 @@ from .serializers import (
     OrderPaySerializer,
     CafeReceiptPrinterSettingsSerializer,
 )
+from .services_stock import deduct_order_ingredients
+from . import realtime
 
 
-_NUM_RE = re.compile(r"[-+]?\d+(?:[.,]\d+)?")
-
-
-def _decimal_from_warehouse_remainder(raw) -> Decimal:
-    """
-    Warehouse.remainder в cafe — CharField. На практике там часто лежит число строкой,
-    иногда с пробелами/единицами. Пробуем вытащить первое число.
-    """
-    if raw is None:
-        return Decimal("0")
-    if isinstance(raw, Decimal):
-        return raw
-    s = str(raw).strip()
-    if not s:
-        return Decimal("0")
-    m = _NUM_RE.search(s)
-    if not m:
-        return Decimal("0")
-    try:
-        return Decimal(m.group(0).replace(",", "."))
-    except InvalidOperation:
-        return Decimal("0")
-
-
-def deduct_ingredients_for_order(order: Order):
+def deduct_ingredients_for_order(order: Order, user=None):
     """
-    Списывает со склада ингредиенты по заказу.
+    Списывает со склада ингредиенты по заказу (один UPDATE + движения IngredientMove).
     Запускать ТОЛЬКО внутри transaction.atomic().
     """
-    # Соберём расход по каждому складу (Warehouse)
-    usage_by_product_id: dict = {}
-
-    items = (
-        order.items
-        .select_related("menu_item")
-        .prefetch_related("menu_item__ingredients__product")
-        .all()
-    )
-    for it in items:
-        qty = Decimal(str(it.quantity or 0))
-        if qty <= 0:
-            continue
-        for ing in it.menu_item.ingredients.all():
-            need = (ing.amount or Decimal("0")) * qty
-            if need <= 0:
-                continue
-            usage_by_product_id[ing.product_id] = usage_by_product_id.get(ing.product_id, Decimal("0")) + need
-
-    if not usage_by_product_id:
-        return
-
-    # Залочим нужные строки склада
-    products = (
-        Warehouse.objects
-        .select_for_update()
-        .filter(id__in=list(usage_by_product_id.keys()))
-    )
-    products_by_id = {p.id: p for p in products}
-
-    # Проверка: все ингредиенты должны существовать на складе
-    missing = [str(pid) for pid in usage_by_product_id.keys() if pid not in products_by_id]
+    missing = deduct_order_ingredients(order, user=user)
     if missing:
-        raise ValidationError({"detail": f"Не найдены товары склада для ингредиентов: {', '.join(missing)}"})
-
-    # Проверяем остатки и применяем списание
-    for pid, need in usage_by_product_id.items():
-        p = products_by_id[pid]
-        have = _decimal_from_warehouse_remainder(p.remainder)
-        new_val = have - need
-
-        # remainder хранится строкой
-        p.remainder = str(new_val)
-        p.save(update_fields=["remainder"])
+        raise ValidationError(
+            {"detail": f"Не найдены товары склада для ингредиентов: {', '.join(str(pid) for pid in missing)}"}
+        )
 
 try:
     from apps.users.permissions import IsCompanyOwnerOrAdmin
@@ -136,23 +71,13 @@ class CompanyBranchQuerysetMixin:
 
     def _user_company(self):
         """
-        Компания пользователя:
-          - сначала owned_company / company
-          - если нет, пробуем взять через user.branch.company
+        Компания пользователя (owned_company / company / компания филиала) —
+        из контекста арендатора (apps.users.tenancy), без запросов на каждый вызов.
         """
         u = self._user()
         if not u or not getattr(u, "is_authenticated", False):
             return None
-
-        company = getattr(u, "company", None) or getattr(u, "owned_company", None)
-        if company:
-            return company
-
-        br = getattr(u, "branch", None)
-        if br is not None:
-            return getattr(br, "company", None)
-
-        return None
+        return get_tenancy(self.request).company
 
     def _model_has_field(self, qs, field_name: str) -> bool:
         model = getattr(qs, "model", None)
@@ -163,48 +88,18 @@ class CompanyBranchQuerysetMixin:
     def _fixed_branch_from_user(self, company):
         """
         «Жёсткий» филиал сотрудника (который нельзя менять ?branch):
-
-          - user.primary_branch() / user.primary_branch (если принадлежит company)
-          - user.branch (если принадлежит company)
-          - если есть branch_ids и там ровно один филиал этой компании — считаем его фиксированным
+        основной филиал (primary), если он принадлежит company.
         """
-        user = self._user()
-        if not user or not company:
+        tenancy = get_tenancy(self.request)
+        if not company or tenancy.company_id != getattr(company, "id", None):
             return None
-
-        company_id = getattr(company, "id", None)
-
-        primary = getattr(user, "primary_branch", None)
-        if callable(primary):
-            try:
-                val = primary()
-                if val and getattr(val, "company_id", None) == company_id:
-                    return val
-            except Exception:
-                pass
-
-        if primary and not callable(primary) and getattr(primary, "company_id", None) == company_id:
-            return primary
-
-        if hasattr(user, "branch"):
-            b = getattr(user, "branch")
-            if b and getattr(b, "company_id", None) == company_id:
-                return b
-
-        branch_ids = getattr(user, "branch_ids", None)
-        if isinstance(branch_ids, (list, tuple)) and len(branch_ids) == 1:
-            try:
-                return Branch.objects.get(id=branch_ids[0], company_id=company_id)
-            except Branch.DoesNotExist:
-                pass
-
-        return None
+        return tenancy.primary_branch
 
     def _active_branch(self):
         """
         Определяем активный филиал:
 
-          1) жёстко назначенный филиал (primary / user.branch / единственный из branch_ids)
+          1) жёстко назначенный филиал (primary)
           2) если жёсткого нет — ?branch=<uuid>, если филиал принадлежит компании
           3) иначе None (работаем по всей компании)
 
@@ -216,26 +111,15 @@ class CompanyBranchQuerysetMixin:
             setattr(request, "branch", None)
             return None
 
-        company_id = getattr(company, "id", None)
-
         fixed = self._fixed_branch_from_user(company)
         if fixed is not None:
             setattr(request, "branch", fixed)
             return fixed
 
-        branch_id = None
-        if hasattr(request, "query_params"):
-            branch_id = request.query_params.get("branch")
-        elif hasattr(request, "GET"):
-            branch_id = request.GET.get("branch")
-
-        if branch_id:
-            try:
-                br = Branch.objects.get(id=branch_id, company_id=company_id)
-                setattr(request, "branch", br)
-                return br
-            except (Branch.DoesNotExist, ValueError):
-                pass
+        br = query_branch(request, get_tenancy(request))
+        if br is not None:
+            setattr(request, "branch", br)
+            return br
 
         setattr(request, "branch", None)
         return None
@@ -581,6 +465,18 @@ class WarehouseRetrieveUpdateDestroyView(CompanyBranchQuerysetMixin, generics.Re
             raise
 
 
+class WarehouseMoveListView(CompanyBranchQuerysetMixin, generics.ListAPIView):
+    """Журнал движений позиции склада (списания по заказам, инвентаризации, корректировки)."""
+    queryset = IngredientMove.objects.all()
+    serializer_class = IngredientMoveSerializer
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
+    filterset_fields = ["kind", "order", "inventory_session"]
+    ordering_fields = ["created_at", "delta"]
+
+    def get_queryset(self):
+        return super().get_queryset().filter(warehouse_id=self.kwargs["pk"])
+
+
 # ==================== Purchase ====================
 class PurchaseListCreateView(CompanyBranchQuerysetMixin, generics.ListCreateAPIView):
     queryset = Purchase.objects.all()
@@ -883,7 +779,7 @@ class OrderPayView(CompanyBranchQuerysetMixin, APIView):
                 # поэтому лочим только сам Order (без client/waiter).
                 .select_for_update(of=("self",))
                 .select_related("table")
-                .prefetch_related("items__menu_item__ingredients__product")
+                .prefetch_related("items__menu_item__ingredients")
                 .filter(company=company)
             )
             if active_branch is not None:
@@ -899,7 +795,7 @@ class OrderPayView(CompanyBranchQuerysetMixin, APIView):
                 return Response({"detail": "Скидка больше суммы заказа."}, status=status.HTTP_400_BAD_REQUEST)
 
             # Списываем ингредиенты "по продаже" — в момент оплаты (один раз).
-            deduct_ingredients_for_order(order)
+            deduct_ingredients_for_order(order, user=request.user)
 
             order.discount_amount = discount_amount or Decimal("0")
             order.is_paid = True
@@ -1154,8 +1050,9 @@ def _mark_task_ready(task, request):
                 "unit_index": task.unit_index,
             },
         )
-    send_kitchen_task_ready_notification(task)
-    return KitchenTaskSerializer(task, context={"request": request}).data
+    data = KitchenTaskSerializer(task, context={"request": request}).data
+    send_kitchen_task_ready_notification(task, data=data)
+    return data
 
 
 class KitchenTaskReadyBulkView(CompanyBranchQuerysetMixin, APIView):
@@ -1191,8 +1088,7 @@ class KitchenTaskReadyBulkView(CompanyBranchQuerysetMixin, APIView):
             )
             updated = []
             for task in tasks:
-                _mark_task_ready(task, request)
-                updated.append(KitchenTaskSerializer(task, context={"request": request}).data)
+                updated.append(_mark_task_ready(task, request))
         return Response({"updated": updated, "count": len(updated)}, status=status.HTTP_200_OK)
 
 
@@ -1275,7 +1171,8 @@ class KitchenTaskRetrieveUpdateDestroyView(CompanyBranchQuerysetMixin, generics.
 
         # WebSocket событие о готовности блюда (для поваров/монитора)
         if new_status == KitchenTask.Status.READY and old_status != new_status:
-            send_kitchen_task_ready_notification(task)
+            # serializer.data кэшируется — ответ update() отдаст те же данные
+            send_kitchen_task_ready_notification(task, data=serializer.data)
 
 
 class KitchenTaskMonitorView(CompanyBranchQuerysetMixin, generics.ListAPIView):
@@ -1490,51 +1387,25 @@ class KitchenRetrieveUpdateDestroyView(CompanyBranchQuerysetMixin, generics.Retr
 
 
 # ==================== WebSocket уведомления ====================
+# События уходят через apps.cafe.realtime: после коммита, пачками по группе, вне потока запроса.
+
+def _order_payload(order):
+    from .serializers import OrderSerializer
+
+    return {
+        "order": OrderSerializer(order).data,
+        "company_id": str(order.company_id),
+        "branch_id": str(order.branch_id) if order.branch_id else None,
+    }
+
+
 def send_order_created_notification(order):
     """
     Отправляет WebSocket уведомление о создании заказа.
     """
     try:
-        logger.info(f"[send_order_created_notification] Starting: order_id={order.id}")
-        channel_layer = get_channel_layer()
-        if not channel_layer:
-            logger.warning(f"[send_order_created_notification] Channel layer not configured")
-            return
-        
-        company_id = str(order.company_id)
-        branch_id = str(order.branch_id) if order.branch_id else None
-        
-        # Формируем имя группы
-        if branch_id:
-            group_name = f"cafe_orders_{company_id}_{branch_id}"
-        else:
-            group_name = f"cafe_orders_{company_id}"
-        
-        logger.info(f"[send_order_created_notification] Sending to group: {group_name}, order_id={order.id}")
-        
-        # Сериализуем данные заказа
-        from .serializers import OrderSerializer
-        serializer = OrderSerializer(order)
-        order_data = serializer.data
-        
-        # Конвертируем UUID и Decimal в строки для msgpack сериализации
-        order_data = json.loads(json.dumps(order_data, default=str))
-        
-        logger.debug(f"[send_order_created_notification] Order data serialized: {len(str(order_data))} chars")
-        
-        # Отправляем уведомление в группу
-        async_to_sync(channel_layer.group_send)(
-            group_name,
-            {
-                "type": "order_created",
-                "payload": {
-                    "order": order_data,
-                    "company_id": company_id,
-                    "branch_id": branch_id,
-                }
-            }
-        )
-        logger.info(f"[send_order_created_notification] Message sent to channel layer: group={group_name}")
+        group = realtime.group_name("orders", order.company_id, order.branch_id)
+        realtime.publish(group, "order_created", _order_payload(order), key=("order", str(order.id)))
     except Exception as e:
         logger.error(f"[send_order_created_notification] Error sending notification: {e}", exc_info=True)
 
@@ -1542,91 +1413,30 @@ def send_order_created_notification(order):
 def send_order_updated_notification(order):
     """
     Отправляет WebSocket уведомление об обновлении заказа.
+    Несколько обновлений одного заказа в окне склейки уходят одним (последним) событием.
     """
     try:
-        logger.info(f"[send_order_updated_notification] Starting: order_id={order.id}")
-        channel_layer = get_channel_layer()
-        if not channel_layer:
-            logger.warning(f"[send_order_updated_notification] Channel layer not configured")
-            return
-        
-        company_id = str(order.company_id)
-        branch_id = str(order.branch_id) if order.branch_id else None
-        
-        # Формируем имя группы
-        if branch_id:
-            group_name = f"cafe_orders_{company_id}_{branch_id}"
-        else:
-            group_name = f"cafe_orders_{company_id}"
-        
-        logger.info(f"[send_order_updated_notification] Sending to group: {group_name}, order_id={order.id}")
-        
-        # Сериализуем данные заказа
-        from .serializers import OrderSerializer
-        serializer = OrderSerializer(order)
-        order_data = serializer.data
-        
-        # Конвертируем UUID и Decimal в строки для msgpack сериализации
-        order_data = json.loads(json.dumps(order_data, default=str))
-        
-        logger.debug(f"[send_order_updated_notification] Order data serialized: {len(str(order_data))} chars")
-        
-        # Отправляем уведомление в группу
-        async_to_sync(channel_layer.group_send)(
-            group_name,
-            {
-                "type": "order_updated",
-                "payload": {
-                    "order": order_data,
-                    "company_id": company_id,
-                    "branch_id": branch_id,
-                }
-            }
-        )
-        logger.info(f"[send_order_updated_notification] Message sent to channel layer: group={group_name}")
+        group = realtime.group_name("orders", order.company_id, order.branch_id)
+        realtime.publish(group, "order_updated", _order_payload(order), key=("order_updated", str(order.id)))
     except Exception as e:
         logger.error(f"[send_order_updated_notification] Error sending notification: {e}", exc_info=True)
 
 
-def send_kitchen_task_ready_notification(task):
+def send_kitchen_task_ready_notification(task, data=None):
     """
     Отправляет WebSocket уведомление о готовности блюда (задачи кухни).
+    data — уже готовый KitchenTaskSerializer(task).data (если вызывающий его посчитал).
     Событие уходит:
       - в группу заказов (для официантов/зала): cafe_orders_{company_id}_{branch_id?}
       - в группу кухни (для поваров/монитора кухни): cafe_kitchen_{company_id}_{branch_id?}
     """
     try:
-        logger.info(f"[send_kitchen_task_ready_notification] Starting: task_id={task.id}")
-        channel_layer = get_channel_layer()
-        if not channel_layer:
-            logger.warning("[send_kitchen_task_ready_notification] Channel layer not configured")
-            return
+        from .serializers import KitchenTaskSerializer
 
         company_id = str(task.company_id)
         branch_id = str(task.branch_id) if task.branch_id else None
-
-        # Формируем имя группы заказов
-        if branch_id:
-            orders_group_name = f"cafe_orders_{company_id}_{branch_id}"
-        else:
-            orders_group_name = f"cafe_orders_{company_id}"
-
-        # Формируем имя группы кухни
-        if branch_id:
-            kitchen_group_name = f"cafe_kitchen_{company_id}_{branch_id}"
-        else:
-            kitchen_group_name = f"cafe_kitchen_{company_id}"
-
-        # Сериализуем данные задачи кухни
-        from .serializers import KitchenTaskSerializer
-        serializer = KitchenTaskSerializer(task)
-        task_data = serializer.data
-
-        # Конвертируем UUID и Decimal в строки для msgpack сериализации
-        task_data = json.loads(json.dumps(task_data, default=str))
-
         payload = {
-            "task": task_data,
+            "task": data if data is not None else KitchenTaskSerializer(task).data,
             "task_id": str(task.id),
             "order_id": str(task.order_id),
             "table": (task.order.table.number if task.order_id and task.order.table_id else None),
@@ -1635,18 +1445,22 @@ def send_kitchen_task_ready_notification(task):
             "company_id": company_id,
             "branch_id": branch_id,
         }
+        key = ("kitchen_task_ready", str(task.id))
+        # 1) официанты/заказы  2) кухня/повара
+        realtime.publish(realtime.group_name("orders", company_id, branch_id), "kitchen_task_ready", payload, key=key)
+        realtime.publish(realtime.group_name("kitchen", company_id, branch_id), "kitchen_task_ready", payload, key=key)
+    except Exception as e:
+        logger.error(f"[send_kitchen_task_ready_notification] Error sending notification: {e}", exc_info=True)
 
-        message = {"type": "kitchen_task_ready", "payload": payload}
 
-        # 1) официанты/заказы
-        async_to_sync(channel_layer.group_send)(orders_group_name, message)
-        logger.info(f"[send_kitchen_task_ready_notification] Message sent to channel layer: group={orders_group_name}")
+def _table_payload(table):
+    from .serializers import TableSerializer
 
-        # 2) кухня/повара
-        async_to_sync(channel_layer.group_send)(kitchen_group_name, message)
-        logger.info(f"[send_kitchen_task_ready_notification] Message sent to channel layer: group={kitchen_group_name}")
-    except Exception as e:
-        logger.error(f"[send_kitchen_task_ready_notification] Error sending notification: {e}", exc_info=True)
+    return {
+        "table": TableSerializer(table).data,
+        "company_id": str(table.company_id),
+        "branch_id": str(table.branch_id) if table.branch_id else None,
+    }
 
 
 def send_table_created_notification(table):
@@ -1654,39 +1468,8 @@ def send_table_created_notification(table):
     Отправляет WebSocket уведомление о создании стола.
     """
     try:
-        channel_layer = get_channel_layer()
-        if not channel_layer:
-            return
-        
-        company_id = str(table.company_id)
-        branch_id = str(table.branch_id) if table.branch_id else None
-        
-        # Формируем имя группы
-        if branch_id:
-            group_name = f"cafe_tables_{company_id}_{branch_id}"
-        else:
-            group_name = f"cafe_tables_{company_id}"
-        
-        # Сериализуем данные стола
-        from .serializers import TableSerializer
-        serializer = TableSerializer(table)
-        table_data = serializer.data
-        
-        # Конвертируем UUID и Decimal в строки для msgpack сериализации
-        table_data = json.loads(json.dumps(table_data, default=str))
-        
-        # Отправляем уведомление в группу
-        async_to_sync(channel_layer.group_send)(
-            group_name,
-            {
-                "type": "table_created",
-                "payload": {
-                    "table": table_data,
-                    "company_id": company_id,
-                    "branch_id": branch_id,
-                }
-            }
-        )
+        group = realtime.group_name("tables", table.company_id, table.branch_id)
+        realtime.publish(group, "table_created", _table_payload(table), key=("table_created", str(table.id)))
     except Exception as e:
         logger.error(f"[send_table_created_notification] Error: {e}", exc_info=True)
 
@@ -1696,39 +1479,8 @@ def send_table_updated_notification(table):
     Отправляет WebSocket уведомление об обновлении стола.
     """
     try:
-        channel_layer = get_channel_layer()
-        if not channel_layer:
-            return
-        
-        company_id = str(table.company_id)
-        branch_id = str(table.branch_id) if table.branch_id else None
-        
-        # Формируем имя группы
-        if branch_id:
-            group_name = f"cafe_tables_{company_id}_{branch_id}"
-        else:
-            group_name = f"cafe_tables_{company_id}"
-        
-        # Сериализуем данные стола
-        from .serializers import TableSerializer
-        serializer = TableSerializer(table)
-        table_data = serializer.data
-        
-        # Конвертируем UUID и Decimal в строки для msgpack сериализации
-        table_data = json.loads(json.dumps(table_data, default=str))
-        
-        # Отправляем уведомление в группу
-        async_to_sync(channel_layer.group_send)(
-            group_name,
-            {
-                "type": "table_updated",
-                "payload": {
-                    "table": table_data,
-                    "company_id": company_id,
-                    "branch_id": branch_id,
-                }
-            }
-        )
+        group = realtime.group_name("tables", table.company_id, table.branch_id)
+        realtime.publish(group, "table_updated", _table_payload(table), key=("table_updated", str(table.id)))
     except Exception as e:
         logger.error(f"[send_table_updated_notification] Error: {e}", exc_info=True)
 
@@ -1737,67 +1489,19 @@ def send_table_status_changed_notification(table):
     """
     Отправляет WebSocket уведомление об изменении статуса стола (FREE/BUSY).
     Это специальное уведомление для отслеживания занятости столов в реальном времени.
+    Уходит в группу столов и в группу заказов (официанты видят изменения).
     """
     try:
-        channel_layer = get_channel_layer()
-        if not channel_layer:
-            return
-        
-        company_id = str(table.company_id)
-        branch_id = str(table.branch_id) if table.branch_id else None
-        
-        # Формируем имя группы для столов
-        if branch_id:
-            group_name = f"cafe_tables_{company_id}_{branch_id}"
-        else:
-            group_name = f"cafe_tables_{company_id}"
-        
-        # Также отправляем в группу заказов, так как изменение статуса стола связано с заказами
-        if branch_id:
-            orders_group_name = f"cafe_orders_{company_id}_{branch_id}"
-        else:
-            orders_group_name = f"cafe_orders_{company_id}"
-        
-        # Сериализуем данные стола
-        from .serializers import TableSerializer
-        serializer = TableSerializer(table)
-        table_data = serializer.data
-        
-        # Конвертируем UUID и Decimal в строки для msgpack сериализации
-        table_data = json.loads(json.dumps(table_data, default=str))
-        
-        # Отправляем уведомление в группу столов
-        async_to_sync(channel_layer.group_send)(
-            group_name,
-            {
-                "type": "table_status_changed",
-                "payload": {
-                    "table": table_data,
-                    "table_id": str(table.id),
-                    "table_number": table.number,
-                    "status": table.status,
-                    "status_display": table.get_status_display(),
-                    "company_id": company_id,
-                    "branch_id": branch_id,
-                }
-            }
-        )
-        
-        # Отправляем уведомление в группу заказов (чтобы официанты видели изменения)
-        async_to_sync(channel_layer.group_send)(
-            orders_group_name,
-            {
-                "type": "table_status_changed",
-                "payload": {
-                    "table": table_data,
-                    "table_id": str(table.id),
-                    "table_number": table.number,
-                    "status": table.status,
-                    "status_display": table.get_status_display(),
-                    "company_id": company_id,
-                    "branch_id": branch_id,
-                }
-            }
-        )
+        payload = _table_payload(table)
+        payload.update({
+            "table_id": str(table.id),
+            "table_number": table.number,
+            "status": table.status,
+            "status_display": table.get_status_display(),
+        })
+        key = ("table_status_changed", str(table.id))
+        for prefix in ("tables", "orders"):
+            group = realtime.group_name(prefix, table.company_id, table.branch_id)
+            realtime.publish(group, "table_status_changed", payload, key=key)
     except Exception as e:
         logger.error(f"[send_table_status_changed_notification] Error: {e}", exc_info=True)
@@ -17,7 +17,7 @@ from .serializers import (
     RequestsConsaltingSerializer,
     BookingConsaltingSerializer,
 )
-from apps.users.models import Branch
+from apps.users.tenancy import get_tenancy, query_branch
 
 
 # ===== helpers =====
@@ -65,69 +65,23 @@ class CompanyBranchQuerysetMixin:
 
     def _user_company(self):
         """
-        Компания пользователя:
-          - сначала owned_company / company
-          - если нет, пробуем взять через user.branch.company
+        Компания пользователя (owned_company / company / компания филиала) —
+        из контекста арендатора (apps.users.tenancy), без запросов на каждый вызов.
         """
-        user = self._user()
-        if not user or not getattr(user, "is_authenticated", False):
+        u = self._user()
+        if not u or not getattr(u, "is_authenticated", False):
             return None
-
-        company = getattr(user, "company", None) or getattr(user, "owned_company", None)
-        if company:
-            return company
-
-        # fallback: компания только через филиал пользователя
-        br = getattr(user, "branch", None)
-        if br is not None:
-            return getattr(br, "company", None)
-
-        return None
+        return get_tenancy(self.request).company
 
     def _fixed_branch_from_user(self, company):
         """
-        «Жёстко» назначенный филиал сотрудника (который нельзя менять ?branch):
-          - user.primary_branch() / user.primary_branch
-          - user.branch
-          - (опционально) единственный филиал из branch_ids
+        «Жёсткий» филиал сотрудника (который нельзя менять ?branch):
+        основной филиал (primary), если он принадлежит company.
         """
-        user = self._user()
-        if not user or not company:
+        tenancy = get_tenancy(self.request)
+        if not company or tenancy.company_id != getattr(company, "id", None):
             return None
-
-        company_id = getattr(company, "id", None)
-
-        # 1) primary_branch: метод или атрибут
-        primary = getattr(user, "primary_branch", None)
-
-        # 1a) как метод
-        if callable(primary):
-            try:
-                val = primary()
-                if val and getattr(val, "company_id", None) == company_id:
-                    return val
-            except Exception:
-                pass
-
-        # 1b) как свойство
-        if primary and not callable(primary) and getattr(primary, "company_id", None) == company_id:
-            return primary
-
-        # 2) user.branch
-        if hasattr(user, "branch"):
-            b = getattr(user, "branch")
-            if b and getattr(b, "company_id", None) == company_id:
-                return b
-
-        # 3) единственный филиал в branch_ids
-        branch_ids = getattr(user, "branch_ids", None)
-        if isinstance(branch_ids, (list, tuple)) and len(branch_ids) == 1:
-            try:
-                return Branch.objects.get(id=branch_ids[0], company_id=company_id)
-            except Branch.DoesNotExist:
-                pass
-
-        return None
+        return tenancy.primary_branch
 
     def _active_branch(self):
         """
@@ -150,21 +104,10 @@ class CompanyBranchQuerysetMixin:
             return fixed
 
         # 2) если жёсткого филиала нет — смотрим ?branch=
-        branch_id = None
-        if request is not None:
-            if hasattr(request, "query_params"):
-                branch_id = request.query_params.get("branch")
-            elif hasattr(request, "GET"):
-                branch_id = request.GET.get("branch")
-
-        if branch_id:
-            try:
-                br = Branch.objects.get(id=branch_id, company_id=company_id)
-                setattr(request, "branch", br)
-                return br
-            except (Branch.DoesNotExist, ValueError):
-                # чужой/кривой id — игнорируем
-                pass
+        br = query_branch(request, get_tenancy(request))
+        if br is not None:
+            setattr(request, "branch", br)
+            return br
 
         # 3) request.branch, если middleware уже поставил корректный филиал
         if request and hasattr(request, "branch"):
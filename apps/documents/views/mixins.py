@@ -1,6 +1,7 @@
 
 from typing import Optional
 from apps.users.models import Branch, User
+from apps.users.tenancy import get_tenancy, query_branch
 from django.db.models import Q
 
 from rest_framework.permissions import IsAuthenticated
@@ -18,9 +19,7 @@ class CompanyBranchRestrictedMixin:
     Активный филиал:
 
         1) «жёсткий» филиал сотрудника:
-            - user.primary_branch() / user.primary_branch
-            - первый филиал из branch_ids
-            - первая запись из user.branch_memberships / user.branches (если есть такие связи)
+            - основной филиал (primary) или первый филиал компании из членств
             - request.branch (если мидлварь уже положила)
         2) ?branch=<uuid> в запросе (если филиал принадлежит компании,
            И у пользователя нет жёстко назначенного филиала)
@@ -41,38 +40,29 @@ class CompanyBranchRestrictedMixin:
         req = self._request()
         return getattr(req, "user", None) if req else None
 
+    def _tenancy(self):
+        return get_tenancy(self._request())
+
     def _company(self):
         """
         Компания текущего пользователя.
         Для суперюзера -> None (без ограничения по company).
 
-        Если у юзера нет company, но есть филиал с company — берём её.
+        owned_company / company / компания филиала — из контекста арендатора
+        (apps.users.tenancy: один раз на запрос, между запросами — из кэша).
         """
         u = self._user()
         if not u or not getattr(u, "is_authenticated", False):
             return None
         if getattr(u, "is_superuser", False):
             return None
-
-        company = getattr(u, "owned_company", None) or getattr(u, "company", None)
-        if company:
-            return company
-
-        # fallback: пробуем достать компанию из его филиала (если есть связь)
-        br = getattr(u, "branch", None)
-        if br is not None:
-            return getattr(br, "company", None)
-
-        return None
+        return self._tenancy().company
 
     def _fixed_branch_from_user(self, company) -> Optional[Branch]:
         """
         «Жёстко» назначенный филиал сотрудника (который нельзя менять через ?branch):
 
-         - user.primary_branch() или user.primary_branch
-         - user.branch (если есть такое поле)
-         - первый филиал из branch_ids (как в /me)
-         - первая связь из user.branches / user.branch_memberships (если такие есть)
+         - основной филиал (primary) или первый филиал компании из членств
          - request.branch (если мидлварь уже положила)
         """
         req = self._request()
@@ -81,71 +71,11 @@ class CompanyBranchRestrictedMixin:
             return None
 
         company_id = getattr(company, "id", None)
+        tenancy = self._tenancy()
+        if tenancy.company_id == company_id and tenancy.member_branch is not None:
+            return tenancy.member_branch
 
-        # 1) user.primary_branch как метод
-        primary = getattr(user, "primary_branch", None)
-        if callable(primary):
-            try:
-                val = primary()
-                if val and getattr(val, "company_id", None) == company_id:
-                    return val
-            except Exception:
-                pass
-
-        # 1b) user.primary_branch как атрибут
-        if primary and not callable(primary) and getattr(primary, "company_id", None) == company_id:
-            return primary
-
-        # 1c) user.branch (если так хранится)
-        if hasattr(user, "branch"):
-            b = getattr(user, "branch")
-            if b and getattr(b, "company_id", None) == company_id:
-                return b
-
-        # 1d) если у пользователя есть M2M/through связи на филиалы: user.branches
-        try:
-            if hasattr(user, "branches"):
-                qs = user.branches.all()
-                if company_id:
-                    qs = qs.filter(company_id=company_id)
-                b = qs.first()
-                if b:
-                    return b
-        except Exception:
-            pass
-
-        # 1e) если есть user.branch_memberships -> branch
-        try:
-            if hasattr(user, "branch_memberships"):
-                ms = (
-                    user.branch_memberships
-                    .select_related("branch")
-                )
-                if company_id:
-                    ms = ms.filter(branch__company_id=company_id)
-                m = ms.first()
-                if m and getattr(m, "branch", None):
-                    return m.branch
-        except Exception:
-            pass
-
-        # 1f) если на модели User есть поле/свойство branch_ids (как в /me)
-        #     выбираем первый филиал этой компании
-        branch_ids = getattr(user, "branch_ids", None)
-        if branch_ids:
-            try:
-                b = (
-                    Branch.objects
-                    .filter(id__in=list(branch_ids), company_id=company_id)
-                    .first()
-                )
-                if b:
-                    return b
-            except Exception:
-                # на всякий случай не роняем
-                pass
-
-        # 2) request.branch как результат работы middleware
+        # request.branch как результат работы middleware
         if req and hasattr(req, "branch"):
             b = getattr(req, "branch")
             if b and getattr(b, "company_id", None) == company_id:
@@ -156,7 +86,7 @@ class CompanyBranchRestrictedMixin:
     def _auto_branch(self) -> Optional[Branch]:
         """
         Активный филиал:
-          1) «Жёсткий» филиал сотрудника (primary / branch / branch_ids / memberships / request.branch)
+          1) «Жёсткий» филиал сотрудника (primary / членство / request.branch)
           2) ?branch=<uuid> в запросе (если принадлежит компании и НЕТ жёсткого филиала)
           3) None (нет филиала — глобальный режим по всей компании, но только записи без branch)
         """
@@ -166,12 +96,10 @@ class CompanyBranchRestrictedMixin:
             return None
 
         # чтобы не дергать логику по несколько раз на один запрос
-        cached = getattr(req, "_cached_auto_branch", None)
-        if cached is not None:
-            return cached
+        if hasattr(req, "_cached_auto_branch"):
+            return req._cached_auto_branch
 
         company = self._company()
-        company_id = getattr(company, "id", None)
 
         # 1) сначала ищем жёстко назначенный филиал
         fixed_branch = self._fixed_branch_from_user(company)
@@ -181,21 +109,13 @@ class CompanyBranchRestrictedMixin:
             return fixed_branch
 
         # 2) если у пользователя НЕТ назначенного филиала — позволяем выбирать через ?branch
-        branch_id = None
-        if hasattr(req, "query_params"):
-            branch_id = req.query_params.get("branch")
-        elif hasattr(req, "GET"):
-            branch_id = req.GET.get("branch")
-
-        if branch_id and company_id:
-            try:
-                br = Branch.objects.get(id=branch_id, company_id=company_id)
+        #    (чужой/битый UUID — игнорируем)
+        if company is not None:
+            br = query_branch(req, self._tenancy())
+            if br is not None:
                 setattr(req, "branch", br)
                 setattr(req, "_cached_auto_branch", br)
                 return br
-            except (Branch.DoesNotExist, ValueError):
-                # чужой/битый UUID — игнорируем
-                pass
 
         # 3) никакого филиала → None (работаем по компании, но без филиалов)
         setattr(req, "_cached_auto_branch", None)
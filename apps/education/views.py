@@ -17,7 +17,7 @@ from .serializers import (
     StudentSerializer, LessonSerializer, FolderSerializer, DocumentSerializer,
     LessonAttendanceItemSerializer, StudentAttendanceSerializer, TeacherRateSerializer
 )
-from apps.users.models import Branch  # 🔑 для branch-логики
+from apps.users.tenancy import get_tenancy, query_branch
 
 
 # ----- Кастомный фильтр для Document (не автофильтруем FileField) -----
@@ -33,69 +33,6 @@ class DocumentFilter(dj_filters.FilterSet):
         fields = ['name', 'folder', 'file_name', 'created_at', 'updated_at']
 
 
-# ===== helpers для company/branch =====
-def _get_company(user):
-    """Компания текущего пользователя (owner/company)."""
-    if not user or not getattr(user, "is_authenticated", False):
-        return None
-
-    company = getattr(user, "company", None) or getattr(user, "owned_company", None)
-    if company:
-        return company
-
-    # fallback: если у юзера нет company, но есть branch с company
-    br = getattr(user, "branch", None)
-    if br is not None:
-        return getattr(br, "company", None)
-
-    return None
-
-
-def _fixed_branch_from_user(user, company):
-    """
-    «Жёстко» назначенный филиал (который нельзя менять ?branch):
-      - user.primary_branch() / user.primary_branch
-      - user.branch
-      - единственный id в user.branch_ids
-    """
-    if not user or not company:
-        return None
-
-    company_id = getattr(company, "id", None)
-
-    # 1) primary_branch: метод или атрибут
-    primary = getattr(user, "primary_branch", None)
-
-    # 1a) как метод
-    if callable(primary):
-        try:
-            val = primary()
-            if val and getattr(val, "company_id", None) == company_id:
-                return val
-        except Exception:
-            pass
-
-    # 1b) как свойство
-    if primary and not callable(primary) and getattr(primary, "company_id", None) == company_id:
-        return primary
-
-    # 2) user.branch
-    if hasattr(user, "branch"):
-        b = getattr(user, "branch")
-        if b and getattr(b, "company_id", None) == company_id:
-            return b
-
-    # 3) единственный филиал из branch_ids
-    branch_ids = getattr(user, "branch_ids", None)
-    if isinstance(branch_ids, (list, tuple)) and len(branch_ids) == 1:
-        try:
-            return Branch.objects.get(id=branch_ids[0], company_id=company_id)
-        except Branch.DoesNotExist:
-            pass
-
-    return None
-
-
 # ===== Company + Branch scoped mixin (единая логика, как в других модулях) =====
 class CompanyBranchQuerysetMixin:
     """
@@ -135,7 +72,24 @@ class CompanyBranchQuerysetMixin:
         return getattr(self.request, "user", None)
 
     def _user_company(self):
-        return _get_company(self._user())
+        """
+        Компания пользователя (owned_company / company / компания филиала) —
+        из контекста арендатора (apps.users.tenancy), без запросов на каждый вызов.
+        """
+        u = self._user()
+        if not u or not getattr(u, "is_authenticated", False):
+            return None
+        return get_tenancy(self.request).company
+
+    def _fixed_branch_from_user(self, company):
+        """
+        «Жёсткий» филиал сотрудника (который нельзя менять ?branch):
+        основной филиал (primary), если он принадлежит company.
+        """
+        tenancy = get_tenancy(self.request)
+        if not company or tenancy.company_id != getattr(company, "id", None):
+            return None
+        return tenancy.primary_branch
 
     def _model_has_field_on_model(self, model, field_name: str) -> bool:
         if not model:
@@ -164,32 +118,21 @@ class CompanyBranchQuerysetMixin:
             self._cached_active_branch = None
             return None
 
-        user = self._user()
         company_id = getattr(company, "id", None)
 
         # 1) жёсткий филиал
-        fixed = _fixed_branch_from_user(user, company)
+        fixed = self._fixed_branch_from_user(company)
         if fixed is not None:
             setattr(request, "branch", fixed)
             self._cached_active_branch = fixed
             return fixed
 
         # 2) branch из query-параметра (?branch=<uuid>), если нет жёсткого
-        branch_id = None
-        if hasattr(request, "query_params"):
-            branch_id = request.query_params.get("branch")
-        elif hasattr(request, "GET"):
-            branch_id = request.GET.get("branch")
-
-        if branch_id:
-            try:
-                br = Branch.objects.get(id=branch_id, company_id=company_id)
-                setattr(request, "branch", br)
-                self._cached_active_branch = br
-                return br
-            except (Branch.DoesNotExist, ValueError):
-                # чужой/кривой id — игнорируем и продолжаем
-                pass
+        br = query_branch(request, get_tenancy(request))
+        if br is not None:
+            setattr(request, "branch", br)
+            self._cached_active_branch = br
+            return br
 
         # 3) request.branch (middleware / ранее проставлен)
         if hasattr(request, "branch"):
@@ -19,6 +19,7 @@ except Exception:
 
 from .models import CompanyIGAccount, IGThread, IGMessage
 from .service import IGChatService
+from .redis_pool import get_redis, pack, text, unpack_many
 
 import logging
 logger = logging.getLogger(__name__)
@@ -33,12 +34,6 @@ try:
 except Exception:
     msgpack = None
 
-try:
-    import redis.asyncio as aioredis
-except Exception:
-    aioredis = None
-
-REDIS_URL       = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
 POLL_LIMIT      = int(os.getenv("IG_POLL_LIMIT", "12"))
 MAX_HIST        = int(os.getenv("IG_HIST_CACHE", "200"))
 BOOTSTRAP_THREADS = int(os.getenv("IG_BOOTSTRAP_THREADS", "40"))
@@ -124,15 +119,7 @@ class DirectConsumer(AsyncJsonWebsocketConsumer):
             return []
         key = HIST_LIST_FMT.format(thread_id=thread_id)
         try:
-            raw = await self._r.lrange(key, -limit, -1)
-            out = []
-            for s in raw or []:
-                try:
-                    m = orjson.loads(s) if orjson else json.loads(s)
-                    out.append(m)
-                except Exception:
-                    continue
-            return out
+            return unpack_many(await self._r.lrange(key, -limit, -1))
         except Exception as e:
             logger.warning("hist read failed: %s", e)
             return []
@@ -154,8 +141,10 @@ class DirectConsumer(AsyncJsonWebsocketConsumer):
             "attachments": msg.get("attachments") or [],
         }
         try:
-            await self._r.rpush(key, dumps(item))
-            await self._r.ltrim(key, -MAX_HIST, -1)
+            pipe = self._r.pipeline(transaction=False)
+            pipe.rpush(key, pack(item))
+            pipe.ltrim(key, -MAX_HIST, -1)
+            await pipe.execute()
         except Exception as e:
             logger.warning("hist push local failed: %s", e)
 
@@ -168,21 +157,11 @@ class DirectConsumer(AsyncJsonWebsocketConsumer):
             tids = await self._r.zrevrange(zkey, 0, max(0, limit - 1))
             if not tids:
                 return []
-            pipe = self._r.pipeline()
-            for tid in tids:
-                pipe.get(THREAD_KEY_FMT.format(thread_id=tid))
-            rows = await pipe.execute()
-            out = []
-            for s in rows:
-                if not s:
-                    continue
-                try:
-                    obj = orjson.loads(s) if orjson else json.loads(s)
-                    # нормализуем last_activity на всякий случай
-                    obj["last_activity"] = ts_json(obj.get("last_activity"))
-                    out.append(obj)
-                except Exception:
-                    continue
+            rows = await self._r.mget([THREAD_KEY_FMT.format(thread_id=text(tid)) for tid in tids])
+            out = unpack_many(rows)
+            for obj in out:
+                # нормализуем last_activity на всякий случай
+                obj["last_activity"] = ts_json(obj.get("last_activity"))
             return out
         except Exception as e:
             logger.warning("threads snapshot redis failed: %s", e)
@@ -199,7 +178,7 @@ class DirectConsumer(AsyncJsonWebsocketConsumer):
         if not rows or not self._r:
             return
         zkey = THREADS_ZSET_FMT.format(account_id=str(self.account.pk))
-        pipe = self._r.pipeline()
+        pipe = self._r.pipeline(transaction=False)
         for th in rows:
             tid = th["thread_id"]
             score = ts_json(th["last_activity"]) or _dt_to_epoch_ms(datetime.utcnow())
@@ -209,7 +188,7 @@ class DirectConsumer(AsyncJsonWebsocketConsumer):
                 "users": th["users"],
                 "last_activity": score,
             }
-            pipe.set(THREAD_KEY_FMT.format(thread_id=tid), dumps(row))
+            pipe.set(THREAD_KEY_FMT.format(thread_id=tid), pack(row))
             pipe.zadd(zkey, {tid: score})
         try:
             await pipe.execute()
@@ -229,7 +208,7 @@ class DirectConsumer(AsyncJsonWebsocketConsumer):
         key = HIST_LIST_FMT.format(thread_id=thread_id)
         payload = []
         for r in reversed(rows):
-            payload.append(dumps({
+            payload.append(pack({
                 "mid": r["mid"],
                 "text": r["text"],
                 "sender_pk": r["sender_pk"],
@@ -239,9 +218,8 @@ class DirectConsumer(AsyncJsonWebsocketConsumer):
                 "attachments": r.get("attachments") or [],
             }))
         try:
-            pipe = self._r.pipeline()
-            for s in payload:
-                pipe.rpush(key, s)
+            pipe = self._r.pipeline(transaction=False)
+            pipe.rpush(key, *payload)
             pipe.ltrim(key, -MAX_HIST, -1)
             await pipe.execute()
         except Exception as e:
@@ -356,15 +334,8 @@ class DirectConsumer(AsyncJsonWebsocketConsumer):
         self.account = account
         self.group = GROUP_FMT.format(account_id=str(self.account.pk))
 
-        # Redis
-        self._r = None
-        if aioredis:
-            try:
-                self._r = aioredis.from_url(REDIS_URL, decode_responses=True)
-                await self._r.ping()
-            except Exception as e:
-                logger.warning("Redis not available in consumer: %s", e)
-                self._r = None
+        # Redis: общий пул процесса (см. redis_pool), на disconnect не закрываем
+        self._r = await get_redis()
 
         # подписка на группу
         await self.channel_layer.group_add(self.group, self.channel_name)
@@ -415,12 +386,6 @@ class DirectConsumer(AsyncJsonWebsocketConsumer):
             except Exception:
                 pass
 
-        if getattr(self, "_r", None):
-            try:
-                await self._r.close()
-            except Exception:
-                pass
-
     # события от пуллера
     async def ig_event(self, event):
         await self._send_pkt(event["payload"])
@@ -579,16 +544,21 @@ class DirectConsumer(AsyncJsonWebsocketConsumer):
     async def _start_watch(self, thread_id: str):
         self.thread_id = thread_id
 
-        # отметить активный тред для пуллера
+        # отметить активный тред для пуллера и прочитать историю — один round trip
+        hist = []
         if self._r:
             try:
                 key = ACTIVE_SET_FMT.format(account_id=str(self.account.pk))
+                pipe = self._r.pipeline(transaction=False)
                 if getattr(self, "_active_tid", None) and self._active_tid != thread_id:
-                    await self._r.srem(key, self._active_tid)
-                await self._r.sadd(key, thread_id)
+                    pipe.srem(key, self._active_tid)
+                pipe.sadd(key, thread_id)
+                pipe.lrange(HIST_LIST_FMT.format(thread_id=thread_id), -POLL_LIMIT, -1)
+                res = await pipe.execute()
                 self._active_tid = thread_id
+                hist = unpack_many(res[-1])
             except Exception as e:
-                logger.warning("active set write failed: %s", e)
+                logger.warning("active set write / hist read failed: %s", e)
 
         # users из БД
         th = await sync_to_async(
@@ -598,9 +568,6 @@ class DirectConsumer(AsyncJsonWebsocketConsumer):
         )()
         users = (th or {}).get("users") or []
 
-        # история из Redis (быстро)
-        hist = await self._hist_read(thread_id, POLL_LIMIT)
-
         if not hist:
             msgs = await sync_to_async(list, thread_sensitive=False)(
                 IGMessage.objects.filter(thread__ig_account=self.account, thread__thread_id=thread_id)
@@ -0,0 +1,224 @@
+# apps/instagram/leases.py
+"""
+Шардирование ig_poller по процессам: аренды (leases) аккаунтов в Redis.
+
+Раньше один процесс ig_poller опрашивал все аккаунты на одном event loop, а второй
+процесс опрашивал бы их же повторно. Теперь каждый процесс — узел:
+
+  - узел живёт в ZSET NODES_ZSET (score — срок жизни, epoch ms) и продлевает
+    себя каждые LEASE_RENEW секунд. Процессы с --accounts образуют свою группу
+    со своим ZSET (nodes_key_for): делят между собой только свой список, а от
+    двойного опроса с другими группами защищает та же аренда аккаунта;
+  - аккаунт опрашивает только держатель аренды LEASE_KEY_FMT (значение — node_id,
+    SET NX PX LEASE_TTL). Продление и снятие — Lua «только если аренда моя»;
+  - какой узел должен держать аккаунт, все узлы считают одинаково по списку живых
+    узлов (rendezvous hashing): при входе/выходе узла переезжает ~1/N аккаунтов;
+  - переезд: старый владелец останавливает воркер (последний цикл сбрасывает
+    сообщения и watermarks), и только потом снимает аренду; новый берёт её на
+    своём следующем тике и читает WM_HASH_FMT уже после сброса. Упавший узел
+    отдаёт аккаунты по истечении LEASE_TTL;
+  - узел без связи с Redis (тик падает) сам останавливает воркеры, чья аренда
+    давно не продлевалась: к истечению LEASE_TTL на другом узле его опрос
+    уже закончен. Redis при этом не трогается;
+  - watermarks пишутся скриптом HSET_IF_OWNER: узел, потерявший аренду (пауза
+    процесса, сеть), не перезапишет их поверх нового владельца.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable, Iterable, Optional
+
+from .redis_pool import text
+
+logger = logging.getLogger(__name__)
+
+LEASE_TTL    = float(os.getenv("IG_LEASE_TTL", "15"))                    # сек.
+LEASE_RENEW  = float(os.getenv("IG_LEASE_RENEW", str(LEASE_TTL / 3)))    # тик координатора
+STOP_TIMEOUT = float(os.getenv("IG_LEASE_STOP_TIMEOUT", str(LEASE_TTL / 3)))
+
+NODES_ZSET    = "ig:poller:nodes"          # ZSET живых узлов: node_id -> expires (epoch ms)
+LEASE_KEY_FMT = "ig:lease:{account_id}"    # String: node_id владельца аккаунта
+
+_RENEW = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# KEYS: аренда, hash watermarks; ARGV: node_id, field1, value1, ...
+HSET_IF_OWNER = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('hset', KEYS[2], unpack(ARGV, 2))
+    return 1
+end
+return 0
+"""
+
+
+def default_node_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def _weight(node_id: str, account_id: str) -> int:
+    digest = hashlib.blake2b(f"{node_id}|{account_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def nodes_key_for(account_ids: Optional[Iterable[str]] = None) -> str:
+    """ZSET узлов группы: общий для всех аккаунтов, отдельный — для каждого списка --accounts."""
+    if not account_ids:
+        return NODES_ZSET
+    digest = hashlib.blake2b("|".join(sorted(map(str, account_ids))).encode(), digest_size=6).hexdigest()
+    return f"{NODES_ZSET}:{digest}"
+
+
+def owner_of(account_id: str, nodes: Iterable[str]) -> Optional[str]:
+    """Узел, которому положено держать аккаунт (rendezvous hashing); None — узлов нет."""
+    return max(nodes, key=lambda node: _weight(node, account_id), default=None)
+
+
+def assign(account_ids: Iterable[str], nodes: Iterable[str], node_id: str) -> set[str]:
+    nodes = sorted(set(nodes) | {node_id})
+    return {a for a in account_ids if owner_of(a, nodes) == node_id}
+
+
+class LeaseCoordinator:
+    """
+    Тик раз в LEASE_RENEW: продлить себя и свои аренды, отдать лишние, взять положенные.
+    accounts() — id аккаунтов для опроса; start(id)/stop(id) — запуск и остановка
+    воркера (stop возвращается, когда последний цикл воркера сброшен или прерван).
+    nodes_key — ZSET узлов группы (см. nodes_key_for); аренды аккаунтов общие для всех групп.
+    safety — запас до истечения аренды: воркер аккаунта, не продлённого дольше
+    ttl − safety, останавливается локально (по умолчанию тик + STOP_TIMEOUT).
+    """
+
+    def __init__(
+        self,
+        r,
+        *,
+        accounts: Callable[[], Awaitable[list]],
+        start: Callable[[str], Awaitable[None]],
+        stop: Callable[[str], Awaitable[None]],
+        node_id: Optional[str] = None,
+        nodes_key: str = NODES_ZSET,
+        ttl: float = LEASE_TTL,
+        renew_every: Optional[float] = None,
+        safety: Optional[float] = None,
+    ):
+        self.r = r
+        self.nodes_key = nodes_key
+        self.accounts = accounts
+        self.start = start
+        self.stop = stop
+        self.node_id = node_id or default_node_id()
+        self.ttl_ms = int(ttl * 1000)
+        self.renew_every = renew_every if renew_every is not None else ttl / 3
+        if safety is None:
+            safety = self.renew_every + min(STOP_TIMEOUT, ttl / 3)
+        self.stale_after = ttl - safety
+        self.owned: set[str] = set()
+        self.renewed_at: dict[str, float] = {}  # account_id -> time.monotonic() отправки продления
+        self.nodes: list[str] = []
+
+    @staticmethod
+    def lease_key(account_id: str) -> str:
+        return LEASE_KEY_FMT.format(account_id=account_id)
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    await self.tick()
+                except Exception as e:
+                    logger.exception("lease tick failed (%s): %s", self.node_id, e)
+                    await self.expire_stale()
+                await asyncio.sleep(self.renew_every)
+        finally:
+            await self.shutdown()
+
+    async def tick(self):
+        sent_at = time.monotonic()
+        now_ms = int(time.time() * 1000)
+        pipe = self.r.pipeline(transaction=False)
+        pipe.zadd(self.nodes_key, {self.node_id: now_ms + self.ttl_ms})
+        pipe.zremrangebyscore(self.nodes_key, "-inf", now_ms)
+        pipe.zrangebyscore(self.nodes_key, now_ms, "+inf")
+        for account_id in sorted(self.owned):
+            pipe.eval(_RENEW, 1, self.lease_key(account_id), self.node_id, self.ttl_ms)
+        res = await pipe.execute()
+
+        self.nodes = sorted(text(n) for n in res[2])
+        lost = set()
+        for account_id, ok in zip(sorted(self.owned), res[3:]):
+            if ok:
+                self.renewed_at[account_id] = sent_at
+            else:
+                lost.add(account_id)
+        if lost:
+            # аренду уже держит другой узел (или она истекла): останавливаемся без снятия
+            logger.warning("leases lost by %s: %s", self.node_id, sorted(lost))
+            self._forget(lost)
+            await asyncio.gather(*(self.stop(a) for a in lost))
+
+        account_ids = {str(a) for a in await self.accounts()}
+        desired = assign(account_ids, self.nodes, self.node_id)
+
+        surplus = self.owned - desired
+        if surplus:
+            await asyncio.gather(*(self._hand_off(a) for a in surplus))
+
+        for account_id in sorted(desired - self.owned):
+            sent_at = time.monotonic()
+            acquired = await self.r.set(self.lease_key(account_id), self.node_id, nx=True, px=self.ttl_ms)
+            if acquired:
+                self.owned.add(account_id)
+                self.renewed_at[account_id] = sent_at
+                await self.start(account_id)
+
+    async def expire_stale(self):
+        """Остановить воркеры аренд, не продлённых дольше stale_after (Redis недоступен)."""
+        now = time.monotonic()
+        stale = {a for a in self.owned if now - self.renewed_at.get(a, 0.0) >= self.stale_after}
+        if not stale:
+            return
+        logger.warning("leases expiring on %s without renewal: %s", self.node_id, sorted(stale))
+        self._forget(stale)
+        await asyncio.gather(*(self.stop(a) for a in stale), return_exceptions=True)
+
+    def _forget(self, account_ids):
+        self.owned -= set(account_ids)
+        for account_id in account_ids:
+            self.renewed_at.pop(account_id, None)
+
+    async def _hand_off(self, account_id: str):
+        await self.stop(account_id)
+        self._forget({account_id})
+        await self.r.eval(_RELEASE, 1, self.lease_key(account_id), self.node_id)
+
+    async def shutdown(self):
+        """Отдать все аренды и выйти из списка узлов — остальные подхватят аккаунты сразу."""
+        owned, self.owned = set(self.owned), set()
+        self.renewed_at.clear()
+        await asyncio.gather(*(self.stop(a) for a in owned), return_exceptions=True)
+        try:
+            pipe = self.r.pipeline(transaction=False)
+            for account_id in owned:
+                pipe.eval(_RELEASE, 1, self.lease_key(account_id), self.node_id)
+            pipe.zrem(self.nodes_key, self.node_id)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning("lease shutdown failed (%s): %s", self.node_id, e)
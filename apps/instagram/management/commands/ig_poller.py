@@ -3,26 +3,27 @@ import os
 import asyncio
 import logging
 import random
+import signal
+import time
 from datetime import datetime, timezone as dt_tz
 from typing import Dict, Optional
 
 from asgiref.sync import sync_to_async
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, DateTimeField, Value, When
 from django.utils import timezone
 from channels.layers import get_channel_layer
 
-try:
-    import redis.asyncio as aioredis
-except Exception:
-    aioredis = None
-
 try:
     import orjson
 except Exception:
     orjson = None
 
-from ...models import CompanyIGAccount, IGThread, IGMessage
+from ...leases import HSET_IF_OWNER, LEASE_KEY_FMT, STOP_TIMEOUT, LeaseCoordinator, nodes_key_for
+from ...models import CompanyIGAccount, IGThread
 from ...service import IGChatService
+from ...redis_pool import close_redis, get_redis, pack, pool_metrics, text
 
 logger = logging.getLogger(__name__)
 
@@ -31,7 +32,7 @@ INBOX_INTERVAL_ACTIVE = float(os.getenv("IG_INBOX_ACTIVE", "0.5"))
 INBOX_INTERVAL_IDLE   = float(os.getenv("IG_INBOX_IDLE", "0.2"))
 THREAD_POLL_INTERVAL  = float(os.getenv("IG_THREAD_POLL", "0.1"))
 POLL_LIMIT            = int(os.getenv("IG_POLL_LIMIT", "6"))
-REDIS_URL             = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+METRICS_INTERVAL      = float(os.getenv("IG_METRICS_INTERVAL", "60"))
 MAX_HIST              = int(os.getenv("IG_HIST_CACHE", "400"))
 
 # Имена групп/ключей
@@ -41,6 +42,7 @@ WM_HASH_FMT       = "ig:wm:{account_id}"       # Redis Hash watermarks (ISO)
 HIST_LIST_FMT     = "ig:hist:{thread_id}"      # Redis List истории треда
 THREADS_ZSET_FMT  = "ig:threads:{account_id}"  # Redis ZSET списка тредов
 THREAD_KEY_FMT    = "ig:thread:{thread_id}"    # Redis per-thread snapshot
+METRICS_KEY_FMT   = "ig:metrics:{account_id}"  # Redis Hash метрик воркера (обновляется раз в METRICS_INTERVAL)
 
 
 # ---------- helpers: time / json ----------
@@ -126,23 +128,87 @@ def dumps(obj: dict) -> str:
     return json.dumps(obj, separators=(",", ":"))
 
 
+def _hist_item(msg: dict, u_map: Dict[str, str]) -> dict:
+    """Нормализованная запись Redis-истории треда (created_at — epoch ms)."""
+    return {
+        "mid": msg.get("mid"),
+        "text": msg.get("text") or "",
+        "sender_pk": msg.get("sender_pk") or "",
+        "username": u_map.get(msg.get("sender_pk") or "") if u_map else None,
+        "created_at": ts_json(msg.get("created_at")),
+        "direction": msg.get("direction") or "in",
+        "attachments": msg.get("attachments") or [],
+    }
+
+
+class CycleBatch:
+    """
+    Всё, что один цикл опроса пишет в БД и Redis. Сбрасывается AccountWorker.flush():
+    сообщения — одним bulk upsert, история/снапшоты/watermarks — одним pipeline.
+    События incoming_batch рассылаются только после записи в БД: если запись упала,
+    следующий цикл перечитает те же сообщения и разошлёт их один раз.
+    """
+    def __init__(self):
+        self.messages: list = []                              # [(IGThread, m)]
+        self.history: Dict[str, list] = {}                    # thread_id -> [packed item]
+        self.watermarks: Dict[str, datetime] = {}             # thread_id -> created_at последнего
+        self.snapshots: Dict[str, tuple] = {}                 # thread_id -> (score, payload)
+        self.touched: Dict = {}                               # IGThread.pk -> last_activity
+        self.cache_prev: Dict[str, Optional[datetime]] = {}   # откат threads_cache, если БД не записалась
+        self.newest: Optional[datetime] = None                # самое свежее сообщение (для lag)
+        self.events: list = []                                # incoming_batch — после записи в БД
+
+    def add_messages(self, th: IGThread, thread_id: str, msgs: list, u_map: Dict[str, str]):
+        items = self.history.setdefault(thread_id, [])
+        for m in msgs:
+            self.messages.append((th, m))
+            items.append(pack(_hist_item(m, u_map)))
+            created = _to_dt(m.get("created_at"))
+            if created and (self.newest is None or created > self.newest):
+                self.newest = created
+        last_created = _to_dt(msgs[-1].get("created_at")) if msgs else None
+        if last_created:
+            prev = self.watermarks.get(thread_id)
+            self.watermarks[thread_id] = max(prev, last_created) if prev else last_created
+
+
 class AccountWorker:
     """
     Воркер на IG-аккаунт:
       — опрашивает inbox и активные треды через IGChatService
-      — синкает БД (IGThread/IGMessage)
-      — шлёт события в Channels-группу (created_at/last_activity уже epoch-ms)
+      — синкает БД (IGThread/IGMessage): новые сообщения цикла — одним bulk upsert
+      — шлёт события в Channels-группу (created_at/last_activity уже epoch-ms):
+        thread_new/thread_update сразу, incoming_batch — после записи цикла в БД
       — ведёт Redis-кэш истории (LIST) и снапшот списка тредов (ZSET + per-thread key)
+        одним pipeline на цикл; watermarks двигаются только после записи в БД
+        и (при lease_owner) только пока аренда аккаунта у этого узла
     """
-    def __init__(self, account: CompanyIGAccount, channel_layer, r=None):
+    def __init__(self, account: CompanyIGAccount, channel_layer, r=None, lease_owner: Optional[str] = None):
         self.account = account
+        self.lease_owner = lease_owner  # node_id из LeaseCoordinator; None — без шардирования
+        self._stopping = asyncio.Event()
         self.cl = IGChatService(account)
         self.channel_layer = channel_layer
-        self.r = r  # aioredis client (decode_responses=True)
+        self.r = r  # общий клиент redis_pool (bytes, decode_responses=False)
         self.group = GROUP_FMT.format(account_id=str(account.pk))
 
         self.threads_cache: Dict[str, datetime] = {}      # thread_id -> last_activity (datetime)
         self.thread_users: Dict[str, Dict[str, str]] = {} # thread_id -> {pk: username}
+        self.thread_rows: Dict[str, IGThread] = {}        # thread_id -> IGThread (без get на каждый опрос)
+        self.batch = CycleBatch()
+
+        # метрики: счётчики с запуска + окно с прошлого metrics()
+        self.backoff = 0.0
+        self.stats = {
+            "cycles": 0,
+            "messages": 0,
+            "errors": 0,
+            "flush_ms_last": 0.0,
+            "lag_ms_last": None,
+            "lag_ms_max": 0,
+        }
+        self._window_started = time.monotonic()
+        self._window_messages = 0
 
     async def group_send(self, payload: dict):
         await self.channel_layer.group_send(self.group, {"type": "ig.event", "payload": payload})
@@ -153,74 +219,132 @@ class AccountWorker:
             return set()
         key = ACTIVE_SET_FMT.format(account_id=str(self.account.pk))
         try:
-            return set(await self.r.smembers(key) or [])
+            return {text(tid) for tid in (await self.r.smembers(key) or [])}
         except Exception as e:
             logger.warning("active set read failed: %s", e)
             return set()
 
     async def _get_wm(self, thread_id: str) -> Optional[datetime]:
+        pending = self.batch.watermarks.get(thread_id)
+        if pending:
+            return pending  # ещё не сброшен в Redis, но уже выдан этим циклом
         if not self.r:
             return None
         key = WM_HASH_FMT.format(account_id=str(self.account.pk))
         try:
             iso = await self.r.hget(key, thread_id)
-            return parse_dt(iso) if iso else None
+            return parse_dt(text(iso)) if iso else None
         except Exception:
             return None
 
-    async def _set_wm(self, thread_id: str, ts: datetime):
-        if not self.r:
-            return
-        key = WM_HASH_FMT.format(account_id=str(self.account.pk))
-        try:
-            await self.r.hset(key, thread_id, serialize_dt(ts))
-        except Exception as e:
-            logger.warning("wm hset failed: %s", e)
-
-    async def _hist_push(self, thread_id: str, msg: dict, u_map: Dict[str, str]):
+    def _queue_snapshot(self, t: dict, users: list | None, last_dt: Optional[datetime]):
         """
-        Кладём нормализованную запись в Redis LIST (последние MAX_HIST).
-        created_at — epoch ms.
+        Снапшот треда в батч цикла: ZSET (score — секунды) и компактный per-thread ключ
+        (last_activity — epoch-ms).
         """
-        if not self.r:
+        tid = t["thread_id"]
+        self.batch.snapshots[tid] = (
+            int(last_dt.timestamp()) if last_dt else 0,
+            {
+                "thread_id": tid,
+                "title": t.get("title") or "",
+                "users": users or [],
+                "last_activity": ts_json(last_dt),
+            },
+        )
+
+    # ---------- flush ----------
+    def _persist(self, batch: CycleBatch) -> int:
+        """Синхронная часть сброса (в потоке): сообщения и last_activity опрошенных тредов."""
+        with transaction.atomic():
+            written = self.cl.sync_messages(batch.messages) if batch.messages else 0
+            if batch.touched:
+                # одним UPDATE, но каждому треду — его время опроса (CASE по группам одинаковых значений)
+                by_value: Dict[datetime, list] = {}
+                for pk, ts in batch.touched.items():
+                    by_value.setdefault(ts, []).append(pk)
+                IGThread.objects.filter(pk__in=list(batch.touched)).update(
+                    last_activity=Case(
+                        *(When(pk__in=pks, then=Value(ts)) for ts, pks in by_value.items()),
+                        output_field=DateTimeField(),
+                    )
+                )
+        return written
+
+    async def _write_redis(self, batch: CycleBatch):
+        if not self.r or not (batch.history or batch.snapshots or batch.watermarks):
             return
-        key = HIST_LIST_FMT.format(thread_id=thread_id)
-        item = {
-            "mid": msg.get("mid"),
-            "text": msg.get("text") or "",
-            "sender_pk": msg.get("sender_pk") or "",
-            "username": u_map.get(msg.get("sender_pk") or "") if u_map else None,
-            "created_at": ts_json(msg.get("created_at")),
-            "direction": msg.get("direction") or "in",
-            "attachments": msg.get("attachments") or [],
-        }
+        account_id = str(self.account.pk)
+        pipe = self.r.pipeline(transaction=False)
+        for tid, items in batch.history.items():
+            key = HIST_LIST_FMT.format(thread_id=tid)
+            pipe.rpush(key, *items)
+            pipe.ltrim(key, -MAX_HIST, -1)
+        if batch.snapshots:
+            pipe.zadd(
+                THREADS_ZSET_FMT.format(account_id=account_id),
+                {tid: score for tid, (score, _) in batch.snapshots.items()},
+            )
+            for tid, (_, payload) in batch.snapshots.items():
+                pipe.set(THREAD_KEY_FMT.format(thread_id=tid), pack(payload))
+        if batch.watermarks:
+            wm_key = WM_HASH_FMT.format(account_id=account_id)
+            mapping = {tid: serialize_dt(ts) for tid, ts in batch.watermarks.items()}
+            if self.lease_owner:
+                pairs = [v for item in mapping.items() for v in item]
+                pipe.eval(HSET_IF_OWNER, 2, LEASE_KEY_FMT.format(account_id=account_id), wm_key, self.lease_owner, *pairs)
+            else:
+                pipe.hset(wm_key, mapping=mapping)
         try:
-            await self.r.rpush(key, dumps(item))
-            await self.r.ltrim(key, -MAX_HIST, -1)
+            await pipe.execute()
         except Exception as e:
-            logger.warning("hist push failed: %s", e)
+            logger.warning("redis flush failed: %s", e)
 
-    async def _snapshot_thread(self, t: dict, users: list | None, last_dt: Optional[datetime]):
+    async def flush(self):
         """
-        Обновляем ZSET (по времени) и персистим компактный снапшот треда.
-        last_activity кладём как epoch-ms в JSON, а score — в секундах.
+        Сбросить батч цикла. Не записалось в БД — watermarks не двигаем и откатываем
+        threads_cache: следующий цикл перечитает эти сообщения (upsert идемпотентен).
         """
-        if not self.r:
-            return
-        tid = t["thread_id"]
-        score = int(last_dt.timestamp()) if last_dt else 0
-        zkey = THREADS_ZSET_FMT.format(account_id=str(self.account.pk))
-        try:
-            await self.r.zadd(zkey, {tid: score})
-            payload = {
-                "thread_id": tid,
-                "title": t.get("title") or "",
-                "users": users or [],
-                "last_activity": ts_json(last_dt),  # epoch-ms
-            }
-            await self.r.set(THREAD_KEY_FMT.format(thread_id=tid), dumps(payload))
-        except Exception as e:
-            logger.warning("snapshot thread failed: %s", e)
+        batch, self.batch = self.batch, CycleBatch()
+        started = time.monotonic()
+        written = 0
+        if batch.messages or batch.touched:
+            try:
+                written = await asyncio.to_thread(self._persist, batch)
+            except Exception:
+                for tid, prev in batch.cache_prev.items():
+                    if prev is None:
+                        self.threads_cache.pop(tid, None)
+                    else:
+                        self.threads_cache[tid] = prev
+                raise
+        await self._write_redis(batch)
+        for event in batch.events:
+            await self.group_send(event)
+
+        self.stats["flush_ms_last"] = round((time.monotonic() - started) * 1000, 1)
+        self.stats["messages"] += written
+        self._window_messages += written
+        if batch.newest is not None:
+            lag = max(int((timezone.now() - batch.newest).total_seconds() * 1000), 0)
+            self.stats["lag_ms_last"] = lag
+            self.stats["lag_ms_max"] = max(self.stats["lag_ms_max"], lag)
+
+    def metrics(self) -> dict:
+        """Метрики аккаунта; окно пропускной способности (messages_per_s) — с прошлого вызова."""
+        now = time.monotonic()
+        elapsed = max(now - self._window_started, 1e-6)
+        out = {
+            "account_id": str(self.account.pk),
+            "username": getattr(self.account, "username", ""),
+            **self.stats,
+            "messages_per_s": round(self._window_messages / elapsed, 3),
+            "backoff_s": round(self.backoff, 2),
+        }
+        self._window_started = now
+        self._window_messages = 0
+        self.stats["lag_ms_max"] = 0
+        return out
 
     # ---------- helpers ----------
     async def _ensure_thread_users(self, thread_id: str) -> Dict[str, str]:
@@ -233,12 +357,21 @@ class AccountWorker:
         return u_map
 
     async def _sync_thread(self, t: dict) -> IGThread:
-        return await asyncio.to_thread(self.cl.sync_thread, t)
-
-    async def _sync_msg(self, th: IGThread, m: dict) -> IGMessage:
-        return await asyncio.to_thread(self.cl.sync_message, th, m)
+        th = await asyncio.to_thread(self.cl.sync_thread, t)
+        self.thread_rows[th.thread_id] = th
+        return th
 
     # ---------- main loop ----------
+    def stop(self):
+        """Завершить run() после текущего цикла (его батч будет сброшен)."""
+        self._stopping.set()
+
+    async def _sleep(self, seconds: float):
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
     async def run(self):
         ok = await asyncio.to_thread(self.cl.try_resume_session)
         if not ok:
@@ -258,8 +391,7 @@ class AccountWorker:
         except Exception:
             pass
 
-        inbox_backoff = 0.0
-        while True:
+        while not self._stopping.is_set():
             try:
                 active = await self._get_active_threads()
                 base_sleep = INBOX_INTERVAL_ACTIVE if active else INBOX_INTERVAL_IDLE
@@ -267,16 +399,19 @@ class AccountWorker:
                 updates_found = await self._tick_inbox(active_threads=active)
                 if active:
                     await self._tick_active_threads(active)
+                await self.flush()
+                self.stats["cycles"] += 1
 
-                sleep_for = inbox_backoff or (max(0.6, base_sleep * 0.5) if updates_found else base_sleep)
+                sleep_for = self.backoff or (max(0.6, base_sleep * 0.5) if updates_found else base_sleep)
                 # небольшой джиттер, чтобы рассинхронизировать аккаунты/воркеры
                 sleep_for *= 0.85 + 0.3 * random.random()
-                await asyncio.sleep(sleep_for)
-                inbox_backoff = 0.0
+                await self._sleep(sleep_for)
+                self.backoff = 0.0
             except Exception as e:
                 logger.exception("account loop error (%s): %s", getattr(self.account, "username", self.account.pk), e)
-                inbox_backoff = min((inbox_backoff or 0.5) * 2, 8.0)
-                await asyncio.sleep(inbox_backoff)
+                self.stats["errors"] += 1
+                self.backoff = min((self.backoff or 0.5) * 2, 8.0)
+                await self._sleep(self.backoff)
 
     async def _tick_inbox(self, active_threads: set[str]) -> bool:
         updates_found = False
@@ -306,18 +441,14 @@ class AccountWorker:
                 users = [{"pk": pk, "username": name} for pk, name in u_map.items()]
 
             # поддерживаем Redis snapshot
-            await self._snapshot_thread(t_for_db, users, last)
+            self._queue_snapshot(t_for_db, users, last)
 
             # Новый тред
             if prev is None:
                 preview = await asyncio.to_thread(self.cl.fetch_last_text, tid, u_map)
                 if preview:
                     # в БД — как есть (datetime), в Redis/клиента — нормализуем ниже
-                    await self._sync_msg(th, preview)
-                    wm = _to_dt(preview.get("created_at"))   # FIX: epoch-ms -> datetime
-                    if wm:
-                        await self._set_wm(tid, wm)
-                    await self._hist_push(tid, preview, u_map)
+                    self.batch.add_messages(th, tid, [preview], u_map)
 
                 await self.group_send({
                     "type": "thread_new",
@@ -333,7 +464,7 @@ class AccountWorker:
                 })
 
                 if preview and (tid not in active_threads):
-                    await self.group_send({
+                    self.batch.events.append({
                         "type": "incoming_batch",
                         "thread_id": tid,
                         "messages": [{
@@ -343,6 +474,7 @@ class AccountWorker:
                         }],
                     })
 
+                self.batch.cache_prev.setdefault(tid, prev)
                 self.threads_cache[tid] = last
                 updates_found = True
                 continue
@@ -360,11 +492,9 @@ class AccountWorker:
                         since=since_dt,
                     )
                     if new_msgs:
-                        for m in new_msgs:
-                            await self._sync_msg(th, m)
-                            await self._hist_push(tid, m, u_map)
+                        self.batch.add_messages(th, tid, new_msgs, u_map)
 
-                        await self.group_send({
+                        self.batch.events.append({
                             "type": "incoming_batch",
                             "thread_id": tid,
                             "messages": [
@@ -373,10 +503,6 @@ class AccountWorker:
                             ],
                         })
 
-                        last_created = _to_dt(new_msgs[-1].get("created_at"))  # FIX
-                        if last_created:
-                            await self._set_wm(tid, last_created)
-
                 preview = await asyncio.to_thread(self.cl.fetch_last_text, tid, u_map)
                 await self.group_send({
                     "type": "thread_update",
@@ -389,6 +515,7 @@ class AccountWorker:
                     "has_new": True,
                 })
 
+                self.batch.cache_prev.setdefault(tid, prev)
                 self.threads_cache[tid] = last
                 updates_found = True
 
@@ -400,9 +527,14 @@ class AccountWorker:
             await asyncio.gather(*tasks)
 
     async def _poll_thread_once(self, thread_id: str):
-        try:
-            th = await asyncio.to_thread(IGThread.objects.get, ig_account=self.account, thread_id=thread_id)
-        except IGThread.DoesNotExist:
+        th = self.thread_rows.get(thread_id)
+        if th is None:
+            th = await asyncio.to_thread(
+                lambda: IGThread.objects.filter(ig_account=self.account, thread_id=thread_id).first()
+            )
+            if th is not None:
+                self.thread_rows[thread_id] = th
+        if th is None:
             th = await self._sync_thread({
                 "thread_id": thread_id,
                 "title": "",
@@ -423,11 +555,9 @@ class AccountWorker:
         )
 
         if msgs:
-            for m in msgs:
-                await self._sync_msg(th, m)
-                await self._hist_push(thread_id, m, u_map)
+            self.batch.add_messages(th, thread_id, msgs, u_map)
 
-            await self.group_send({
+            self.batch.events.append({
                 "type": "incoming_batch",
                 "thread_id": thread_id,
                 "messages": [
@@ -436,64 +566,142 @@ class AccountWorker:
                 ],
             })
 
-            last_created = _to_dt(msgs[-1].get("created_at"))  # FIX
-            if last_created:
-                await self._set_wm(thread_id, last_created)
-
         # Поддержка Redis snapshot по last_activity
         now_dt = timezone.localtime()
-        await self._snapshot_thread(
+        self._queue_snapshot(
             {"thread_id": thread_id, "title": ""},
             [{"pk": pk, "username": name} for pk, name in u_map.items()],
             now_dt,
         )
 
-        # Обновим last_activity в БД без гидрации
-        await asyncio.to_thread(
-            lambda: IGThread.objects.filter(pk=th.pk).update(last_activity=now_dt)
-        )
-        await asyncio.sleep(THREAD_POLL_INTERVAL)
+        # last_activity в БД — при сбросе цикла, одним UPDATE на все опрошенные треды
+        self.batch.touched[th.pk] = now_dt
+        await self._sleep(THREAD_POLL_INTERVAL)
 
 
 class Command(BaseCommand):
-    help = "Instagram central poller with Redis history & threads snapshots"
+    help = (
+        "Instagram central poller with Redis history & threads snapshots. "
+        "Several processes share accounts through Redis leases (apps/instagram/leases.py)."
+    )
 
     def add_arguments(self, parser):
         parser.add_argument("--accounts", nargs="*", help="Limit to specific account UUIDs", default=None)
+        parser.add_argument("--node-id", default=None, help="Lease owner id of this process (default host:pid:rand)")
 
     def handle(self, *args, **opts):
         logging.basicConfig(level=logging.INFO)
-        asyncio.run(self._amain(opts))
+        try:
+            asyncio.run(self._amain(opts))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            logger.info("IG poller stopped.")
 
     async def _amain(self, opts):
         channel_layer = get_channel_layer()
         if channel_layer is None:
             raise RuntimeError("CHANNEL_LAYERS not configured for Redis")
 
-        r = None
-        if aioredis:
-            try:
-                r = aioredis.from_url(REDIS_URL, decode_responses=True)
-                await r.ping()
-            except Exception as e:
-                logger.warning("Redis not available for history cache: %s", e)
-                r = None
+        # SIGTERM (деплой) — как Ctrl+C: отдать аренды сразу, не ждать их истечения
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+        r = await get_redis()
+        if r is None:
+            logger.warning("Redis not available for history cache")
 
         qs = CompanyIGAccount.objects.filter(is_active=True)
         if opts.get("accounts"):
             qs = qs.filter(pk__in=opts["accounts"])
-        accounts = await sync_to_async(list)(qs)
 
+        self.workers: Dict[str, AccountWorker] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+        reporter = asyncio.create_task(self._report_metrics(self.workers, r))
+        try:
+            if r is None:
+                # без Redis аренды недоступны: опрашиваем всё сами (второй процесс запускать нельзя)
+                await self._run_all(qs, channel_layer, r)
+            else:
+                await self._run_sharded(qs, channel_layer, r, opts.get("node_id"), opts.get("accounts"))
+        finally:
+            reporter.cancel()
+            await close_redis()
+
+    async def _run_all(self, qs, channel_layer, r):
+        accounts = await sync_to_async(list)(qs)
         if not accounts:
             logger.info("No active accounts found.")
             return
+        for acc in accounts:
+            worker = AccountWorker(acc, channel_layer, r)
+            self.workers[str(acc.pk)] = worker
+            self.tasks[str(acc.pk)] = asyncio.create_task(worker.run())
+        logger.info("IG poller started for %d account(s).", len(accounts))
+        await asyncio.gather(*self.tasks.values())
+
+    async def _run_sharded(self, qs, channel_layer, r, node_id, account_filter=None):
+        async def accounts():
+            return await sync_to_async(list)(qs.values_list("pk", flat=True))
+
+        async def start(account_id: str):
+            acc = await sync_to_async(qs.filter(pk=account_id).first)()
+            if acc is None:
+                return
+            worker = AccountWorker(acc, channel_layer, r, lease_owner=coordinator.node_id)
+            self.workers[account_id] = worker
+            self.tasks[account_id] = asyncio.create_task(worker.run())
+            logger.info("IG account @%s claimed by %s", acc.username, coordinator.node_id)
+
+        async def stop(account_id: str):
+            worker = self.workers.pop(account_id, None)
+            task = self.tasks.pop(account_id, None)
+            if worker is None or task is None:
+                return
+            worker.stop()
+            try:
+                await asyncio.wait_for(task, timeout=STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                # недосброшенный цикл: watermarks не сдвинуты, новый владелец перечитает сообщения
+                logger.warning("IG account @%s did not stop in %.1fs, cancelled", worker.account.username, STOP_TIMEOUT)
+            except Exception:
+                pass
+            logger.info("IG account @%s released by %s", worker.account.username, coordinator.node_id)
+
+        # с --accounts узел делит аккаунты только с узлами того же списка: иначе узлы
+        # с разными списками считали бы владельцев по чужому составу и часть аккаунтов
+        # не опрашивал бы никто
+        coordinator = LeaseCoordinator(
+            r, accounts=accounts, start=start, stop=stop, node_id=node_id,
+            nodes_key=nodes_key_for(account_filter),
+        )
+        logger.info("IG poller node %s started.", coordinator.node_id)
+        await coordinator.run()
 
-        workers = [AccountWorker(acc, channel_layer, r) for acc in accounts]
-        tasks = [asyncio.create_task(w.run()) for w in workers]
+    async def _report_metrics(self, workers, r):
+        while METRICS_INTERVAL > 0:
+            await asyncio.sleep(METRICS_INTERVAL)
+            logger.info("IG redis pool: %s", pool_metrics())
+            await publish_metrics(list(workers.values()), r)
 
-        logger.info("IG poller started for %d account(s).", len(tasks))
+
+async def publish_metrics(workers, r) -> list:
+    """
+    Метрики аккаунтов в лог и в Redis (METRICS_KEY_FMT, живут 3 интервала):
+    пропускная способность, lag (сейчас − самое свежее записанное сообщение), backoff.
+    """
+    rows = [w.metrics() for w in workers]
+    for row in rows:
+        logger.info("IG account @%s: %s", row["username"], row)
+    if r is not None and rows:
+        ttl = int(max(METRICS_INTERVAL * 3, 60))
+        pipe = r.pipeline(transaction=False)
+        for row in rows:
+            key = METRICS_KEY_FMT.format(account_id=row["account_id"])
+            pipe.hset(key, mapping={k: "" if v is None else str(v) for k, v in row.items()})
+            pipe.expire(key, ttl)
         try:
-            await asyncio.gather(*tasks)
-        finally:
-            if r:
-                await r.close()
+            await pipe.execute()
+        except Exception as e:
+            logger.warning("metrics publish failed: %s", e)
+    return rows
@@ -0,0 +1,193 @@
+# apps/instagram/redis_pool.py
+"""
+Общий async-клиент Redis для Instagram (DirectConsumer, ig_poller) и
+компактный формат кэша истории/снапшотов тредов.
+
+Раньше каждый WebSocket открывал свой aioredis.from_url(...) с ping и закрывал
+его на disconnect — сотни вкладок операторов = сотни соединений и постоянный
+connect/teardown. Теперь на процесс (точнее — на event loop) один
+BlockingConnectionPool на IG_REDIS_MAX_CONN соединений; при исчерпании команды
+ждут свободное соединение, а не открывают новое.
+
+Значения HIST_LIST_FMT / THREAD_KEY_FMT пишутся msgpack'ом. Старые JSON-записи
+(начинаются с '{') читаются как раньше, поэтому кэш не нужно сбрасывать при выкладке.
+Клиент работает с bytes (decode_responses=False): строковые ответы
+(id тредов, watermarks) приводить через text().
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import time
+import weakref
+from typing import Optional
+
+try:
+    import redis.asyncio as aioredis
+    from redis.asyncio.connection import Connection as _Connection
+except Exception:
+    aioredis = None
+    _Connection = None
+
+try:
+    import msgpack
+except Exception:
+    msgpack = None
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL        = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+MAX_CONNECTIONS  = int(os.getenv("IG_REDIS_MAX_CONN", "32"))
+POOL_TIMEOUT     = float(os.getenv("IG_REDIS_POOL_TIMEOUT", "5"))
+RETRY_AFTER      = float(os.getenv("IG_REDIS_RETRY_AFTER", "5"))  # сек. после неудачного ping
+
+# loop -> Redis; у redis.asyncio пул привязан к event loop
+_clients: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_down_until: float = 0.0
+
+_metrics = {
+    "connects": 0,          # успешные (пере)подключения соединений пула
+    "connect_errors": 0,
+    "connect_ms_last": 0.0,
+    "connect_ms_max": 0.0,
+    "connect_ms_total": 0.0,
+}
+
+
+if _Connection is not None:
+    class _TimedConnection(_Connection):
+        """Connection, который замеряет время (пере)подключения."""
+
+        async def connect_check_health(self, check_health: bool = True):
+            if self.is_connected:
+                return
+            started = time.perf_counter()
+            try:
+                await super().connect_check_health(check_health=check_health)
+            except Exception:
+                _metrics["connect_errors"] += 1
+                raise
+            elapsed = (time.perf_counter() - started) * 1000
+            _metrics["connects"] += 1
+            _metrics["connect_ms_last"] = round(elapsed, 3)
+            _metrics["connect_ms_max"] = round(max(_metrics["connect_ms_max"], elapsed), 3)
+            _metrics["connect_ms_total"] += elapsed
+else:  # pragma: no cover
+    _TimedConnection = None
+
+
+# ---------------- client ----------------
+def client():
+    """Клиент на общем пуле текущего event loop (без проверки доступности). None — нет redis-py."""
+    if aioredis is None:
+        return None
+    loop = asyncio.get_running_loop()
+    r = _clients.get(loop)
+    if r is None:
+        kwargs = {"max_connections": MAX_CONNECTIONS, "timeout": POOL_TIMEOUT, "health_check_interval": 30}
+        if REDIS_URL.startswith("redis://"):
+            kwargs["connection_class"] = _TimedConnection  # для rediss:// — SSLConnection из URL
+        pool = aioredis.BlockingConnectionPool.from_url(REDIS_URL, **kwargs)
+        r = aioredis.Redis(connection_pool=pool)
+        _clients[loop] = r
+    return r
+
+
+async def get_redis():
+    """
+    Общий клиент или None, если Redis недоступен. После неудачного ping
+    следующие RETRY_AFTER секунд сразу отдаём None, не дёргая сеть на каждом коннекте.
+    """
+    global _down_until
+    r = client()
+    if r is None or time.monotonic() < _down_until:
+        return None
+    if r.connection_pool._available_connections or r.connection_pool._in_use_connections:
+        return r  # пул уже жив — ping не нужен, обрывы переподключит сам пул
+    try:
+        await r.ping()
+    except Exception as e:
+        logger.warning("Redis not available: %s", e)
+        _down_until = time.monotonic() + RETRY_AFTER
+        return None
+    return r
+
+
+async def close_redis():
+    """Закрыть пул текущего loop (конец ig_poller; в консьюмерах не вызывать)."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    r = _clients.pop(loop, None)
+    if r is not None:
+        try:
+            await r.aclose(close_connection_pool=True)
+        except Exception:
+            pass
+
+
+def pool_metrics() -> dict:
+    """Соединения пулов процесса и задержка (пере)подключения."""
+    available = in_use = 0
+    for r in list(_clients.values()):
+        available += len(r.connection_pool._available_connections)
+        in_use += len(r.connection_pool._in_use_connections)
+    connects = _metrics["connects"]
+    return {
+        "pools": len(_clients),
+        "max_connections": MAX_CONNECTIONS,
+        "connections": available + in_use,
+        "in_use": in_use,
+        "available": available,
+        "connects": connects,
+        "connect_errors": _metrics["connect_errors"],
+        "connect_ms_last": _metrics["connect_ms_last"],
+        "connect_ms_max": _metrics["connect_ms_max"],
+        "connect_ms_avg": round(_metrics["connect_ms_total"] / connects, 3) if connects else 0.0,
+    }
+
+
+# ---------------- codec ----------------
+def text(val) -> Optional[str]:
+    if isinstance(val, bytes):
+        return val.decode("utf-8")
+    return val
+
+
+def pack(obj: dict) -> bytes:
+    if msgpack is not None:
+        return msgpack.packb(obj, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def unpack(raw):
+    """msgpack или старый JSON ('{...}'); None — пусто/битое значение."""
+    if not raw:
+        return None
+    if isinstance(raw, str):
+        raw = raw.encode("utf-8")
+    try:
+        if raw[:1] == b"{" or msgpack is None:
+            return orjson.loads(raw) if orjson else json.loads(raw)
+        return msgpack.unpackb(raw, raw=False)
+    except Exception:
+        return None
+
+
+def unpack_many(rows) -> list:
+    out = []
+    for raw in rows or []:
+        obj = unpack(raw)
+        if isinstance(obj, dict):
+            out.append(obj)
+    return out
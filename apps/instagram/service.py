@@ -460,6 +460,35 @@ class IGChatService:
             obj = IGMessage.objects.get(thread=thread, mid=mid)
         return obj
 
+    def sync_messages(self, rows) -> int:
+        """
+        Пачка [(IGThread, m)] одним INSERT … ON CONFLICT (mid) DO UPDATE — для
+        ig_poller вместо sync_message на каждое сообщение. Повтор mid в пачке —
+        берётся последний. Возвращает число записанных сообщений.
+        """
+        objs: Dict[str, IGMessage] = {}
+        for thread, m in rows:
+            mid = str(m.get("mid") or "")
+            if not mid:
+                continue
+            objs[mid] = IGMessage(
+                thread=thread,
+                mid=mid,
+                text=m.get("text") or "",
+                sender_pk=str(m.get("sender_pk") or ""),
+                created_at=_from_ig_ts_to_dt(m.get("created_at")) or timezone.now(),
+                direction=m.get("direction") or "in",
+                attachments=m.get("attachments") or [],
+            )
+        if objs:
+            IGMessage.objects.bulk_create(
+                list(objs.values()),
+                update_conflicts=True,
+                unique_fields=["mid"],
+                update_fields=["text", "sender_pk", "direction", "attachments", "created_at"],
+            )
+        return len(objs)
+
     def fetch_messages_db(self, thread: IGThread, limit: int) -> List[dict]:
         rows = list(
             IGMessage.objects.filter(thread=thread)
@@ -1,3 +1,376 @@
-from django.test import TestCase
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import time
+import uuid
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from apps.instagram import leases, redis_pool
+from apps.instagram.management.commands import ig_poller
+from apps.instagram.models import CompanyIGAccount, IGMessage, IGThread
+from apps.instagram.service import IGChatService
+from apps.users.models import Company, User
+
+
+class IGRedisPoolTestCase(SimpleTestCase):
+    def test_history_item_roundtrip_is_msgpack(self):
+        item = {
+            "mid": "m1",
+            "text": "Привет",
+            "sender_pk": "42",
+            "username": None,
+            "created_at": 1718000000000,
+            "direction": "in",
+            "attachments": [{"type": "image", "url": "https://x/y.jpg"}],
+        }
+        raw = redis_pool.pack(item)
+        self.assertIsInstance(raw, bytes)
+        self.assertLess(len(raw), len(json.dumps(item, ensure_ascii=False).encode()))
+        self.assertEqual(redis_pool.unpack(raw), item)
+
+    def test_legacy_json_values_are_still_readable(self):
+        legacy = json.dumps({"thread_id": "t1", "last_activity": 1}).encode()
+        rows = [legacy, redis_pool.pack({"thread_id": "t2"}), None, b"\xc1garbage"]
+        self.assertEqual(
+            [r["thread_id"] for r in redis_pool.unpack_many(rows)],
+            ["t1", "t2"],
+        )
+        self.assertEqual(redis_pool.text(b"t1"), "t1")
+
+    async def test_one_shared_pool_per_event_loop(self):
+        first = redis_pool.client()
+        second = redis_pool.client()
+        self.assertIs(first, second)
+        self.assertIs(first.connection_pool, second.connection_pool)
+        self.assertEqual(first.connection_pool.max_connections, redis_pool.MAX_CONNECTIONS)
+
+        metrics = redis_pool.pool_metrics()
+        self.assertGreaterEqual(metrics["pools"], 1)
+        self.assertEqual(metrics["in_use"], 0)
+        await redis_pool.close_redis()
+
+
+class _FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    async def execute(self):
+        self.redis.executed.append(self.commands)
+        return [None] * len(self.commands)
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.executed = []
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self)
+
+
+def _ig_account(suffix):
+    owner = User.objects.create_user(email=f"owner@{suffix}.test", password="x")
+    company = Company.objects.create(name=f"IG {suffix}", owner=owner)
+    return CompanyIGAccount.objects.create(company=company, username=f"shop_{suffix}")
+
+
+def _msg(mid, minutes_ago, text="hi"):
+    return {
+        "mid": mid,
+        "text": text,
+        "sender_pk": "42",
+        "created_at": timezone.now() - timedelta(minutes=minutes_ago),
+        "direction": "in",
+        "attachments": [],
+    }
+
+
+class IGSyncMessagesTests(TestCase):
+    def setUp(self):
+        self.account = _ig_account("sync")
+        self.thread = IGThread.objects.create(ig_account=self.account, thread_id="t1")
+        self.service = IGChatService(self.account)
+
+    def test_batch_is_one_upsert_and_updates_existing(self):
+        self.service.sync_message(self.thread, _msg("m1", 5, text="old"))
+        rows = [(self.thread, _msg("m1", 5, text="edited")), (self.thread, _msg("m2", 1)), (self.thread, _msg("m2", 1))]
+
+        with CaptureQueriesContext(connection) as ctx:
+            written = self.service.sync_messages(rows)
+
+        self.assertEqual(written, 2)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(IGMessage.objects.count(), 2)
+        self.assertEqual(IGMessage.objects.get(mid="m1").text, "edited")
+
+
+class IGPollerFlushTests(TransactionTestCase):
+    def setUp(self):
+        self.account = _ig_account("flush")
+        self.thread = IGThread.objects.create(ig_account=self.account, thread_id="t1")
+        self.redis = _FakeRedis()
+        self.worker = ig_poller.AccountWorker(self.account, channel_layer=None, r=self.redis)
+
+    def test_cycle_is_one_db_upsert_and_one_redis_pipeline(self):
+        batch = self.worker.batch
+        batch.add_messages(self.thread, "t1", [_msg("m1", 3), _msg("m2", 2)], {"42": "client"})
+        batch.add_messages(self.thread, "t2", [_msg("m3", 1)], {})
+        batch.touched[self.thread.pk] = timezone.now()
+
+        with mock.patch.object(IGChatService, "sync_messages", autospec=True, side_effect=IGChatService.sync_messages) as bulk:
+            async_to_sync(self.worker.flush)()
+
+        self.assertEqual(bulk.call_count, 1)
+        self.assertEqual(set(IGMessage.objects.values_list("mid", flat=True)), {"m1", "m2", "m3"})
+        self.assertEqual(len(self.redis.executed), 1)
+        ops = [name for name, _, _ in self.redis.executed[0]]
+        self.assertEqual(ops.count("rpush"), 2)
+        self.assertEqual(ops[-1], "hset")  # watermarks — последними
+
+        metrics = self.worker.metrics()
+        self.assertEqual(metrics["messages"], 3)
+        self.assertGreaterEqual(metrics["lag_ms_last"], 60_000)
+        self.assertEqual(metrics["backoff_s"], 0)
+
+    def test_failed_db_write_keeps_watermarks_and_rolls_back_inbox_cache(self):
+        self.worker.threads_cache["t1"] = timezone.now()
+        self.worker.batch.add_messages(self.thread, "t1", [_msg("m1", 1)], {})
+        self.worker.batch.cache_prev["t1"] = None
+
+        with mock.patch.object(IGChatService, "sync_messages", side_effect=RuntimeError("db down")):
+            with self.assertRaises(RuntimeError):
+                async_to_sync(self.worker.flush)()
+
+        self.assertEqual(self.redis.executed, [])
+        self.assertNotIn("t1", self.worker.threads_cache)
+        self.assertIsNone(async_to_sync(self.worker._get_wm)("t1"))
+
+    def test_each_touched_thread_keeps_its_own_last_activity(self):
+        other = IGThread.objects.create(ig_account=self.account, thread_id="t2")
+        first, second = timezone.now() - timedelta(minutes=5), timezone.now()
+        self.worker.batch.touched.update({self.thread.pk: first, other.pk: second})
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.worker._persist(self.worker.batch)
+
+        self.assertEqual(sum(q["sql"].startswith("UPDATE") for q in ctx.captured_queries), 1)
+        self.thread.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((self.thread.last_activity, other.last_activity), (first, second))
+
+    def test_incoming_batch_is_sent_only_after_db_write(self):
+        layer = mock.AsyncMock()
+        self.worker.channel_layer = layer
+        event = {"type": "incoming_batch", "thread_id": "t1", "messages": []}
+        self.worker.batch.add_messages(self.thread, "t1", [_msg("m1", 1)], {})
+        self.worker.batch.events.append(event)
+
+        with mock.patch.object(IGChatService, "sync_messages", side_effect=RuntimeError("db down")):
+            with self.assertRaises(RuntimeError):
+                async_to_sync(self.worker.flush)()
+        layer.group_send.assert_not_called()
+
+        self.worker.batch.add_messages(self.thread, "t1", [_msg("m1", 1)], {})
+        self.worker.batch.events.append(event)
+        async_to_sync(self.worker.flush)()
+        layer.group_send.assert_awaited_once_with(self.worker.group, {"type": "ig.event", "payload": event})
+
+    def test_metrics_are_published_to_redis(self):
+        rows = async_to_sync(ig_poller.publish_metrics)([self.worker], self.redis)
+
+        self.assertEqual(rows[0]["account_id"], str(self.account.pk))
+        (commands,) = self.redis.executed
+        self.assertEqual(commands[0][0], "hset")
+        self.assertEqual(commands[0][1], (f"ig:metrics:{self.account.pk}",))
+        self.assertEqual(commands[1][0], "expire")
+
+
+class IGLeaseAssignmentTests(SimpleTestCase):
+    def test_each_account_has_exactly_one_owner(self):
+        accounts = [str(uuid.uuid4()) for _ in range(200)]
+        nodes = ["a", "b", "c"]
+        shares = [leases.assign(accounts, nodes, node) for node in nodes]
+
+        self.assertEqual(sum(len(share) for share in shares), len(accounts))
+        self.assertEqual(set().union(*shares), set(accounts))
+        self.assertTrue(all(len(share) > 30 for share in shares))
+
+    def test_joining_node_only_takes_its_share(self):
+        accounts = [str(uuid.uuid4()) for _ in range(300)]
+        before = {a: leases.owner_of(a, ["a", "b"]) for a in accounts}
+        after = {a: leases.owner_of(a, ["a", "b", "c"]) for a in accounts}
+
+        moved = [a for a in accounts if before[a] != after[a]]
+        self.assertTrue(all(after[a] == "c" for a in moved))
+        self.assertLess(len(moved), len(accounts) / 2)
+
+    def test_account_filter_gets_its_own_node_group(self):
+        a, b = str(uuid.uuid4()), str(uuid.uuid4())
+        self.assertEqual(leases.nodes_key_for(None), leases.NODES_ZSET)
+        self.assertEqual(leases.nodes_key_for([a, b]), leases.nodes_key_for([b, a]))
+        self.assertNotEqual(leases.nodes_key_for([a]), leases.nodes_key_for([a, b]))
+        self.assertNotEqual(leases.nodes_key_for([a]), leases.NODES_ZSET)
+
+
+class _LeasePipeline(_FakePipeline):
+    async def execute(self):
+        if self.redis.down:
+            raise ConnectionError("redis is down")
+        replies = {"zadd": 1, "zremrangebyscore": 0, "zrangebyscore": [self.redis.node_id], "eval": 1}
+        return [replies[name] for name, _, _ in self.commands]
+
+
+class _LeaseRedis:
+    """Redis одного узла, который можно «уронить»: down=True — любой вызов падает."""
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.down = False
+        self.calls_while_down = []
+
+    def pipeline(self, transaction=True):
+        return _LeasePipeline(self)
+
+    async def set(self, *args, **kwargs):
+        return await self._call("set", args)
+
+    async def eval(self, *args):
+        return await self._call("eval", args)
+
+    async def _call(self, name, args):
+        if self.down:
+            self.calls_while_down.append((name, args))
+            raise ConnectionError("redis is down")
+        return 1
+
+
+class IGLeaseRenewalFailureTests(SimpleTestCase):
+    async def test_workers_stop_before_ttl_when_ticks_keep_failing(self):
+        r = _LeaseRedis("n1")
+        started, stopped = asyncio.Event(), []
+
+        async def accounts():
+            return ["acc"]
+
+        async def start(account_id):
+            started.set()
+
+        async def stop(account_id):
+            stopped.append((account_id, time.monotonic()))
+
+        coordinator = leases.LeaseCoordinator(
+            r, accounts=accounts, start=start, stop=stop, node_id="n1",
+            ttl=0.3, renew_every=0.02, safety=0.1,
+        )
+        with self.assertLogs("apps.instagram.leases", "WARNING"):
+            task = asyncio.create_task(coordinator.run())
+            await asyncio.wait_for(started.wait(), 1)
+            r.down = True
+            last_renewal = coordinator.renewed_at["acc"]
+            await asyncio.sleep(0.35)
+
+            # воркер остановлен до истечения аренды, аренда в Redis не снималась
+            self.assertEqual([a for a, _ in stopped], ["acc"])
+            self.assertLess(stopped[0][1] - last_renewal, 0.3)
+            self.assertEqual(coordinator.owned, set())
+            self.assertEqual(r.calls_while_down, [])
+
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+
+def _redis_available() -> bool:
+    try:
+        import redis
+        return bool(redis.Redis.from_url(redis_pool.REDIS_URL, socket_timeout=0.5).ping())
+    except Exception:
+        return False
+
+
+def _lease_node(node_id, account_ids, ns, run_for):
+    """Процесс-узел: «опрос» аккаунта = счётчик ns:polling:<id>; больше 1 — двойной опрос."""
+    import redis.asyncio as aioredis
+
+    async def main():
+        r = aioredis.from_url(redis_pool.REDIS_URL)
+
+        async def accounts():
+            return account_ids
+
+        async def start(account_id):
+            if await r.incr(f"{ns}:polling:{account_id}") > 1:
+                await r.rpush(f"{ns}:violations", f"{node_id}:{account_id}")
+            await r.sadd(f"{ns}:polled", account_id)
+            await r.sadd(f"{ns}:held:{node_id}", account_id)
+
+        async def stop(account_id):
+            await asyncio.sleep(0.05)  # последний цикл воркера
+            await r.srem(f"{ns}:held:{node_id}", account_id)
+            await r.decr(f"{ns}:polling:{account_id}")
+
+        coordinator = leases.LeaseCoordinator(
+            r, accounts=accounts, start=start, stop=stop, node_id=node_id,
+            nodes_key=f"{ns}:nodes", ttl=1.5, renew_every=0.2,
+        )
+        task = asyncio.create_task(coordinator.run())
+        await asyncio.sleep(run_for)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        await r.aclose()
+
+    asyncio.run(main())
+
+
+@skipUnless(_redis_available(), "нужен Redis по REDIS_URL")
+class IGLeaseMultiProcessTests(SimpleTestCase):
+    def test_no_account_is_polled_by_two_processes(self):
+        import redis
+
+        r = redis.Redis.from_url(redis_pool.REDIS_URL)
+        ns = f"ig:test:{uuid.uuid4().hex}"
+        accounts = [str(uuid.uuid4()) for _ in range(24)]
+        ctx = multiprocessing.get_context("fork")
+
+        def spawn(name, run_for):
+            proc = ctx.Process(target=_lease_node, args=(f"{ns}:{name}", accounts, ns, run_for))
+            proc.start()
+            return proc
+
+        try:
+            first = spawn("n1", 6)
+            time.sleep(0.6)
+            second = spawn("n2", 1.5)  # вошёл и штатно вышел: аккаунты вернулись остальным
+            time.sleep(0.6)
+            killed = spawn("n3", 30)
+            third = spawn("n4", 5)
+            time.sleep(1.0)
+            os.kill(killed.pid, signal.SIGKILL)  # упал без снятия аренд: ждём их истечения
+            killed.join(5)
+            for account_id in r.smembers(f"{ns}:held:{ns}:n3"):  # его опрос кончился вместе с ним
+                r.decr(f"{ns}:polling:{account_id.decode()}")
+            for proc in (first, second, third, killed):
+                proc.join(15)
+
+            self.assertEqual(r.lrange(f"{ns}:violations", 0, -1), [])
+            self.assertEqual({v.decode() for v in r.smembers(f"{ns}:polled")}, set(accounts))
+        finally:
+            r.delete(f"{ns}:violations", f"{ns}:polled", *[f"{ns}:polling:{a}" for a in accounts])
+            r.delete(*[f"{ns}:held:{ns}:n{i}" for i in range(1, 5)])
+            r.delete(f"{ns}:nodes")
+            r.close()
@@ -4,7 +4,8 @@ from apps.instagram.views import (
     AccountConnectLoginView,
     IGAccountLoginView,
     AutoLoginMyCompanyView,
-    ThreadsLiveView
+    ThreadsLiveView,
+    RedisPoolMetricsView,
 )
 
 app_name = "instagram"
@@ -15,4 +16,5 @@ urlpatterns = [
     path("accounts/<uuid:pk>/login/", IGAccountLoginView.as_view(), name="account_login"),
     path("accounts/auto-login/", AutoLoginMyCompanyView.as_view(), name="accounts_auto_login"),
     path("accounts/<uuid:pk>/threads/live/", ThreadsLiveView.as_view(), name="threads_live"),
+    path("redis/metrics/", RedisPoolMetricsView.as_view(), name="redis_metrics"),
 ]
@@ -1,6 +1,6 @@
 from django.shortcuts import get_object_or_404
 from rest_framework.views import APIView
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 
 from instagrapi.exceptions import TwoFactorRequired, ChallengeRequired, PleaseWaitFewMinutes
@@ -117,4 +117,13 @@ class ThreadsLiveView(APIView):
             return Response({"detail": "manual_login_required"}, status=401)
 
         amount = int(request.query_params.get("amount", 20))
-        return Response({"threads": svc.fetch_threads_live(amount=amount)})
\ No newline at end of file
+        return Response({"threads": svc.fetch_threads_live(amount=amount)})
+
+
+class RedisPoolMetricsView(APIView):
+    """Соединения общего Redis-пула этого процесса (ASGI-воркер с DirectConsumer)."""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        from .redis_pool import pool_metrics
+        return Response(pool_metrics())
@@ -2,10 +2,8 @@
 from urllib.parse import parse_qs
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
-from rest_framework_simplejwt.tokens import AccessToken
-from django.contrib.auth import get_user_model
 
-User = get_user_model()
+from apps.users.ws_auth import authenticate_ws_token
 
 
 class JWTAuthMiddleware:
@@ -44,19 +42,8 @@ class JWTAuthMiddleware:
             scope["user"] = AnonymousUser()
             return await self.inner(scope, receive, send)
 
-        try:
-            access = AccessToken(token)
-            user_id = access["user_id"]
-        except Exception:
-            scope["user"] = AnonymousUser()
-            return await self.inner(scope, receive, send)
-
-        @database_sync_to_async
-        def get_user(uid):
-            try:
-                return User.objects.get(id=uid)
-            except User.DoesNotExist:
-                return AnonymousUser()
-
-        scope["user"] = await get_user(user_id)
+        # пользователь + tenancy за один переход в sync-поток, с кэшем по токену
+        user, tenancy = await database_sync_to_async(authenticate_ws_token)(token)
+        scope["user"] = user or AnonymousUser()
+        scope["tenancy"] = tenancy
         return await self.inner(scope, receive, send)
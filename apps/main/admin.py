@@ -14,9 +14,10 @@ from .models import (
     # Company-scoped taxonomies & goods
     ProductCategory, ProductBrand, Product, ItemMake,
     # Extra product models
-    ProductImage, ProductCharacteristics, ProductPackage,
+    ProductImage, ProductCharacteristics, ProductPackage, ProductWebhookOutbox, ProductCodeSequence,
+    ProductImportJob,
     # POS
-    Cart, CartItem, MobileScannerToken, Sale, SaleItem,
+    Cart, CartItem, MobileScannerToken, Sale, SaleItem, SaleDocSequence,
     # Others
     Review, Notification, Integration, Analytics, Event,
     # Warehouse
@@ -386,6 +387,26 @@ class ProductPackageAdmin(admin.ModelAdmin):
     autocomplete_fields = ("company", "branch", "product")
     readonly_fields = ("created_at",)
 
+
+@admin.register(ProductWebhookOutbox)
+class ProductWebhookOutboxAdmin(admin.ModelAdmin):
+    list_display = ("product_id", "event", "status", "attempts", "company", "created_at", "available_at", "leased_until", "sent_at")
+    list_filter = ("status", "event", "company")
+    search_fields = ("product_id", "last_error")
+    list_select_related = ("company",)
+    readonly_fields = ("created_at", "leased_until", "sent_at", "payload", "last_error")
+
+
+@admin.register(ProductImportJob)
+class ProductImportJobAdmin(admin.ModelAdmin):
+    list_display = ("file", "company", "status", "rows_processed", "created_count", "updated_count", "error_count", "created_at")
+    list_filter = ("status", "company")
+    list_select_related = ("company",)
+    readonly_fields = (
+        "status", "rows_processed", "created_count", "updated_count", "skipped_count", "error_count",
+        "rows_per_second", "errors", "error", "created_at", "started_at", "finished_at",
+    )
+
 @admin.register(Cart)
 class CartAdmin(admin.ModelAdmin):
     inlines = (CartItemInline,)
@@ -445,6 +466,21 @@ class SaleItemAdmin(admin.ModelAdmin):
     list_select_related = ("sale", "product", "company", "branch")
     autocomplete_fields = ("sale", "product", "company", "branch")
 
+
+@admin.register(SaleDocSequence)
+class SaleDocSequenceAdmin(admin.ModelAdmin):
+    list_display = ("company", "cashbox", "last_number")
+    list_filter = ("company",)
+    list_select_related = ("company", "cashbox")
+    autocomplete_fields = ("company",)
+
+
+@admin.register(ProductCodeSequence)
+class ProductCodeSequenceAdmin(admin.ModelAdmin):
+    list_display = ("company", "last_code", "last_plu")
+    list_select_related = ("company",)
+    autocomplete_fields = ("company",)
+
 # ========= Промо-правила =========
 @admin.register(PromoRule)
 class PromoRuleAdmin(admin.ModelAdmin):
@@ -2,27 +2,22 @@ from __future__ import annotations
 
 from datetime import date, timedelta, datetime
 from decimal import Decimal
-from itertools import groupby
-from operator import attrgetter
 
 from django.conf import settings
 from django.db.models import (
-    Prefetch,
     Sum,
     Count,
     Value as V,
     F,
     DecimalField,
-    Q,
 )
 from django.db.models.functions import Coalesce, TruncDate
 from django.utils import timezone
 
 from .models import (
+    AgentProductBalance,
     ManufactureSubreal,
     Acceptance,
-    ReturnFromAgent,
-    AgentSaleAllocation,
     Sale,
     SaleItem,
 )
@@ -30,8 +25,10 @@ from apps.users.models import User
 
 
 try:
-    from apps.main.cache_utils import cached_result
+    from apps.main.cache_utils import CACHE_DOMAIN_PRODUCTION, CACHE_DOMAIN_SALES, cached_result
 except ImportError:
+    CACHE_DOMAIN_PRODUCTION = CACHE_DOMAIN_SALES = None
+
     # Fallback если cache_utils не доступен
     def cached_result(*args, **kwargs):
         def decorator(func):
@@ -110,73 +107,33 @@ def _parse_period(request):
     return {"period": "month", "date_from": date_from, "date_to": date_to, "group_by": "day"}
 
 
-@cached_result(timeout=settings.CACHE_TIMEOUT_SHORT, key_prefix="agent_on_hand")
+@cached_result(
+    timeout=settings.CACHE_TIMEOUT_SHORT,
+    key_prefix="agent_on_hand",
+    domains=(CACHE_DOMAIN_SALES, CACHE_DOMAIN_PRODUCTION),
+)
 def _compute_agent_on_hand(*, company, branch, agent) -> dict:
     """
-    Остатки у агента на руках (логика максимально совпадает с /agents/me/products).
-    Кэшируется на 1 минуту (CACHE_TIMEOUT_SHORT).
+    Остатки у агента на руках — из AgentProductBalance (services/agent_stock.py),
+    те же числа, что в /agents/me/products. Кэшируется на 1 минуту (CACHE_TIMEOUT_SHORT).
     """
-    accepted_returns_qs = ReturnFromAgent.objects.filter(
-        company=company,
-        status=ReturnFromAgent.Status.ACCEPTED,
-    )
-    alloc_qs = AgentSaleAllocation.objects.filter(company=company)
-
-    base = (
-        ManufactureSubreal.objects
-        .filter(company=company, agent=agent)
+    # ВАЖНО: та же логика филиала, что и в миксине
+    balances = (
+        AgentProductBalance.objects
+        .filter(company=company, agent=agent, branch=branch, qty_on_hand__gt=0)
         .select_related("product")
-        .prefetch_related(
-            # "acceptances",  # не используется в расчёте — убрал, чтобы не грузить БД
-            Prefetch("returns", queryset=accepted_returns_qs, to_attr="accepted_returns"),
-            Prefetch("sale_allocations", queryset=alloc_qs, to_attr="prefetched_allocs"),
-        )
-        # ВАЖНО: sold_qty только по allocations этой компании (чтобы не схватить чужое)
-        .annotate(
-            sold_qty=Coalesce(
-                Sum("sale_allocations__qty", filter=Q(sale_allocations__company=company)),
-                V(0),
-            )
-        )
-        .order_by("product_id", "-created_at")
+        .order_by("product_id")
     )
 
-    # ВАЖНО: та же логика, что и в миксине
-    if branch is not None:
-        base = base.filter(branch=branch)
-    else:
-        base = base.filter(branch__isnull=True)
-
     total_qty = 0
     total_amount = Decimal("0.00")
     by_product_qty = []
     by_product_amount = []
 
-    for _product_id, subreals_iter in groupby(base, key=attrgetter("product_id")):
-        subreals = list(subreals_iter)
-        if not subreals:
-            continue
-
-        product = subreals[0].product if getattr(subreals[0], "product", None) else None
-        if not product:
-            continue
-
+    for balance in balances:
+        product = balance.product
         price = getattr(product, "price", None) or Decimal("0.00")
-        qty_on_hand = 0
-
-        for s in subreals:
-            accepted = int(s.qty_accepted or 0)
-            returned = int(s.qty_returned or 0)
-
-            sold = int(getattr(s, "sold_qty", 0) or 0)
-            # fallback: если sold_qty пустой, используем prefetched_allocs
-            if not sold and getattr(s, "prefetched_allocs", None) is not None:
-                sold = sum(int(a.qty or 0) for a in s.prefetched_allocs)
-
-            qty_on_hand += max(accepted - returned - sold, 0)
-
-        if qty_on_hand <= 0:
-            continue
+        qty_on_hand = balance.qty_on_hand
 
         amount = price * qty_on_hand
         total_qty += qty_on_hand
@@ -202,7 +159,11 @@ def _compute_agent_on_hand(*, company, branch, agent) -> dict:
     }
 
 
-@cached_result(timeout=settings.CACHE_TIMEOUT_ANALYTICS, key_prefix="analytics_agent")
+@cached_result(
+    timeout=settings.CACHE_TIMEOUT_ANALYTICS,
+    key_prefix="analytics_agent",
+    domains=(CACHE_DOMAIN_SALES, CACHE_DOMAIN_PRODUCTION),
+)
 def build_agent_analytics_payload(
     *,
     company,
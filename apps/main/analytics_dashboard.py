@@ -1,8 +1,12 @@
 from __future__ import annotations
 
-from collections import Counter, defaultdict
+from collections import Counter
+from dataclasses import dataclass
 from datetime import date, datetime, timedelta
 from decimal import Decimal, ROUND_HALF_UP
+from typing import Any
+
+from django.conf import settings
 
 from django.db.models import (
     Avg,
@@ -25,7 +29,9 @@ from apps.barber.models import Appointment as BarberAppointment, Client as Barbe
 from apps.cafe.models import Purchase as CafePurchase
 from apps.construction.models import CashFlow, Cashbox
 from apps.main.analytics_agent import _parse_period
+from apps.main.cache_utils import CACHE_DOMAIN_CASH, CACHE_DOMAIN_SALES
 from apps.main.models import Sale, SaleItem
+from apps.main.services.dashboard_widgets import Widget, run_widgets
 from apps.main.views import CompanyBranchRestrictedMixin
 
 
@@ -73,94 +79,133 @@ _WEEKDAY_RU = {
 }
 
 
-def build_dashboard_payload(*, company, branch, period_params: dict, user=None, scope: str = "company") -> dict:
-    """
-    scope:
-      - company: общая аналитика (для владельца/админа)
-      - my: аналитика текущего мастера (barber)
-    """
-    date_from: date = period_params["date_from"]
-    date_to: date = period_params["date_to"]
-    dt_from, dt_to_excl = _dt_range(date_from, date_to)
+@dataclass(frozen=True)
+class _DashboardContext:
+    company: Any
+    branch: Any
+    user: Any
+    scope: str
+    date_from: date
+    date_to: date
+
+    @property
+    def dt_range(self):
+        return _dt_range(self.date_from, self.date_to)
+
+    def cache_key(self) -> tuple:
+        user_id = getattr(self.user, "pk", None) if self.scope == "my" else None
+        return (
+            getattr(self.company, "pk", None), getattr(self.branch, "pk", None), self.scope, user_id,
+            self.date_from, self.date_to,
+        )
 
-    # ─────────────────────────────────────────────────────────
-    # Barber: appointments / services / clients
-    # ─────────────────────────────────────────────────────────
-    appt_qs = BarberAppointment.objects.filter(company=company, start_at__gte=dt_from, start_at__lt=dt_to_excl)
-    appt_qs = _apply_branch(appt_qs, branch, include_global=True, field_name="branch")
-    if scope == "my" and user is not None:
-        appt_qs = appt_qs.filter(barber=user)
-
-    effective_price = ExpressionWrapper(
-        F("price") * (Value(Decimal("1.00")) - (F("discount") / Value(Decimal("100.00")))),
-        output_field=DecimalField(max_digits=14, decimal_places=6),
-    )
+    def appointments(self):
+        dt_from, dt_to_excl = self.dt_range
+        qs = BarberAppointment.objects.filter(company=self.company, start_at__gte=dt_from, start_at__lt=dt_to_excl)
+        qs = _apply_branch(qs, self.branch, include_global=True, field_name="branch")
+        if self.scope == "my" and self.user is not None:
+            qs = qs.filter(barber=self.user)
+        return qs
+
+    def completed_appointments(self):
+        return self.appointments().filter(status=BarberAppointment.Status.COMPLETED)
+
+    def online_bookings(self):
+        dt_from, dt_to_excl = self.dt_range
+        qs = OnlineBooking.objects.filter(company=self.company, created_at__gte=dt_from, created_at__lt=dt_to_excl)
+        return _apply_branch(qs, self.branch, include_global=True, field_name="branch")
+
+    def sales(self):
+        dt_from, dt_to_excl = self.dt_range
+        qs = Sale.objects.filter(company=self.company, status=Sale.Status.PAID, paid_at__gte=dt_from, paid_at__lt=dt_to_excl)
+        return _apply_branch(qs, self.branch, include_global=True, field_name="branch")
+
+    def cash_flows(self):
+        dt_from, dt_to_excl = self.dt_range
+        qs = CashFlow.objects.filter(
+            company=self.company,
+            status=CashFlow.Status.APPROVED,
+            created_at__gte=dt_from,
+            created_at__lt=dt_to_excl,
+        )
+        return _apply_branch(qs, self.branch, include_global=True, field_name="branch")
+
+    def purchases(self):
+        dt_from, dt_to_excl = self.dt_range
+        qs = CafePurchase.objects.filter(company=self.company, created_at__gte=dt_from, created_at__lt=dt_to_excl)
+        return _apply_branch(qs, self.branch, include_global=True, field_name="branch")
+
+
+_EFFECTIVE_PRICE = ExpressionWrapper(
+    F("price") * (Value(Decimal("1.00")) - (F("discount") / Value(Decimal("100.00")))),
+    output_field=DecimalField(max_digits=14, decimal_places=6),
+)
 
-    barber_totals = appt_qs.aggregate(
+
+def _percent(part: int, total: int) -> float:
+    return float((Decimal(part) / Decimal(total) * 100).quantize(Decimal("0.1"))) if total else 0.0
+
+
+# ─────────────────────────────────────────────────────────
+# Виджеты: каждый — один независимый блок запросов
+# ─────────────────────────────────────────────────────────
+def _w_barber_totals(ctx: _DashboardContext) -> dict:
+    completed = Q(status=BarberAppointment.Status.COMPLETED)
+    return ctx.appointments().aggregate(
         appointments_total=Count("id"),
-        appointments_completed=Count("id", filter=Q(status=BarberAppointment.Status.COMPLETED)),
+        appointments_completed=Count("id", filter=completed),
         appointments_canceled=Count("id", filter=Q(status=BarberAppointment.Status.CANCELED)),
         appointments_no_show=Count("id", filter=Q(status=BarberAppointment.Status.NO_SHOW)),
-        revenue=Coalesce(Sum(effective_price, filter=Q(status=BarberAppointment.Status.COMPLETED)), ZERO_MONEY),
-        avg_ticket=Avg(effective_price, filter=Q(status=BarberAppointment.Status.COMPLETED)),
+        revenue=Coalesce(Sum(_EFFECTIVE_PRICE, filter=completed), ZERO_MONEY),
+        avg_ticket=Avg(_EFFECTIVE_PRICE, filter=completed),
     )
 
-    appt_total = int(barber_totals["appointments_total"] or 0)
-    appt_completed = int(barber_totals["appointments_completed"] or 0)
-    conversion = float((Decimal(appt_completed) / Decimal(appt_total) * 100).quantize(Decimal("0.1"))) if appt_total else 0.0
-
-    # busy weekday
-    by_wd = (
-        appt_qs.annotate(wd=ExtractWeekDay("start_at"))
-        .values("wd")
-        .annotate(cnt=Count("id"))
-        .order_by("-cnt")
-    )
-    busy_day = None
-    if by_wd:
-        top = by_wd[0]
-        busy_day = {"day": _WEEKDAY_RU.get(top["wd"], str(top["wd"])), "count": int(top["cnt"] or 0)}
-
-    # statuses block (month, overall)
-    completed_revenue = appt_qs.filter(status=BarberAppointment.Status.COMPLETED).aggregate(
-        s=Coalesce(Sum(effective_price), ZERO_MONEY)
-    )["s"]
-    canceled_and_no_show = appt_qs.filter(status__in=[BarberAppointment.Status.CANCELED, BarberAppointment.Status.NO_SHOW]).count()
-
-    # top masters
-    top_masters = list(
-        appt_qs.filter(status=BarberAppointment.Status.COMPLETED)
+
+def _w_barber_weekdays(ctx: _DashboardContext) -> dict:
+    """{ExtractWeekDay: записей} — и для busy_day, и для appointments_by_weekday."""
+    return {
+        row["wd"]: int(row["cnt"] or 0)
+        for row in ctx.appointments().annotate(wd=ExtractWeekDay("start_at")).values("wd").annotate(cnt=Count("id"))
+    }
+
+
+def _w_top_masters(ctx: _DashboardContext) -> list:
+    rows = list(
+        ctx.completed_appointments()
         .values("barber_id", "barber__first_name", "barber__last_name", "barber__email")
-        .annotate(count=Count("id"), revenue=Coalesce(Sum(effective_price), ZERO_MONEY))
+        .annotate(count=Count("id"), revenue=Coalesce(Sum(_EFFECTIVE_PRICE), ZERO_MONEY))
         .order_by("-revenue", "-count")[:10]
     )
-    for r in top_masters:
+    for r in rows:
         first = (r.pop("barber__first_name") or "").strip()
         last = (r.pop("barber__last_name") or "").strip()
         email = (r.pop("barber__email") or "").strip()
         r["master_id"] = str(r.pop("barber_id"))
         r["master_name"] = (f"{first} {last}".strip() or email or "—")
         r["revenue"] = _money_str(r["revenue"])
+    return rows
+
 
-    # top barber clients
-    top_clients = list(
-        appt_qs.filter(status=BarberAppointment.Status.COMPLETED)
+def _w_top_barber_clients(ctx: _DashboardContext) -> list:
+    rows = list(
+        ctx.completed_appointments()
         .values("client_id", "client__full_name")
-        .annotate(visits=Count("id"), revenue=Coalesce(Sum(effective_price), ZERO_MONEY))
+        .annotate(visits=Count("id"), revenue=Coalesce(Sum(_EFFECTIVE_PRICE), ZERO_MONEY))
         .order_by("-revenue", "-visits")[:10]
     )
-    for r in top_clients:
+    for r in rows:
         r["client_id"] = str(r["client_id"]) if r["client_id"] else None
         r["client_name"] = r.pop("client__full_name") or "Без имени"
         r["revenue"] = _money_str(r["revenue"])
+    return rows
 
-    # services total + top services (month)
-    services_qs = BarberService.objects.filter(company=company)
-    services_qs = _apply_branch(services_qs, branch, include_global=True, field_name="branch")
-    services_total = services_qs.count()
 
-    top_services = list(
-        BarberService.objects.filter(appointments__in=appt_qs.filter(status=BarberAppointment.Status.COMPLETED))
+def _w_barber_services(ctx: _DashboardContext) -> dict:
+    services_qs = _apply_branch(
+        BarberService.objects.filter(company=ctx.company), ctx.branch, include_global=True, field_name="branch"
+    )
+    top = list(
+        BarberService.objects.filter(appointments__in=ctx.completed_appointments())
         .values("id", "name")
         .annotate(
             count=Count("appointments", distinct=True),
@@ -168,34 +213,19 @@ def build_dashboard_payload(*, company, branch, period_params: dict, user=None,
         )
         .order_by("-count", "name")[:10]
     )
-    for r in top_services:
+    for r in top:
         r["service_id"] = str(r.pop("id"))
         r["revenue"] = _money_str(r["revenue"])
+    return {"total": services_qs.count(), "top": top}
 
-    # appointments by weekday
-    appt_by_weekday = [
-        {"day": _WEEKDAY_RU.get(i, str(i)), "count": 0} for i in range(2, 8)
-    ] + [{"day": _WEEKDAY_RU.get(1, "Вс"), "count": 0}]
-    appt_wd_map = {row["day"]: row for row in appt_by_weekday}
-    for row in (
-        appt_qs.annotate(wd=ExtractWeekDay("start_at")).values("wd").annotate(cnt=Count("id"))
-    ):
-        day = _WEEKDAY_RU.get(row["wd"], str(row["wd"]))
-        if day in appt_wd_map:
-            appt_wd_map[day]["count"] = int(row["cnt"] or 0)
 
-    barber_clients_count = BarberClient.objects.filter(company=company).count()
+def _w_barber_clients(ctx: _DashboardContext) -> int:
+    return BarberClient.objects.filter(company=ctx.company).count()
 
-    # ─────────────────────────────────────────────────────────
-    # Online booking: statuses + top services by bookings
-    # ─────────────────────────────────────────────────────────
-    ob_qs = OnlineBooking.objects.filter(company=company, created_at__gte=dt_from, created_at__lt=dt_to_excl)
-    ob_qs = _apply_branch(ob_qs, branch, include_global=True, field_name="branch")
 
-    booking_status_counts = {
-        k: int(v or 0)
-        for k, v in ob_qs.values_list("status").annotate(v=Count("id"))
-    }
+def _w_online_bookings(ctx: _DashboardContext) -> dict:
+    ob_qs = ctx.online_bookings()
+    statuses = {k: int(v or 0) for k, v in ob_qs.values_list("status").annotate(v=Count("id"))}
 
     service_title_counter = Counter()
     for services in ob_qs.values_list("services", flat=True):
@@ -207,74 +237,64 @@ def build_dashboard_payload(*, company, branch, period_params: dict, user=None,
                 if title:
                     service_title_counter[str(title)] += 1
 
-    top_services_by_bookings = [
-        {"title": title, "count": cnt}
-        for title, cnt in service_title_counter.most_common(5)
-    ]
+    return {
+        "statuses": statuses,
+        "top_services": [{"title": title, "count": cnt} for title, cnt in service_title_counter.most_common(5)],
+    }
 
-    # ─────────────────────────────────────────────────────────
-    # Sales (products): revenue/tx/clients + top products + top clients
-    # ─────────────────────────────────────────────────────────
-    sale_qs = Sale.objects.filter(company=company, status=Sale.Status.PAID, paid_at__gte=dt_from, paid_at__lt=dt_to_excl)
-    sale_qs = _apply_branch(sale_qs, branch, include_global=True, field_name="branch")
 
-    sales_agg = sale_qs.aggregate(
+def _w_sales_totals(ctx: _DashboardContext) -> dict:
+    return ctx.sales().aggregate(
         revenue=Coalesce(Sum("total"), ZERO_MONEY),
         tx=Count("id"),
         clients=Count("client_id", distinct=True),
     )
-    sales_revenue = sales_agg["revenue"] or Decimal("0.00")
-    sales_tx = int(sales_agg["tx"] or 0)
-    sales_clients = int(sales_agg["clients"] or 0)
 
-    items_qs = SaleItem.objects.filter(sale__in=sale_qs)
-    top_products_sales = list(
-        items_qs.values("name_snapshot")
+
+def _w_top_products(ctx: _DashboardContext) -> list:
+    rows = list(
+        SaleItem.objects.filter(sale__in=ctx.sales())
+        .values("name_snapshot")
         .annotate(
             qty=Coalesce(Sum("quantity"), Value(Decimal("0.000"), output_field=DecimalField(max_digits=14, decimal_places=3))),
             revenue=Coalesce(Sum(F("quantity") * F("unit_price"), output_field=MONEY_FIELD), ZERO_MONEY),
         )
         .order_by("-revenue")[:10]
     )
-    for r in top_products_sales:
+    for r in rows:
         r["product_name"] = r.pop("name_snapshot") or "—"
         r["qty"] = float(r["qty"] or Decimal("0.000"))
         r["revenue"] = _money_str(r["revenue"])
+    return rows
+
 
-    top_sales_clients = list(
-        sale_qs.values("client_id", "client__full_name")
+def _w_top_sales_clients(ctx: _DashboardContext) -> list:
+    rows = list(
+        ctx.sales().values("client_id", "client__full_name")
         .annotate(orders=Count("id"), revenue=Coalesce(Sum("total"), ZERO_MONEY))
         .order_by("-revenue")[:10]
     )
-    for r in top_sales_clients:
+    for r in rows:
         r["client_id"] = str(r["client_id"]) if r["client_id"] else None
         r["client_name"] = r.pop("client__full_name") or "Без имени"
         r["revenue"] = _money_str(r["revenue"])
+    return rows
 
-    # ─────────────────────────────────────────────────────────
-    # Cashboxes: operations + income/expense (month)
-    # ─────────────────────────────────────────────────────────
-    flow_qs = CashFlow.objects.filter(
-        company=company,
-        status=CashFlow.Status.APPROVED,
-        created_at__gte=dt_from,
-        created_at__lt=dt_to_excl,
-    )
-    flow_qs = _apply_branch(flow_qs, branch, include_global=True, field_name="branch")
 
-    flow_agg = flow_qs.aggregate(
+def _w_cash_totals(ctx: _DashboardContext) -> dict:
+    return ctx.cash_flows().aggregate(
         income=Coalesce(Sum("amount", filter=Q(type=CashFlow.Type.INCOME)), ZERO_MONEY),
         expense=Coalesce(Sum("amount", filter=Q(type=CashFlow.Type.EXPENSE)), ZERO_MONEY),
     )
-    flows_income = flow_agg["income"] or Decimal("0.00")
-    flows_expense = flow_agg["expense"] or Decimal("0.00")
 
-    cashboxes_qs = Cashbox.objects.filter(company=company)
-    cashboxes_qs = _apply_branch(cashboxes_qs, branch, include_global=True, field_name="branch")
 
+def _w_cashboxes(ctx: _DashboardContext) -> list:
+    cashboxes_qs = _apply_branch(
+        Cashbox.objects.filter(company=ctx.company), ctx.branch, include_global=True, field_name="branch"
+    )
     flow_by_cb = {
         str(r["cashbox_id"]): r
-        for r in flow_qs.values("cashbox_id").annotate(
+        for r in ctx.cash_flows().values("cashbox_id").annotate(
             ops=Count("id"),
             income=Coalesce(Sum("amount", filter=Q(type=CashFlow.Type.INCOME)), ZERO_MONEY),
             expense=Coalesce(Sum("amount", filter=Q(type=CashFlow.Type.EXPENSE)), ZERO_MONEY),
@@ -282,12 +302,12 @@ def build_dashboard_payload(*, company, branch, period_params: dict, user=None,
     }
     sale_by_cb = {
         str(r["cashbox_id"]): r
-        for r in sale_qs.values("cashbox_id").annotate(
+        for r in ctx.sales().values("cashbox_id").annotate(
             sales_count=Count("id"),
             sales_amount=Coalesce(Sum("total"), ZERO_MONEY),
         )
     }
-    cashboxes_rows = []
+    rows = []
     for cb in cashboxes_qs.only("id", "name"):
         cb_id = str(cb.id)
         frow = flow_by_cb.get(cb_id) or {}
@@ -295,7 +315,7 @@ def build_dashboard_payload(*, company, branch, period_params: dict, user=None,
         income_cb = _money((srow.get("sales_amount") or 0) + (frow.get("income") or 0))
         expense_cb = _money(frow.get("expense") or 0)
         ops = int((frow.get("ops") or 0) + (srow.get("sales_count") or 0))
-        cashboxes_rows.append(
+        rows.append(
             {
                 "cashbox_id": cb_id,
                 "cashbox_name": cb.name or cb_id,
@@ -304,71 +324,149 @@ def build_dashboard_payload(*, company, branch, period_params: dict, user=None,
                 "expense": str(expense_cb),
             }
         )
+    return rows
 
-    # ─────────────────────────────────────────────────────────
-    # Purchases by supplier (month)
-    # ─────────────────────────────────────────────────────────
-    purchases_qs = CafePurchase.objects.filter(company=company, created_at__gte=dt_from, created_at__lt=dt_to_excl)
-    purchases_qs = _apply_branch(purchases_qs, branch, include_global=True, field_name="branch")
-    suppliers_rows = list(
+
+def _w_suppliers(ctx: _DashboardContext) -> dict:
+    purchases_qs = ctx.purchases()
+    rows = list(
         purchases_qs.values("supplier").annotate(
             positions=Count("id"),
             amount=Coalesce(Sum("price"), ZERO_MONEY),
         ).order_by("-amount")[:10]
     )
-    for r in suppliers_rows:
+    for r in rows:
         r["supplier"] = r["supplier"] or "—"
         r["amount"] = _money_str(r["amount"])
+    total = purchases_qs.aggregate(s=Coalesce(Sum("price"), ZERO_MONEY))["s"] or Decimal("0.00")
+    return {"total": total, "rows": rows}
 
-    purchases_total = purchases_qs.aggregate(s=Coalesce(Sum("price"), ZERO_MONEY))["s"] or Decimal("0.00")
+
+def _w_barber_daily(ctx: _DashboardContext) -> dict:
+    return {
+        r["d"]: _money(r["v"])
+        for r in ctx.completed_appointments()
+        .annotate(d=TruncDate("start_at"))
+        .values("d")
+        .annotate(v=Coalesce(Sum(_EFFECTIVE_PRICE), ZERO_MONEY))
+    }
+
+
+def _w_sales_daily(ctx: _DashboardContext) -> dict:
+    return {
+        r["d"]: _money(r["v"])
+        for r in ctx.sales().annotate(d=TruncDate("paid_at")).values("d").annotate(v=Coalesce(Sum("total"), ZERO_MONEY))
+    }
+
+
+def _w_cash_daily(ctx: _DashboardContext) -> dict:
+    """{дата: (приход, расход)} одним запросом."""
+    return {
+        r["d"]: (_money(r["income"]), _money(r["expense"]))
+        for r in ctx.cash_flows().annotate(d=TruncDate("created_at")).values("d").annotate(
+            income=Coalesce(Sum("amount", filter=Q(type=CashFlow.Type.INCOME)), ZERO_MONEY),
+            expense=Coalesce(Sum("amount", filter=Q(type=CashFlow.Type.EXPENSE)), ZERO_MONEY),
+        )
+    }
+
+
+def _zero_totals(*keys):
+    return lambda: dict.fromkeys(keys, 0)
+
+
+# без доменов поколений (барбершоп, онлайн-запись, закупки) — короткий TTL
+_TTL_SHORT = getattr(settings, "CACHE_TIMEOUT_SHORT", 60)
+_TTL_MEDIUM = getattr(settings, "CACHE_TIMEOUT_MEDIUM", 300)
+
+DASHBOARD_WIDGETS = {
+    w.name: w
+    for w in (
+        Widget("barber_totals", _w_barber_totals, _TTL_SHORT, default=_zero_totals(
+            "appointments_total", "appointments_completed", "appointments_canceled", "appointments_no_show", "revenue",
+        )),
+        Widget("barber_weekdays", _w_barber_weekdays, _TTL_SHORT),
+        Widget("top_masters", _w_top_masters, _TTL_SHORT, default=list),
+        Widget("top_barber_clients", _w_top_barber_clients, _TTL_SHORT, default=list),
+        Widget("barber_services", _w_barber_services, _TTL_SHORT, default=lambda: {"total": 0, "top": []}),
+        Widget("barber_clients", _w_barber_clients, _TTL_SHORT, default=int),
+        Widget("online_bookings", _w_online_bookings, _TTL_SHORT, default=lambda: {"statuses": {}, "top_services": []}),
+        Widget("sales_totals", _w_sales_totals, _TTL_MEDIUM, (CACHE_DOMAIN_SALES,), default=_zero_totals("revenue", "tx", "clients")),
+        Widget("top_products", _w_top_products, _TTL_MEDIUM, (CACHE_DOMAIN_SALES,), default=list),
+        Widget("top_sales_clients", _w_top_sales_clients, _TTL_MEDIUM, (CACHE_DOMAIN_SALES,), default=list),
+        Widget("cash_totals", _w_cash_totals, _TTL_MEDIUM, (CACHE_DOMAIN_CASH,), default=_zero_totals("income", "expense")),
+        Widget("cashboxes", _w_cashboxes, _TTL_MEDIUM, (CACHE_DOMAIN_SALES, CACHE_DOMAIN_CASH), default=list),
+        Widget("suppliers", _w_suppliers, _TTL_SHORT, default=lambda: {"total": 0, "rows": []}),
+        Widget("barber_daily", _w_barber_daily, _TTL_SHORT),
+        Widget("sales_daily", _w_sales_daily, _TTL_MEDIUM, (CACHE_DOMAIN_SALES,)),
+        Widget("cash_daily", _w_cash_daily, _TTL_MEDIUM, (CACHE_DOMAIN_CASH,)),
+    )
+}
+
+
+def build_dashboard_payload(*, company, branch, period_params: dict, user=None, scope: str = "company") -> dict:
+    """
+    scope:
+      - company: общая аналитика (для владельца/админа)
+      - my: аналитика текущего мастера (barber)
+
+    Блоки считаются виджетами (services/dashboard_widgets.py): параллельно, с кэшем
+    на виджет. Не уложившийся в бюджет виджет отдаётся пустым и попадает в
+    meta.timed_out (meta.partial = true); meta.widgets — тайминги каждого.
+    """
+    date_from: date = period_params["date_from"]
+    date_to: date = period_params["date_to"]
+    ctx = _DashboardContext(company=company, branch=branch, user=user, scope=scope, date_from=date_from, date_to=date_to)
+    run = run_widgets(
+        DASHBOARD_WIDGETS.values(), ctx, ctx_key=ctx.cache_key(), company_id=getattr(company, "pk", None)
+    )
+    w = {name: run.get(widget) for name, widget in DASHBOARD_WIDGETS.items()}
+
+    # ─────────────────────────────────────────────────────────
+    # Barber: appointments / services / clients
+    # ─────────────────────────────────────────────────────────
+    barber_totals = w["barber_totals"]
+    appt_total = int(barber_totals["appointments_total"] or 0)
+    appt_completed = int(barber_totals["appointments_completed"] or 0)
+    canceled_and_no_show = int(barber_totals["appointments_canceled"] or 0) + int(barber_totals["appointments_no_show"] or 0)
+    barber_revenue = barber_totals["revenue"] or Decimal("0.00")
+
+    # busy weekday + appointments by weekday (Пн … Вс)
+    by_wd = w["barber_weekdays"]
+    busy_day = None
+    if by_wd:
+        wd, cnt = max(by_wd.items(), key=lambda kv: kv[1])
+        busy_day = {"day": _WEEKDAY_RU.get(wd, str(wd)), "count": cnt}
+    appt_by_weekday = [{"day": _WEEKDAY_RU[i], "count": by_wd.get(i, 0)} for i in (2, 3, 4, 5, 6, 7, 1)]
+
+    # ─────────────────────────────────────────────────────────
+    # Sales / cashboxes / purchases
+    # ─────────────────────────────────────────────────────────
+    sales_agg = w["sales_totals"]
+    sales_revenue = sales_agg["revenue"] or Decimal("0.00")
+    flows_income = w["cash_totals"]["income"] or Decimal("0.00")
+    flows_expense = w["cash_totals"]["expense"] or Decimal("0.00")
 
     # ─────────────────────────────────────────────────────────
     # Finance totals (month)
     # ─────────────────────────────────────────────────────────
-    income_month = _money((barber_totals["revenue"] or 0) + (sales_revenue or 0) + (flows_income or 0))
-    expense_month = _money(flows_expense or 0)
+    income_month = _money(barber_revenue + sales_revenue + flows_income)
+    expense_month = _money(flows_expense)
     profit_month = _money(income_month - expense_month)
 
-    avg_ticket = barber_totals["avg_ticket"]
+    avg_ticket = barber_totals.get("avg_ticket")
     avg_ticket_str = _money_str(avg_ticket) if avg_ticket is not None else None
 
     # ─────────────────────────────────────────────────────────
     # Income/expense dynamics (daily)
     # ─────────────────────────────────────────────────────────
-    def _date_iter(a: date, b: date):
-        cur = a
-        while cur <= b:
-            yield cur
-            cur += timedelta(days=1)
-
-    barber_daily = {
-        r["d"]: _money(r["v"])
-        for r in appt_qs.filter(status=BarberAppointment.Status.COMPLETED)
-        .annotate(d=TruncDate("start_at"))
-        .values("d")
-        .annotate(v=Coalesce(Sum(effective_price), ZERO_MONEY))
-    }
-    sales_daily = {
-        r["d"]: _money(r["v"])
-        for r in sale_qs.annotate(d=TruncDate("paid_at")).values("d").annotate(v=Coalesce(Sum("total"), ZERO_MONEY))
-    }
-    flows_income_daily = {
-        r["d"]: _money(r["v"])
-        for r in flow_qs.filter(type=CashFlow.Type.INCOME).annotate(d=TruncDate("created_at")).values("d").annotate(
-            v=Coalesce(Sum("amount"), ZERO_MONEY)
-        )
-    }
-    flows_expense_daily = {
-        r["d"]: _money(r["v"])
-        for r in flow_qs.filter(type=CashFlow.Type.EXPENSE).annotate(d=TruncDate("created_at")).values("d").annotate(
-            v=Coalesce(Sum("amount"), ZERO_MONEY)
-        )
-    }
-
+    zero = Decimal("0.00")
+    barber_daily, sales_daily, cash_daily = w["barber_daily"], w["sales_daily"], w["cash_daily"]
     dynamics = []
-    for d in _date_iter(date_from, date_to):
-        income_d = _money(barber_daily.get(d) + sales_daily.get(d) + flows_income_daily.get(d))
-        expense_d = _money(flows_expense_daily.get(d))
+    d = date_from
+    while d <= date_to:
+        cash_income_d, cash_expense_d = cash_daily.get(d, (zero, zero))
+        income_d = _money(barber_daily.get(d, zero) + sales_daily.get(d, zero) + cash_income_d)
+        expense_d = _money(cash_expense_d)
         dynamics.append(
             {
                 "date": d.isoformat(),
@@ -377,6 +475,7 @@ def build_dashboard_payload(*, company, branch, period_params: dict, user=None,
                 "profit": str(_money(income_d - expense_d)),
             }
         )
+        d += timedelta(days=1)
 
     payload = {
         "period": {
@@ -391,49 +490,51 @@ def build_dashboard_payload(*, company, branch, period_params: dict, user=None,
         },
         "barber": {
             "avg_ticket": avg_ticket_str,
-            "conversion_percent": conversion,
+            "conversion_percent": _percent(appt_completed, appt_total),
             "appointments_total": appt_total,
             "appointments_completed": appt_completed,
-            "services_total": services_total,
-            "clients_barber": barber_clients_count,
+            "services_total": w["barber_services"]["total"],
+            "clients_barber": w["barber_clients"],
             "busy_day": busy_day,
             "statuses": {
                 "completed": {
                     "count": appt_completed,
-                    "percent": float((Decimal(appt_completed) / Decimal(appt_total) * 100).quantize(Decimal("0.1"))) if appt_total else 0.0,
-                    "amount": _money_str(completed_revenue),
+                    "percent": _percent(appt_completed, appt_total),
+                    "amount": _money_str(barber_revenue),
                 },
                 "canceled_or_no_show": {
-                    "count": int(canceled_and_no_show),
-                    "percent": float((Decimal(canceled_and_no_show) / Decimal(appt_total) * 100).quantize(Decimal("0.1"))) if appt_total else 0.0,
+                    "count": canceled_and_no_show,
+                    "percent": _percent(canceled_and_no_show, appt_total),
                 },
             },
-            "top_masters": top_masters,
-            "top_clients": top_clients,
-            "top_services": top_services,
+            "top_masters": w["top_masters"],
+            "top_clients": w["top_barber_clients"],
+            "top_services": w["barber_services"]["top"],
             "appointments_by_weekday": appt_by_weekday,
         },
-        "online_bookings": {
-            "statuses": booking_status_counts,
-            "top_services": top_services_by_bookings,
-        },
+        "online_bookings": w["online_bookings"],
         "sales": {
-            "clients_sales": sales_clients,
-            "transactions": sales_tx,
+            "clients_sales": int(sales_agg["clients"] or 0),
+            "transactions": int(sales_agg["tx"] or 0),
             "revenue": _money_str(sales_revenue),
-            "top_products": top_products_sales,
-            "top_clients": top_sales_clients,
+            "top_products": w["top_products"],
+            "top_clients": w["top_sales_clients"],
         },
         "cashboxes": {
             "income": _money_str(sales_revenue + flows_income),
             "expense": _money_str(flows_expense),
-            "rows": cashboxes_rows,
+            "rows": w["cashboxes"],
         },
         "suppliers": {
-            "purchases_total": _money_str(purchases_total),
-            "rows": suppliers_rows,
+            "purchases_total": _money_str(w["suppliers"]["total"]),
+            "rows": w["suppliers"]["rows"],
         },
         "dynamics": dynamics,
+        "meta": {
+            "partial": bool(run.timed_out),
+            "timed_out": run.timed_out,
+            "widgets": run.timings,
+        },
     }
     return payload
 
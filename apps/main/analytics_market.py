@@ -26,10 +26,16 @@ from rest_framework.response import Response
 from rest_framework import permissions
 from rest_framework.exceptions import PermissionDenied
 
-from apps.users.models import Branch
+from apps.users.models import Branch, User
 from apps.construction.models import CashShift
+from apps.main.services import sales_rollup
 
-from apps.main.cache_utils import cache_market_analytics_key  # путь поправь под свой проект
+from apps.main.cache_utils import (  # путь поправь под свой проект
+    CACHE_DOMAIN_CASH,
+    CACHE_DOMAIN_SALES,
+    CACHE_DOMAIN_WAREHOUSE,
+    cache_market_analytics_key,
+)
 
 
 # ─────────────────────────────────────────────────────────────
@@ -420,8 +426,73 @@ class AnalyticsView(APIView):
 
         return qs
 
-    def _cache_hash_from_query(self, request) -> str:
-        qp = {k: request.query_params.getlist(k) for k in request.query_params.keys()}
+    # фильтры, которых нет в агрегатах SaleRollup: с ними считаем по сырым продажам
+    _RAW_ONLY_FILTERS = ("cashbox", "shift", "min_total", "max_total")
+    # от каких данных зависит вкладка (поколения кэша, см. cache_utils)
+    _TAB_CACHE_DOMAINS = {
+        "sales": (CACHE_DOMAIN_SALES,),
+        "cashboxes": (CACHE_DOMAIN_SALES,),
+        "shifts": (CACHE_DOMAIN_SALES, CACHE_DOMAIN_CASH),
+        "users": (CACHE_DOMAIN_SALES, CACHE_DOMAIN_CASH),
+        "finance": (CACHE_DOMAIN_CASH,),
+        "products": (CACHE_DOMAIN_SALES, CACHE_DOMAIN_WAREHOUSE),
+        "stock": (CACHE_DOMAIN_SALES, CACHE_DOMAIN_WAREHOUSE),
+    }
+    # вкладки, целиком покрытые поколениями: их можно держать в кэше дольше.
+    # products/stock читают ещё и Product (правки карточек не поднимают поколение) — им обычный TTL
+    _EXACT_CACHE_TABS = ("sales", "cashboxes", "shifts", "users", "finance")
+
+    # параметры, не влияющие на ответ (даты учитываются уже разобранным периодом)
+    _CACHE_IGNORED_PARAMS = ("tab", "date_from", "date_to", "period_start", "period_end", "_")
+
+    def _paid_sales(self, request, company, branch, period: Period, Sale):
+        qs = Sale.objects.filter(
+            company=company,
+            status=_choice_value(Sale, "Status", "PAID", "paid"),
+            paid_at__gte=period.start,
+            paid_at__lt=period.end,
+        )
+        if branch is not None:
+            if self._include_global(request):
+                qs = qs.filter(Q(branch=branch) | Q(branch__isnull=True))
+            else:
+                qs = qs.filter(branch=branch)
+        return self._apply_sale_filters(request, qs, Sale)
+
+    def _rollup_summary(self, request, company, branch, period: Period, *, with_products=False, sale_filters=True):
+        """
+        Итоги продаж из предагрегатов (полные дни) + сырых продаж (сегодня/края периода).
+        None — агрегаты неприменимы: нет покрытия у компании или в запросе фильтр, которого в них нет.
+        """
+        Sale, _ = get_sale_models()
+        if Sale is None or Sale._meta.label != "main.Sale":
+            return None
+        qp = request.query_params
+        if sale_filters and any(qp.get(k) for k in self._RAW_ONLY_FILTERS):
+            return None
+        return sales_rollup.summarize(
+            company.id,
+            period.start,
+            period.end,
+            branch_id=branch.id if branch is not None else None,
+            include_global=self._include_global(request),
+            cashier_id=qp.get("cashier") if sale_filters else None,
+            payment_method=qp.get("payment_method") if sale_filters else None,
+            with_products=with_products,
+        )
+
+    def _cache_hash_from_query(self, request, period: Period) -> str:
+        """
+        Хэш значимых параметров: пустые и служебные отбрасываются, период — уже разобранный,
+        поэтому date_from/period_start и "?x=&y=1" / "?y=1" попадают в один ключ.
+        """
+        qp = {
+            k: sorted(v for v in request.query_params.getlist(k) if v != "")
+            for k in request.query_params.keys()
+            if k not in self._CACHE_IGNORED_PARAMS
+        }
+        qp = {k: v for k, v in qp.items() if v}
+        qp["_period"] = [period.start.isoformat(), period.end.isoformat()]
         raw = json.dumps(qp, ensure_ascii=False, sort_keys=True)
         return hashlib.md5(raw.encode("utf-8")).hexdigest()
 
@@ -437,8 +508,8 @@ class AnalyticsView(APIView):
 
         company_id = str(getattr(company, "id", ""))
         branch_id = str(getattr(branch, "id", "")) if branch else None
-        qhash = self._cache_hash_from_query(request)
-        ck = cache_market_analytics_key(company_id, branch_id, tab, qhash)
+        qhash = self._cache_hash_from_query(request, period)
+        ck = cache_market_analytics_key(company_id, branch_id, tab, qhash, self._TAB_CACHE_DOMAINS.get(tab, ()))
 
         cached = cache.get(ck)
         if cached is not None:
@@ -462,6 +533,8 @@ class AnalyticsView(APIView):
             return Response({"detail": "Unknown tab. Use: sales|stock|cashboxes|shifts|products|users|finance"}, status=400)
 
         ttl = getattr(settings, "CACHE_TIMEOUT_ANALYTICS", getattr(settings, "CACHE_TIMEOUT_MEDIUM", 300))
+        if tab in self._EXACT_CACHE_TABS:
+            ttl = max(ttl, getattr(settings, "CACHE_TIMEOUT_LONG", 3600))
         cache.set(ck, data, ttl)
         return Response(data)
 
@@ -479,9 +552,41 @@ class AnalyticsView(APIView):
         gross_profit = None
         margin_percent = None
         cogs_warning = None
+        payment_breakdown = []
 
         Sale, SaleItem = get_sale_models()
-        if Sale is not None:
+        summary = self._rollup_summary(request, company, branch, period, with_products=True)
+        if summary is not None:
+            revenue = summary.revenue
+            tx = summary.transactions
+            cogs, gross_profit, margin_percent = _calc_margin_pack(revenue, summary.cogs)
+            if _money(revenue) > 0 and _money(cogs) == 0:
+                cogs_warning = "Себестоимость не заполнена (маржа может быть некорректной)."
+
+            # уникальных клиентов из агрегатов не сложить — один distinct-запрос
+            clients = (
+                self._paid_sales(request, company, branch, period, Sale)
+                .values("client_id").exclude(client_id__isnull=True).distinct().count()
+            )
+
+            daily = [
+                {"date": d.isoformat(), "value": str(_money(v))}
+                for d, v in sorted(summary.by_day.items())
+            ]
+            payment_breakdown = [
+                {"method": method or "unknown", "count": cnt, "total": str(_money(rev))}
+                for method, (rev, cnt) in sorted(summary.by_method.items(), key=lambda kv: kv[1][0], reverse=True)
+            ]
+            top_products = [
+                {
+                    "name": name or "Товар",
+                    "sold": str(qty.quantize(Decimal("0.001"))),
+                    "revenue": str(_money(rev)),
+                }
+                for (_pid, name), (qty, rev) in sorted(summary.products.items(), key=lambda kv: kv[1][1], reverse=True)[:5]
+            ]
+
+        elif Sale is not None:
             qs = Sale.objects.filter(company=company)
 
             if branch is not None and _model_has_field(Sale, "branch"):
@@ -552,7 +657,6 @@ class AnalyticsView(APIView):
             daily = [{"date": r["d"].isoformat(), "value": str(_money(r["v"]))} for r in daily_rows if r["d"]]
 
             # ── Payment Method Breakdown ──
-            payment_breakdown = []
             if _model_has_field(Sale, "payment_method"):
                 payment_rows = (
                     qs.values("payment_method")
@@ -874,7 +978,37 @@ class AnalyticsView(APIView):
         peak_hours = []
 
         Sale, SaleItem = get_sale_models()
-        if Sale is not None:
+        summary = self._rollup_summary(request, company, branch, period)
+        if summary is not None:
+            revenue = summary.revenue
+            tx = summary.transactions
+            avg_check = _safe_div(_money(revenue), tx)
+            cogs, gross_profit, margin_percent = _calc_margin_pack(revenue, summary.cogs)
+            if _money(revenue) > 0 and _money(cogs) == 0:
+                cogs_warning = "Себестоимость не заполнена (маржа может быть некорректной)."
+
+            methods = sorted(summary.by_method.items(), key=lambda kv: kv[1][0], reverse=True)
+            total_sum = sum((rev for _m, (rev, _c) in methods), Z_MONEY)
+            for method, (rev, cnt) in methods:
+                sm = _money(rev)
+                share = float((sm / total_sum * 100).quantize(Decimal("0.1"))) if total_sum else 0.0
+                pay_detail.append({"method": method or "unknown", "transactions": cnt, "sum": str(sm), "share": share})
+            pay_pie = [{"name": d["method"], "percent": d["share"]} for d in pay_detail]
+
+            cash_value = _choice_value(Sale, "PaymentMethod", "CASH", "cash")
+            cash_in_box = summary.by_method.get(cash_value, [Z_MONEY, 0])[0]
+
+            hourly = [
+                {"hour": int(h), "revenue": str(_money(rev)), "transactions": int(cnt)}
+                for h, (rev, cnt) in sorted(summary.by_hour.items())
+            ]
+            tx_week = [{"weekday": wd, "transactions": cnt} for wd, cnt in sorted(summary.by_weekday.items())]
+
+            peak_hours = sorted(hourly, key=lambda x: Decimal(x["revenue"]), reverse=True)[:6]
+            for r in peak_hours:
+                r["avg_check"] = str(_safe_div(Decimal(r["revenue"]), int(r["transactions"])))
+
+        elif Sale is not None:
             paid_value = _choice_value(Sale, "Status", "PAID", "paid")
             dt_field = "paid_at" if _model_has_field(Sale, "paid_at") else "created_at"
 
@@ -1571,7 +1705,38 @@ class AnalyticsView(APIView):
         shift_stats = {}
 
         Sale, _ = get_sale_models()
-        if Sale and _model_has_field(Sale, "user"):
+        summary = self._rollup_summary(request, company, branch, period, sale_filters=False)
+        if summary is not None:
+            ranked = sorted(summary.by_cashier.items(), key=lambda kv: kv[1][0], reverse=True)
+            if limit:
+                ranked = ranked[:limit]
+            users = {
+                u["id"]: u
+                for u in User.objects.filter(id__in=[uid for uid, _ in ranked if uid]).values(
+                    "id", "first_name", "last_name", "email", "phone_number"
+                )
+            }
+            for uid, (rev, txc) in ranked:
+                u = users.get(uid, {})
+                rev = _money(rev)
+                users_performance.append({
+                    "user_id": str(uid) if uid else None,
+                    "user": _user_label(
+                        None,
+                        first_name=u.get("first_name"),
+                        last_name=u.get("last_name"),
+                        email=u.get("email"),
+                        phone=u.get("phone_number"),
+                        user_id=uid,
+                    ),
+                    "email": u.get("email"),
+                    "phone": u.get("phone_number"),
+                    "revenue": str(rev),
+                    "transactions": txc,
+                    "avg_check": str(_safe_div(rev, txc)),
+                })
+
+        elif Sale and _model_has_field(Sale, "user"):
             paid_value = _choice_value(Sale, "Status", "PAID", "paid")
             dt_field = "paid_at" if _model_has_field(Sale, "paid_at") else "created_at"
             
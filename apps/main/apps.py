@@ -6,4 +6,7 @@ class MainConfig(AppConfig):
     name = 'apps.main'
 
     def ready(self):
-        import apps.main.signals
\ No newline at end of file
+        import apps.main.signals
+        from apps.main.pdf_render import register_fonts_if_needed
+
+        register_fonts_if_needed()
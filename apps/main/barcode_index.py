@@ -0,0 +1,225 @@
+"""
+Двухуровневый индекс штрихкодов/ПЛУ для POS-сканирования.
+
+Уровни:
+  1) локальный LRU процесса: (company_id, поле) -> компактный кортеж товара;
+  2) Redis-хэш на компанию: nurcrm:barcode_index:{company_id}:{version}.
+
+В индексе храним только (id, price, name, is_weight, plu) — без остатков,
+поэтому массовые update(quantity=...) индекс не портят.
+
+Инвалидация — через версию компании: Product.save()/delete увеличивают версию,
+старый хэш перестаёт читаться и сам истекает по TTL. Локальный LRU сверяет версию
+с кэшем не чаще, чем раз в BARCODE_INDEX_VERSION_CHECK секунд.
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Callable, NamedTuple, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+LOCAL_MAX_ITEMS = int(getattr(settings, "BARCODE_INDEX_LOCAL_MAX_ITEMS", 50_000))
+VERSION_CHECK_INTERVAL = float(getattr(settings, "BARCODE_INDEX_VERSION_CHECK", 5))
+REDIS_TTL = int(getattr(settings, "BARCODE_INDEX_REDIS_TTL", 24 * 60 * 60))
+
+# маркер "товара нет" — чтобы весовые штрихкоды не били в БД при каждом скане
+_MISS = ""
+
+
+class IndexedProduct(NamedTuple):
+    id: str
+    price: Decimal
+    name: str
+    is_weight: bool
+    plu: Optional[int]
+
+
+_lock = threading.Lock()
+_local: "OrderedDict[tuple, tuple]" = OrderedDict()  # (company, field) -> (version, entry|None)
+_versions: dict = {}  # company -> (version, checked_at)
+
+
+def _version_key(company_id) -> str:
+    return f"barcode_index:ver:{company_id}"
+
+
+def _hash_key(company_id, version: int) -> str:
+    return f"nurcrm:barcode_index:{company_id}:{version}"
+
+
+def _redis():
+    """
+    Сырой клиент Redis (нужен для HGET/HSET). None — если бэкенд кэша не redis
+    или Redis недоступен: тогда работаем только с локальным уровнем и БД.
+    """
+    try:
+        from django_redis import get_redis_connection
+
+        return get_redis_connection("default")
+    except Exception:
+        return None
+
+
+def _current_version(company_id) -> int:
+    company_id = str(company_id)
+    now = time.monotonic()
+    with _lock:
+        known = _versions.get(company_id)
+    if known and now - known[1] < VERSION_CHECK_INTERVAL:
+        return known[0]
+
+    version = cache.get(_version_key(company_id)) or 0
+    with _lock:
+        _versions[company_id] = (int(version), now)
+    return int(version)
+
+
+def _encode(entry: Optional[IndexedProduct]) -> str:
+    if entry is None:
+        return _MISS
+    return json.dumps(
+        [entry.id, str(entry.price), entry.name, entry.is_weight, entry.plu],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+
+
+def _decode(raw) -> Optional[IndexedProduct]:
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8")
+    if not raw:
+        return None
+    pid, price, name, is_weight, plu = json.loads(raw)
+    return IndexedProduct(pid, Decimal(price), name, bool(is_weight), plu)
+
+
+def _local_get(key: tuple, version: int):
+    with _lock:
+        hit = _local.get(key)
+        if hit is None:
+            return False, None
+        if hit[0] != version:
+            del _local[key]
+            return False, None
+        _local.move_to_end(key)
+        return True, hit[1]
+
+
+def _local_put(key: tuple, version: int, entry: Optional[IndexedProduct]) -> None:
+    with _lock:
+        _local[key] = (version, entry)
+        _local.move_to_end(key)
+        while len(_local) > LOCAL_MAX_ITEMS:
+            _local.popitem(last=False)
+
+
+def _lookup(company_id, field: str, load: Callable[[], Optional[IndexedProduct]]) -> Optional[IndexedProduct]:
+    version = _current_version(company_id)
+    key = (str(company_id), field)
+
+    found, entry = _local_get(key, version)
+    if found:
+        return entry
+
+    client = _redis()
+    if client is not None:
+        try:
+            raw = client.hget(_hash_key(company_id, version), field)
+        except Exception:
+            client, raw = None, None
+        if raw is not None:
+            entry = _decode(raw)
+            _local_put(key, version, entry)
+            return entry
+
+    entry = load()
+    _local_put(key, version, entry)
+
+    if client is not None:
+        try:
+            hkey = _hash_key(company_id, version)
+            pipe = client.pipeline(transaction=False)
+            pipe.hset(hkey, field, _encode(entry))
+            pipe.expire(hkey, REDIS_TTL)
+            pipe.execute()
+        except Exception:
+            pass
+    return entry
+
+
+def _load_one(**filters) -> Optional[IndexedProduct]:
+    from apps.main.models import Product
+
+    row = (
+        Product.objects
+        .filter(**filters)
+        .values_list("id", "price", "name", "is_weight", "plu")
+        .first()
+    )
+    if row is None:
+        return None
+    pid, price, name, is_weight, plu = row
+    return IndexedProduct(str(pid), price, name, bool(is_weight), plu)
+
+
+def lookup_barcode(company_id, barcode: str) -> Optional[IndexedProduct]:
+    """Товар компании по штрихкоду (или None)."""
+    if not company_id or not barcode:
+        return None
+    return _lookup(
+        company_id,
+        f"b:{barcode}",
+        lambda: _load_one(company_id=company_id, barcode=barcode),
+    )
+
+
+def lookup_plu(company_id, plu: int) -> Optional[IndexedProduct]:
+    """Товар компании по ПЛУ весов (или None)."""
+    if not company_id or plu is None:
+        return None
+    return _lookup(
+        company_id,
+        f"p:{int(plu)}",
+        lambda: _load_one(company_id=company_id, plu=int(plu)),
+    )
+
+
+def invalidate_company(company_id) -> None:
+    """
+    Сбрасывает индекс компании: новая версия делает старые записи
+    (локальные и в Redis) недостижимыми.
+    """
+    if not company_id:
+        return
+    company_id = str(company_id)
+    key = _version_key(company_id)
+    try:
+        cache.add(key, 0, None)
+        version = cache.incr(key)
+    except ValueError:
+        version = None
+    if version is None:
+        # кэш недоступен: хотя бы локально разойдёмся со старыми записями
+        with _lock:
+            prev = _versions.get(company_id, (0, 0))[0]
+        version = prev + 1
+    with _lock:
+        _versions[company_id] = (int(version), time.monotonic())
+
+
+def invalidate_company_on_commit(company_id) -> None:
+    """Инвалидация после коммита (иначе параллельный скан может закэшировать старые данные)."""
+    from django.db import transaction
+
+    try:
+        transaction.on_commit(lambda: invalidate_company(company_id))
+    except Exception:
+        invalidate_company(company_id)
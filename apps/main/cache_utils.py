@@ -5,11 +5,19 @@
 from __future__ import annotations
 
 from functools import wraps
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Iterable, Optional
 from django.core.cache import cache
 from django.conf import settings
+from django.db import connections, transaction
 import hashlib
 import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
 
 
 def _stable_repr(value: Any) -> str:
@@ -68,41 +76,265 @@ def cache_key(*args, **kwargs) -> str:
     return f"nurcrm:cache:{key_hash}"
 
 
+# ─────────────────────────────────────────────────────────────
+# Поколения кэша: nurcrm:gen:<domain>:<company_id> -> int
+#
+# Номер поколения входит в ключ закэшированного значения. Изменение данных домена
+# увеличивает поколение (один INCR), и все старые ключи компании просто перестают
+# читаться — без SCAN по keyspace; сами записи доживают свой TTL.
+# ─────────────────────────────────────────────────────────────
+CACHE_DOMAIN_SALES = "sales"  # Sale
+CACHE_DOMAIN_CASH = "cash"  # CashFlow, CashShift
+CACHE_DOMAIN_WAREHOUSE = "warehouse"  # warehouse.Document
+CACHE_DOMAIN_PRODUCTION = "production"  # ManufactureSubreal
+CACHE_DOMAIN_PROMO = "promo"  # PromoRule (services.promo_index)
+CACHE_DOMAIN_TENANCY = "tenancy"  # Company, Branch (apps.users.tenancy)
+
+
+def _generation_key(company_id, domain: str) -> str:
+    return f"nurcrm:gen:{domain}:{company_id}"
+
+
+def _fresh_generation() -> int:
+    # не 1: если ключ поколения вытеснят, новое значение не совпадёт ни с одним старым
+    return time.time_ns() // 1000
+
+
+def cache_generations(company_id, domains: Iterable[str]) -> dict:
+    """Текущие поколения доменов компании (один get_many)."""
+    keys = {domain: _generation_key(company_id, domain) for domain in domains}
+    found = cache.get_many(list(keys.values()))
+    out = {}
+    for domain, key in keys.items():
+        gen = found.get(key)
+        if gen is None:
+            gen = _fresh_generation()
+            if not cache.add(key, gen, timeout=None):
+                gen = cache.get(key, gen)
+        out[domain] = gen
+    return out
+
+
+def generation_tag(company_id, domains: Iterable[str]) -> str:
+    """Строка поколений для встраивания в ключ кэша: "sales=..,cash=..". """
+    gens = cache_generations(company_id, sorted(set(domains)))
+    return ",".join(f"{domain}={gen}" for domain, gen in gens.items())
+
+
+def bump_cache_generation(company_id, *domains: str) -> None:
+    """Инвалидирует все ключи компании, зависящие от доменов. O(1) на домен."""
+    if not company_id:
+        return
+    for domain in domains:
+        key = _generation_key(company_id, domain)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # поколения ещё нет (или вытеснено) — любое новое значение отличается от старых
+            cache.set(key, _fresh_generation(), timeout=None)
+        except Exception:
+            logger.warning("Failed to bump cache generation %s", key, exc_info=True)
+
+
+def bump_cache_generation_on_commit(company_id, *domains: str) -> None:
+    """
+    Поднимает поколение после коммита: иначе параллельный запрос успел бы
+    закэшировать ещё не закоммиченное состояние под новым поколением.
+    """
+    if company_id:
+        transaction.on_commit(lambda: bump_cache_generation(company_id, *domains))
+
+
+def _company_id_from_kwargs(kwargs) -> Optional[str]:
+    if kwargs.get("company_id"):
+        return str(kwargs["company_id"])
+    company = kwargs.get("company")
+    pk = getattr(company, "pk", company)
+    return str(pk) if pk else None
+
+
+# ─────────────────────────────────────────────────────────────
+# Счётчики cached_result по key_prefix: hit / stale (отдали устаревшее) / miss /
+# recompute (+ суммарное время пересчёта, мс). Копятся в процессе и раз в
+# CACHE_STATS_FLUSH_SECONDS сбрасываются в общий кэш (nurcrm:cachestats:<prefix>:<metric>).
+# ─────────────────────────────────────────────────────────────
+CACHE_STAT_METRICS = ("hit", "stale", "miss", "recompute", "recompute_ms")
+
+_stats_lock = threading.Lock()
+_stats_pending: dict = {}
+_stats_flushed_at = time.monotonic()
+
+
+def _stats_key(prefix: str, metric: str) -> str:
+    return f"nurcrm:cachestats:{prefix}:{metric}"
+
+
+def _record(prefix: str, metric: str, value: int = 1) -> None:
+    global _stats_flushed_at
+    with _stats_lock:
+        key = (prefix, metric)
+        _stats_pending[key] = _stats_pending.get(key, 0) + value
+        if time.monotonic() - _stats_flushed_at < getattr(settings, "CACHE_STATS_FLUSH_SECONDS", 10):
+            return
+        pending = dict(_stats_pending)
+        _stats_pending.clear()
+        _stats_flushed_at = time.monotonic()
+    _flush_stats(pending)
+
+
+def _flush_stats(pending: dict) -> None:
+    for (prefix, metric), value in pending.items():
+        key = _stats_key(prefix, metric)
+        try:
+            cache.incr(key, value)
+        except ValueError:
+            if not cache.add(key, value, timeout=None):
+                cache.incr(key, value)
+        except Exception:
+            logger.warning("Failed to flush cache stats %s", key, exc_info=True)
+
+
+def cache_stats(key_prefix: str) -> dict:
+    """Счётчики key_prefix по всем процессам (включая ещё не сброшенные этим процессом)."""
+    with _stats_lock:
+        pending = {k: _stats_pending.pop(k) for k in list(_stats_pending) if k[0] == key_prefix}
+    _flush_stats(pending)
+    keys = {metric: _stats_key(key_prefix, metric) for metric in CACHE_STAT_METRICS}
+    found = cache.get_many(list(keys.values()))
+    return {metric: int(found.get(key) or 0) for metric, key in keys.items()}
+
+
+# ─────────────────────────────────────────────────────────────
+# Фоновое обновление устаревших значений
+# ─────────────────────────────────────────────────────────────
+_refresh_pool = None
+_refresh_pool_lock = threading.Lock()
+
+
+def _wall_clock() -> float:
+    """Часы сроков свежести (epoch: записи кэша общие для процессов); в тестах подменяется."""
+    return time.time()
+
+
+def _run_in_background(fn: Callable) -> None:
+    global _refresh_pool
+    with _refresh_pool_lock:
+        if _refresh_pool is None:
+            _refresh_pool = ThreadPoolExecutor(
+                max_workers=getattr(settings, "CACHE_REFRESH_WORKERS", 2),
+                thread_name_prefix="cache-refresh",
+            )
+    _refresh_pool.submit(_background_task, fn)
+
+
+def _background_task(fn: Callable) -> None:
+    try:
+        fn()
+    finally:
+        # соединения с БД потока пула не должны висеть до следующей задачи
+        connections.close_all()
+
+
+def _release_lock(lock_key: str, token: str) -> None:
+    # снимаем только свою блокировку: чужую (после истечения аренды) не трогаем
+    if cache.get(lock_key) == token:
+        cache.delete(lock_key)
+
+
 def cached_result(
     timeout: Optional[int] = None,
     key_prefix: str = "",
     *,
     version: str = "v1",
     cache_none: bool = True,
+    domains: tuple = (),
+    stale_timeout: Optional[int] = None,
+    lock_timeout: Optional[int] = None,
 ):
     """
     Декоратор для кэширования результатов функций.
 
     params:
-      - timeout: TTL; если None -> settings.CACHE_TIMEOUT_MEDIUM (default 300)
+      - timeout: TTL свежести; если None -> settings.CACHE_TIMEOUT_MEDIUM (default 300)
       - key_prefix: префикс домена (например "agent_products")
       - version: ручная версия ключа (полезно при изменении формата ответа)
       - cache_none: кэшировать ли None (обычно да, чтобы не лупить БД повторно)
+      - domains: домены поколений (CACHE_DOMAIN_*); в ключ входят их поколения
+        для компании из kwargs company_id/company, и изменение данных сразу
+        делает результат неактуальным
+      - stale_timeout: сколько секунд после timeout ещё отдавать устаревшее значение,
+        пока один воркер пересчитывает его в фоне (по умолчанию = timeout)
+      - lock_timeout: аренда блокировки пересчёта; остальные запросы ждут результат
+        не дольше неё (settings.CACHE_LOCK_TIMEOUT, default 30)
+
+    Пересчёт — single-flight: одновременно значение считает один воркер
+    (cache.add, в Redis — SET NX EX), остальные ждут его или получают устаревшее.
     """
     def decorator(func: Callable) -> Callable:
         @wraps(func)
         def wrapper(*args, **kwargs):
-            base = f"nurcrm:{key_prefix}:{func.__name__}:{version}"
+            # ":swr" — значения хранятся как (fresh_until, result), не путать с прежним форматом
+            base = f"nurcrm:{key_prefix}:{func.__name__}:{version}:swr"
+            company_id = _company_id_from_kwargs(kwargs) if domains else None
+            if company_id:
+                base = f"{base}:{generation_tag(company_id, domains)}"
             ck = cache_key(base, args, kwargs)
-
-            hit = cache.get(ck)
-            if hit is not None:
-                return hit
-
-            result = func(*args, **kwargs)
-
-            # если None не надо кэшировать
-            if result is None and not cache_none:
-                return None
-
-            ttl = timeout if timeout is not None else getattr(settings, "CACHE_TIMEOUT_MEDIUM", 300)
-            cache.set(ck, result, ttl)
-            return result
+            lock_key = f"{ck}:lock"
+
+            fresh_ttl = timeout if timeout is not None else getattr(settings, "CACHE_TIMEOUT_MEDIUM", 300)
+            stale_ttl = stale_timeout if stale_timeout is not None else fresh_ttl
+            lease = lock_timeout if lock_timeout is not None else getattr(settings, "CACHE_LOCK_TIMEOUT", 30)
+
+            def compute_and_store():
+                started = time.monotonic()
+                result = func(*args, **kwargs)
+                _record(key_prefix, "recompute")
+                _record(key_prefix, "recompute_ms", int((time.monotonic() - started) * 1000))
+                if result is not None or cache_none:
+                    # в кэше — (момент устаревания, значение); ключ живёт ещё stale_ttl после него
+                    cache.set(ck, (_wall_clock() + fresh_ttl, result), fresh_ttl + stale_ttl)
+                return result
+
+            entry = cache.get(ck)
+            if entry is not None:
+                fresh_until, value = entry
+                if _wall_clock() < fresh_until:
+                    _record(key_prefix, "hit")
+                    return value
+
+                _record(key_prefix, "stale")
+                token = uuid.uuid4().hex
+                if cache.add(lock_key, token, lease):
+                    def refresh():
+                        try:
+                            compute_and_store()
+                        except Exception:
+                            logger.warning("Background cache refresh failed: %s", ck, exc_info=True)
+                        finally:
+                            _release_lock(lock_key, token)
+
+                    _run_in_background(refresh)
+                return value
+
+            _record(key_prefix, "miss")
+            token = uuid.uuid4().hex
+            if not cache.add(lock_key, token, lease):
+                # значение уже считает другой воркер — ждём его, но не дольше аренды
+                deadline = time.monotonic() + lease
+                while time.monotonic() < deadline:
+                    time.sleep(0.05)
+                    entry = cache.get(ck)
+                    if entry is not None:
+                        return entry[1]
+                    if cache.get(lock_key) is None:
+                        break
+                token = None
+
+            try:
+                return compute_and_store()
+            finally:
+                if token:
+                    _release_lock(lock_key, token)
 
         return wrapper
     return decorator
@@ -111,7 +343,8 @@ def cached_result(
 def invalidate_cache_pattern(pattern: str) -> int:
     """
     Инвалидирует кэш по паттерну (требует django-redis).
-    Использует SCAN вместо KEYS.
+    Использует SCAN вместо KEYS — это проход по всему keyspace, поэтому для
+    аналитики используйте поколения (bump_cache_generation), а не этот вызов.
 
     pattern example:
       - "analytics:market:"
@@ -160,8 +393,18 @@ def cache_agent_products_key(agent_id: str, company_id: str, branch_id: Optional
     return f"nurcrm:agent:products:{agent_id}:{company_id}:{branch_id or 'global'}"
 
 
-def cache_market_analytics_key(company_id: str, branch_id: Optional[str], tab: str, query_hash: str) -> str:
+def cache_market_analytics_key(
+    company_id: str,
+    branch_id: Optional[str],
+    tab: str,
+    query_hash: str,
+    domains: Iterable[str] = (),
+) -> str:
     """
     Ключ для market analytics (то, что тебе нужно для analytics_market.py).
+    domains — от каких данных зависит вкладка; их поколения входят в ключ.
     """
-    return f"nurcrm:analytics:market:{company_id}:{branch_id or 'global'}:{tab}:{query_hash}"
+    key = f"nurcrm:analytics:market:{company_id}:{branch_id or 'global'}:{tab}:{query_hash}"
+    if domains:
+        key = f"{key}:{hashlib.md5(generation_tag(company_id, domains).encode('utf-8')).hexdigest()[:12]}"
+    return key
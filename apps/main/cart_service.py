@@ -95,7 +95,7 @@ def get_or_create_active_cart(
         if order_discount_total is not None:
             cart.order_discount_total = _money(order_discount_total)
             cart.save(update_fields=["order_discount_total", "updated_at"])
-            cart.recalc()
+            cart.refresh_totals()
 
         return cart
 
@@ -166,9 +166,9 @@ def add_item_to_cart(
             )
 
     item = (
-        CartItem.objects
+        cart.items
         .select_for_update()
-        .filter(cart_id=cart.id, product_id=product.id)
+        .filter(product_id=product.id)
         .first()
     )
 
@@ -193,7 +193,6 @@ def add_item_to_cart(
             line_discount=line_disc,
         )
 
-    cart.recalc()
     return item
 
 
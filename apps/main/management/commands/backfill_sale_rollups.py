@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from apps.main.models import Sale
+from apps.main.services import sales_rollup
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild SaleRollup/SaleProductRollup from paid sales for a date range "
+        "(inclusive, project TIME_ZONE). Safe to re-run: rows of the range are replaced. "
+        "Analytics switches to rollups once the rebuilt range reaches today."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--company", default="", help="Filter by company UUID (optional).")
+        parser.add_argument("--date-from", default="", help="YYYY-MM-DD (default: first paid sale).")
+        parser.add_argument("--date-to", default="", help="YYYY-MM-DD (default: today).")
+        parser.add_argument("--chunk-days", type=int, default=31, help="Days per transaction.")
+
+    def _date(self, raw, name):
+        if not raw:
+            return None
+        value = parse_date(raw)
+        if value is None:
+            raise CommandError(f"--{name}: expected YYYY-MM-DD, got {raw!r}")
+        return value
+
+    def handle(self, *args, **opts):
+        date_from = self._date(opts["date_from"], "date-from")
+        date_to = self._date(opts["date_to"], "date-to") or timezone.localdate()
+        chunk = max(1, opts["chunk_days"])
+
+        qs = Sale.objects.filter(status=Sale.Status.PAID, paid_at__isnull=False)
+        if opts["company"]:
+            qs = qs.filter(company_id=opts["company"])
+        firsts = dict(qs.values_list("company_id").annotate(first=Min("paid_at")).order_by())
+
+        for company_id, first_paid in firsts.items():
+            start = date_from or timezone.localtime(first_paid).date()
+            if start > date_to:
+                continue
+            rows = products = 0
+            day = start
+            while day <= date_to:
+                last = min(day + timedelta(days=chunk - 1), date_to)
+                r, p = sales_rollup.rebuild(company_id, day, last)
+                rows += r
+                products += p
+                day = last + timedelta(days=1)
+
+            covered = sales_rollup.extend_coverage(company_id, start, date_to)
+            self.stdout.write(
+                f"{company_id}: {start}..{date_to} rollup rows={rows}, product rows={products}"
+                + (", coverage extended" if covered else "")
+            )
+
+        self.stdout.write(self.style.SUCCESS(f"Companies processed: {len(firsts)}"))
@@ -14,51 +14,29 @@
   --article-col Индекс колонки артикула
   --price-col  Индекс колонки цены
   --dry-run    Только показать, что будет импортировано, без записи в БД
-  --skip-duplicates Пропускать если товар с таким штрихкодом уже есть (по умолчанию True)
+  --skip-duplicates Пропускать если товар с таким штрихкодом уже есть (по умолчанию True);
+                   --no-skip-duplicates — обновить цены/название/артикул/единицу существующих
   --default-qty Количество по умолчанию для каждого товара (по умолчанию 50)
+  --chunk-size Строк на транзакцию (по умолчанию 1000)
+
+Файл читается потоково (apps.main.services.product_import): .xlsx через openpyxl read_only,
+CSV/TSV построчно; .xls и выгрузки 1С загружаются целиком (_load_excel_rows).
 """
 import re
-from decimal import Decimal, InvalidOperation
+from decimal import Decimal
 
 from django.core.management.base import BaseCommand
-from django.db import transaction
 
-from apps.main.models import Product, Company
+from apps.main.models import Company
+from apps.main.services.product_import import (
+    DEFAULT_CHUNK_SIZE,
+    ProductImporter,
+    ProductImportError,
+    iter_file_rows,
+)
 from apps.users.models import Branch
 
 
-def _col_index(headers, names, fallback_col=None):
-    """Найти индекс колонки по заголовку или вернуть fallback."""
-    if fallback_col is not None:
-        return fallback_col
-    headers_lower = [str(h).strip().lower() if h is not None else "" for h in headers]
-    for name in names:
-        for i, h in enumerate(headers_lower):
-            if name in h or h in name:
-                return i
-    return None
-
-
-def _val(row, col, default=""):
-    if col is None or col >= len(row):
-        return default
-    v = row[col]
-    if v is None:
-        return default
-    s = str(v).strip()
-    return s if s else default
-
-
-def _decimal_val(row, col, default=Decimal("0")):
-    v = _val(row, col)
-    if not v:
-        return default
-    try:
-        return Decimal(str(v).replace(",", "."))
-    except (InvalidOperation, ValueError):
-        return default
-
-
 class Command(BaseCommand):
     help = "Импорт товаров из Excel в main.Product. Строки без штрихкода пропускаются."
 
@@ -78,6 +56,7 @@ class Command(BaseCommand):
         parser.add_argument("--skip-duplicates", action="store_true", default=True, help="Пропускать дубликаты по штрихкоду")
         parser.add_argument("--no-skip-duplicates", action="store_false", dest="skip_duplicates", help="Не пропускать дубликаты")
         parser.add_argument("--default-qty", type=float, default=50, help="Количество по умолчанию для каждого товара (по умолчанию 50)")
+        parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Строк на транзакцию")
 
     def _extract_1c_binary_text(self, file_path):
         """Извлечь текст из бинарного дампа 1С (формат L\\x00). Возвращает rows или []."""
@@ -130,45 +109,14 @@ class Command(BaseCommand):
         return []
 
     def _load_excel_rows(self, file_path):
-        """Загружает строки из Excel (.xlsx или .xls). Возвращает (rows, wb_to_close) или (None, None) при ошибке."""
+        """
+        Запасной загрузчик для форматов, которые не читаются потоково (.xls, выгрузки 1С).
+        Возвращает (rows, None) или (None, None) при ошибке.
+        """
         import os
         file_path = os.path.abspath(os.path.normpath(file_path))
 
-        # 1. Пробуем pandas (надёжно читает .xlsx, лучше обрабатывает пути)
-        try:
-            import pandas as pd
-            df = pd.read_excel(file_path, header=None, engine="openpyxl")
-            rows = [["" if (pd.isna(c) or c is None) else c for c in row] for row in df.values.tolist()]
-            return (rows, None)
-        except ImportError:
-            pass
-        except Exception as e:
-            err_msg = str(e).lower()
-            if "zip" in err_msg or "not a zip" in err_msg:
-                pass
-            else:
-                self.stderr.write(self.style.ERROR(f"Ошибка pandas/openpyxl: {e}"))
-                return (None, None)
-
-        # 2. Пробуем openpyxl напрямую
-        try:
-            import openpyxl
-            wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
-            ws = wb.active
-            if ws is None:
-                self.stderr.write(self.style.ERROR("Нет активного листа"))
-                return (None, None)
-            rows = [list(cell if cell is not None else "" for cell in row) for row in ws.iter_rows(values_only=True)]
-            return (rows, wb)
-        except Exception as e:
-            err_msg = str(e).lower()
-            if "zip" in err_msg or "not a zip" in err_msg:
-                pass
-            else:
-                self.stderr.write(self.style.ERROR(f"Ошибка openpyxl: {e}"))
-                return (None, None)
-
-        # 3. Пробуем xlrd (для .xls)
+        # 1. Пробуем xlrd (для .xls)
         try:
             import xlrd
             wb = xlrd.open_workbook(file_path)
@@ -180,7 +128,7 @@ class Command(BaseCommand):
         except Exception:
             pass  # не .xls — пробуем CSV
 
-        # 4. Пробуем как CSV/TSV (только если файл похож на текст)
+        # 2. Пробуем как CSV/TSV (только если файл похож на текст)
         try:
             with open(file_path, "rb") as f:
                 sample = f.read(512)
@@ -212,7 +160,7 @@ class Command(BaseCommand):
             except Exception:
                 pass
 
-        # 5. Пробуем извлечь текст из бинарного дампа 1С (формат L\x00)
+        # 3. Пробуем извлечь текст из бинарного дампа 1С (формат L\x00)
         try:
             with open(file_path, "rb") as f:
                 head = f.read(8)
@@ -247,85 +195,24 @@ class Command(BaseCommand):
         )
         return (None, None)
 
-    def handle(self, *args, **options):
-        file_path = options["file"]
-        company_id = options["company"].strip()
-        branch_id = (options["branch"] or "").strip() or None
-        header_row = options["header_row"]
-        dry_run = options["dry_run"]
-        skip_duplicates = options["skip_duplicates"]
-        default_qty = Decimal(str(options.get("default_qty", 50)))
-
-        rows, wb_to_close = self._load_excel_rows(file_path)
-        if rows is None:
-            return
-
+    def _rows(self, file_path):
         try:
-            if wb_to_close:
-                wb_to_close.close()
-        except Exception:
+            return iter_file_rows(file_path)
+        except ProductImportError:
             pass
+        rows, _ = self._load_excel_rows(file_path)
+        return rows
 
-        if not rows:
-            self.stderr.write(self.style.ERROR("Файл пустой"))
-            return
-
-        headers = rows[header_row]
-        data_rows = rows[header_row + 1 :]
-
-        barcode_col = _col_index(
-            headers,
-            ["barcode", "штрих", "штрихкод", "штрих-код", "ean", "barcode"],
-            options.get("barcode_col"),
-        )
-        name_col = _col_index(
-            headers,
-            ["name", "название", "наименование", "товар"],
-            options.get("name_col"),
-        )
-        article_col = _col_index(
-            headers,
-            ["article", "артикул", "код"],
-            options.get("article_col"),
-        )
-        price_col = _col_index(
-            headers,
-            ["price", "цена", "цена продажи"],
-            options.get("price_col"),
-        )
-        purchase_price_col = _col_index(
-            headers,
-            ["purchase_price", "закупка", "цена закупки", "себестоимость"],
-            options.get("purchase_price_col"),
-        )
-        quantity_col = _col_index(
-            headers,
-            ["quantity", "количество", "остаток", "qty"],
-            options.get("quantity_col"),
-        )
-        unit_col = _col_index(
-            headers,
-            ["unit", "единица", "ед. изм", "ед"],
-            options.get("unit_col"),
+    def _progress(self, stats):
+        self.stdout.write(
+            f"  Строк: {stats.rows}, создано: {stats.created}, обновлено: {stats.updated}, "
+            f"{stats.rows_per_second} строк/с"
         )
 
-        if barcode_col is None:
-            self.stderr.write(
-                self.style.ERROR(
-                    "Не найдена колонка штрихкода. Укажите --barcode-col <индекс> (0-based)."
-                )
-            )
-            self.stdout.write("Заголовки (1-я строка): " + str(headers[:10]))
-            if len(rows) > header_row + 1:
-                sample = rows[header_row + 1]
-                if isinstance(sample, (list, tuple)):
-                    self.stdout.write("Пример данных (2-я строка): " + str(list(sample)[:10]))
-            self.stdout.write(
-                "Пример: --barcode-col 0 --name-col 1 --article-col 2 --price-col 3"
-            )
-            return
-
-        self.stdout.write(f"Колонки: barcode={barcode_col}, name={name_col}, article={article_col}, price={price_col}")
+    def handle(self, *args, **options):
+        file_path = options["file"]
+        company_id = options["company"].strip()
+        branch_id = (options["branch"] or "").strip() or None
 
         try:
             company = Company.objects.get(id=company_id)
@@ -340,73 +227,47 @@ class Command(BaseCommand):
             except Branch.DoesNotExist:
                 self.stderr.write(self.style.WARNING(f"Филиал не найден: {branch_id}, импорт без филиала"))
 
-        existing_barcodes = set(
-            Product.objects.filter(company=company).exclude(barcode__in=(None, "")).values_list("barcode", flat=True)
-        )
-
-        created = 0
-        skipped_no_barcode = 0
-        skipped_duplicate = 0
-        errors = []
-
-        for row_idx, row in enumerate(data_rows):
-            row_num = header_row + 2 + row_idx
-            barcode = _val(row, barcode_col)
-            if not barcode:
-                skipped_no_barcode += 1
-                continue
-
-            barcode = str(barcode).strip()
-            if skip_duplicates and barcode in existing_barcodes:
-                skipped_duplicate += 1
-                continue
-
-            name = _val(row, name_col) if name_col is not None else barcode
-            if not name:
-                name = f"Товар {barcode}"
-
-            article = _val(row, article_col) if article_col is not None else ""
-            price = _decimal_val(row, price_col) if price_col is not None else Decimal("0")
-            purchase_price = _decimal_val(row, purchase_price_col) if purchase_price_col is not None else price
-            quantity = default_qty
-            unit = _val(row, unit_col) if unit_col is not None else "шт."
-            if not unit:
-                unit = "шт."
-
-            if dry_run:
-                self.stdout.write(f"  [dry-run] {barcode} | {name[:40]} | {price}")
-                created += 1
-                continue
+        rows = self._rows(file_path)
+        if rows is None:
+            return
 
-            try:
-                with transaction.atomic():
-                    Product.objects.create(
-                        company=company,
-                        branch=branch,
-                        name=name[:255],
-                        barcode=barcode,
-                        article=article[:64] if article else "",
-                        price=price,
-                        purchase_price=purchase_price,
-                        markup_percent=Decimal("0") if purchase_price == 0 else ((price - purchase_price) / purchase_price * 100).quantize(Decimal("0.01")),
-                        quantity=quantity,
-                        unit=unit[:32] if unit else "шт.",
-                        kind=Product.Kind.PRODUCT,
-                    )
-                created += 1
-                existing_barcodes.add(barcode)
-                if created % 100 == 0:
-                    self.stdout.write(f"  Импортировано: {created}")
-            except Exception as e:
-                errors.append((row_num, barcode, str(e)))
+        columns = {
+            name: options.get(f"{name}_col")
+            for name in ("barcode", "name", "article", "price", "purchase_price", "quantity", "unit")
+        }
+        importer = ProductImporter(
+            company,
+            branch=branch,
+            columns={k: v for k, v in columns.items() if v is not None},
+            header_row=options["header_row"],
+            update_existing=not options["skip_duplicates"],
+            default_qty=Decimal(str(options.get("default_qty", 50))),
+            chunk_size=options["chunk_size"],
+            dry_run=options["dry_run"],
+            progress=self._progress,
+        )
+        try:
+            stats = importer.run(rows)
+        except ProductImportError as e:
+            self.stderr.write(self.style.ERROR(str(e)))
+            self.stdout.write("Пример: --barcode-col 0 --name-col 1 --article-col 2 --price-col 3")
+            return
 
-        self.stdout.write(self.style.SUCCESS(f"\nИмпорт завершён."))
-        self.stdout.write(f"  Создано: {created}")
-        self.stdout.write(f"  Пропущено (нет штрихкода): {skipped_no_barcode}")
-        self.stdout.write(f"  Пропущено (дубликат): {skipped_duplicate}")
-        if errors:
-            self.stderr.write(self.style.WARNING(f"  Ошибок: {len(errors)}"))
-            for rn, bc, err in errors[:10]:
+        cols = importer.cols
+        self.stdout.write(
+            f"Колонки: barcode={cols['barcode']}, name={cols['name']}, "
+            f"article={cols['article']}, price={cols['price']}"
+        )
+        prefix = "[dry-run] " if options["dry_run"] else ""
+        self.stdout.write(self.style.SUCCESS(f"\n{prefix}Импорт завершён."))
+        self.stdout.write(f"  Строк: {stats.rows} за {stats.elapsed:.1f} с ({stats.rows_per_second} строк/с)")
+        self.stdout.write(f"  Создано: {stats.created}")
+        self.stdout.write(f"  Обновлено: {stats.updated}")
+        self.stdout.write(f"  Пропущено (нет штрихкода): {stats.skipped_no_barcode}")
+        self.stdout.write(f"  Пропущено (дубликат): {stats.skipped_duplicate}")
+        if stats.error_count:
+            self.stderr.write(self.style.WARNING(f"  Ошибок: {stats.error_count}"))
+            for rn, bc, err in stats.errors[:10]:
                 self.stderr.write(f"    Строка {rn}, {bc}: {err}")
-            if len(errors) > 10:
-                self.stderr.write(f"    ... и ещё {len(errors) - 10}")
+            if stats.error_count > 10:
+                self.stderr.write(f"    ... и ещё {stats.error_count - 10}")
@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.main.services import agent_stock
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild agent on-hand balances (AgentProductBalance) from transfers, acceptances, "
+        "accepted returns and sale allocations. Run once after deploying the table and after "
+        "bulk imports or queryset.update() on source rows. With --verify only compares and "
+        "exits with an error when stored balances differ."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--company", default="", help="Filter by company UUID (optional).")
+        parser.add_argument("--verify", action="store_true", help="Compare only, do not rewrite.")
+
+    def handle(self, *args, **opts):
+        company_id = opts["company"] or None
+
+        if opts["verify"]:
+            diffs = agent_stock.verify(company_id)
+            for key, stored, expected in diffs[:50]:
+                self.stdout.write(f"{key}: stored={stored} expected={expected}")
+            if diffs:
+                raise CommandError(f"{len(diffs)} agent balances differ")
+            self.stdout.write(self.style.SUCCESS("Agent balances are consistent"))
+            return
+
+        rows = agent_stock.rebuild(company_id)
+        self.stdout.write(self.style.SUCCESS(f"Agent balances rebuilt: rows={rows}"))
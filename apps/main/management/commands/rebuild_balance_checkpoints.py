@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from apps.main.services.balance_checkpoints import CLIENT_LEDGER
+from apps.warehouse.services_checkpoints import COUNTERPARTY_LEDGER
+
+LEDGERS = {"clients": CLIENT_LEDGER, "counterparties": COUNTERPARTY_LEDGER}
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild monthly balance checkpoints used by client and counterparty reconciliation "
+        "from raw sales, deals, installments and posted (money) documents. Safe to re-run: "
+        "checkpoints of the selected scope are replaced. Use after bulk imports or "
+        "queryset.update() on source rows, which bypass incremental maintenance. With --verify "
+        "only compares stored checkpoints and exits with an error when they differ."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--company", default="", help="Filter by company UUID (optional).")
+        parser.add_argument(
+            "--only", choices=sorted(LEDGERS), default="", help="Rebuild only clients or only counterparties."
+        )
+        parser.add_argument("--until", default="", help="YYYY-MM-DD: last checkpoint month (default: current).")
+        parser.add_argument("--verify", action="store_true", help="Compare only, do not rewrite.")
+
+    def handle(self, *args, **opts):
+        until = None
+        if opts["until"]:
+            until = parse_date(opts["until"])
+            if until is None:
+                raise CommandError(f"--until: expected YYYY-MM-DD, got {opts['until']!r}")
+
+        company_id = opts["company"] or None
+        names = [opts["only"]] if opts["only"] else sorted(LEDGERS)
+
+        if opts["verify"]:
+            total = 0
+            for name in names:
+                diffs = LEDGERS[name].verify(company_id)
+                for key, month, stored, expected in diffs[:50]:
+                    self.stdout.write(f"{name} {key} {month}: stored={stored} expected={expected}")
+                total += len(diffs)
+            if total:
+                raise CommandError(f"{total} balance checkpoints differ")
+            self.stdout.write(self.style.SUCCESS("Balance checkpoints are consistent"))
+            return
+
+        for name in names:
+            rows = LEDGERS[name].rebuild(company_id, until=until)
+            self.stdout.write(f"{name}: checkpoints={rows}")
+
+        self.stdout.write(self.style.SUCCESS("Balance checkpoints rebuilt"))
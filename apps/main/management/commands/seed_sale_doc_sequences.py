@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Q
+
+from apps.main.models import Sale, SaleDocSequence
+
+
+class Command(BaseCommand):
+    help = (
+        "Create/raise SaleDocSequence counters from existing Sale.doc_number values. "
+        "Safe to re-run: a counter is never moved backwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--company",
+            default="",
+            help="Filter by company UUID (optional).",
+        )
+        parser.add_argument(
+            "--per-cashbox",
+            action="store_true",
+            help="Seed per-cashbox counters (for SALE_DOC_NUMBER_SCOPE='cashbox').",
+        )
+
+    def handle(self, *args, **opts):
+        qs = Sale.objects.filter(doc_number__isnull=False)
+        if opts["company"]:
+            qs = qs.filter(company_id=opts["company"])
+
+        if opts["per_cashbox"]:
+            # касса продажи или (для старых записей) касса смены
+            rows = {}
+            for company_id, cashbox_id, shift_cashbox_id, top in (
+                qs.filter(Q(cashbox__isnull=False) | Q(shift__cashbox__isnull=False))
+                .values_list("company_id", "cashbox_id", "shift__cashbox_id")
+                .annotate(top=Max("doc_number"))
+            ):
+                key = (company_id, cashbox_id or shift_cashbox_id)
+                rows[key] = max(rows.get(key, 0), top or 0)
+        else:
+            rows = {
+                (company_id, None): top or 0
+                for company_id, top in qs.values_list("company_id").annotate(top=Max("doc_number"))
+            }
+
+        created = raised = 0
+        for (company_id, cashbox_id), top in rows.items():
+            with transaction.atomic():
+                seq, was_created = SaleDocSequence.objects.select_for_update().get_or_create(
+                    company_id=company_id,
+                    cashbox_id=cashbox_id,
+                    defaults={"last_number": top},
+                )
+                if was_created:
+                    created += 1
+                elif seq.last_number < top:
+                    seq.last_number = top
+                    seq.save(update_fields=["last_number"])
+                    raised += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Counters created: {created}, raised: {raised}, total scopes: {len(rows)}"))
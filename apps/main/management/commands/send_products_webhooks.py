@@ -6,11 +6,19 @@ from django.core.management.base import BaseCommand
 from django.utils import timezone
 
 from apps.main.models import Product
-from apps.main.services.webhooks import send_product_webhook
+from apps.main.services.webhook_outbox import (
+    dispatch_pending,
+    enqueue_product_events,
+    get_delivery_metrics,
+    schedule_dispatch,
+)
 
 
 class Command(BaseCommand):
-    help = "Resend existing products to external webhook (SITE_WEBHOOK_URL)."
+    help = (
+        "Resend existing products to external webhook (SITE_WEBHOOK_URL). "
+        "Products go through the same outbox as live changes; by default the outbox is drained inline."
+    )
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -48,19 +56,24 @@ class Command(BaseCommand):
             "--retries",
             type=int,
             default=3,
-            help="Retries per product (default: 3).",
-        )
-        parser.add_argument(
-            "--backoff",
-            type=float,
-            default=1.5,
-            help="Backoff base for retries (default: 1.5).",
+            help="Delivery attempts per product before it is marked failed (default: 3).",
         )
         parser.add_argument(
             "--sleep",
             type=float,
             default=0.0,
-            help="Sleep seconds between requests (default: 0).",
+            help="Sleep seconds between delivery rounds (default: 0).",
+        )
+        parser.add_argument(
+            "--async",
+            action="store_true",
+            dest="run_async",
+            help="Only enqueue and let the Celery dispatcher deliver.",
+        )
+        parser.add_argument(
+            "--stats",
+            action="store_true",
+            help="Print outbox delivery metrics and exit.",
         )
         parser.add_argument(
             "--limit",
@@ -75,6 +88,11 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options):
+        if options.get("stats"):
+            for key, value in get_delivery_metrics().items():
+                self.stdout.write(f"{key}: {value}")
+            return
+
         company_raw = (options.get("company") or "").strip()
         branch_raw = (options.get("branch") or "").strip()
         product_ids_raw = (options.get("product_ids") or "").strip()
@@ -83,7 +101,7 @@ class Command(BaseCommand):
         event = str(options["event"] or "product.updated")
         timeout_s = float(options.get("timeout") or 30.0)
         retries = int(options.get("retries") or 3)
-        backoff = float(options.get("backoff") or 1.5)
+        run_async = bool(options.get("run_async"))
         sleep_s = float(options["sleep"] or 0.0)
         limit = int(options["limit"] or 0)
         updated_since_raw = (options.get("updated_since") or "").strip()
@@ -116,47 +134,50 @@ class Command(BaseCommand):
             except Exception:
                 raise SystemExit("Invalid --updated-since value. Use YYYY-MM-DD or ISO datetime.")
 
-        # Best-effort: prefetch relations used by ProductSerializer to avoid N+1.
-        qs = (
-            qs.select_related(
-                "company",
-                "branch",
-                "brand",
-                "category",
-                "client",
-                "created_by",
-                "characteristics",
-            )
-            .prefetch_related(
-                "images",
-                "packages",
-                "item_make",
-            )
-            .order_by("created_at")
-        )
-
+        qs = qs.order_by("created_at").values_list("id", "company_id")
         if limit > 0:
             qs = qs[:limit]
 
         total = 0
         started = time.time()
 
-        for product in qs.iterator(chunk_size=200):
-            send_product_webhook(
-                product,
-                event,
-                retries=retries,
-                timeout=timeout_s,
-                backoff=backoff,
-            )
-            total += 1
-
+        # ставим в outbox пачками по компании (payload сериализует диспетчер)
+        chunk = []
+        for row in qs.iterator(chunk_size=1000):
+            chunk.append(row)
+            if len(chunk) >= 1000:
+                total += self._enqueue(chunk, event)
+                chunk = []
+        if chunk:
+            total += self._enqueue(chunk, event)
+        self.stdout.write(f"Enqueued {total} products")
+
+        if run_async:
+            schedule_dispatch()
+            self.stdout.write(self.style.SUCCESS("Done. Delivery is left to the background dispatcher."))
+            return
+
+        sent = failed = 0
+        while True:
+            stats = dispatch_pending(timeout=timeout_s, max_attempts=retries, max_rows=200)
+            sent += stats["sent"]
+            failed += stats["failed"]
+            if not any(stats[k] for k in ("sent", "failed", "retried", "skipped")):
+                break
+            elapsed = max(time.time() - started, 0.001)
+            self.stdout.write(f"Sent {sent} products ({sent/elapsed:.2f}/s), failed {failed}")
             if sleep_s > 0:
                 time.sleep(sleep_s)
 
-            if total % 50 == 0:
-                elapsed = max(time.time() - started, 0.001)
-                self.stdout.write(f"Sent {total} products ({total/elapsed:.2f}/s)")
-
         elapsed = max(time.time() - started, 0.001)
-        self.stdout.write(self.style.SUCCESS(f"Done. Sent {total} products in {elapsed:.1f}s"))
+        self.stdout.write(self.style.SUCCESS(f"Done. Sent {sent} products in {elapsed:.1f}s (failed: {failed})"))
+
+    @staticmethod
+    def _enqueue(rows, event: str) -> int:
+        by_company = {}
+        for product_id, company_id in rows:
+            by_company.setdefault(company_id, []).append(product_id)
+        return sum(
+            enqueue_product_events(company_id, ids, event, schedule=False)
+            for company_id, ids in by_company.items()
+        )
@@ -5,15 +5,14 @@ from django.conf import settings
 from django.core.validators import MinValueValidator
 from decimal import Decimal, ROUND_HALF_UP
 from dateutil.relativedelta import relativedelta
-from django.db import transaction, connection
-from django.db.models import Sum, F, Q, Max, IntegerField
+from django.db import transaction
+from django.db.models import Sum, F, Q
 from mptt.models import MPTTModel, TreeForeignKey
 import uuid, secrets
 from django.core.files.base import ContentFile
+from django.core.serializers.json import DjangoJSONEncoder
 from PIL import Image
-from django.db.models.functions import Cast
 import io
-import logging
 import json
 
 from apps.users.models import Company, User, Branch
@@ -760,6 +759,10 @@ class Product(models.Model):
     created_at = models.DateTimeField("Создан", auto_now_add=True)
     updated_at = models.DateTimeField("Обновлён", auto_now=True)
 
+    # ревизия каталога весов компании (ProductCodeSequence.last_revision) на момент
+    # последнего изменения весового товара; по ней агенты весов берут изменения (apps/scale/sync.py)
+    scale_revision = models.PositiveBigIntegerField("Ревизия для весов", default=0)
+
     class Meta:
         verbose_name = "Товар"
         verbose_name_plural = "Товары"
@@ -768,6 +771,7 @@ class Product(models.Model):
             models.Index(fields=["company", "status"]),
             models.Index(fields=["company", "branch", "status"]),
             models.Index(fields=["company", "plu"]),
+            models.Index(fields=["company", "scale_revision"], name="idx_product_scale_revision"),
             # Оптимизация для сканирования по штрих-коду
             models.Index(fields=["company", "barcode"], name="idx_product_company_barcode"),
         ]
@@ -795,53 +799,75 @@ class Product(models.Model):
     def __str__(self):
         return self.name
 
-    # ---------- Postgres advisory lock ----------
-    def _pg_lock_company(self):
+    # --------- отслеживание изменений ---------
+    # поля, которые хранит POS-индекс штрихкодов (barcode_index), + код/ПЛУ для счётчиков;
+    # они же (и kind) — всё, что уходит на весы
+    _TRACKED_FIELDS = ("code", "plu", "barcode", "price", "name", "is_weight", "kind")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_state = instance._tracked_state()
+        return instance
+
+    def _tracked_state(self):
+        """Снимок _TRACKED_FIELDS (None — если что-то отложено)."""
+        if any(f not in self.__dict__ for f in self._TRACKED_FIELDS):
+            return None
+        return {f: self.__dict__[f] for f in self._TRACKED_FIELDS}
+
+    def _index_fields_changed(self, loaded) -> bool:
+        if loaded is None:
+            return True
+        return any(loaded[f] != getattr(self, f) for f in self._TRACKED_FIELDS if f != "code")
+
+    # --------- внутренние методы ---------
+    def _assign_numbers(self, update_fields, loaded):
         """
-        Защита от гонок при генерации max()+1.
-        В Postgres pg_advisory_xact_lock принимает BIGINT (int8).
+        code/ПЛУ из счётчика компании (ProductCodeSequence) — только если их надо выдать.
+        Заданные вручную числовые значения поднимают счётчик, чтобы он их не выдал повторно.
+
+        Изменился весовой товар (или перестал быть весовым) — тем же обращением к
+        счётчику берётся новая ревизия каталога весов (scale_revision). Строка
+        счётчика заблокирована до коммита, поэтому ревизии коммитятся по возрастанию
+        и агент весов, читающий «после N», ничего не пропустит.
+        Возвращает update_fields (с scale_revision, если она выдана).
         """
         if not self.company_id:
-            return
-
-        # 64-bit key (0..2^63-1)
-        key = int(str(self.company_id).replace("-", "")[:16], 16)
-        key = key & 0x7FFFFFFFFFFFFFFF  # чтобы точно влез в signed BIGINT
+            return update_fields
+        from apps.main.utils_numbers import allocate_product_counters, raise_product_counters
 
-        with connection.cursor() as cur:
-            # ЯВНО кастим к BIGINT, чтобы не улетало в numeric
-            cur.execute("SELECT pg_advisory_xact_lock(%s::bigint);", [key])
-    
-    # --------- внутренние методы ---------
-    def _auto_generate_plu(self):
-        if not self.is_weight:
-            return
-        if self.plu is not None or not self.company_id:
-            return
+        def saved(field):
+            return update_fields is None or field in update_fields
 
-        max_plu = (
-            Product.objects
-            .filter(company_id=self.company_id, plu__isnull=False)
-            .aggregate(m=Max("plu"))
-            .get("m") or 0
+        need_code = not self.code and saved("code")
+        need_plu = self.is_weight and self.plu is None and saved("plu")
+        need_revision = (self.is_weight or bool(loaded and loaded.get("is_weight"))) and (
+            need_plu or self._index_fields_changed(loaded)
         )
-        self.plu = max_plu + 1
-
-    def _auto_generate_code(self):
-        if self.code or not self.company_id:
-            return
-
-        qs = (
-            Product.objects
-            .filter(company_id=self.company_id)
-            .exclude(code__isnull=True)
-            .exclude(code__exact="")
-            .filter(code__regex=r"^\d+$")
-            .annotate(code_int=Cast("code", IntegerField()))
+        if need_code or need_plu or need_revision:
+            code, plu, revision = allocate_product_counters(
+                self.company_id, code=need_code, plu=need_plu, revision=need_revision
+            )
+            if need_code:
+                self.code = f"{code:04d}"
+            if need_plu:
+                self.plu = plu
+            if need_revision:
+                self.scale_revision = revision
+                if update_fields is not None:
+                    update_fields = set(update_fields) | {"scale_revision"}
+
+        loaded = loaded or {}
+        manual_code = (
+            int(self.code)
+            if not need_code and (self.code or "").isdigit() and self.code != loaded.get("code")
+            else None
         )
-
-        last_num = qs.aggregate(max_num=Max("code_int"))["max_num"] or 0
-        self.code = f"{last_num + 1:04d}"
+        manual_plu = self.plu if not need_plu and self.plu is not None and self.plu != loaded.get("plu") else None
+        if manual_code is not None or manual_plu is not None:
+            raise_product_counters(self.company_id, code=manual_code, plu=manual_plu)
+        return update_fields
 
     def _recalc_price(self):
         base = self.purchase_price or Decimal("0")
@@ -875,35 +901,60 @@ class Product(models.Model):
             raise ValidationError({"discount_percent": "Скидка должна быть от 0 до 100%."})
 
     def save(self, *args, **kwargs):
-        # Инвалидация кэша при изменении barcode или plu
-        old_barcode = None
-        old_plu = None
-        if self.pk:
-            try:
-                old_instance = Product.objects.get(pk=self.pk)
-                old_barcode = old_instance.barcode
-                old_plu = old_instance.plu
-            except Product.DoesNotExist:
-                pass
-        
         self._recalc_price()
+        loaded = getattr(self, "_loaded_state", None)
         with transaction.atomic():
-            self._pg_lock_company()
-            self._auto_generate_code()
-            self._auto_generate_plu()
+            update_fields = self._assign_numbers(kwargs.get("update_fields"), loaded)
+            if update_fields is not None:
+                kwargs["update_fields"] = update_fields
             super().save(*args, **kwargs)
-            
-            # Инвалидация кэша после сохранения
-            from django.core.cache import cache
-            if old_barcode and old_barcode != self.barcode:
-                cache.delete(f"product_barcode:{self.company_id}:{old_barcode}")
-            if self.barcode:
-                cache.delete(f"product_barcode:{self.company_id}:{self.barcode}")
-            if old_plu and old_plu != self.plu:
-                cache.delete(f"product_plu:{self.company_id}:{old_plu}")
-            if self.plu:
-                cache.delete(f"product_plu:{self.company_id}:{self.plu}")
-            
+
+            # POS-индекс хранит цену/название/ПЛУ — сбрасываем после коммита, если они менялись
+            if self._index_fields_changed(loaded):
+                from apps.main.barcode_index import invalidate_company_on_commit
+                invalidate_company_on_commit(self.company_id)
+        self._loaded_state = self._tracked_state()
+
+
+class ProductCodeSequence(models.Model):
+    """
+    Счётчики автокода (Product.code, "0001"), ПЛУ весовых товаров и ревизии каталога
+    весов: одна строка на компанию. Выдача блокирует только эту строку — при создании
+    товара без кода/ПЛУ и при изменении весового товара.
+    """
+    company = models.OneToOneField(Company, on_delete=models.CASCADE, related_name="product_code_sequence")
+    last_code = models.PositiveBigIntegerField(default=0)
+    last_plu = models.PositiveIntegerField(default=0)
+    last_revision = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Счётчик кодов товаров"
+        verbose_name_plural = "Счётчики кодов товаров"
+
+    def __str__(self):
+        return f"{self.company_id}: code={self.last_code}, plu={self.last_plu}, revision={self.last_revision}"
+
+
+class ScaleProductTombstone(models.Model):
+    """
+    Удалённый весовой товар: агент весов, синхронизирующийся «после ревизии N»,
+    должен стереть его ПЛУ. Строки старше ревизий всех агентов можно чистить.
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name="scale_tombstones")
+    product_id = models.UUIDField()
+    plu = models.PositiveIntegerField(null=True, blank=True)
+    revision = models.PositiveBigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Удалённый товар весов"
+        verbose_name_plural = "Удалённые товары весов"
+        indexes = [models.Index(fields=["company", "revision"])]
+
+    def __str__(self):
+        return f"{self.company_id}: {self.product_id} @ {self.revision}"
+
+
 class ProductCharacteristics(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
 
@@ -1173,6 +1224,103 @@ class ProductImage(models.Model):
         return content
 
 
+class ProductWebhookOutbox(models.Model):
+    """
+    Очередь исходящих product-вебхуков (transactional outbox).
+    Пишется в той же транзакции, что и изменение товара; отправляет фоновый
+    диспетчер (apps.main.services.webhook_outbox). На товар держим не более
+    одной pending-записи — повторные изменения в ней схлопываются.
+    Пока запись отправляется, она в статусе sending с арендой leased_until:
+    новые изменения товара заводят свежую pending-запись и не ждут HTTP.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending", "Ожидает"
+        SENDING = "sending", "Отправляется"
+        SENT = "sent", "Отправлен"
+        FAILED = "failed", "Ошибка"
+
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name="product_webhook_outbox")
+    # без FK: запись должна пережить удаление товара (product.deleted)
+    product_id = models.UUIDField(db_index=True)
+    event = models.CharField(max_length=32)
+    # сериализованный товар фиксируем только для delete; иначе берём свежий при отправке
+    payload = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True, default="")
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=timezone.now)
+    # аренда диспетчера: просроченную sending-запись подберёт следующий прогон
+    leased_until = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Вебхук товара (очередь)"
+        verbose_name_plural = "Вебхуки товаров (очередь)"
+        indexes = [
+            models.Index(fields=["status", "available_at"]),
+            models.Index(fields=["status", "sent_at"]),
+            models.Index(fields=["status", "leased_until"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=("product_id",),
+                condition=Q(status="pending"),
+                name="uq_product_webhook_outbox_pending",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.event} {self.product_id} ({self.status})"
+
+
+class ProductImportJob(models.Model):
+    """Фоновый импорт товаров из файла (Excel/CSV): apps.main.services.product_import + Celery."""
+
+    class Status(models.TextChoices):
+        PENDING = "pending", "В очереди"
+        RUNNING = "running", "Выполняется"
+        DONE = "done", "Завершён"
+        FAILED = "failed", "Ошибка"
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name="product_import_jobs")
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE, related_name="product_import_jobs", null=True, blank=True)
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name="+"
+    )
+
+    file = models.FileField(upload_to="product_imports/%Y/%m/")
+    # колонки/режим импорта: см. ProductImporter
+    options = models.JSONField(default=dict, blank=True)
+
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING, db_index=True)
+    rows_processed = models.PositiveIntegerField(default=0)
+    created_count = models.PositiveIntegerField(default=0)
+    updated_count = models.PositiveIntegerField(default=0)
+    skipped_count = models.PositiveIntegerField(default=0)
+    error_count = models.PositiveIntegerField(default=0)
+    rows_per_second = models.FloatField(default=0)
+    # первые ошибки строк: [[номер строки, штрихкод, текст], ...]
+    errors = models.JSONField(default=list, blank=True)
+    error = models.TextField(blank=True, default="")
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Импорт товаров"
+        verbose_name_plural = "Импорты товаров"
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"{self.file.name} ({self.status})"
+
+
 class ItemMake(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     company = models.ForeignKey(Company, on_delete=models.PROTECT, related_name="item_makes", verbose_name="Компания")
@@ -1306,9 +1454,17 @@ class Cart(models.Model):
         verbose_name="Скидка на чек, %",
     )
 
+    # Несокруглённые суммы строк (база и строковые скидки) — для инкрементального пересчёта.
+    # Меняются дельтами из CartItem.save()/delete(); recalc() пересобирает их с нуля.
+    # NULL — суммы ещё не собраны (корзины до появления полей): refresh_totals() делает recalc().
+    lines_subtotal_raw = models.DecimalField(max_digits=20, decimal_places=6, null=True, blank=True, default=None)
+    lines_discount_raw = models.DecimalField(max_digits=20, decimal_places=6, null=True, blank=True, default=None)
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    TOTALS_FIELDS = ["subtotal", "discount_total", "tax_total", "total", "updated_at"]
+
     class Meta:
         indexes = [
             models.Index(fields=["company", "status"]),
@@ -1366,6 +1522,13 @@ class Cart(models.Model):
         update_fields = kwargs.get("update_fields")
         touched = set()
 
+        # новая корзина пуста — суммы строк известны сразу
+        if self._state.adding:
+            if self.lines_subtotal_raw is None:
+                self.lines_subtotal_raw = Decimal("0")
+            if self.lines_discount_raw is None:
+                self.lines_discount_raw = Decimal("0")
+
         # shift есть → всё берём из смены
         if self.shift_id:
             if self.company_id != self.shift.company_id:
@@ -1398,25 +1561,9 @@ class Cart(models.Model):
         self.full_clean()
         return super().save(*args, **kwargs)
 
-    def recalc(self):
-        subtotal = Decimal("0")
-        line_discount_total = Decimal("0")
-
-        for it in self.items.select_related("product"):
-            qty = Decimal(it.quantity or 0)
-            unit = Decimal(it.unit_price or 0)
-            line_disc = Decimal(getattr(it, "line_discount", None) or 0)
-            # Фактическая сумма: (unit_price - line_discount/qty) * qty = unit_price*qty - line_discount
-            line_actual = unit * qty - line_disc
-            base_unit = getattr(it.product, "price", None) or unit
-            line_base = base_unit * qty
-            subtotal += max(line_base, line_actual)
-            diff = line_base - line_actual
-            if diff > 0:
-                line_discount_total += diff
-
-        subtotal = _money(subtotal)
-        line_discount_total = _money(line_discount_total)
+    def _apply_totals(self, lines_subtotal: Decimal, lines_discount: Decimal) -> None:
+        subtotal = _money(lines_subtotal)
+        line_discount_total = _money(lines_discount)
 
         # Скидка на чек: либо % от subtotal, либо фиксированная сумма
         order_percent = getattr(self, "order_discount_percent", None)
@@ -1436,7 +1583,48 @@ class Cart(models.Model):
         self.tax_total = _money(tax_total)
         self.total = _money(self.subtotal - self.discount_total + self.tax_total)
 
-        self.save(update_fields=["subtotal", "discount_total", "tax_total", "total", "updated_at"])
+    def recalc(self):
+        """
+        Полный пересчёт по всем строкам. Нужен как сверка (checkout) —
+        при правке одной строки итоги двигаются дельтой, см. apply_line_delta().
+        """
+        lines_subtotal = Decimal("0")
+        lines_discount = Decimal("0")
+
+        for it in self.items.select_related("product"):
+            line_sub, line_disc = it.totals_contribution()
+            lines_subtotal += line_sub
+            lines_discount += line_disc
+
+        self.lines_subtotal_raw = lines_subtotal
+        self.lines_discount_raw = lines_discount
+        self._apply_totals(lines_subtotal, lines_discount)
+        self.save(update_fields=self.TOTALS_FIELDS + ["lines_subtotal_raw", "lines_discount_raw"])
+
+    def refresh_totals(self):
+        """
+        O(1): перечитывает накопленные суммы строк и пересчитывает итоги
+        (в т.ч. скидку на чек). Строки корзины не читаются — кроме корзины,
+        чьи суммы ещё не собраны (NULL): её один раз пересчитывает recalc().
+        """
+        self.refresh_from_db(fields=["lines_subtotal_raw", "lines_discount_raw"])
+        if self.lines_subtotal_raw is None or self.lines_discount_raw is None:
+            self.recalc()
+            return
+        self._apply_totals(self.lines_subtotal_raw, self.lines_discount_raw)
+        self.save(update_fields=self.TOTALS_FIELDS)
+
+    def apply_line_delta(self, subtotal_delta: Decimal, discount_delta: Decimal):
+        """
+        Сдвигает суммы строк на вклад одной строки (новый минус старый).
+        UPDATE через F(), поэтому не зависит от того, насколько свеж self.
+        """
+        if subtotal_delta or discount_delta:
+            Cart.objects.filter(pk=self.pk).update(
+                lines_subtotal_raw=F("lines_subtotal_raw") + subtotal_delta,
+                lines_discount_raw=F("lines_discount_raw") + discount_delta,
+            )
+        self.refresh_totals()
 
 
 class CartItem(models.Model):
@@ -1451,10 +1639,47 @@ class CartItem(models.Model):
     unit_price = models.DecimalField(max_digits=12, decimal_places=2)
     # Скидка на строку (хранится отдельно от цены — можно менять цену и скидку независимо)
     line_discount = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal("0.00"))
+    # Базовая цена товара на момент добавления в корзину: от неё считается скидка строки.
+    # Снимок, чтобы смена Product.price не расходилась с накопленными итогами корзины.
+    base_unit_price = models.DecimalField(max_digits=10, decimal_places=3, null=True, blank=True, editable=False)
 
     class Meta:
         unique_together = (("cart", "product"),)
 
+    _TOTALS_STATE_FIELDS = ("quantity", "unit_price", "line_discount", "product_id", "base_unit_price")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_totals_state = instance._totals_state()
+        return instance
+
+    def _totals_state(self):
+        """Поля, от которых зависит вклад строки в итоги (None — если что-то отложено)."""
+        if any(f not in self.__dict__ for f in self._TOTALS_STATE_FIELDS):
+            return None
+        return tuple(self.__dict__[f] for f in self._TOTALS_STATE_FIELDS)
+
+    def totals_contribution(self, state=None) -> tuple[Decimal, Decimal]:
+        """
+        Вклад строки в (subtotal, строковые скидки), без округления.
+        state — снимок _totals_state(); по умолчанию текущие значения.
+        """
+        qty, unit, line_disc, product_id, base_unit = state or (
+            self.quantity, self.unit_price, self.line_discount, self.product_id, self.base_unit_price
+        )
+        qty = Decimal(qty or 0)
+        unit = Decimal(unit or 0)
+        line_disc = Decimal(line_disc or 0)
+        # Фактическая сумма: (unit_price - line_discount/qty) * qty = unit_price*qty - line_discount
+        line_actual = unit * qty - line_disc
+        if base_unit is None and product_id:
+            # старые строки без снимка — берём текущую цену товара
+            base_unit = getattr(self.product, "price", None)
+        base_unit = Decimal(base_unit or 0) or unit
+        line_base = base_unit * qty
+        return max(line_base, line_actual), max(line_base - line_actual, Decimal("0"))
+
     def clean(self):
         if self.cart_id and self.company_id and self.cart.company_id != self.company_id:
             raise ValidationError({"company": "Компания позиции должна совпадать с компанией корзины."})
@@ -1495,8 +1720,48 @@ class CartItem(models.Model):
 
         if not skip_full_clean:
             self.full_clean()
+
+        old_state = None if self._state.adding else getattr(self, "_loaded_totals_state", None)
+        known_old = self._state.adding or old_state is not None
+        self._snapshot_base_price(old_state, kwargs)
         super().save(*args, **kwargs)
-        self.cart.recalc()
+        self._apply_totals_change(old_state, known_old)
+
+    def delete(self, *args, **kwargs):
+        old_state = getattr(self, "_loaded_totals_state", None)
+        cart = self.cart
+        result = super().delete(*args, **kwargs)
+        if old_state is None:
+            cart.recalc()
+        else:
+            old_sub, old_disc = self.totals_contribution(old_state)
+            cart.apply_line_delta(-old_sub, -old_disc)
+        return result
+
+    def _snapshot_base_price(self, old_state, save_kwargs):
+        """Фиксирует base_unit_price при добавлении товара в строку (или смене товара)."""
+        if self.product_id:
+            same_product = old_state is None or old_state[3] == self.product_id
+            if self.base_unit_price is not None and same_product:
+                return
+            self.base_unit_price = self.product.price
+        elif self.base_unit_price is None:
+            return
+        else:
+            self.base_unit_price = None
+        update_fields = save_kwargs.get("update_fields")
+        if update_fields is not None and "base_unit_price" not in update_fields:
+            save_kwargs["update_fields"] = [*update_fields, "base_unit_price"]
+
+    def _apply_totals_change(self, old_state, known_old: bool):
+        if not known_old:
+            # строку загрузили не целиком — дельту не посчитать, пересчитываем всю корзину
+            self.cart.recalc()
+        else:
+            new_sub, new_disc = self.totals_contribution()
+            old_sub, old_disc = self.totals_contribution(old_state) if old_state else (Decimal("0"), Decimal("0"))
+            self.cart.apply_line_delta(new_sub - old_sub, new_disc - old_disc)
+        self._loaded_totals_state = self._totals_state()
 
 
 class Sale(models.Model):
@@ -1566,6 +1831,20 @@ class Sale(models.Model):
             models.Index(fields=["cashbox", "created_at"]),
         ]
 
+    _ROLLUP_STATE_FIELDS = ("company_id", "status", "paid_at", "branch_id", "user_id", "payment_method", "total")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_rollup_state = instance._rollup_state()
+        return instance
+
+    def _rollup_state(self):
+        """Поля, от которых зависит вклад продажи в SaleRollup (None — если что-то отложено)."""
+        if any(f not in self.__dict__ for f in self._ROLLUP_STATE_FIELDS):
+            return None
+        return tuple(self.__dict__[f] for f in self._ROLLUP_STATE_FIELDS)
+
     def clean(self):
         super().clean()
 
@@ -1635,7 +1914,19 @@ class Sale(models.Model):
             kwargs["update_fields"] = list(set(update_fields) | touched)
 
         self.full_clean()
-        return super().save(*args, **kwargs)
+
+        from apps.main.services import sales_rollup
+
+        previous = getattr(self, "_loaded_rollup_state", None)
+        if previous is None and not self._state.adding:
+            previous = sales_rollup.load_state(self.pk)
+        with transaction.atomic():
+            result = super().save(*args, **kwargs)
+            current = self._rollup_state() or sales_rollup.load_state(self.pk)
+            # агрегаты аналитики: переносим вклад продажи (оплата, возврат, смена суммы)
+            sales_rollup.apply_sale_change(self.pk, previous, current)
+        self._loaded_rollup_state = current
+        return result
 
     @property
     def change(self) -> Decimal:
@@ -1674,6 +1965,41 @@ class Sale(models.Model):
         self.save(update_fields=["status", "paid_at", "payment_method", "cash_received"])
 
 
+class SaleDocSequence(models.Model):
+    """
+    Счётчик сквозных номеров чеков (Sale.doc_number): одна строка на компанию
+    (или на кассу, если SALE_DOC_NUMBER_SCOPE="cashbox").
+    Выдача номера блокирует только эту строку, а не все продажи компании.
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name="sale_doc_sequences")
+    cashbox = models.ForeignKey(
+        "construction.Cashbox",
+        on_delete=models.CASCADE,
+        null=True, blank=True,
+        related_name="sale_doc_sequences",
+    )
+    last_number = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Счётчик номеров чеков"
+        verbose_name_plural = "Счётчики номеров чеков"
+        constraints = [
+            models.UniqueConstraint(
+                fields=("company", "cashbox"),
+                condition=Q(cashbox__isnull=False),
+                name="uq_sale_doc_seq_company_cashbox",
+            ),
+            models.UniqueConstraint(
+                fields=("company",),
+                condition=Q(cashbox__isnull=True),
+                name="uq_sale_doc_seq_company",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.company_id}/{self.cashbox_id or '*'}: {self.last_number}"
+
+
 class SaleItem(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
 
@@ -1788,6 +2114,86 @@ class SaleItem(models.Model):
     def line_profit(self) -> Decimal:
         return (self.line_total - self.line_cogs).quantize(Decimal("0.01"))
     
+class SaleRollup(models.Model):
+    """
+    Предагрегат оплаченных продаж: компания × филиал × день × час × кассир × способ оплаты.
+    Ведётся инкрементально (services/sales_rollup.py), день/час — в TIME_ZONE проекта.
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name="sale_rollups")
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE, related_name="sale_rollups", null=True, blank=True)
+    day = models.DateField()
+    hour = models.PositiveSmallIntegerField()
+    # без FK-ограничения: удаление пользователя не должно трогать историю
+    cashier = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True, blank=True,
+        related_name="+",
+    )
+    payment_method = models.CharField(max_length=16)
+
+    sales_count = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal("0.00"))
+    cogs = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal("0.00"))
+
+    class Meta:
+        verbose_name = "Продажи (агрегат)"
+        verbose_name_plural = "Продажи (агрегаты)"
+        constraints = [
+            models.UniqueConstraint(
+                fields=("company", "branch", "day", "hour", "cashier", "payment_method"),
+                name="uq_sale_rollup_key",
+                nulls_distinct=False,
+            ),
+        ]
+        indexes = [models.Index(fields=["company", "day"])]
+
+
+class SaleProductRollup(models.Model):
+    """Предагрегат проданных позиций: компания × филиал × день × кассир × способ оплаты × товар."""
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name="sale_product_rollups")
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE, related_name="sale_product_rollups", null=True, blank=True)
+    day = models.DateField()
+    cashier = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True, blank=True,
+        related_name="+",
+    )
+    payment_method = models.CharField(max_length=16)
+    product_id = models.UUIDField(null=True, blank=True)
+    name = models.CharField(max_length=255)
+
+    quantity = models.DecimalField(max_digits=18, decimal_places=3, default=Decimal("0.000"))
+    revenue = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal("0.00"))
+    cogs = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal("0.00"))
+
+    class Meta:
+        verbose_name = "Продажи по товарам (агрегат)"
+        verbose_name_plural = "Продажи по товарам (агрегаты)"
+        constraints = [
+            models.UniqueConstraint(
+                fields=("company", "branch", "day", "cashier", "payment_method", "product_id", "name"),
+                name="uq_sale_product_rollup_key",
+                nulls_distinct=False,
+            ),
+        ]
+        indexes = [models.Index(fields=["company", "day"])]
+
+
+class SaleRollupCoverage(models.Model):
+    """С какого дня агрегаты компании полные (заполнены backfill_sale_rollups). Раньше — читаем сырые продажи."""
+    company = models.OneToOneField(Company, on_delete=models.CASCADE, related_name="sale_rollup_coverage")
+    since = models.DateField()
+    rebuilt_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Покрытие агрегатов продаж"
+        verbose_name_plural = "Покрытие агрегатов продаж"
+
+
 class MobileScannerToken(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, verbose_name="ID")
     company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name="mobile_tokens", verbose_name="Компания")
@@ -2449,6 +2855,30 @@ class DealInstallment(models.Model):
         return (self.amount - (self.paid_amount or Decimal("0"))).quantize(Decimal("0.01"))
 
 
+class ClientBalanceCheckpoint(models.Model):
+    """
+    Сальдо клиента на начало месяца (period_start — первое число, полночь по TIME_ZONE):
+    суммы всех продаж, сделок и оплат рассрочки раньше этой даты. Акт сверки берёт
+    ближайший чекпоинт + обороты с него до начала периода (services/balance_checkpoints.py).
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name="client_balance_checkpoints")
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name="balance_checkpoints")
+    period_start = models.DateField()
+
+    sales_debit = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal("0.00"))
+    deals_debit = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal("0.00"))
+    deals_credit = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal("0.00"))
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Сальдо клиента (чекпоинт)"
+        verbose_name_plural = "Сальдо клиентов (чекпоинты)"
+        constraints = [
+            models.UniqueConstraint(fields=("company", "client", "period_start"), name="uq_client_balance_checkpoint"),
+        ]
+
+
 class DealPayment(models.Model):
     class Kind(models.TextChoices):
         PAY = "pay", "Оплата"
@@ -2974,6 +3404,17 @@ class ManufactureSubreal(models.Model):
         prod_name = getattr(self.product, "name", None) or str(self.product_id)
         return f"{agent_name} · {prod_name} · {self.qty_transferred}"
 
+    # ключ остатка агента (services/agent_stock.KEY_FIELDS) на момент загрузки:
+    # PATCH может перевесить передачу на другого агента/товар/филиал
+    _STOCK_KEY_FIELDS = ("company_id", "branch_id", "agent_id", "product_id")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if all(f in instance.__dict__ for f in cls._STOCK_KEY_FIELDS):
+            instance._loaded_stock_key = tuple(instance.__dict__[f] for f in cls._STOCK_KEY_FIELDS)
+        return instance
+
     @property
     def qty_remaining(self) -> int:
         return max((self.qty_transferred or 0) - (self.qty_accepted or 0), 0)
@@ -3128,6 +3569,12 @@ class Acceptance(models.Model):
         super().save(*args, **kwargs)
         if creating:
             ManufactureSubreal.objects.filter(pk=self.subreal_id).update(qty_accepted=F("qty_accepted") + self.qty)
+            from apps.main.cache_utils import CACHE_DOMAIN_PRODUCTION, bump_cache_generation_on_commit
+            from apps.main.services import agent_stock
+
+            agent_stock.refresh_subreals([self.subreal_id])
+            # update() мимо post_save передачи — кэш остатков агента сбрасываем сами
+            bump_cache_generation_on_commit(self.company_id, CACHE_DOMAIN_PRODUCTION)
             self.subreal.refresh_from_db(fields=["qty_accepted", "qty_transferred", "status"])
             self.subreal.try_close()
 
@@ -3239,27 +3686,12 @@ class ReturnFromAgent(models.Model):
             )
         product = locked_sub.product
         type(product).objects.select_for_update().filter(pk=product.pk).update(quantity=F("quantity") + self.qty)
-        prod_model = type(product)
-        prod_id = product.pk
-
-        def _send_webhook():
-            from apps.main.services.webhooks import send_product_webhook
-
-            try:
-                prod = prod_model.objects.get(pk=prod_id)
-                send_product_webhook(prod, "product.updated")
-            except Exception:
-                logging.getLogger("crm.webhooks").error(
-                    "Failed to send product.updated webhook after return accept. product_id=%s",
-                    prod_id,
-                    exc_info=True,
-                )
-
-        try:
-            transaction.on_commit(_send_webhook)
-        except Exception:
-            _send_webhook()
+        # вебхук уйдёт из outbox после коммита (фоновый диспетчер)
+        from apps.main.services.webhook_outbox import enqueue_product_events
+        enqueue_product_events(product.company_id, [product.pk], "product.updated")
         ManufactureSubreal.objects.filter(pk=locked_sub.pk).update(qty_returned=F("qty_returned") + self.qty)
+        from apps.main.cache_utils import CACHE_DOMAIN_PRODUCTION, bump_cache_generation_on_commit
+        bump_cache_generation_on_commit(self.company_id, CACHE_DOMAIN_PRODUCTION)
         self.status = self.Status.ACCEPTED
         self.accepted_by = by_user
         self.accepted_at = timezone.now()
@@ -3303,6 +3735,36 @@ class AgentSaleAllocation(models.Model):
         ]
 
 
+class AgentProductBalance(models.Model):
+    """
+    Остаток товара «на руках» у агента: сумма по передачам ключа
+    max(принято − возвращено − продано, 0) и дата последнего движения.
+    Пересчитывается в транзакции передачи/приёма/возврата/продажи
+    (services/agent_stock.py); списки и аналитика читают его напрямую.
+    """
+    company = models.ForeignKey("users.Company", on_delete=models.CASCADE, related_name="agent_product_balances")
+    branch = models.ForeignKey(
+        "users.Branch", on_delete=models.CASCADE, null=True, blank=True, related_name="agent_product_balances"
+    )
+    agent = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="agent_product_balances")
+    product = models.ForeignKey("main.Product", on_delete=models.CASCADE, related_name="agent_balances")
+
+    qty_on_hand = models.IntegerField(default=0)
+    last_movement_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Остаток у агента"
+        verbose_name_plural = "Остатки у агентов"
+        constraints = [
+            models.UniqueConstraint(
+                fields=("company", "branch", "agent", "product"),
+                name="uq_agent_product_balance",
+                nulls_distinct=False,
+            ),
+        ]
+
+
 class AgentRequestCart(models.Model):
     """
     Заявка агента на получение товара.
@@ -3384,25 +3846,33 @@ class AgentRequestCart(models.Model):
         """
         Пересчитать подарки для всех позиций.
         Вызывается при submit() — фиксируем gift_quantity и total_quantity.
+        Подарки считаются в памяти по индексу правил компании, строки пишутся одним bulk_update.
         """
-        for it in self.items.select_related("product"):
+        from apps.main.services.promo_index import gift_quantities
+
+        items = list(self.items.select_related("product"))
+        gifts = gift_quantities(
+            ((it.pk, it.product, it.quantity_requested) for it in items),
+            company=self.company_id,
+            branch=self.branch_id,
+        )
+        now = timezone.now()
+        for it in items:
             base_qty = int(it.quantity_requested or 0)
-            from apps.utils import compute_gift_qty
-            gift_qty = compute_gift_qty(
-                product=it.product,
-                qty=base_qty,
-                company=self.company,
-                branch=self.branch,
-            )
-            it.gift_quantity = gift_qty
-            it.total_quantity = base_qty + gift_qty
+            it.gift_quantity = gifts[it.pk]
+            it.total_quantity = base_qty + it.gift_quantity
             # price_snapshot хранится с 2 знаками после запятой (денежный формат),
             # а Product.price может быть с 3 знаками -> округляем.
             if not it.price_snapshot:
                 it.price_snapshot = _money(it.product.price if it.product else Decimal("0"))
             else:
                 it.price_snapshot = _money(it.price_snapshot)
-            it.save(update_fields=["gift_quantity", "total_quantity", "price_snapshot", "updated_at"])
+            it.updated_at = now
+        if items:
+            AgentRequestItem.objects.bulk_update(
+                items, ["gift_quantity", "total_quantity", "price_snapshot", "updated_at"]
+            )
+        return items
 
     @transaction.atomic
     def submit(self):
@@ -3432,9 +3902,9 @@ class AgentRequestCart(models.Model):
             raise ValidationError("Можно одобрить только заявку в статусе 'submitted'.")
 
         # пересчёт подарков, чтобы qty/подарок/итого были зафиксированы
-        self._recalc_gifts_for_items()
+        items = self._recalc_gifts_for_items()
 
-        for it in self.items.select_related("product"):
+        for it in items:
             prod = it.product
             need_qty = int(it.total_quantity or 0)
             if need_qty <= 0:
@@ -3457,26 +3927,9 @@ class AgentRequestCart(models.Model):
             # списываем со склада
             locked_qs.update(quantity=F("quantity") - need_qty)
 
-            prod_model = type(prod)
-            prod_id = prod.pk
-
-            def _send_webhook():
-                from apps.main.services.webhooks import send_product_webhook
-
-                try:
-                    p = prod_model.objects.get(pk=prod_id)
-                    send_product_webhook(p, "product.updated")
-                except Exception:
-                    logging.getLogger("crm.webhooks").error(
-                        "Failed to send product.updated webhook after agent request approve. product_id=%s",
-                        prod_id,
-                        exc_info=True,
-                    )
-
-            try:
-                transaction.on_commit(_send_webhook)
-            except Exception:
-                _send_webhook()
+            # вебхук уйдёт из outbox после коммита (фоновый диспетчер)
+            from apps.main.services.webhook_outbox import enqueue_product_events
+            enqueue_product_events(prod.company_id, [prod.pk], "product.updated")
 
             # создаём передачу агенту
             sub = ManufactureSubreal.objects.create(
@@ -0,0 +1,244 @@
+"""
+Общий PDF-рендер: шрифты, ответ-файл и акт сверки (клиенты — pos_views,
+контрагенты склада — apps/warehouse/views_reconciliation.py).
+
+Раньше каждый акт собирал все строки в список dict'ов, сортировал, считал итоги
+повторным разбором строк и рисовал canvas в BytesIO. Теперь:
+  - строки приходят генератором (курсоры .iterator() + heapq.merge по дате),
+    итоги копятся Decimal'ами в том же проходе, что и отрисовка;
+  - страницы сжимаются, PDF пишется в SpooledTemporaryFile (в памяти до
+    PDF_SPOOL_MAX_MEMORY байт, дальше — на диск) и отдаётся FileResponse
+    (StreamingHttpResponse) кусками.
+
+Настоящей постраничной отдачи reportlab не умеет: таблица xref пишется в конце,
+поэтому файл сначала целиком дорисовывается, а потом стримится.
+"""
+
+from __future__ import annotations
+
+import heapq
+import os
+import tempfile
+from datetime import timedelta
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+from django.http import FileResponse
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+FONTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+FONTS = {"DejaVu": "DejaVuSans.ttf", "DejaVu-Bold": "DejaVuSans-Bold.ttf"}
+
+ZERO = Decimal("0.00")
+AMOUNT_KEYS = ("a_debit", "a_credit", "b_debit", "b_credit")
+
+
+def register_fonts_if_needed() -> None:
+    """Регистрирует DejaVu один раз на процесс (MainConfig.ready). Нет файлов — останется Helvetica."""
+    registered = set(pdfmetrics.getRegisteredFontNames())
+    for name, filename in FONTS.items():
+        if name in registered:
+            continue
+        try:
+            pdfmetrics.registerFont(TTFont(name, os.path.join(FONTS_DIR, filename)))
+        except Exception:
+            # если шрифтов нет в окружении — PDF всё равно сгенерится на Helvetica
+            pass
+
+
+def set_font(p, name: str, size: int, fallback: str = "Helvetica"):
+    try:
+        p.setFont(name, size)
+    except Exception:
+        p.setFont(fallback, size)
+
+
+def q2(x) -> Decimal:
+    return (x or ZERO).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+
+def fmt(x) -> str:
+    return f"{q2(x):.2f}"
+
+
+def safe(v) -> str:
+    return v if (v is not None and str(v).strip()) else "—"
+
+
+def rows_chunk() -> int:
+    """Размер пачки серверного курсора для строк PDF."""
+    return int(getattr(settings, "PDF_ROWS_CHUNK", 500))
+
+
+def merge_by_date(*sources):
+    """Слить упорядоченные по date генераторы строк; при равных датах — в порядке источников."""
+    return heapq.merge(*sources, key=lambda row: row["date"])
+
+
+def pdf_response(draw, filename: str, *, pagesize=A4, as_attachment: bool = True, status: int = 200):
+    """draw(canvas) рисует документ; файл отдаётся FileResponse из SpooledTemporaryFile."""
+    spool = tempfile.SpooledTemporaryFile(max_size=int(getattr(settings, "PDF_SPOOL_MAX_MEMORY", 1024 * 1024)))
+    p = canvas.Canvas(spool, pagesize=pagesize, pageCompression=1)
+    draw(p)
+    p.save()
+    spool.seek(0)
+    return FileResponse(spool, as_attachment=as_attachment, filename=filename, status=status)
+
+
+def error_pdf(message: str):
+    def draw(p):
+        set_font(p, "DejaVu-Bold", 14, fallback="Helvetica-Bold")
+        p.drawString(30 * mm, 260 * mm, "Невозможно сформировать акт сверки")
+        set_font(p, "DejaVu", 11, fallback="Helvetica")
+        p.drawString(30 * mm, 248 * mm, message)
+        p.showPage()
+
+    return pdf_response(draw, "reconciliation_error.pdf", as_attachment=False, status=400)
+
+
+def _requisites(obj) -> list:
+    g = lambda attr: safe(getattr(obj, attr, None))  # noqa: E731
+    return [
+        f"ИНН: {g('inn')}    ОКПО: {g('okpo')}",
+        f"Р/с: {g('score')}    БИК: {g('bik')}",
+        f"Адрес: {g('address')}",
+        f"Тел.: {g('phone')}    E-mail: {g('email')}",
+    ]
+
+
+def draw_reconciliation_act(
+    p,
+    *,
+    company,
+    company_name: str,
+    party,
+    party_name: str,
+    party_title: str,
+    start_dt,
+    end_dt,
+    currency: str,
+    opening: Decimal,
+    entries,
+) -> dict:
+    """
+    Классический акт сверки за один проход по entries (dict: title, a_debit, a_credit,
+    b_debit, b_credit). Возвращает итоги оборотов (Decimal).
+    """
+    W, H = A4
+
+    set_font(p, "DejaVu-Bold", 14, fallback="Helvetica-Bold")
+    p.drawCentredString(W / 2, H - 20 * mm, "АКТ СВЕРКИ ВЗАИМНЫХ РАСЧЁТОВ")
+    set_font(p, "DejaVu", 11, fallback="Helvetica")
+    p.drawCentredString(
+        W / 2,
+        H - 27 * mm,
+        f"Период: {start_dt.strftime('%d.%m.%Y')} — {end_dt.strftime('%d.%m.%Y')}   валюта сверки {currency}",
+    )
+
+    set_font(p, "DejaVu-Bold", 10, fallback="Helvetica-Bold")
+    p.drawString(20 * mm, H - 38 * mm, "КОМПАНИЯ")
+    p.drawString(110 * mm, H - 38 * mm, party_title)
+    set_font(p, "DejaVu", 11, fallback="Helvetica")
+    p.drawString(20 * mm, H - 44 * mm, safe(company_name))
+    p.drawString(110 * mm, H - 44 * mm, safe(party_name))
+    set_font(p, "DejaVu", 9, fallback="Helvetica")
+    y = H - 50 * mm
+    for left, right in zip(_requisites(company), _requisites(party)):
+        p.drawString(20 * mm, y, left)
+        p.drawString(110 * mm, y, right)
+        y -= 6 * mm
+
+    def table_header(yy: float) -> float:
+        set_font(p, "DejaVu-Bold", 9, fallback="Helvetica-Bold")
+        p.drawString(20 * mm, yy, "№")
+        p.drawString(28 * mm, yy, "Содержание записи")
+        p.drawString(100 * mm, yy, safe(company_name))
+        p.drawString(148 * mm, yy, safe(party_name))
+        yy -= 5 * mm
+        p.drawString(100 * mm, yy, "Дт")
+        p.drawString(118 * mm, yy, "Кт")
+        p.drawString(148 * mm, yy, "Дт")
+        p.drawString(166 * mm, yy, "Кт")
+        p.line(20 * mm, yy - 1 * mm, 190 * mm, yy - 1 * mm)
+        set_font(p, "DejaVu", 9, fallback="Helvetica")
+        return yy - 6 * mm
+
+    def amounts(yy: float, a_debit, a_credit, b_debit, b_credit):
+        p.drawRightString(115 * mm, yy, fmt(a_debit))
+        p.drawRightString(133 * mm, yy, fmt(a_credit))
+        p.drawRightString(163 * mm, yy, fmt(b_debit))
+        p.drawRightString(181 * mm, yy, fmt(b_credit))
+
+    def ensure_page_space(yy: float) -> float:
+        if yy >= 40 * mm:
+            return yy
+        p.showPage()
+        set_font(p, "DejaVu-Bold", 10, fallback="Helvetica-Bold")
+        p.drawString(20 * mm, H - 20 * mm, "Продолжение акта сверки")
+        return table_header(H - 30 * mm)
+
+    y = table_header(H - 78 * mm)
+    a_dt = opening if opening > 0 else ZERO
+    a_kt = -opening if opening < 0 else ZERO
+    p.drawString(28 * mm, y, "Сальдо начальное")
+    amounts(y, a_dt, a_kt, a_kt, a_dt)
+    y -= 7 * mm
+
+    totals = dict.fromkeys(AMOUNT_KEYS, ZERO)
+    num = 0
+    for row in entries:
+        for key in AMOUNT_KEYS:
+            totals[key] += row[key]
+        y = ensure_page_space(y)
+        num += 1
+        p.drawString(20 * mm, y, str(num))
+        desc = row["title"]
+        p.drawString(28 * mm, y, desc[:52])
+        amounts(y, *(row[key] for key in AMOUNT_KEYS))
+        y -= 6 * mm
+        if len(desc) > 52:
+            y = ensure_page_space(y)
+            p.drawString(28 * mm, y, desc[52:104])
+            y -= 6 * mm
+    totals = {key: q2(value) for key, value in totals.items()}
+
+    y -= 4 * mm
+    p.line(20 * mm, y, 190 * mm, y)
+    y -= 7 * mm
+    set_font(p, "DejaVu-Bold", 10, fallback="Helvetica-Bold")
+    p.drawString(28 * mm, y, "Итого обороты:")
+    amounts(y, *(totals[key] for key in AMOUNT_KEYS))
+    y -= 10 * mm
+
+    closing = q2(opening + totals["a_debit"] - totals["a_credit"])
+    on_date = (end_dt + timedelta(days=1)).date()
+    amount = abs(closing)
+    debtor, creditor = (party_name, company_name) if closing > 0 else (company_name, party_name)
+
+    set_font(p, "DejaVu", 10, fallback="Helvetica")
+    if amount == 0:
+        phrase = f"Задолженность отсутствует на {on_date.strftime('%d.%m.%Y')}."
+    else:
+        phrase = (
+            f"Задолженность {debtor} перед {creditor} на {on_date.strftime('%d.%m.%Y')} "
+            f"составляет {fmt(amount)} {currency}"
+        )
+    p.drawString(20 * mm, y, phrase)
+    y -= 8 * mm
+    if amount == 0:
+        p.drawString(20 * mm, y, "(Ноль сом 00 тыйын)")
+    y -= 16 * mm
+
+    set_font(p, "DejaVu-Bold", 10, fallback="Helvetica-Bold")
+    p.drawString(20 * mm, y, safe(company_name))
+    p.drawString(110 * mm, y, safe(party_name))
+    y -= 8 * mm
+    set_font(p, "DejaVu", 10, fallback="Helvetica")
+    p.drawString(20 * mm, y, "Главный бухгалтер: __________________")
+    p.drawString(110 * mm, y, "Главный бухгалтер: __________________")
+    p.showPage()
+    return totals
@@ -7,26 +7,21 @@ from django.utils.dateparse import parse_datetime, parse_date
 from django.utils import timezone
 from django_filters.rest_framework import DjangoFilterBackend
 
-from reportlab.pdfgen import canvas
 from reportlab.lib.units import mm
-from reportlab.lib.pagesizes import A4
 from reportlab.lib.utils import ImageReader
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
 
-from django.http import FileResponse
 from django.http import Http404
 from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
 
 from decimal import Decimal, ROUND_HALF_UP
 from datetime import timedelta, datetime, date, time as dtime
-import io, os, uuid
+import uuid
 
 from django.db.models import Q, F, Value as V, Sum
 from django.db.models.functions import Coalesce
 from django.utils.timezone import is_aware, make_aware, get_current_timezone
 
-from typing import List, Optional, Dict
+from typing import Optional
 from dataclasses import dataclass
 
 from django.core.cache import cache
@@ -35,10 +30,13 @@ import requests
 import qrcode
 
 from apps.users.models import Roles, User, Company
+from apps.users.serializers import _is_market_company
 from apps.main.models import Cart, CartItem, Sale, Product, MobileScannerToken, Client
 from apps.main.models import ManufactureSubreal, AgentSaleAllocation
-from apps.main.cache_utils import invalidate_cache_pattern
+from apps.main import pdf_render
+from apps.main.barcode_index import lookup_barcode, lookup_plu
 from apps.main.services import checkout_cart, NotEnoughStock
+from apps.main.services import balance_checkpoints
 from apps.main.services_agent_pos import checkout_agent_cart, AgentNotEnoughStock
 from apps.main.utils_numbers import ensure_sale_doc_number
 from apps.main.views import CompanyBranchRestrictedMixin
@@ -72,27 +70,6 @@ except Exception:
     DealInstallment = None
 
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-FONTS_DIR = os.path.join(BASE_DIR, "fonts")
-
-try:
-    pdfmetrics.registerFont(TTFont("DejaVu", os.path.join(FONTS_DIR, "DejaVuSans.ttf")))
-    pdfmetrics.registerFont(TTFont("DejaVu-Bold", os.path.join(FONTS_DIR, "DejaVuSans-Bold.ttf")))
-except Exception:
-    # если шрифтов нет в окружении — PDF всё равно сгенерится на Helvetica
-    pass
-
-
-def register_fonts_if_needed():
-    try:
-        pdfmetrics.registerFont(TTFont("DejaVu", "DejaVuSans.ttf"))
-        pdfmetrics.registerFont(TTFont("DejaVu-Bold", "DejaVuSans-Bold.ttf"))
-    except Exception:
-        pass
-
-
-register_fonts_if_needed()
-
 class MarketCashierOnlyMixin:
     """
     Ограничение POS/кассирского функционала:
@@ -104,16 +81,8 @@ class MarketCashierOnlyMixin:
         return
 
 
-def _set_font(p, name: str, size: int, fallback: str = "Helvetica"):
-    """
-    Безопасно ставит шрифт. Если кастомного нет — падаем на fallback,
-    но PDF продолжаем генерировать.
-    """
-    try:
-        p.setFont(name, size)
-    except Exception:
-        p.setFont(fallback, size)
-
+# Безопасно ставит шрифт: нет кастомного — fallback, PDF всё равно генерируется
+_set_font = pdf_render.set_font
 
 # Алиасы для обратной совместимости (используются в коде)
 _to_decimal = to_decimal
@@ -218,6 +187,21 @@ def _parse_scale_barcode(barcode: str):
     }
 
 
+def _resolve_scan(company_id, barcode: str):
+    """
+    Штрихкод -> (IndexedProduct | None, scale_data | None) через POS-индекс.
+    Если обычный штрихкод не найден — пробуем весовой EAN-13 (ПЛУ + вес).
+    """
+    entry = lookup_barcode(company_id, barcode)
+    if entry is not None:
+        return entry, None
+
+    scale_data = _parse_scale_barcode(barcode)
+    if not scale_data:
+        return None, None
+    return lookup_plu(company_id, scale_data["plu"]), scale_data
+
+
 def _resolve_pos_cashbox(company, branch, cashbox_id=None):
     """
     Правило:
@@ -341,55 +325,8 @@ class ClientReconciliationJSONAPIView(APIView):
             )
 
         # ---------- opening ----------
-        debit_before = Decimal("0.00")
-        credit_before = Decimal("0.00")
-
-        if source in ("both", "sales"):
-            sales_before = (
-                Sale.objects.filter(company=company, client=client, created_at__lt=start_dt)
-                .aggregate(s=Sum("total"))
-                .get("s")
-                or Decimal("0")
-            )
-            debit_before += sales_before
-
-        if ClientDeal and source in ("both", "deals"):
-            deals_before = (
-                ClientDeal.objects.filter(
-                    company=company,
-                    client=client,
-                    created_at__lt=start_dt,
-                    kind__in=[ClientDeal.Kind.SALE, ClientDeal.Kind.AMOUNT, ClientDeal.Kind.DEBT],
-                )
-                .aggregate(s=Sum("amount"))
-                .get("s")
-                or Decimal("0")
-            )
-            debit_before += deals_before
-
-            pre_before = (
-                ClientDeal.objects.filter(company=company, client=client, created_at__lt=start_dt)
-                .aggregate(s=Sum("prepayment"))
-                .get("s")
-                or Decimal("0")
-            )
-            credit_before += pre_before
-
-        if DealInstallment and source in ("both", "deals"):
-            inst_before = (
-                DealInstallment.objects.filter(
-                    deal__company=company,
-                    deal__client=client,
-                    paid_on__isnull=False,
-                    paid_on__lt=start_dt.date(),
-                )
-                .aggregate(s=Sum("amount"))
-                .get("s")
-                or Decimal("0")
-            )
-            credit_before += inst_before
-
-        opening = q2(debit_before - credit_before)
+        # чекпоинт сальдо на начало месяца + обороты до start (services/balance_checkpoints)
+        opening = q2(balance_checkpoints.CLIENT_LEDGER.opening(company.id, client.id, start_dt, source))
 
         # ---------- entries ----------
         entries = []
@@ -600,6 +537,80 @@ class ClientReconciliationJSONAPIView(APIView):
         }
         return Response(payload, status=200)
 
+def _client_act_entries(company, client, start_dt, end_dt, source):
+    """
+    Строки классического акта сверки клиента по дате — генератором: каждый источник
+    читается серверным курсором, источники сливаются heapq.merge без общего списка.
+    """
+    zero = Decimal("0.00")
+    chunk = pdf_render.rows_chunk()
+    period = dict(created_at__gte=start_dt, created_at__lte=end_dt)
+
+    def sales():
+        rows = Sale.objects.filter(company=company, client=client, **period).order_by("created_at")
+        for s in rows.only("id", "created_at", "total").iterator(chunk_size=chunk):
+            amt = q2(s.total)
+            if amt > 0:
+                yield dict(date=s.created_at, title=f"Продажа {s.id}", a_debit=amt, a_credit=zero, b_debit=zero, b_credit=amt)
+
+    def deals():
+        rows = ClientDeal.objects.filter(
+            company=company,
+            client=client,
+            kind__in=[ClientDeal.Kind.SALE, ClientDeal.Kind.AMOUNT, ClientDeal.Kind.DEBT],
+            **period,
+        ).order_by("created_at")
+        for d in rows.iterator(chunk_size=chunk):
+            amt = q2(d.amount)
+            if amt > 0:
+                yield dict(
+                    date=d.created_at,
+                    title=f"Сделка: {d.title} ({d.get_kind_display()})",
+                    a_debit=amt,
+                    a_credit=zero,
+                    b_debit=zero,
+                    b_credit=amt,
+                )
+
+    def prepayments():
+        rows = ClientDeal.objects.filter(company=company, client=client, prepayment__gt=0, **period).order_by("created_at")
+        for d in rows.iterator(chunk_size=chunk):
+            pp = q2(d.prepayment)
+            yield dict(date=d.created_at, title=f"Предоплата (сделка: {d.title})", a_debit=zero, a_credit=pp, b_debit=pp, b_credit=zero)
+
+    def installments():
+        rows = (
+            DealInstallment.objects.filter(
+                deal__company=company,
+                deal__client=client,
+                paid_on__isnull=False,
+                paid_on__gte=start_dt.date(),
+                paid_on__lte=end_dt.date(),
+            )
+            .select_related("deal")
+            .order_by("paid_on", "number")
+        )
+        for inst in rows.iterator(chunk_size=chunk):
+            amt = q2(inst.amount)
+            yield dict(
+                date=_aware(inst.paid_on, end=False),
+                title=f"Оплата по рассрочке №{inst.number} (сделка: {inst.deal.title})",
+                a_debit=zero,
+                a_credit=amt,
+                b_debit=amt,
+                b_credit=zero,
+            )
+
+    sources = []
+    if source in ("both", "sales"):
+        sources.append(sales())
+    if ClientDeal and source in ("both", "deals"):
+        sources += [deals(), prepayments()]
+    if DealInstallment and source in ("both", "deals"):
+        sources.append(installments())
+    return pdf_render.merge_by_date(*sources)
+
+
 class ClientReconciliationClassicAPIView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
@@ -623,350 +634,28 @@ class ClientReconciliationClassicAPIView(APIView):
         start_dt = _aware(start_dt, end=False)
         end_dt = _aware(end_dt, end=True)
 
-        debit_before = Decimal("0.00")
-        credit_before = Decimal("0.00")
-
-        if source in ("both", "sales"):
-            sales_before = (
-                Sale.objects.filter(company=company, client=client, created_at__lt=start_dt).aggregate(s=Sum("total"))[
-                    "s"
-                ]
-                or Decimal("0")
-            )
-            debit_before += sales_before
-
-        if ClientDeal and source in ("both", "deals"):
-            deals_before = (
-                ClientDeal.objects.filter(
-                    company=company,
-                    client=client,
-                    created_at__lt=start_dt,
-                    kind__in=[ClientDeal.Kind.SALE, ClientDeal.Kind.AMOUNT, ClientDeal.Kind.DEBT],
-                ).aggregate(s=Sum("amount"))["s"]
-                or Decimal("0")
-            )
-            debit_before += deals_before
-
-            pre_before = (
-                ClientDeal.objects.filter(company=company, client=client, created_at__lt=start_dt).aggregate(
-                    s=Sum("prepayment")
-                )["s"]
-                or Decimal("0")
-            )
-            credit_before += pre_before
-
-        if DealInstallment and source in ("both", "deals"):
-            inst_before = (
-                DealInstallment.objects.filter(
-                    deal__company=company,
-                    deal__client=client,
-                    paid_on__isnull=False,
-                    paid_on__lt=start_dt.date(),
-                ).aggregate(s=Sum("amount"))["s"]
-                or Decimal("0")
-            )
-            credit_before += inst_before
-
-        opening = q2(debit_before - credit_before)
-
-        entries: List[Dict] = []
-
-        if source in ("both", "sales"):
-            for s in (
-                Sale.objects.filter(
-                    company=company,
-                    client=client,
-                    created_at__gte=start_dt,
-                    created_at__lte=end_dt,
-                ).order_by("created_at")
-            ):
-                if q2(s.total) > 0:
-                    entries.append(
-                        dict(
-                            date=s.created_at,
-                            title=f"Продажа {s.id}",
-                            a_debit=q2(s.total),
-                            a_credit=Decimal("0.00"),
-                            b_debit=Decimal("0.00"),
-                            b_credit=q2(s.total),
-                        )
-                    )
-
-        if ClientDeal and source in ("both", "deals"):
-            for d in (
-                ClientDeal.objects.filter(
-                    company=company,
-                    client=client,
-                    created_at__gte=start_dt,
-                    created_at__lte=end_dt,
-                    kind__in=[ClientDeal.Kind.SALE, ClientDeal.Kind.AMOUNT, ClientDeal.Kind.DEBT],
-                ).order_by("created_at")
-            ):
-                amt = q2(d.amount)
-                if amt > 0:
-                    entries.append(
-                        dict(
-                            date=d.created_at,
-                            title=f"Сделка: {d.title} ({d.get_kind_display()})",
-                            a_debit=amt,
-                            a_credit=Decimal("0.00"),
-                            b_debit=Decimal("0.00"),
-                            b_credit=amt,
-                        )
-                    )
-
-            for d in (
-                ClientDeal.objects.filter(
-                    company=company,
-                    client=client,
-                    prepayment__gt=0,
-                    created_at__gte=start_dt,
-                    created_at__lte=end_dt,
-                ).order_by("created_at")
-            ):
-                pp = q2(d.prepayment)
-                entries.append(
-                    dict(
-                        date=d.created_at,
-                        title=f"Предоплата (сделка: {d.title})",
-                        a_debit=Decimal("0.00"),
-                        a_credit=pp,
-                        b_debit=pp,
-                        b_credit=Decimal("0.00"),
-                    )
-                )
-
-        if DealInstallment and source in ("both", "deals"):
-            for inst in (
-                DealInstallment.objects.filter(
-                    deal__company=company,
-                    deal__client=client,
-                    paid_on__isnull=False,
-                    paid_on__gte=start_dt.date(),
-                    paid_on__lte=end_dt.date(),
-                )
-                .select_related("deal")
-                .order_by("paid_on", "number")
-            ):
-                amt = q2(inst.amount)
-                dt = _aware(inst.paid_on, end=False)
-                entries.append(
-                    dict(
-                        date=dt,
-                        title=f"Оплата по рассрочке №{inst.number} (сделка: {inst.deal.title})",
-                        a_debit=Decimal("0.00"),
-                        a_credit=amt,
-                        b_debit=amt,
-                        b_credit=Decimal("0.00"),
-                    )
-                )
-
-        entries.sort(key=lambda x: x["date"])
-
-        totals = dict(
-            a_debit=q2(sum(x["a_debit"] for x in entries) if entries else 0),
-            a_credit=q2(sum(x["a_credit"] for x in entries) if entries else 0),
-            b_debit=q2(sum(x["b_debit"] for x in entries) if entries else 0),
-            b_credit=q2(sum(x["b_credit"] for x in entries) if entries else 0),
-        )
-
-        closing = q2(opening + totals["a_debit"] - totals["a_credit"])
-        on_date = (end_dt + timedelta(days=1)).date()
-
-        buf = io.BytesIO()
-        p = canvas.Canvas(buf, pagesize=A4)
-        W, H = A4
-
-        try:
-            FONT, BFONT = "DejaVu", "DejaVu-Bold"
-            p.setFont(BFONT, 14)
-        except Exception:
-            FONT, BFONT = "Helvetica", "Helvetica-Bold"
-            p.setFont(BFONT, 14)
-
-        p.drawCentredString(W / 2, H - 20 * mm, "АКТ СВЕРКИ ВЗАИМНЫХ РАСЧЁТОВ")
-        p.setFont(FONT, 11)
-        p.drawCentredString(
-            W / 2,
-            H - 27 * mm,
-            f"Период: {start_dt.strftime('%d.%m.%Y')} — {end_dt.strftime('%d.%m.%Y')}   валюта сверки {currency}",
-        )
-
-        company_name = getattr(company, "llc", None) or getattr(company, "name", str(company))
-        client_name = client.llc or client.enterprise or client.full_name
+        opening = q2(balance_checkpoints.CLIENT_LEDGER.opening(company.id, client.id, start_dt, source))
 
-        p.setFont(BFONT, 10)
-        p.drawString(20 * mm, H - 38 * mm, "КОМПАНИЯ")
-        p.drawString(110 * mm, H - 38 * mm, "КЛИЕНТ")
-        p.setFont(FONT, 11)
-        p.drawString(20 * mm, H - 44 * mm, _safe(company_name))
-        p.drawString(110 * mm, H - 44 * mm, _safe(client_name))
-        p.setFont(FONT, 9)
-        p.drawString(
-            20 * mm,
-            H - 50 * mm,
-            f"ИНН: {_safe(getattr(company,'inn',None))}    ОКПО: {_safe(getattr(company,'okpo',None))}",
-        )
-        p.drawString(
-            110 * mm,
-            H - 50 * mm,
-            f"ИНН: {_safe(client.inn)}    ОКПО: {_safe(client.okpo)}",
-        )
-        p.drawString(
-            20 * mm,
-            H - 56 * mm,
-            f"Р/с: {_safe(getattr(company,'score',None))}    БИК: {_safe(getattr(company,'bik',None))}",
-        )
-        p.drawString(
-            110 * mm,
-            H - 56 * mm,
-            f"Р/с: {_safe(client.score)}    БИК: {_safe(client.bik)}",
-        )
-        p.drawString(20 * mm, H - 62 * mm, f"Адрес: {_safe(getattr(company,'address',None))}")
-        p.drawString(110 * mm, H - 62 * mm, f"Адрес: {_safe(client.address)}")
-        p.drawString(
-            20 * mm,
-            H - 68 * mm,
-            f"Тел.: {_safe(getattr(company,'phone',None))}    E-mail: {_safe(getattr(company,'email',None))}",
-        )
-        p.drawString(
-            110 * mm,
-            H - 68 * mm,
-            f"Тел.: {_safe(client.phone)}    E-mail: {_safe(client.email)}",
-        )
-
-        y = H - 78 * mm
-        p.setFont(BFONT, 9)
-        p.drawString(20 * mm, y, "№")
-        p.drawString(28 * mm, y, "Содержание записи")
-        p.drawString(100 * mm, y, _safe(company_name))
-        p.drawString(148 * mm, y, _safe(client_name))
-
-        y -= 5 * mm
-        p.setFont(BFONT, 9)
-        p.drawString(100 * mm, y, "Дт")
-        p.drawString(118 * mm, y, "Кт")
-        p.drawString(148 * mm, y, "Дт")
-        p.drawString(166 * mm, y, "Кт")
-        p.line(20 * mm, y - 1 * mm, 190 * mm, y - 1 * mm)
-        y -= 6 * mm
-
-        p.setFont(FONT, 9)
-        a_dt = opening if opening > 0 else Decimal("0.00")
-        a_kt = -opening if opening < 0 else Decimal("0.00")
-        b_dt = a_kt
-        b_kt = a_dt
-
-        p.drawString(28 * mm, y, "Сальдо начальное")
-        p.drawRightString(115 * mm, y, fmt(a_dt))
-        p.drawRightString(133 * mm, y, fmt(a_kt))
-        p.drawRightString(163 * mm, y, fmt(b_dt))
-        p.drawRightString(181 * mm, y, fmt(b_kt))
-        y -= 7 * mm
-
-        num = 0
-        p.setFont(FONT, 9)
-
-        def ensure_page_space(current_y: float) -> float:
-            if current_y < 40 * mm:
-                p.showPage()
-                try:
-                    p.setFont(BFONT, 10)
-                except Exception:
-                    p.setFont("Helvetica-Bold", 10)
-                p.drawString(20 * mm, H - 20 * mm, "Продолжение акта сверки")
-                yy = H - 30 * mm
-                p.setFont(BFONT, 9)
-                p.drawString(20 * mm, yy, "№")
-                p.drawString(28 * mm, yy, "Содержание записи")
-                p.drawString(100 * mm, yy, _safe(company_name))
-                p.drawString(148 * mm, yy, _safe(client_name))
-                yy -= 5 * mm
-                p.drawString(100 * mm, yy, "Дт")
-                p.drawString(118 * mm, yy, "Кт")
-                p.drawString(148 * mm, yy, "Дт")
-                p.drawString(166 * mm, yy, "Кт")
-                p.line(20 * mm, yy - 1 * mm, 190 * mm, yy - 1 * mm)
-                return yy - 6 * mm
-            return current_y
-
-        for row in entries:
-            y = ensure_page_space(y)
-            num += 1
-            p.drawString(20 * mm, y, str(num))
-            desc = row["title"]
-            line1 = desc[:52]
-            line2 = desc[52:104] if len(desc) > 52 else ""
-            p.drawString(28 * mm, y, line1)
-
-            p.drawRightString(115 * mm, y, fmt(row["a_debit"]))
-            p.drawRightString(133 * mm, y, fmt(row["a_credit"]))
-            p.drawRightString(163 * mm, y, fmt(row["b_debit"]))
-            p.drawRightString(181 * mm, y, fmt(row["b_credit"]))
-            y -= 6 * mm
-            if line2:
-                y = ensure_page_space(y)
-                p.drawString(28 * mm, y, line2)
-                y -= 6 * mm
-
-        y -= 4 * mm
-        p.line(20 * mm, y, 190 * mm, y)
-        y -= 7 * mm
-        p.setFont(BFONT, 10)
-        p.drawString(28 * mm, y, "Итого обороты:")
-        p.drawRightString(115 * mm, y, fmt(totals["a_debit"]))
-        p.drawRightString(133 * mm, y, fmt(totals["a_credit"]))
-        p.drawRightString(163 * mm, y, fmt(totals["b_debit"]))
-        p.drawRightString(181 * mm, y, fmt(totals["b_credit"]))
-        y -= 10 * mm
-
-        debtor, creditor, amount = None, None, abs(closing)
-        if closing > 0:
-            debtor = client_name
-            creditor = company_name
-        elif closing < 0:
-            debtor = company_name
-            creditor = client_name
-
-        p.setFont(FONT, 10)
-        if amount == 0:
-            phrase = f"Задолженность отсутствует на {on_date.strftime('%d.%m.%Y')}."
-        else:
-            phrase = (
-                f"Задолженность {debtor} перед {creditor} на {on_date.strftime('%d.%m.%Y')} "
-                f"составляет {fmt(amount)} {currency}"
+        def draw(p):
+            pdf_render.draw_reconciliation_act(
+                p,
+                company=company,
+                company_name=getattr(company, "llc", None) or getattr(company, "name", str(company)),
+                party=client,
+                party_name=client.llc or client.enterprise or client.full_name,
+                party_title="КЛИЕНТ",
+                start_dt=start_dt,
+                end_dt=end_dt,
+                currency=currency,
+                opening=opening,
+                entries=_client_act_entries(company, client, start_dt, end_dt, source),
             )
-        p.drawString(20 * mm, y, phrase)
-        y -= 8 * mm
-        if amount == 0:
-            p.drawString(20 * mm, y, "(Ноль сом 00 тыйын)")
-        y -= 16 * mm
-
-        p.setFont(BFONT, 10)
-        p.drawString(20 * mm, y, _safe(company_name))
-        p.drawString(110 * mm, y, _safe(client_name))
-        y -= 8 * mm
-        p.setFont(FONT, 10)
-        p.drawString(20 * mm, y, "Главный бухгалтер: __________________")
-        p.drawString(110 * mm, y, "Главный бухгалтер: __________________")
 
-        p.showPage()
-        p.save()
-        buf.seek(0)
         filename = f"reconciliation_classic_{client.id}_{start_dt.date()}_{end_dt.date()}.pdf"
-        return FileResponse(buf, as_attachment=True, filename=filename)
+        return pdf_render.pdf_response(draw, filename)
 
     def _error_pdf(self, message: str):
-        buf = io.BytesIO()
-        p = canvas.Canvas(buf, pagesize=A4)
-        p.setFont("Helvetica-Bold", 14)
-        p.drawString(30 * mm, 260 * mm, "Невозможно сформировать акт сверки")
-        p.setFont("Helvetica", 11)
-        p.drawString(30 * mm, 248 * mm, message)
-        p.showPage()
-        p.save()
-        buf.seek(0)
-        return FileResponse(buf, as_attachment=False, filename="reconciliation_error.pdf", status=400)
+        return pdf_render.error_pdf(message)
 
 
 class SaleInvoiceDownloadAPIView(APIView):
@@ -974,16 +663,18 @@ class SaleInvoiceDownloadAPIView(APIView):
 
     def get(self, request, pk, *args, **kwargs):
         sale = get_object_or_404(
-            Sale.objects.select_related("company", "user", "client").prefetch_related("items__product"),
+            Sale.objects.select_related("company", "user", "client"),
             id=pk,
             company=request.user.company,
         )
 
         doc_no = ensure_sale_doc_number(sale)
 
-        buffer = io.BytesIO()
-        p = canvas.Canvas(buffer, pagesize=(210 * mm, 297 * mm))
+        return pdf_render.pdf_response(
+            lambda p: self._draw(p, sale, doc_no), f"invoice_{doc_no}.pdf", pagesize=(210 * mm, 297 * mm)
+        )
 
+    def _draw(self, p, sale, doc_no):
         # ✅ безопасно: если DejaVu не зарегистрирован — упадём на Helvetica
         _set_font(p, "DejaVu-Bold", 14, fallback="Helvetica-Bold")
         p.drawCentredString(105 * mm, 280 * mm, f"НАКЛАДНАЯ № {doc_no}")
@@ -1041,7 +732,8 @@ class SaleInvoiceDownloadAPIView(APIView):
         y -= 10
 
         _set_font(p, "DejaVu", 10, fallback="Helvetica")
-        for it in sale.items.all():
+        items = sale.items.only("name_snapshot", "quantity", "unit_price")
+        for it in items.iterator(chunk_size=pdf_render.rows_chunk()):
             p.drawString(20 * mm, y, (it.name_snapshot or "")[:60])
             p.drawRightString(140 * mm, y, str(it.quantity))
             p.drawRightString(160 * mm, y, fmt_money(it.unit_price))
@@ -1070,10 +762,6 @@ class SaleInvoiceDownloadAPIView(APIView):
         p.drawString(120 * mm, y, "Покупатель: _____________")
 
         p.showPage()
-        p.save()
-
-        buffer.seek(0)
-        return FileResponse(buffer, as_attachment=True, filename=f"invoice_{doc_no}.pdf")
 
 
 class SaleReceiptDataAPIView(MarketCashierOnlyMixin, APIView):
@@ -1175,7 +863,7 @@ class SaleStartAPIView(MarketCashierOnlyMixin, CompanyBranchRestrictedMixin, API
             cart.order_discount_total = _q2(order_disc_total or Decimal("0.00"))
         cart.save(update_fields=["order_discount_total", "order_discount_percent", "updated_at"])
 
-        cart.recalc()
+        cart.refresh_totals()
         return Response(SaleCartSerializer(cart).data, status=status.HTTP_201_CREATED)
 
 
@@ -1203,7 +891,7 @@ class CartDetailAPIView(MarketCashierOnlyMixin, generics.RetrieveAPIView):
             cart.order_discount_total = _q2(order_disc_total)
         if order_disc_total is not None or order_disc_percent is not None:
             cart.save(update_fields=["order_discount_total", "order_discount_percent", "updated_at"])
-        cart.recalc()
+        cart.refresh_totals()
         return Response(SaleCartSerializer(cart).data, status=200)
 
 
@@ -1225,36 +913,15 @@ class SaleScanAPIView(MarketCashierOnlyMixin, APIView):
         barcode = ser.validated_data["barcode"].strip()
         qty = ser.validated_data["quantity"]
 
-        product = None
-        scale_data = None
-
-        # Оптимизация: используем select_related для связанных объектов и кэширование
-        cache_key = f"product_barcode:{cart.company_id}:{barcode}"
-        product = cache.get(cache_key)
-        
+        # Штрихкод/ПЛУ резолвим через POS-индекс (локальный LRU -> Redis -> БД)
+        product, scale_data = _resolve_scan(cart.company_id, barcode)
         if product is None:
-            try:
-                product = Product.objects.select_related("brand", "category").get(
-                    company=cart.company, barcode=barcode
+            if scale_data:
+                return Response(
+                    {"not_found": True, "message": f"Товар с ПЛУ {scale_data['plu']} не найден"},
+                    status=404,
                 )
-                # Кэшируем на 5 минут
-                cache.set(cache_key, product, 300)
-            except Product.DoesNotExist:
-                scale_data = _parse_scale_barcode(barcode)
-                if not scale_data:
-                    return Response({"not_found": True, "message": "Товар не найден"}, status=404)
-
-                plu = scale_data["plu"]
-                try:
-                    plu_cache_key = f"product_plu:{cart.company_id}:{plu}"
-                    product = cache.get(plu_cache_key)
-                    if product is None:
-                        product = Product.objects.select_related("brand", "category").get(
-                            company=cart.company, plu=plu
-                        )
-                        cache.set(plu_cache_key, product, 300)
-                except Product.DoesNotExist:
-                    return Response({"not_found": True, "message": f"Товар с ПЛУ {plu} не найден"}, status=404)
+            return Response({"not_found": True, "message": "Товар не найден"}, status=404)
 
         if scale_data:
             effective_qty = Decimal(str(scale_data["weight_kg"]))
@@ -1264,9 +931,8 @@ class SaleScanAPIView(MarketCashierOnlyMixin, APIView):
         # Блокируем корзину для предотвращения race conditions
         cart = Cart.objects.select_for_update().get(id=cart.id)
         
-        item, created = CartItem.objects.select_for_update().get_or_create(
-            cart=cart,
-            product=product,
+        item, created = cart.items.select_for_update().get_or_create(
+            product_id=product.id,
             defaults={
                 "company": cart.company,
                 "branch": getattr(cart, "branch", None),
@@ -1280,7 +946,6 @@ class SaleScanAPIView(MarketCashierOnlyMixin, APIView):
             item.quantity = qty3(item.quantity + effective_qty)
             item.save(update_fields=["quantity"])
 
-        cart.recalc()
         return Response(SaleCartSerializer(cart).data, status=status.HTTP_201_CREATED)
 
 
@@ -1327,8 +992,7 @@ class SaleAddItemAPIView(MarketCashierOnlyMixin, APIView):
         # Блокируем корзину для предотвращения race conditions
         cart = Cart.objects.select_for_update().get(id=cart.id)
         
-        item, created = CartItem.objects.select_for_update().get_or_create(
-            cart=cart,
+        item, created = cart.items.select_for_update().get_or_create(
             product=product,
             defaults={
                 "company": cart.company,
@@ -1352,7 +1016,6 @@ class SaleAddItemAPIView(MarketCashierOnlyMixin, APIView):
                 update_f.append("line_discount")
             item.save(update_fields=update_f)
 
-        cart.recalc()
         return Response(SaleCartSerializer(cart).data, status=status.HTTP_201_CREATED)
 
 
@@ -1555,15 +1218,10 @@ class SaleReturnAPIView(MarketCashierOnlyMixin, CompanyBranchRestrictedMixin, AP
                     quantity=F("quantity") + qty
                 )
 
+        # кэш аналитики сбрасывается поколением "sales" (post_save продажи)
         sale.status = Sale.Status.CANCELED
         sale.save(update_fields=["status"])
 
-        # Инвалидируем кэши аналитики/списков, чтобы цифры обновлялись сразу после возврата.
-        # (market analytics кэшируется по ключам nurcrm:analytics:market:... )
-        invalidate_cache_pattern(f"analytics:market:{sale.company_id}:")
-        # списки товаров/остатков тоже могут быть кэшированы
-        invalidate_cache_pattern(f"products:list:{sale.company_id}:")
-
         sale.refresh_from_db()
         return Response(
             SaleDetailSerializer(sale, context={"request": request}).data,
@@ -1621,8 +1279,6 @@ class AgentSaleReturnAPIView(SaleReturnAPIView):
 
         sale.status = Sale.Status.CANCELED
         sale.save(update_fields=["status"])
-        invalidate_cache_pattern(f"analytics:market:{sale.company_id}:")
-        invalidate_cache_pattern(f"products:list:{sale.company_id}:")
         sale.refresh_from_db()
         return Response(
             SaleDetailSerializer(sale, context={"request": request}).data,
@@ -1652,23 +1308,12 @@ class ProductFindByBarcodeAPIView(MarketCashierOnlyMixin, APIView):
         if not barcode:
             return Response([], status=200)
         
-        # Оптимизация: кэширование и select_related
-        cache_key = f"product_barcode:{request.user.company_id}:{barcode}"
-        product = cache.get(cache_key)
-        
-        if product is None:
-            qs = Product.objects.select_related("brand", "category").filter(
-                company=request.user.company, barcode=barcode
-            )[:1]
-            product = qs.first()
-            if product:
-                cache.set(cache_key, product, 300)
-        
+        product = lookup_barcode(request.user.company_id, barcode)
         if not product:
             return Response([], status=200)
-        
+
         return Response(
-            [{"id": str(product.id), "name": product.name, "barcode": product.barcode, "price": str(product.price)}],
+            [{"id": str(product.id), "name": product.name, "barcode": barcode, "price": str(product.price)}],
             status=200,
         )
 
@@ -1700,17 +1345,15 @@ class MobileScannerIngestAPIView(APIView):
         if cart.status != Cart.Status.ACTIVE:
             return Response({"detail": "cart is not active"}, status=409)
 
-        try:
-            product = Product.objects.get(company=cart.company, barcode=barcode)
-        except Product.DoesNotExist:
+        product = lookup_barcode(cart.company_id, barcode)
+        if product is None:
             return Response({"not_found": True, "message": "Товар не найден"}, status=404)
 
         # Блокируем корзину для предотвращения race conditions
         cart = Cart.objects.select_for_update().get(id=cart.id)
         
-        item, created = CartItem.objects.select_for_update().get_or_create(
-            cart=cart,
-            product=product,
+        item, created = cart.items.select_for_update().get_or_create(
+            product_id=product.id,
             defaults={
                 "company": cart.company,
                 "branch": getattr(cart, "branch", None),
@@ -1920,11 +1563,11 @@ class CartItemUpdateDestroyAPIView(MarketCashierOnlyMixin, APIView):
         )
 
     def _get_item_in_cart(self, cart, item_or_product_id):
-        item = CartItem.objects.filter(cart=cart, id=item_or_product_id).select_related("product").first()
+        item = cart.items.filter(id=item_or_product_id).select_related("product").first()
         if item:
             return item
 
-        item = CartItem.objects.filter(cart=cart, product_id=item_or_product_id).select_related("product").first()
+        item = cart.items.filter(product_id=item_or_product_id).select_related("product").first()
         if item:
             return item
 
@@ -1957,7 +1600,6 @@ class CartItemUpdateDestroyAPIView(MarketCashierOnlyMixin, APIView):
                 return Response({"quantity": "Количество не может быть отрицательным."}, status=400)
             if qty == 0:
                 item.delete()
-                cart.recalc()
                 return Response(SaleCartSerializer(cart).data, status=200)
             item.quantity = qty
 
@@ -1979,7 +1621,6 @@ class CartItemUpdateDestroyAPIView(MarketCashierOnlyMixin, APIView):
             update_fields.append("line_discount")
         if update_fields:
             item.save(update_fields=update_fields)
-        cart.recalc()
         return Response(SaleCartSerializer(cart).data, status=200)
 
     @transaction.atomic
@@ -1987,7 +1628,6 @@ class CartItemUpdateDestroyAPIView(MarketCashierOnlyMixin, APIView):
         cart = self._get_active_cart(request, cart_id)
         item = self._get_item_in_cart(cart, item_id)
         item.delete()
-        cart.recalc()
         return Response(SaleCartSerializer(cart).data, status=200)
 
 
@@ -2015,16 +1655,16 @@ class SaleAddCustomItemAPIView(MarketCashierOnlyMixin, APIView):
         qty = qty3(qty)
 
 
-        item = CartItem.objects.filter(
-            cart=cart,
+        item = cart.items.select_for_update().filter(
             product__isnull=True,
             custom_name=name,
             unit_price=price,
         ).first()
 
         if item:
-            CartItem.objects.filter(pk=item.pk).update(quantity=F("quantity") + qty)
-            item.refresh_from_db(fields=["quantity"])
+            # через save(): итоги корзины сдвигаются дельтой строки
+            item.quantity = qty3(item.quantity + qty)
+            item.save(update_fields=["quantity"])
         else:
             CartItem.objects.create(
                 company=cart.company,
@@ -2036,7 +1676,6 @@ class SaleAddCustomItemAPIView(MarketCashierOnlyMixin, APIView):
                 quantity=qty,
             )
 
-        cart.recalc()
         return Response(SaleCartSerializer(cart).data, status=status.HTTP_201_CREATED)
 
 
@@ -2243,17 +1882,7 @@ class AgentSaleScanAPIView(MarketCashierOnlyMixin, CompanyBranchRestrictedMixin,
         barcode = ser.validated_data["barcode"].strip()
         qty = ser.validated_data["quantity"]
 
-        # Оптимизация: кэширование и select_related
-        cache_key = f"product_barcode:{cart.company_id}:{barcode}"
-        product = cache.get(cache_key)
-        
-        if product is None:
-            product = Product.objects.select_related("brand", "category").filter(
-                company=cart.company, barcode=barcode
-            ).first()
-            if product:
-                cache.set(cache_key, product, 300)
-        
+        product = lookup_barcode(cart.company_id, barcode)
         if not product:
             return Response({"not_found": True, "message": "Товар не найден"}, status=404)
 
@@ -2261,13 +1890,14 @@ class AgentSaleScanAPIView(MarketCashierOnlyMixin, CompanyBranchRestrictedMixin,
         use_main_stock = _should_use_main_stock_in_agent_sale(user=request.user, acting_agent=acting_agent)
 
         # ✅ типобезопасно: int/Decimal не смешиваем
+        # остаток в POS-индекс не входит — читаем его точечно
         available = (
-            Decimal(str(getattr(product, "quantity", 0) or 0))
+            Decimal(str(Product.objects.filter(pk=product.id).values_list("quantity", flat=True).first() or 0))
             if use_main_stock
             else Decimal(_agent_available_qty(acting_agent, cart.company, product.id))
         )
         in_cart = _as_decimal(
-            CartItem.objects.filter(cart=cart, product=product).aggregate(s=Sum("quantity"))["s"] or 0,
+            CartItem.objects.filter(cart=cart, product_id=product.id).aggregate(s=Sum("quantity"))["s"] or 0,
             default=Decimal("0"),
         )
         req = _as_decimal(qty, default=Decimal("0"))
@@ -2288,9 +1918,8 @@ class AgentSaleScanAPIView(MarketCashierOnlyMixin, CompanyBranchRestrictedMixin,
         # Блокируем корзину для предотвращения race conditions
         cart = Cart.objects.select_for_update().get(id=cart.id)
         
-        item, created = CartItem.objects.select_for_update().get_or_create(
-            cart=cart,
-            product=product,
+        item, created = cart.items.select_for_update().get_or_create(
+            product_id=product.id,
             defaults={
                 "company": cart.company,
                 "branch": getattr(cart, "branch", None),
@@ -2303,7 +1932,6 @@ class AgentSaleScanAPIView(MarketCashierOnlyMixin, CompanyBranchRestrictedMixin,
             item.quantity = qty3(item.quantity + qty)
             item.save(update_fields=["quantity"])
 
-        cart.recalc()
         return Response(SaleCartSerializer(cart).data, status=status.HTTP_201_CREATED)
 
 
@@ -2367,8 +1995,8 @@ class AgentSaleAddItemAPIView(MarketCashierOnlyMixin, CompanyBranchRestrictedMix
         cart = Cart.objects.select_for_update().get(id=cart.id)
 
         item = (
-            CartItem.objects.select_for_update()
-            .filter(cart=cart, product=product)
+            cart.items.select_for_update()
+            .filter(product=product)
             .first()
         )
         if item:
@@ -2395,7 +2023,6 @@ class AgentSaleAddItemAPIView(MarketCashierOnlyMixin, CompanyBranchRestrictedMix
             )
             item.save(skip_full_clean=True)
 
-        cart.recalc()
         return Response(SaleCartSerializer(cart).data, status=status.HTTP_201_CREATED)
 
 
@@ -2421,16 +2048,16 @@ class AgentSaleAddCustomItemAPIView(MarketCashierOnlyMixin, CompanyBranchRestric
         price = money(ser.validated_data["price"])
         qty = ser.validated_data.get("quantity", 1)
 
-        item = CartItem.objects.filter(
-            cart=cart,
+        item = cart.items.select_for_update().filter(
             product__isnull=True,
             custom_name=name,
             unit_price=price,
         ).first()
 
         if item:
-            CartItem.objects.filter(pk=item.pk).update(quantity=F("quantity") + qty)
-            item.refresh_from_db(fields=["quantity"])
+            # через save(): итоги корзины сдвигаются дельтой строки
+            item.quantity = qty3(item.quantity + qty)
+            item.save(update_fields=["quantity"])
         else:
             CartItem.objects.create(
                 company=cart.company,
@@ -2442,7 +2069,6 @@ class AgentSaleAddCustomItemAPIView(MarketCashierOnlyMixin, CompanyBranchRestric
                 quantity=qty,
             )
 
-        cart.recalc()
         return Response(SaleCartSerializer(cart).data, status=status.HTTP_201_CREATED)
 
 
@@ -2577,10 +2203,10 @@ class AgentCartItemUpdateDestroyAPIView(MarketCashierOnlyMixin, APIView):
         )
 
     def _get_item_in_cart(self, cart, item_or_product_id):
-        item = CartItem.objects.filter(cart=cart, id=item_or_product_id).select_related("product").first()
+        item = cart.items.filter(id=item_or_product_id).select_related("product").first()
         if item:
             return item
-        item = CartItem.objects.filter(cart=cart, product_id=item_or_product_id).select_related("product").first()
+        item = cart.items.filter(product_id=item_or_product_id).select_related("product").first()
         if item:
             return item
         raise Http404("CartItem not found in this cart.")
@@ -2601,7 +2227,6 @@ class AgentCartItemUpdateDestroyAPIView(MarketCashierOnlyMixin, APIView):
                 return Response({"quantity": "Количество не может быть отрицательным."}, status=400)
             if qty == 0:
                 item.delete()
-                cart.recalc()
                 return Response(SaleCartSerializer(cart).data, status=200)
             item.quantity = qty
 
@@ -2623,7 +2248,6 @@ class AgentCartItemUpdateDestroyAPIView(MarketCashierOnlyMixin, APIView):
             update_fields.append("line_discount")
         if update_fields:
             item.save(update_fields=update_fields, skip_full_clean=True)
-        cart.recalc()
         return Response(SaleCartSerializer(cart).data, status=200)
 
     @transaction.atomic
@@ -2631,5 +2255,4 @@ class AgentCartItemUpdateDestroyAPIView(MarketCashierOnlyMixin, APIView):
         cart = self._get_active_cart(request, cart_id)
         item = self._get_item_in_cart(cart, item_id)
         item.delete()
-        cart.recalc()
         return Response(SaleCartSerializer(cart).data, status=200)
@@ -18,7 +18,7 @@ from apps.main.models import (
     ObjectItem, ObjectSale, ObjectSaleItem, ItemMake, ManufactureSubreal, Acceptance,
     ReturnFromAgent, ProductImage, PromoRule, AgentRequestCart, AgentRequestItem,
     ProductPackage, ProductCharacteristics, DealPayment, AgentSaleAllocation,
-    ProductRecipeItem,
+    ProductRecipeItem, ProductImportJob,
 )
 
 from apps.consalting.models import ServicesConsalting
@@ -584,6 +584,50 @@ class ProductImageSerializer(serializers.ModelSerializer):
             return req.build_absolute_uri(obj.image.url) if req else obj.image.url
         return None
     
+class ProductImportJobSerializer(serializers.ModelSerializer):
+    """
+    Загрузка файла для фонового импорта товаров.
+    options: {"columns": {"barcode": 0, "name": 1, ...}, "header_row": 0,
+              "update_existing": false, "default_qty": 50}
+    """
+    _COLUMNS = ("barcode", "name", "article", "price", "purchase_price", "quantity", "unit")
+
+    class Meta:
+        model = ProductImportJob
+        fields = [
+            "id", "file", "options", "status",
+            "rows_processed", "created_count", "updated_count", "skipped_count", "error_count",
+            "rows_per_second", "errors", "error", "created_at", "started_at", "finished_at",
+        ]
+        read_only_fields = [f for f in fields if f not in ("file", "options")]
+
+    def validate_options(self, value):
+        if not isinstance(value, dict):
+            raise serializers.ValidationError("Ожидается объект.")
+        columns = value.get("columns") or {}
+        if not isinstance(columns, dict):
+            raise serializers.ValidationError({"columns": "Ожидается объект {поле: индекс колонки}."})
+        unknown = set(columns) - set(self._COLUMNS)
+        if unknown:
+            raise serializers.ValidationError({"columns": f"Неизвестные поля: {', '.join(sorted(unknown))}."})
+        for name, idx in columns.items():
+            if not isinstance(idx, int) or isinstance(idx, bool) or idx < 0:
+                raise serializers.ValidationError({"columns": f"{name}: индекс колонки — целое число ≥ 0."})
+        header_row = value.get("header_row", 0)
+        if not isinstance(header_row, int) or isinstance(header_row, bool) or header_row < 0:
+            raise serializers.ValidationError({"header_row": "Целое число ≥ 0."})
+        try:
+            default_qty = Decimal(str(value.get("default_qty", 50)))
+        except (InvalidOperation, ValueError):
+            raise serializers.ValidationError({"default_qty": "Ожидается число."})
+        return {
+            "columns": columns,
+            "header_row": header_row,
+            "update_existing": bool(value.get("update_existing", False)),
+            "default_qty": str(default_qty),
+        }
+
+
 class ProductCharacteristicsSerializer(serializers.ModelSerializer):
     class Meta:
         model = ProductCharacteristics
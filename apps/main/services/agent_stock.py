@@ -0,0 +1,183 @@
+"""
+Остатки агентов «на руках» (AgentProductBalance).
+
+Раньше /agents/me/products, /owner/agents/products и аналитика агента на каждый
+запрос грузили ВСЕ передачи агента/компании с приёмами, возвратами и продажами и
+группировали их в Python. Теперь остаток ключа (компания, филиал, агент, товар)
+хранится строкой и пересчитывается в той же транзакции, что меняет источник:
+
+  - передача, распределение продажи, принятый возврат, удаление любого из них —
+    receivers в apps/main/signals.py;
+  - приём (Acceptance.save) и счётчики через queryset.update()/bulk_update —
+    явный refresh_subreals(...).
+
+Остаток ключа = Σ max(принято − возвращено − продано, 0) по его передачам, как
+считали списки. Пересчитывается ключ целиком под select_for_update строки
+остатка: параллельные транзакции по одному ключу выстраиваются в очередь, и
+вторая считает уже по закоммиченным данным первой.
+
+Сверка и перестройка с нуля — команда rebuild_agent_balances (--verify).
+"""
+
+from __future__ import annotations
+
+from django.db import transaction
+from django.db.models import IntegerField, Max, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+KEY_FIELDS = ("company_id", "branch_id", "agent_id", "product_id")
+SUBREAL_KEY_FIELDS = tuple(f"subreal__{f}" for f in KEY_FIELDS)
+
+
+def key_of(subreal) -> tuple:
+    return tuple(getattr(subreal, f) for f in KEY_FIELDS)
+
+
+def _key_filter(key: tuple) -> dict:
+    return dict(zip(KEY_FIELDS, key))
+
+
+def _latest(*values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+def with_sold(subreals):
+    """Передачи с проданным количеством (все распределения продаж по передаче)."""
+    from apps.main.models import AgentSaleAllocation
+
+    sold = (
+        AgentSaleAllocation.objects.filter(subreal=OuterRef("pk"))
+        .order_by()
+        .values("subreal")
+        .annotate(s=Sum("qty"))
+        .values("s")
+    )
+    return subreals.annotate(sold=Coalesce(Subquery(sold, output_field=IntegerField()), Value(0)))
+
+
+def on_hand(accepted, returned, sold) -> int:
+    return max(int(accepted or 0) - int(returned or 0) - int(sold or 0), 0)
+
+
+# ---------- один ключ ----------
+def compute(key: tuple):
+    """(остаток, последнее движение, есть ли передачи) ключа по сырым строкам."""
+    from apps.main.models import ManufactureSubreal, ReturnFromAgent
+
+    subreals = ManufactureSubreal.objects.filter(**_key_filter(key))
+    qty = 0
+    exists = False
+    for accepted, returned, sold in with_sold(subreals).values_list("qty_accepted", "qty_returned", "sold"):
+        exists = True
+        qty += on_hand(accepted, returned, sold)
+    if not exists:
+        return 0, None, False
+
+    dates = subreals.aggregate(
+        created=Max("created_at"),
+        accepted=Max("acceptances__accepted_at"),
+        returned=Max("returns__accepted_at", filter=Q(returns__status=ReturnFromAgent.Status.ACCEPTED)),
+    )
+    return qty, _latest(*dates.values()), True
+
+
+def refresh_keys(keys, *, create: bool = True) -> None:
+    """
+    Пересчитать строки остатков ключей. create=False — только существующие строки
+    (вызовы из удаления: не создаём строк посреди каскадного удаления компании).
+    """
+    from apps.main.models import AgentProductBalance
+
+    for key in sorted(set(keys), key=lambda k: tuple(str(v) for v in k)):
+        with transaction.atomic():
+            rows = AgentProductBalance.objects.select_for_update().filter(**_key_filter(key))
+            row = rows.first()
+            if row is None:
+                if not create:
+                    continue
+                AgentProductBalance.objects.get_or_create(**_key_filter(key))
+                row = rows.first()  # блокируем свою или параллельно созданную строку
+            qty, last_movement_at, exists = compute(key)
+            if not exists:
+                rows.delete()
+                continue
+            if (row.qty_on_hand, row.last_movement_at) != (qty, last_movement_at):
+                row.qty_on_hand = qty
+                row.last_movement_at = last_movement_at
+                row.save(update_fields=["qty_on_hand", "last_movement_at", "updated_at"])
+
+
+def refresh_subreals(subreal_ids, *, create: bool = True) -> None:
+    from apps.main.models import ManufactureSubreal
+
+    ids = {pk for pk in subreal_ids if pk}
+    if not ids:
+        return
+    keys = ManufactureSubreal.objects.filter(pk__in=ids).values_list(*KEY_FIELDS).distinct()
+    refresh_keys([tuple(k) for k in keys], create=create)
+
+
+# ---------- все ключи ----------
+def scan(company_id=None) -> dict:
+    """{ключ: [остаток, последнее движение]} по сырым строкам — для перестройки и сверки."""
+    from apps.main.models import Acceptance, ManufactureSubreal, ReturnFromAgent
+
+    scope = {"company_id": company_id} if company_id else {}
+    result: dict = {}
+    subreals = with_sold(ManufactureSubreal.objects.filter(**scope)).values_list(
+        *KEY_FIELDS, "qty_accepted", "qty_returned", "sold", "created_at"
+    )
+    for *key, accepted, returned, sold, created_at in subreals.iterator(chunk_size=2000):
+        acc = result.setdefault(tuple(key), [0, None])
+        acc[0] += on_hand(accepted, returned, sold)
+        acc[1] = _latest(acc[1], created_at)
+
+    sub_scope = {"subreal__company_id": company_id} if company_id else {}
+    for model, extra in (
+        (Acceptance, {}),
+        (ReturnFromAgent, {"status": ReturnFromAgent.Status.ACCEPTED}),
+    ):
+        for *key, moved_at in (
+            model.objects.filter(**sub_scope, **extra)
+            .values(*SUBREAL_KEY_FIELDS)
+            .annotate(m=Max("accepted_at"))
+            .order_by()
+            .values_list(*SUBREAL_KEY_FIELDS, "m")
+        ):
+            acc = result.get(tuple(key))
+            if acc is not None:
+                acc[1] = _latest(acc[1], moved_at)
+    return result
+
+
+def rebuild(company_id=None) -> int:
+    """Пересоздать строки остатков с нуля; возвращает их число."""
+    from apps.main.models import AgentProductBalance
+
+    rows = [
+        AgentProductBalance(**_key_filter(key), qty_on_hand=qty, last_movement_at=last)
+        for key, (qty, last) in scan(company_id).items()
+    ]
+    scope = {"company_id": company_id} if company_id else {}
+    with transaction.atomic():
+        AgentProductBalance.objects.filter(**scope).delete()
+        AgentProductBalance.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def verify(company_id=None) -> list:
+    """Расхождения [(ключ, сохранено, ожидается)]; (остаток, последнее движение) или None."""
+    from apps.main.models import AgentProductBalance
+
+    scope = {"company_id": company_id} if company_id else {}
+    stored = {
+        tuple(r[:4]): (r[4], r[5])
+        for r in AgentProductBalance.objects.filter(**scope).values_list(*KEY_FIELDS, "qty_on_hand", "last_movement_at")
+    }
+    expected = {key: tuple(value) for key, value in scan(company_id).items()}
+    return [
+        (key, stored.get(key), expected.get(key))
+        for key in stored.keys() | expected.keys()
+        if stored.get(key) != expected.get(key)
+    ]
@@ -0,0 +1,459 @@
+"""
+Чекпоинты сальдо для актов сверки (клиенты — здесь, контрагенты склада —
+apps/warehouse/services_checkpoints.py).
+
+Раньше начальное сальдо считалось агрегатом по ВСЕЙ истории клиента/контрагента
+до start. Теперь:
+
+    сальдо на start = чекпоинт на первое число месяца start
+                      + обороты с первого числа до start.
+
+Чекпоинт месяца P хранит суммы по всем строкам, локальная дата которых < P.
+Нет чекпоинта — он строится при чтении от ближайшего более раннего (или с начала
+истории) и сохраняется.
+
+Ведение: save/delete строк-источников (продажа, сделка, оплата рассрочки,
+проведение/отмена документа) переносят их вклад — из старого состояния в новое —
+одним UPDATE ... SET f = f + delta на все чекпоинты ключа позже даты строки
+(receivers в apps/main/signals.py; старое состояние снимается в post_init).
+
+Построение чекпоинта и перенос вклада берут одну блокировку — строку владельца
+ключа (клиент / контрагент) под select_for_update. Чекпоинт считается только по
+закоммиченным строкам, а вклад, записанный во время построения, ложится уже на
+сохранённый чекпоинт. Гарантия действует, когда строка-источник пишется внутри
+транзакции (все пути проведения так и делают).
+
+queryset.update()/bulk_create мимо save() сигналов не шлют. Такие расхождения
+находит ночная задача verify_balance_checkpoints (CELERY_BEAT_SCHEDULE): она
+сверяет чекпоинты с сырыми строками и перестраивает компании с расхождениями.
+Вручную — rebuild_balance_checkpoints (--verify только сверяет).
+"""
+
+from __future__ import annotations
+
+from datetime import datetime, time
+from decimal import Decimal
+from functools import cached_property, lru_cache
+
+from django.db import transaction
+from django.db.models import DecimalField, F, Q, Sum, Value
+from django.db.models.functions import Coalesce, TruncMonth
+from django.utils import timezone
+
+Z_MONEY = Decimal("0.00")
+MONEY_FIELD = DecimalField(max_digits=18, decimal_places=2)
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def next_month(day):
+    return day.replace(year=day.year + 1, month=1) if day.month == 12 else day.replace(month=day.month + 1)
+
+
+def midnight(day):
+    return timezone.make_aware(datetime.combine(day, time.min), timezone.get_current_timezone())
+
+
+def local_day(value):
+    """date для DateField, локальная дата для DateTimeField (как TruncDate в TIME_ZONE проекта)."""
+    if isinstance(value, datetime):
+        return timezone.localtime(value).date() if timezone.is_aware(value) else value.date()
+    return value
+
+
+def money_sum(field, **filter_kwargs):
+    """Coalesce(Sum(...), 0) — чтобы в Python не проверять None."""
+    return Coalesce(
+        Sum(field, filter=Q(**filter_kwargs) if filter_kwargs else None),
+        Value(Z_MONEY, output_field=MONEY_FIELD),
+        output_field=MONEY_FIELD,
+    )
+
+
+class CheckpointLedger:
+    """
+    Общая механика; наследник задаёт модель чекпоинта, поля ключа/сумм и источники:
+
+      sources        — {модель-источник: поля состояния}
+      owner_model    — модель владельца ключа (её строка — блокировка ключа), поле owner_field
+      contributions  — вклад состояния строки: [(ключ, локальная дата, {поле: сумма})];
+                       lookups — общий на одно изменение кэш справочных выборок
+      period_sums    — обороты ключа за [since, until) из сырых строк
+      monthly_sums   — обороты по ключам и месяцам для перестройки
+    """
+
+    model = None
+    owner_model = None
+    owner_field: str = ""
+    key_fields: tuple = ()
+    amount_fields: tuple = ()
+
+    def sources(self) -> dict:
+        raise NotImplementedError
+
+    def contributions(self, sender, state, lookups: dict) -> list:
+        raise NotImplementedError
+
+    def period_sums(self, key: tuple, since, until) -> dict:
+        raise NotImplementedError
+
+    def monthly_sums(self, company_id=None):
+        raise NotImplementedError
+
+    # ---------- helpers ----------
+    def zero(self) -> dict:
+        return {f: Z_MONEY for f in self.amount_fields}
+
+    def _key_filter(self, key: tuple) -> dict:
+        return dict(zip(self.key_fields, key))
+
+    def lock_keys(self, keys) -> None:
+        """SELECT ... FOR UPDATE строк владельцев ключей (в порядке pk). Вызывать внутри atomic()."""
+        index = self.key_fields.index(self.owner_field)
+        owner_ids = sorted({key[index] for key in keys}, key=str)
+        if owner_ids:
+            list(
+                self.owner_model.objects.select_for_update()
+                .filter(pk__in=owner_ids)
+                .order_by("pk")
+                .values_list("pk", flat=True)
+            )
+
+    # ---------- состояние строк-источников ----------
+    @cached_property
+    def _fields(self) -> dict:
+        return self.sources()
+
+    def state(self, instance):
+        """Поля источника из __dict__ (None — что-то отложено, тогда читаем из БД)."""
+        fields = self._fields[type(instance)]
+        if any(f not in instance.__dict__ for f in fields):
+            return None
+        return tuple(instance.__dict__[f] for f in fields)
+
+    def load_state(self, sender, pk):
+        row = sender._default_manager.filter(pk=pk).values_list(*self._fields[sender]).first()
+        return tuple(row) if row else None
+
+    # ---------- ведение ----------
+    def apply_change(self, sender, old_state, new_state) -> int:
+        """Переносит вклад строки из old_state в new_state; возвращает число UPDATE."""
+        if old_state == new_state:
+            return 0
+        deltas: dict = {}
+        lookups: dict = {}
+        for sign, state in ((-1, old_state), (1, new_state)):
+            if state is None:
+                continue
+            for key, day, amounts in self.contributions(sender, state, lookups):
+                acc = deltas.setdefault((key, day), self.zero())
+                for name, amount in amounts.items():
+                    acc[name] += sign * Decimal(amount or 0)
+
+        pending = []
+        for (key, day), amounts in deltas.items():
+            changes = {name: F(name) + amount for name, amount in amounts.items() if amount}
+            if changes:
+                pending.append((key, day, changes))
+        if not pending:
+            return 0
+
+        with transaction.atomic():
+            self.lock_keys([key for key, _, _ in pending])
+            for key, day, changes in pending:
+                self.model.objects.filter(**self._key_filter(key), period_start__gt=day).update(**changes)
+        return len(pending)
+
+    # ---------- чтение ----------
+    def checkpoint(self, key: tuple, month) -> dict:
+        """
+        Суммы на начало месяца month; недостающий чекпоинт досчитывается под
+        блокировкой ключа (см. docstring модуля) и сохраняется.
+        """
+        def nearest():
+            return (
+                self.model.objects.filter(**self._key_filter(key), period_start__lte=month)
+                .order_by("-period_start")
+                .values("period_start", *self.amount_fields)
+                .first()
+            )
+
+        row = nearest()
+        if row is not None and row["period_start"] == month:
+            return {f: row[f] for f in self.amount_fields}
+
+        with transaction.atomic():
+            self.lock_keys([key])
+            row = nearest()  # пока ждали блокировку, чекпоинт мог построить соседний запрос
+            if row is not None and row["period_start"] == month:
+                return {f: row[f] for f in self.amount_fields}
+
+            since = row["period_start"] if row is not None else None
+            sums = self.period_sums(key, since, midnight(month))
+            values = {f: (row[f] if row is not None else Z_MONEY) + sums[f] for f in self.amount_fields}
+            self.model.objects.create(**self._key_filter(key), period_start=month, **values)
+        return values
+
+    def balance_before(self, key: tuple, start_dt) -> dict:
+        """Суммы по всем строкам ключа раньше start_dt: чекпоинт + хвост текущего месяца."""
+        month = month_start(local_day(start_dt))
+        base = self.checkpoint(key, month)
+        tail = self.period_sums(key, month, start_dt)
+        return {f: base[f] + tail[f] for f in self.amount_fields}
+
+    # ---------- перестройка и сверка ----------
+    def expected(self, company_id=None, *, until=None) -> dict:
+        """
+        Чекпоинты с нуля по сырым строкам: {(ключ, месяц): суммы} на каждый месяц
+        от первой строки ключа до until (по умолчанию — текущий месяц).
+        """
+        until = month_start(until or timezone.localdate())
+        per_key: dict = {}
+        for key, month, amounts in self.monthly_sums(company_id):
+            months = per_key.setdefault(key, {})
+            acc = months.setdefault(month, self.zero())
+            for name, amount in amounts.items():
+                acc[name] += amount or Z_MONEY
+
+        result = {}
+        for key, months in per_key.items():
+            running = self.zero()
+            month = min(months)
+            while True:
+                for name, amount in months.get(month, {}).items():
+                    running[name] += amount
+                month = next_month(month)
+                if month > until:
+                    break
+                result[(key, month)] = dict(running)
+        return result
+
+    def rebuild(self, company_id=None, *, until=None) -> int:
+        """Пересчитать чекпоинты с нуля (см. expected). Возвращает число созданных строк."""
+        rows = [
+            self.model(**self._key_filter(key), period_start=month, **amounts)
+            for (key, month), amounts in self.expected(company_id, until=until).items()
+        ]
+        scope = {"company_id": company_id} if company_id else {}
+        with transaction.atomic():
+            self.model.objects.filter(**scope).delete()
+            self.model.objects.bulk_create(rows, batch_size=1000)
+        return len(rows)
+
+    def verify(self, company_id=None) -> list:
+        """Расхождения сохранённых чекпоинтов с сырыми строками: [(ключ, месяц, сохранено, ожидается)]."""
+        scope = {"company_id": company_id} if company_id else {}
+        size = len(self.key_fields)
+        stored = {
+            (tuple(r[:size]), r[size]): dict(zip(self.amount_fields, r[size + 1:]))
+            for r in self.model.objects.filter(**scope).values_list(
+                *self.key_fields, "period_start", *self.amount_fields
+            )
+        }
+        if not stored:
+            return []
+        expected = self.expected(company_id, until=max(month for _, month in stored))
+        diffs = []
+        for (key, month), amounts in stored.items():
+            fresh = expected.get((key, month), self.zero())
+            if amounts != fresh:
+                diffs.append((key, month, amounts, fresh))
+        return diffs
+
+
+def month_of(field):
+    return TruncMonth(field, tzinfo=timezone.get_current_timezone())
+
+
+# ─────────────────────────────────────────────────────────────
+# клиенты (акт сверки pos_views.ClientReconciliation*)
+# ─────────────────────────────────────────────────────────────
+class ClientLedger(CheckpointLedger):
+    key_fields = ("company_id", "client_id")
+    amount_fields = ("sales_debit", "deals_debit", "deals_credit")
+
+    owner_field = "client_id"
+
+    @property
+    def model(self):
+        from apps.main.models import ClientBalanceCheckpoint
+
+        return ClientBalanceCheckpoint
+
+    @property
+    def owner_model(self):
+        from apps.main.models import Client
+
+        return Client
+
+    def sources(self) -> dict:
+        from apps.main.models import ClientDeal, DealInstallment, Sale
+
+        return {
+            Sale: ("company_id", "client_id", "created_at", "total"),
+            ClientDeal: ("company_id", "client_id", "created_at", "kind", "amount", "prepayment"),
+            DealInstallment: ("deal_id", "paid_on", "amount"),
+        }
+
+    @staticmethod
+    def debit_kinds():
+        from apps.main.models import ClientDeal
+
+        return (ClientDeal.Kind.SALE, ClientDeal.Kind.AMOUNT, ClientDeal.Kind.DEBT)
+
+    def contributions(self, sender, state, lookups: dict) -> list:
+        from apps.main.models import ClientDeal, Sale
+
+        if sender is Sale:
+            company_id, client_id, created_at, total = state
+            if not (company_id and client_id and created_at):
+                return []
+            return [((company_id, client_id), local_day(created_at), {"sales_debit": total})]
+
+        if sender is ClientDeal:
+            company_id, client_id, created_at, kind, amount, prepayment = state
+            if not (company_id and client_id and created_at):
+                return []
+            debit = amount if kind in self.debit_kinds() else Z_MONEY
+            return [((company_id, client_id), local_day(created_at), {"deals_debit": debit, "deals_credit": prepayment})]
+
+        # DealInstallment: клиент и компания — со сделки (как в акте: deal__company, deal__client)
+        deal_id, paid_on, amount = state
+        if not (deal_id and paid_on):
+            return []
+        if ("deal", deal_id) not in lookups:
+            lookups[("deal", deal_id)] = (
+                ClientDeal.objects.filter(pk=deal_id).values_list("company_id", "client_id").first()
+            )
+        deal = lookups[("deal", deal_id)]
+        if deal is None or not all(deal):
+            return []
+        return [(tuple(deal), paid_on, {"deals_credit": amount})]
+
+    def period_sums(self, key: tuple, since, until) -> dict:
+        from apps.main.models import ClientDeal, DealInstallment, Sale
+
+        company_id, client_id = key
+        dt_range = {"created_at__lt": until}
+        day_range = {"paid_on__lt": until.date()}
+        if since is not None:
+            dt_range["created_at__gte"] = midnight(since)
+            day_range["paid_on__gte"] = since
+
+        sales = Sale.objects.filter(company_id=company_id, client_id=client_id, **dt_range).aggregate(
+            s=money_sum("total")
+        )
+        deals = ClientDeal.objects.filter(company_id=company_id, client_id=client_id, **dt_range).aggregate(
+            debit=money_sum("amount", kind__in=self.debit_kinds()),
+            credit=money_sum("prepayment"),
+        )
+        inst = DealInstallment.objects.filter(
+            deal__company_id=company_id, deal__client_id=client_id, paid_on__isnull=False, **day_range
+        ).aggregate(s=money_sum("amount"))
+        return {
+            "sales_debit": sales["s"],
+            "deals_debit": deals["debit"],
+            "deals_credit": deals["credit"] + inst["s"],
+        }
+
+    def monthly_sums(self, company_id=None):
+        from apps.main.models import ClientDeal, DealInstallment, Sale
+
+        scope = {"company_id": company_id} if company_id else {}
+        for r in (
+            Sale.objects.filter(client__isnull=False, **scope)
+            .annotate(m=month_of("created_at"))
+            .values("company_id", "client_id", "m")
+            .annotate(s=money_sum("total"))
+            .order_by()
+        ):
+            yield (r["company_id"], r["client_id"]), local_day(r["m"]), {"sales_debit": r["s"]}
+
+        for r in (
+            ClientDeal.objects.filter(**scope)
+            .annotate(m=month_of("created_at"))
+            .values("company_id", "client_id", "m")
+            .annotate(debit=money_sum("amount", kind__in=self.debit_kinds()), credit=money_sum("prepayment"))
+            .order_by()
+        ):
+            yield (r["company_id"], r["client_id"]), local_day(r["m"]), {"deals_debit": r["debit"], "deals_credit": r["credit"]}
+
+        deal_scope = {"deal__company_id": company_id} if company_id else {}
+        for r in (
+            DealInstallment.objects.filter(paid_on__isnull=False, **deal_scope)
+            .annotate(m=TruncMonth("paid_on"))
+            .values("deal__company_id", "deal__client_id", "m")
+            .annotate(s=money_sum("amount"))
+            .order_by()
+        ):
+            yield (r["deal__company_id"], r["deal__client_id"]), r["m"], {"deals_credit": r["s"]}
+
+    def opening(self, company_id, client_id, start_dt, source: str = "both") -> Decimal:
+        """Начальное сальдо акта сверки клиента (дебет − кредит) для source = both|sales|deals."""
+        sums = self.balance_before((company_id, client_id), start_dt)
+        debit = credit = Z_MONEY
+        if source in ("both", "sales"):
+            debit += sums["sales_debit"]
+        if source in ("both", "deals"):
+            debit += sums["deals_debit"]
+            credit += sums["deals_credit"]
+        return debit - credit
+
+
+CLIENT_LEDGER = ClientLedger()
+
+
+# ─────────────────────────────────────────────────────────────
+# реестр для signals.py
+# ─────────────────────────────────────────────────────────────
+def ledgers() -> tuple:
+    from apps.warehouse.services_checkpoints import COUNTERPARTY_LEDGER
+
+    return (CLIENT_LEDGER, COUNTERPARTY_LEDGER)
+
+
+@lru_cache(maxsize=None)
+def _registry() -> dict:
+    return {model: ledger for ledger in ledgers() for model in ledger._fields}
+
+
+def _ledger_for(instance):
+    return _registry().get(type(instance))
+
+
+def remember(instance) -> None:
+    """post_init: запомнить состояние строки, с которым она пришла из БД."""
+    ledger = _ledger_for(instance)
+    if ledger is not None:
+        instance._balance_state = ledger.state(instance)
+
+
+def before_save(instance) -> None:
+    """pre_save: состояния нет (поля были отложены) — дочитать из БД до записи."""
+    if instance._state.adding or getattr(instance, "_balance_state", None) is not None:
+        return
+    ledger = _ledger_for(instance)
+    if ledger is not None:
+        instance._balance_state = ledger.load_state(type(instance), instance.pk)
+
+
+def after_save(instance, created: bool) -> None:
+    ledger = _ledger_for(instance)
+    if ledger is None:
+        return
+    sender = type(instance)
+    old = None if created else getattr(instance, "_balance_state", None)
+    new = ledger.state(instance) or ledger.load_state(sender, instance.pk)
+    ledger.apply_change(sender, old, new)
+    instance._balance_state = new
+
+
+def before_delete(instance) -> None:
+    ledger = _ledger_for(instance)
+    if ledger is None:
+        return
+    sender = type(instance)
+    old = getattr(instance, "_balance_state", None) or ledger.load_state(sender, instance.pk)
+    ledger.apply_change(sender, old, None)
@@ -0,0 +1,173 @@
+"""
+Движок виджетов дашборда (apps/main/analytics_dashboard.py).
+
+Раньше build_dashboard_payload выполнял ~20 независимых агрегатов подряд, и
+задержка дашборда была их суммой. Теперь каждый блок — Widget: функция от
+контекста (компания, филиал, период, мастер), свой TTL и домены поколений кэша.
+
+run_widgets():
+  - читает закэшированные виджеты одним get_many;
+  - остальные считает параллельно на общем пуле потоков
+    (DASHBOARD_WIDGET_WORKERS); у потока пула свои соединения с БД, они
+    закрываются/переиспользуются по CONN_MAX_AGE, как после запроса;
+  - ждёт каждый виджет не дольше его budget: не успевший попадает в timed_out,
+    а вызывающий подставляет default. Уже начатый виджет досчитывается и всё
+    равно кладётся в кэш — следующий запрос его получит; ещё не начатый
+    (стоит в очереди пула) отменяется, чтобы не занимать пул зря;
+  - виджет с тем же ключом кэша, который уже в очереди или считается (другим
+    запросом), второй раз не ставится: запрос ждёт тот же future;
+  - возвращает тайминги каждого виджета (мс, из кэша или нет).
+
+Внутри транзакции (ATOMIC_REQUESTS, тесты) потоки пула не видят её данных,
+поэтому там виджеты считаются последовательно в текущем потоке.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from apps.main.cache_utils import cache_generations, cache_key
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Widget:
+    name: str
+    compute: Callable[[Any], Any]  # compute(ctx) -> значение (pickle-совместимое)
+    ttl: int = 60
+    domains: tuple = ()  # CACHE_DOMAIN_*: изменение данных домена сбрасывает виджет
+    budget: float | None = None  # секунд; None -> settings.DASHBOARD_WIDGET_BUDGET
+    default: Callable[[], Any] = dict  # значение, если виджет не уложился в budget
+
+
+@dataclass
+class WidgetRun:
+    results: dict = field(default_factory=dict)  # name -> значение
+    timings: dict = field(default_factory=dict)  # name -> {"ms": int, "cached": bool}
+    timed_out: list = field(default_factory=list)
+
+    def get(self, widget: Widget):
+        if widget.name in self.results:
+            return self.results[widget.name]
+        return widget.default()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=getattr(settings, "DASHBOARD_WIDGET_WORKERS", 4),
+                thread_name_prefix="dashboard-widget",
+            )
+    return _pool
+
+
+_inflight: dict[str, Future] = {}  # ключ кэша виджета -> future в очереди/в работе
+_inflight_lock = threading.Lock()
+
+
+def _forget(key: str, future: Future) -> None:
+    with _inflight_lock:
+        if _inflight.get(key) is future:
+            del _inflight[key]
+
+
+def _submit(widget: Widget, ctx, key: str, tz) -> Future:
+    with _inflight_lock:
+        future = _inflight.get(key)
+        if future is not None:
+            return future
+        future = _executor().submit(_compute_in_pool, widget, ctx, key, tz)
+        _inflight[key] = future
+    # снаружи блокировки: у завершённого future колбэк вызывается сразу
+    future.add_done_callback(lambda f: _forget(key, f))
+    return future
+
+
+def _widget_key(widget: Widget, ctx_key: tuple, generations: dict) -> str:
+    gens = tuple((d, generations[d]) for d in sorted(widget.domains))
+    return cache_key("dashboard:widget", widget.name, ctx_key, gens)
+
+
+def _compute_in_pool(widget: Widget, ctx, key: str, tz):
+    close_old_connections()
+    try:
+        # активная таймзона запроса потоково-локальна: TruncDate/ExtractWeekDay считают в ней
+        with timezone.override(tz):
+            started = time.monotonic()
+            value = widget.compute(ctx)
+            elapsed_ms = int((time.monotonic() - started) * 1000)
+        cache.set(key, value, widget.ttl)
+        return value, elapsed_ms
+    finally:
+        close_old_connections()
+
+
+def run_widgets(widgets, ctx, *, ctx_key: tuple, company_id=None) -> WidgetRun:
+    """
+    Посчитать виджеты для ctx. ctx_key — всё, от чего зависит результат, кроме
+    имени виджета (компания, филиал, период, мастер): из него строится ключ кэша.
+    """
+    run = WidgetRun()
+    widgets = list(widgets)
+    domains = {d for w in widgets for d in w.domains}
+    generations = cache_generations(company_id, sorted(domains)) if (domains and company_id) else {}
+    keys = {w.name: _widget_key(w, ctx_key, generations) for w in widgets}
+
+    cached = cache.get_many(list(keys.values()))
+    pending = []
+    for w in widgets:
+        if keys[w.name] in cached:
+            run.results[w.name] = cached[keys[w.name]]
+            run.timings[w.name] = {"ms": 0, "cached": True}
+        else:
+            pending.append(w)
+    if not pending:
+        return run
+
+    workers = int(getattr(settings, "DASHBOARD_WIDGET_WORKERS", 4))
+    single = len(pending) == 1 and keys[pending[0].name] not in _inflight
+    if workers <= 1 or single or connection.in_atomic_block:
+        for w in pending:
+            started = time.monotonic()
+            value = w.compute(ctx)
+            cache.set(keys[w.name], value, w.ttl)
+            run.results[w.name] = value
+            run.timings[w.name] = {"ms": int((time.monotonic() - started) * 1000), "cached": False}
+        return run
+
+    tz = timezone.get_current_timezone()
+    default_budget = float(getattr(settings, "DASHBOARD_WIDGET_BUDGET", 5.0))
+    started = time.monotonic()
+    futures = [(w, _submit(w, ctx, keys[w.name], tz)) for w in pending]
+    for w, future in futures:
+        budget = w.budget if w.budget is not None else default_budget
+        try:
+            value, elapsed_ms = future.result(timeout=max(started + budget - time.monotonic(), 0))
+        except (FutureTimeoutError, CancelledError):
+            # CancelledError: тот же виджет ждал другой запрос и отменил его по своему budget
+            future.cancel()
+            run.timed_out.append(w.name)
+            run.timings[w.name] = {"ms": int((time.monotonic() - started) * 1000), "cached": False}
+            logger.warning("Dashboard widget %s exceeded budget %.1fs", w.name, budget)
+            continue
+        run.results[w.name] = value
+        run.timings[w.name] = {"ms": elapsed_ms, "cached": False}
+    return run
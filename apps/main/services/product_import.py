@@ -0,0 +1,474 @@
+"""
+Потоковый импорт товаров (Excel/CSV) в main.Product.
+
+Используется командой import_products_from_excel и фоновой задачей
+import_products_job (ProductImportJob, загрузка через API).
+
+Файл читается лениво (openpyxl read_only / csv.reader) и обрабатывается
+кусками по chunk_size строк; на кусок:
+  1) одна выборка существующих товаров по штрихкодам;
+  2) один блок кодов из счётчика компании (ProductCodeSequence);
+  3) bulk_create новых / bulk_update существующих (upsert по штрихкоду);
+     изменившимся весовым товарам — блок ревизий каталога весов;
+  4) события вебхука пишутся в outbox пачкой — без post_save на каждую строку.
+Сброс POS-индекса штрихкодов и запуск рассылки вебхуков — один раз на импорт.
+"""
+
+from __future__ import annotations
+
+import csv
+import io
+import os
+import time
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+from typing import Callable, Iterable, Iterator, Optional
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from apps.main.models import Product
+from apps.main.services.webhook_outbox import EVENT_CREATED, EVENT_UPDATED, enqueue_product_events, schedule_dispatch
+
+DEFAULT_CHUNK_SIZE = 1000
+MAX_STORED_ERRORS = 100
+
+# поле -> варианты заголовка (поиск по вхождению, как в прежней команде)
+COLUMN_ALIASES = {
+    "barcode": ["barcode", "штрих", "штрихкод", "штрих-код", "ean"],
+    "name": ["name", "название", "наименование", "товар"],
+    "article": ["article", "артикул", "код"],
+    "price": ["price", "цена", "цена продажи"],
+    "purchase_price": ["purchase_price", "закупка", "цена закупки", "себестоимость"],
+    "quantity": ["quantity", "количество", "остаток", "qty"],
+    "unit": ["unit", "единица", "ед. изм", "ед"],
+}
+
+# при обновлении существующего товара количество и код не трогаем;
+# scale_revision — новая ревизия каталога весов для изменившихся весовых товаров
+UPDATE_FIELDS = ["name", "article", "price", "purchase_price", "markup_percent", "unit", "scale_revision", "updated_at"]
+# поля, которые импорт может поменять и которые уходят на весы
+SCALE_FIELDS = ("name", "price")
+
+
+class ProductImportError(Exception):
+    """Файл нельзя импортировать (формат, нет колонки штрихкода и т.п.)."""
+
+
+# --------- чтение файла ---------
+
+def col_index(headers, names, fallback_col=None):
+    """Найти индекс колонки по заголовку или вернуть fallback."""
+    if fallback_col is not None:
+        return fallback_col
+    headers_lower = [str(h).strip().lower() if h is not None else "" for h in headers]
+    for name in names:
+        for i, h in enumerate(headers_lower):
+            if name in h or h in name:
+                return i
+    return None
+
+
+def cell(row, col, default=""):
+    if col is None or col >= len(row):
+        return default
+    v = row[col]
+    if v is None:
+        return default
+    s = str(v).strip()
+    return s if s else default
+
+
+def decimal_cell(row, col, default=Decimal("0")):
+    v = cell(row, col)
+    if not v:
+        return default
+    try:
+        return Decimal(str(v).replace(",", "."))
+    except (InvalidOperation, ValueError):
+        return default
+
+
+def _iter_xlsx(path) -> Iterator[list]:
+    import openpyxl
+
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        if ws is None:
+            raise ProductImportError("Нет активного листа")
+        for row in ws.iter_rows(values_only=True):
+            yield list(row)
+    finally:
+        wb.close()
+
+
+def _sniff_csv(sample: bytes):
+    for encoding in ("utf-8-sig", "cp1251"):
+        try:
+            text = sample.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        encoding, text = "latin-1", sample.decode("latin-1")
+    # обрезанный последний символ/строка не мешают определению разделителя
+    head = "\n".join(text.splitlines()[:20])
+    try:
+        delimiter = csv.Sniffer().sniff(head, delimiters="\t;,").delimiter
+    except csv.Error:
+        delimiter = max(("\t", ";", ","), key=head.count)
+    return encoding, delimiter
+
+
+def _iter_csv(path) -> Iterator[list]:
+    with open(path, "rb") as f:
+        sample = f.read(64 * 1024)
+    encoding, delimiter = _sniff_csv(sample)
+    with io.open(path, "r", encoding=encoding, newline="") as f:
+        yield from csv.reader(f, delimiter=delimiter)
+
+
+def iter_file_rows(path) -> Iterator[list]:
+    """
+    Ленивый итератор строк файла: .xlsx/.xlsm — openpyxl read_only, текст — CSV/TSV.
+    Для прочих форматов (.xls, выгрузки 1С) — ProductImportError.
+    """
+    with open(path, "rb") as f:
+        head = f.read(512)
+    if head[:2] == b"PK":
+        return _iter_xlsx(path)
+    binary = head[:4] == b"\xd0\xcf\x11\xe0" or head[:2] == b"L\x00" or head.count(b"\x00") > len(head) // 4
+    if binary or not head:
+        raise ProductImportError(f"Формат файла не поддерживается потоковым импортом: {os.path.basename(str(path))}")
+    return _iter_csv(path)
+
+
+# --------- импорт ---------
+
+@dataclass
+class ImportStats:
+    rows: int = 0
+    created: int = 0
+    updated: int = 0
+    skipped_no_barcode: int = 0
+    skipped_duplicate: int = 0
+    error_count: int = 0
+    errors: list = field(default_factory=list)  # [(номер строки, штрихкод, текст)], не больше MAX_STORED_ERRORS
+    started: float = field(default_factory=time.monotonic)
+    finished: Optional[float] = None
+
+    @property
+    def skipped(self) -> int:
+        return self.skipped_no_barcode + self.skipped_duplicate
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rows_per_second(self) -> float:
+        elapsed = self.elapsed
+        return round(self.rows / elapsed, 1) if elapsed > 0 else 0.0
+
+    def add_error(self, row_num, barcode, message) -> None:
+        self.error_count += 1
+        if len(self.errors) < MAX_STORED_ERRORS:
+            self.errors.append((row_num, barcode, message))
+
+
+class ProductImporter:
+    """
+    columns: {"barcode": 0, "name": 1, ...} — явные индексы колонок (0-based),
+    остальные ищутся по заголовку (COLUMN_ALIASES).
+    update_existing=False — товары с уже известным штрихкодом пропускаются (как --skip-duplicates),
+    True — обновляются цены/название/артикул/единица.
+    progress(stats) вызывается после каждого куска.
+    """
+
+    def __init__(
+        self,
+        company,
+        *,
+        branch=None,
+        columns: Optional[dict] = None,
+        header_row: int = 0,
+        update_existing: bool = False,
+        default_qty: Decimal = Decimal("50"),
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        dry_run: bool = False,
+        progress: Optional[Callable[[ImportStats], None]] = None,
+    ):
+        self.company = company
+        self.branch = branch
+        self.columns = dict(columns or {})
+        self.header_row = max(0, int(header_row))
+        self.update_existing = update_existing
+        self.default_qty = Decimal(str(default_qty))
+        self.chunk_size = max(1, int(chunk_size))
+        self.dry_run = dry_run
+        self.progress = progress
+        self.stats = ImportStats()
+        self.headers: list = []
+        self.cols: dict = {}
+
+    # --- колонки ---
+
+    def _resolve_columns(self, headers) -> dict:
+        cols = {
+            name: col_index(headers, aliases, self.columns.get(name))
+            for name, aliases in COLUMN_ALIASES.items()
+        }
+        if cols["barcode"] is None:
+            raise ProductImportError(
+                "Не найдена колонка штрихкода. Укажите индекс колонки barcode (0-based). "
+                f"Заголовки: {list(headers)[:10]}"
+            )
+        return cols
+
+    # --- строки ---
+
+    def _parse(self, row) -> Optional[dict]:
+        cols = self.cols
+        barcode = cell(row, cols["barcode"])
+        if not barcode:
+            return None
+
+        name = cell(row, cols["name"]) if cols["name"] is not None else barcode
+        price = decimal_cell(row, cols["price"]) if cols["price"] is not None else Decimal("0")
+        purchase_price = (
+            decimal_cell(row, cols["purchase_price"], price) if cols["purchase_price"] is not None else price
+        )
+        quantity = (
+            decimal_cell(row, cols["quantity"], self.default_qty) if cols["quantity"] is not None else self.default_qty
+        )
+        unit = cell(row, cols["unit"]) if cols["unit"] is not None else ""
+        article = cell(row, cols["article"]) if cols["article"] is not None else ""
+        markup = (
+            Decimal("0")
+            if purchase_price == 0
+            else ((price - purchase_price) / purchase_price * 100).quantize(Decimal("0.01"))
+        )
+        return {
+            "barcode": barcode[:64],
+            "name": (name or f"Товар {barcode}")[:255],
+            "article": article[:64],
+            "price": price,
+            "purchase_price": purchase_price,
+            "markup_percent": markup,
+            "quantity": quantity,
+            "unit": (unit or "шт.")[:32],
+        }
+
+    def _apply(self, product: Product, values: dict) -> None:
+        for name in ("name", "article", "price", "purchase_price", "markup_percent"):
+            setattr(product, name, values[name])
+        product.unit = values["unit"]
+        product._recalc_price()
+
+    # --- запись куска ---
+
+    def _write_chunk(self, parsed: dict) -> tuple[list, list]:
+        company_id = self.company.id
+        existing = {
+            p.barcode: p
+            for p in Product.objects.filter(company_id=company_id, barcode__in=list(parsed))
+            .only("id", "company_id", "barcode", "is_weight", *UPDATE_FIELDS)
+        }
+        new_barcodes = [b for b in parsed if b not in existing]
+        if self.dry_run:
+            return [None] * len(new_barcodes), list(existing.values()) if self.update_existing else []
+
+        updated = []
+        if self.update_existing and existing:
+            now = timezone.now()
+            scale_changed = []
+            for barcode, product in existing.items():
+                before = [getattr(product, f) for f in SCALE_FIELDS]
+                self._apply(product, parsed[barcode][1])
+                product.updated_at = now
+                updated.append(product)
+                if product.is_weight and [getattr(product, f) for f in SCALE_FIELDS] != before:
+                    scale_changed.append(product)
+            if scale_changed:
+                # bulk_update минует Product._assign_numbers — ревизии выдаём блоком сами
+                from apps.main.utils_numbers import allocate_product_counters
+
+                first_revision = allocate_product_counters(company_id, revision=len(scale_changed))[2]
+                for offset, product in enumerate(scale_changed):
+                    product.scale_revision = first_revision + offset
+            Product.objects.bulk_update(updated, UPDATE_FIELDS, batch_size=self.chunk_size)
+
+        created = []
+        if new_barcodes:
+            from apps.main.utils_numbers import allocate_product_numbers
+
+            first_code, _ = allocate_product_numbers(company_id, code=len(new_barcodes))
+            for offset, barcode in enumerate(new_barcodes):
+                values = parsed[barcode][1]
+                product = Product(
+                    company=self.company,
+                    branch=self.branch,
+                    kind=Product.Kind.PRODUCT,
+                    barcode=barcode,
+                    code=f"{first_code + offset:04d}",
+                    quantity=values["quantity"],
+                )
+                self._apply(product, values)
+                created.append(product)
+            Product.objects.bulk_create(created, batch_size=self.chunk_size)
+
+        enqueue_product_events(company_id, [p.pk for p in created], EVENT_CREATED, schedule=False)
+        enqueue_product_events(company_id, [p.pk for p in updated], EVENT_UPDATED, schedule=False)
+        return created, updated
+
+    def _flush(self, chunk: list) -> None:
+        stats = self.stats
+        parsed = {}  # barcode -> (номер строки, значения); повтор в файле = дубликат
+        for row_num, row in chunk:
+            try:
+                values = self._parse(row)
+            except Exception as e:
+                stats.add_error(row_num, "", str(e))
+                continue
+            if values is None:
+                stats.skipped_no_barcode += 1
+            elif values["barcode"] in parsed or values["barcode"] in self._seen:
+                stats.skipped_duplicate += 1
+            else:
+                parsed[values["barcode"]] = (row_num, values)
+        if not parsed:
+            return
+
+        # конфликт по штрихкоду/коду с параллельной записью — перечитываем существующие и повторяем
+        for attempt in range(2):
+            try:
+                with transaction.atomic():
+                    created, updated = self._write_chunk(parsed)
+                break
+            except IntegrityError as e:
+                if attempt:
+                    for barcode, (row_num, _values) in parsed.items():
+                        stats.add_error(row_num, barcode, str(e))
+                    return
+
+        stats.created += len(created)
+        stats.updated += len(updated)
+        stats.skipped_duplicate += len(parsed) - len(created) - len(updated)
+        self._seen.update(parsed)
+
+    def run(self, rows: Iterable) -> ImportStats:
+        """rows — итератор строк файла вместе с заголовком (см. iter_file_rows)."""
+        it = iter(rows)
+        for _ in range(self.header_row):
+            next(it, None)
+        headers = next(it, None)
+        if headers is None:
+            raise ProductImportError("Файл пустой")
+        self.headers = list(headers)
+        self.cols = self._resolve_columns(self.headers)
+        self._seen = set()
+
+        stats = self.stats
+        chunk = []
+        row_num = self.header_row + 1  # номер строки заголовка (1-based)
+        for row in it:
+            row_num += 1
+            stats.rows += 1
+            chunk.append((row_num, row))
+            if len(chunk) >= self.chunk_size:
+                self._flush(chunk)
+                chunk = []
+                if self.progress:
+                    self.progress(stats)
+        if chunk:
+            self._flush(chunk)
+
+        stats.finished = time.monotonic()
+        if not self.dry_run and (stats.created or stats.updated):
+            from apps.main.barcode_index import invalidate_company_on_commit
+
+            invalidate_company_on_commit(self.company.id)
+            schedule_dispatch()
+        if self.progress:
+            self.progress(stats)
+        return stats
+
+
+# --------- фоновая задача ---------
+
+def _job_progress(job, stats: ImportStats, **extra) -> None:
+    type(job).objects.filter(pk=job.pk).update(
+        rows_processed=stats.rows,
+        created_count=stats.created,
+        updated_count=stats.updated,
+        skipped_count=stats.skipped,
+        error_count=stats.error_count,
+        rows_per_second=stats.rows_per_second,
+        **extra,
+    )
+
+
+def _local_copy(job):
+    """Путь к файлу задачи; для удалённого хранилища — временная копия (удаляется вызывающим)."""
+    try:
+        return job.file.path, False
+    except NotImplementedError:
+        pass
+    import shutil
+    import tempfile
+
+    suffix = os.path.splitext(job.file.name)[1]
+    with job.file.open("rb") as src, tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as dst:
+        shutil.copyfileobj(src, dst)
+    return dst.name, True
+
+
+def run_import_job(job_id) -> Optional[ImportStats]:
+    """Выполнить ProductImportJob (вызывается из Celery-задачи import_products_job)."""
+    from apps.main.models import ProductImportJob
+
+    job = ProductImportJob.objects.select_related("company", "branch").filter(
+        pk=job_id, status=ProductImportJob.Status.PENDING
+    ).first()
+    if job is None:
+        return None
+    started = ProductImportJob.objects.filter(pk=job.pk, status=ProductImportJob.Status.PENDING).update(
+        status=ProductImportJob.Status.RUNNING, started_at=timezone.now()
+    )
+    if not started:
+        return None  # задачу уже забрал другой воркер
+
+    options = job.options or {}
+    importer = ProductImporter(
+        job.company,
+        branch=job.branch,
+        columns=options.get("columns") or {},
+        header_row=options.get("header_row", 0),
+        update_existing=bool(options.get("update_existing", False)),
+        default_qty=Decimal(str(options.get("default_qty", 50))),
+        progress=lambda stats: _job_progress(job, stats),
+    )
+    path, temporary = None, False
+    try:
+        path, temporary = _local_copy(job)
+        stats = importer.run(iter_file_rows(path))
+    except Exception as e:
+        _job_progress(
+            job, importer.stats,
+            status=ProductImportJob.Status.FAILED, error=str(e)[:2000], finished_at=timezone.now(),
+        )
+        if not isinstance(e, ProductImportError):
+            raise
+        return None
+    finally:
+        if temporary and path:
+            os.unlink(path)
+
+    _job_progress(
+        job, stats,
+        status=ProductImportJob.Status.DONE,
+        errors=[list(e) for e in stats.errors],
+        finished_at=timezone.now(),
+    )
+    return stats
@@ -0,0 +1,126 @@
+"""
+Скомпилированный индекс правил подарков (PromoRule) компании.
+
+Правила компании один раз читаются из БД и раскладываются по области действия:
+товар / бренд / категория / все товары; внутри области — в порядке выбора
+(priority, min_qty, id по убыванию). Индекс лежит в кэше под поколением
+CACHE_DOMAIN_PROMO, которое поднимается при сохранении/удалении правила
+(apps.main.signals), поэтому подбор подарка для позиции — чистый проход в памяти.
+"""
+
+from __future__ import annotations
+
+from typing import NamedTuple, Optional
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from apps.main.cache_utils import CACHE_DOMAIN_PROMO, generation_tag
+
+_TTL = 24 * 60 * 60
+
+SCOPE_PRODUCT = "product"
+SCOPE_BRAND = "brand"
+SCOPE_CATEGORY = "category"
+SCOPE_ALL = "all"
+
+
+class CompiledRule(NamedTuple):
+    priority: int
+    min_qty: int
+    id: object
+    branch_id: object
+    inclusive: bool
+    gift_qty: int
+    active_from: object
+    active_to: object
+
+    def applies(self, qty: int, branch_id, day) -> bool:
+        if self.branch_id is not None and self.branch_id != branch_id:
+            return False
+        if self.active_from is not None and self.active_from > day:
+            return False
+        if self.active_to is not None and self.active_to < day:
+            return False
+        return qty >= self.min_qty if self.inclusive else qty > self.min_qty
+
+
+class PromoIndex:
+    """{(область, id цели): [CompiledRule, ...]} — от самого специфичного к общему."""
+
+    def __init__(self, buckets: dict):
+        self.buckets = buckets
+
+    @classmethod
+    def compile(cls, company_id) -> "PromoIndex":
+        from apps.main.models import PromoRule
+
+        buckets = {}
+        rows = PromoRule.objects.filter(company_id=company_id, is_active=True).values_list(
+            "product_id", "brand_id", "category_id",
+            "priority", "min_qty", "id", "branch_id", "inclusive", "gift_qty", "active_from", "active_to",
+        )
+        for product_id, brand_id, category_id, *rule in rows:
+            # область — как в clean(): задан максимум один таргет
+            if product_id:
+                key = (SCOPE_PRODUCT, product_id)
+            elif brand_id:
+                key = (SCOPE_BRAND, brand_id)
+            elif category_id:
+                key = (SCOPE_CATEGORY, category_id)
+            else:
+                key = (SCOPE_ALL, None)
+            buckets.setdefault(key, []).append(CompiledRule(*rule))
+        for rules in buckets.values():
+            rules.sort(key=lambda r: (r.priority, r.min_qty, r.id), reverse=True)
+        return cls(buckets)
+
+    def _scopes(self, product):
+        yield SCOPE_PRODUCT, getattr(product, "id", None)
+        yield SCOPE_BRAND, getattr(product, "brand_id", None)
+        yield SCOPE_CATEGORY, getattr(product, "category_id", None)
+        yield SCOPE_ALL, None
+
+    def gift_qty(self, product, qty: int, *, branch_id=None, day=None, stacking=False) -> int:
+        """
+        Сколько штук дарим при qty: первое подходящее правило самой узкой области
+        (product > brand > category > общее); stacking=True — сумма всех подходящих.
+        """
+        if not qty or qty <= 0 or not self.buckets:
+            return 0
+        day = day or timezone.localdate()
+        total = 0
+        for scope, target in self._scopes(product):
+            if target is None and scope != SCOPE_ALL:
+                continue
+            for rule in self.buckets.get((scope, target), ()):
+                if rule.applies(qty, branch_id, day):
+                    if not stacking:
+                        return rule.gift_qty
+                    total += rule.gift_qty
+        return total
+
+
+def get_promo_index(company_id) -> PromoIndex:
+    """Индекс правил компании из кэша (пересобирается после изменения правил)."""
+    key = f"nurcrm:promo_index:{company_id}:{generation_tag(company_id, (CACHE_DOMAIN_PROMO,))}"
+    buckets = cache.get(key)
+    if buckets is None:
+        index = PromoIndex.compile(company_id)
+        cache.set(key, index.buckets, _TTL)
+        return index
+    return PromoIndex(buckets)
+
+
+def gift_quantities(items, *, company, branch=None, date=None) -> dict:
+    """
+    Подарки для набора позиций: items — [(ключ, product, qty)], результат — {ключ: gift_qty}.
+    Одно обращение к кэшу на весь набор.
+    """
+    items = list(items)
+    if company is None or not items:
+        return {key: 0 for key, _product, _qty in items}
+    index = get_promo_index(getattr(company, "pk", company))
+    branch_id: Optional[object] = getattr(branch, "pk", branch)
+    day = date or timezone.localdate()
+    return {key: index.gift_qty(product, int(qty or 0), branch_id=branch_id, day=day) for key, product, qty in items}
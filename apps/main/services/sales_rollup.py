@@ -0,0 +1,404 @@
+"""
+Предагрегаты оплаченных продаж для аналитики (SaleRollup / SaleProductRollup).
+
+Вклад продажи — её оплата (status=PAID и paid_at заполнен). Sale.save() сравнивает
+вклад до и после сохранения и применяет разницу; удаление оплаченной продажи вычитает
+её вклад (pre_delete в signals.py). День и час — по TIME_ZONE проекта, как TruncDate/ExtractHour.
+
+Аналитика читает агрегаты только за полные прошедшие дни начиная с SaleRollupCoverage.since
+(заполняется командой backfill_sale_rollups); текущий и неполные дни периода — из сырых продаж.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Q, Sum, Value
+from django.db.models.functions import Coalesce, ExtractHour, TruncDate
+from django.utils import timezone
+
+from apps.main.models import Sale, SaleItem, SaleProductRollup, SaleRollup, SaleRollupCoverage
+
+Z_MONEY = Decimal("0.00")
+Z_QTY = Decimal("0.000")
+MONEY_FIELD = DecimalField(max_digits=18, decimal_places=2)
+QTY_FIELD = DecimalField(max_digits=18, decimal_places=3)
+
+
+# ─────────────────────────────────────────────────────────────
+# вклад продажи
+# ─────────────────────────────────────────────────────────────
+def load_state(pk):
+    """Состояние продажи из БД в формате Sale._rollup_state()."""
+    row = Sale.objects.filter(pk=pk).values_list(*Sale._ROLLUP_STATE_FIELDS).first()
+    return tuple(row) if row else None
+
+
+def _bucket(state):
+    """(ключ SaleRollup, total) или None, если продажа не оплачена."""
+    if not state:
+        return None
+    company_id, status, paid_at, branch_id, user_id, payment_method, total = state
+    if status != Sale.Status.PAID or paid_at is None:
+        return None
+    local = timezone.localtime(paid_at)
+    key = {
+        "company_id": company_id,
+        "branch_id": branch_id,
+        "day": local.date(),
+        "hour": local.hour,
+        "cashier_id": user_id,
+        "payment_method": payment_method or "",
+    }
+    return key, Decimal(total or 0)
+
+
+def _cogs_expr():
+    unit_cost = Coalesce(
+        F("purchase_price_snapshot"),
+        F("product__purchase_price"),
+        Value(Z_MONEY, output_field=MONEY_FIELD),
+    )
+    return ExpressionWrapper(F("quantity") * unit_cost, output_field=MONEY_FIELD)
+
+
+def _revenue_expr():
+    return ExpressionWrapper(F("quantity") * F("unit_price"), output_field=MONEY_FIELD)
+
+
+def _sale_lines(sale_id) -> dict:
+    """(product_id, name) -> [quantity, revenue, cogs] по позициям продажи."""
+    rows = (
+        SaleItem.objects.filter(sale_id=sale_id)
+        .values("product_id", "name_snapshot")
+        .annotate(
+            qty=Coalesce(Sum("quantity"), Value(Z_QTY, output_field=QTY_FIELD), output_field=QTY_FIELD),
+            rev=Coalesce(Sum(_revenue_expr()), Value(Z_MONEY, output_field=MONEY_FIELD), output_field=MONEY_FIELD),
+            cogs=Coalesce(Sum(_cogs_expr()), Value(Z_MONEY, output_field=MONEY_FIELD), output_field=MONEY_FIELD),
+        )
+    )
+    return {
+        (r["product_id"], (r["name_snapshot"] or "")[:255]): [r["qty"], r["rev"], r["cogs"]]
+        for r in rows
+    }
+
+
+def _bump_sale_row(key: dict, count: int, revenue: Decimal, cogs: Decimal) -> None:
+    row = SaleRollup.objects.select_for_update().filter(**key).first()
+    if row is None:
+        try:
+            with transaction.atomic():
+                SaleRollup.objects.create(**key, sales_count=count, revenue=revenue, cogs=cogs)
+            return
+        except IntegrityError:
+            # строку параллельно создала другая транзакция
+            row = SaleRollup.objects.select_for_update().get(**key)
+    SaleRollup.objects.filter(pk=row.pk).update(
+        sales_count=F("sales_count") + count,
+        revenue=F("revenue") + revenue,
+        cogs=F("cogs") + cogs,
+    )
+
+
+def _bump_product_rows(key: dict, lines: dict, sign: int) -> None:
+    """
+    Все строки товаров одной продажи отличаются только (product_id, name):
+    блокируем их одним запросом, недостающие создаём пачкой, пишем bulk_update.
+    """
+    if not lines:
+        return
+    scope = {k: v for k, v in key.items() if k != "hour"}
+    names = {name for _pid, name in lines}
+
+    def fetch():
+        qs = (
+            SaleProductRollup.objects.select_for_update()
+            .filter(**scope, name__in=names)
+            .order_by("pk")
+        )
+        return {(r.product_id, r.name): r for r in qs}
+
+    rows = fetch()
+    missing = [k for k in lines if k not in rows]
+    if missing:
+        SaleProductRollup.objects.bulk_create(
+            [SaleProductRollup(**scope, product_id=pid, name=name) for pid, name in missing],
+            ignore_conflicts=True,
+        )
+        rows = fetch()
+
+    changed = []
+    for line_key, (qty, rev, cogs) in lines.items():
+        row = rows[line_key]
+        row.quantity += sign * qty
+        row.revenue += sign * rev
+        row.cogs += sign * cogs
+        changed.append(row)
+    SaleProductRollup.objects.bulk_update(changed, ["quantity", "revenue", "cogs"])
+
+
+def _apply(bucket, sign: int, lines: dict) -> None:
+    key, total = bucket
+    cogs = sum((line[2] for line in lines.values()), Z_MONEY)
+    _bump_sale_row(key, sign, sign * total, sign * cogs)
+    _bump_product_rows(key, lines, sign)
+
+
+def apply_sale_change(sale_id, old_state, new_state) -> None:
+    """Переносит вклад продажи из old_state в new_state (любое из них может быть None)."""
+    old, new = _bucket(old_state), _bucket(new_state)
+    if old is None and new is None:
+        return
+    with transaction.atomic():
+        if old is not None and new is not None and old[0] == new[0]:
+            # изменилась только сумма чека — позиции и ключи те же
+            if old[1] != new[1]:
+                _bump_sale_row(new[0], 0, new[1] - old[1], Z_MONEY)
+            return
+        lines = _sale_lines(sale_id)
+        if old is not None:
+            _apply(old, -1, lines)
+        if new is not None:
+            _apply(new, +1, lines)
+
+
+# ─────────────────────────────────────────────────────────────
+# чтение: агрегаты за полные дни + сырые продажи за остальное
+# ─────────────────────────────────────────────────────────────
+def _midnight(day):
+    return timezone.make_aware(datetime.combine(day, time.min), timezone.get_current_timezone())
+
+
+def rollup_days(company_id, start, end):
+    """
+    Полуинтервал дней [d_from, d_to), который можно читать из агрегатов для периода [start, end),
+    или None. Сегодняшний день всегда читается из продаж.
+    """
+    since = SaleRollupCoverage.objects.filter(company_id=company_id).values_list("since", flat=True).first()
+    if since is None:
+        return None
+    local_start = timezone.localtime(start)
+    d_from = local_start.date()
+    if local_start.timetz().replace(tzinfo=None) != time.min:
+        d_from += timedelta(days=1)
+    d_from = max(d_from, since)
+    d_to = min(timezone.localtime(end).date(), timezone.localdate())
+    if d_from >= d_to:
+        return None
+    return d_from, d_to
+
+
+@dataclass
+class SalesSummary:
+    revenue: Decimal = Z_MONEY
+    transactions: int = 0
+    cogs: Decimal = Z_MONEY
+    by_day: dict = field(default_factory=dict)  # date -> revenue
+    by_hour: dict = field(default_factory=dict)  # hour -> [revenue, count]
+    by_weekday: dict = field(default_factory=dict)  # 1=вс … 7=сб (как ExtractWeekDay) -> count
+    by_method: dict = field(default_factory=dict)  # payment_method -> [revenue, count]
+    by_cashier: dict = field(default_factory=dict)  # user_id -> [revenue, count]
+    products: dict = field(default_factory=dict)  # (product_id, name) -> [quantity, revenue]
+
+    def add(self, day, hour, cashier_id, method, count, revenue):
+        count = int(count or 0)
+        revenue = Decimal(revenue or 0)
+        if not count and not revenue:
+            return
+        self.revenue += revenue
+        self.transactions += count
+        self.by_day[day] = self.by_day.get(day, Z_MONEY) + revenue
+        for bucket, k in ((self.by_hour, hour), (self.by_method, method), (self.by_cashier, cashier_id)):
+            acc = bucket.setdefault(k, [Z_MONEY, 0])
+            acc[0] += revenue
+            acc[1] += count
+        wd = day.isoweekday() % 7 + 1
+        self.by_weekday[wd] = self.by_weekday.get(wd, 0) + count
+
+    def add_product(self, product_id, name, qty, revenue):
+        acc = self.products.setdefault((product_id, name), [Z_QTY, Z_MONEY])
+        acc[0] += Decimal(qty or 0)
+        acc[1] += Decimal(revenue or 0)
+
+    def finish(self):
+        # строки, обнулённые возвратами, не показываем
+        for bucket in (self.by_hour, self.by_method, self.by_cashier):
+            for k in [k for k, (_rev, cnt) in bucket.items() if not cnt]:
+                del bucket[k]
+        self.by_weekday = {k: v for k, v in self.by_weekday.items() if v}
+        self.products = {k: v for k, v in self.products.items() if v[0] or v[1]}
+        return self
+
+
+def _scope_q(prefix: str, company_id, branch_id, include_global, cashier_id, payment_method, cashier_field):
+    q = Q(**{f"{prefix}company_id": company_id})
+    if branch_id is not None:
+        branch_q = Q(**{f"{prefix}branch_id": branch_id})
+        if include_global:
+            branch_q |= Q(**{f"{prefix}branch__isnull": True})
+        q &= branch_q
+    if cashier_id:
+        q &= Q(**{f"{prefix}{cashier_field}": cashier_id})
+    if payment_method:
+        q &= Q(**{f"{prefix}payment_method": payment_method})
+    return q
+
+
+def summarize(company_id, start, end, *, branch_id=None, include_global=False,
+              cashier_id=None, payment_method=None, with_products=False):
+    """
+    Итоги оплаченных продаж за [start, end). None — если агрегатов для периода нет
+    (компания не прогнала backfill или период целиком в сегодняшнем дне).
+    """
+    days = rollup_days(company_id, start, end)
+    if days is None:
+        return None
+    d_from, d_to = days
+    summary = SalesSummary()
+    scope = dict(
+        company_id=company_id, branch_id=branch_id, include_global=include_global,
+        cashier_id=cashier_id, payment_method=payment_method,
+    )
+
+    # 1) полные дни — из агрегатов
+    rollup_q = _scope_q("", cashier_field="cashier_id", **scope) & Q(day__gte=d_from, day__lt=d_to)
+    rows = (
+        SaleRollup.objects.filter(rollup_q)
+        .values_list("day", "hour", "cashier_id", "payment_method")
+        .annotate(cnt=Sum("sales_count"), rev=Sum("revenue"), cg=Sum("cogs"))
+        .order_by()
+    )
+    for day, hour, cashier, method, cnt, rev, cg in rows:
+        summary.add(day, hour, cashier, method, cnt, rev)
+        summary.cogs += Decimal(cg or 0)
+
+    if with_products:
+        prow = (
+            SaleProductRollup.objects.filter(rollup_q)
+            .values_list("product_id", "name")
+            .annotate(qty=Sum("quantity"), rev=Sum("revenue"))
+            .order_by()
+        )
+        for product_id, name, qty, rev in prow:
+            summary.add_product(product_id, name, qty, rev)
+
+    # 2) края периода и сегодня — из продаж
+    raw_ranges = []
+    if start < _midnight(d_from):
+        raw_ranges.append((start, _midnight(d_from)))
+    if _midnight(d_to) < end:
+        raw_ranges.append((_midnight(d_to), end))
+    if raw_ranges:
+        period_q = Q()
+        for lo, hi in raw_ranges:
+            period_q |= Q(paid_at__gte=lo, paid_at__lt=hi)
+        sales = Sale.objects.filter(
+            _scope_q("", cashier_field="user_id", **scope), period_q, status=Sale.Status.PAID
+        )
+        rows = (
+            sales.annotate(d=TruncDate("paid_at"), h=ExtractHour("paid_at"))
+            .values_list("d", "h", "user_id", "payment_method")
+            .annotate(cnt=Count("id"), rev=Sum("total"))
+            .order_by()
+        )
+        for day, hour, cashier, method, cnt, rev in rows:
+            summary.add(day, hour, cashier, method or "", cnt, rev)
+
+        items = SaleItem.objects.filter(sale__in=sales)
+        summary.cogs += items.aggregate(
+            v=Coalesce(Sum(_cogs_expr()), Value(Z_MONEY, output_field=MONEY_FIELD), output_field=MONEY_FIELD)
+        )["v"]
+        if with_products:
+            prow = (
+                items.values_list("product_id", "name_snapshot")
+                .annotate(qty=Sum("quantity"), rev=Sum(_revenue_expr()))
+                .order_by()
+            )
+            for product_id, name, qty, rev in prow:
+                summary.add_product(product_id, name, qty, rev)
+
+    return summary.finish()
+
+
+# ─────────────────────────────────────────────────────────────
+# пересборка (backfill)
+# ─────────────────────────────────────────────────────────────
+@transaction.atomic
+def rebuild(company_id, d_from, d_to) -> tuple[int, int]:
+    """
+    Пересобирает агрегаты компании за дни [d_from, d_to] из продаж.
+    Возвращает (строк SaleRollup, строк SaleProductRollup).
+    """
+    SaleRollup.objects.filter(company_id=company_id, day__gte=d_from, day__lte=d_to).delete()
+    SaleProductRollup.objects.filter(company_id=company_id, day__gte=d_from, day__lte=d_to).delete()
+
+    sales = Sale.objects.filter(
+        company_id=company_id,
+        status=Sale.Status.PAID,
+        paid_at__gte=_midnight(d_from),
+        paid_at__lt=_midnight(d_to + timedelta(days=1)),
+    )
+    cogs_by_key = {}
+    cogs_rows = (
+        SaleItem.objects.filter(sale__in=sales)
+        .annotate(d=TruncDate("sale__paid_at"), h=ExtractHour("sale__paid_at"))
+        .values_list("d", "h", "sale__branch_id", "sale__user_id", "sale__payment_method")
+        .annotate(cg=Sum(_cogs_expr()))
+        .order_by()
+    )
+    for day, hour, branch_id, user_id, method, cg in cogs_rows:
+        cogs_by_key[(day, hour, branch_id, user_id, method or "")] = cg or Z_MONEY
+
+    sale_rows = [
+        SaleRollup(
+            company_id=company_id, branch_id=branch_id, day=day, hour=hour,
+            cashier_id=user_id, payment_method=method or "",
+            sales_count=cnt, revenue=rev or Z_MONEY,
+            cogs=cogs_by_key.get((day, hour, branch_id, user_id, method or ""), Z_MONEY),
+        )
+        for day, hour, branch_id, user_id, method, cnt, rev in (
+            sales.annotate(d=TruncDate("paid_at"), h=ExtractHour("paid_at"))
+            .values_list("d", "h", "branch_id", "user_id", "payment_method")
+            .annotate(cnt=Count("id"), rev=Sum("total"))
+            .order_by()
+        )
+    ]
+    SaleRollup.objects.bulk_create(sale_rows, batch_size=1000)
+
+    product_rows = [
+        SaleProductRollup(
+            company_id=company_id, branch_id=branch_id, day=day, cashier_id=user_id,
+            payment_method=method or "", product_id=product_id, name=(name or "")[:255],
+            quantity=qty or Z_QTY, revenue=rev or Z_MONEY, cogs=cg or Z_MONEY,
+        )
+        for day, branch_id, user_id, method, product_id, name, qty, rev, cg in (
+            SaleItem.objects.filter(sale__in=sales)
+            .annotate(d=TruncDate("sale__paid_at"))
+            .values_list("d", "sale__branch_id", "sale__user_id", "sale__payment_method", "product_id", "name_snapshot")
+            .annotate(qty=Sum("quantity"), rev=Sum(_revenue_expr()), cg=Sum(_cogs_expr()))
+            .order_by()
+        )
+    ]
+    SaleProductRollup.objects.bulk_create(product_rows, batch_size=1000)
+    return len(sale_rows), len(product_rows)
+
+
+def extend_coverage(company_id, d_from, d_to) -> bool:
+    """
+    Отмечает агрегаты полными с d_from, если пересобранный диапазон [d_from, d_to]
+    смыкается с уже покрытым (или доходит до сегодня). Возвращает True, если покрытие сдвинулось.
+    """
+    coverage = SaleRollupCoverage.objects.filter(company_id=company_id).first()
+    if coverage is None:
+        if d_to < timezone.localdate():
+            return False
+        SaleRollupCoverage.objects.create(company_id=company_id, since=d_from)
+        return True
+    if d_from >= coverage.since or d_to + timedelta(days=1) < coverage.since:
+        return False
+    coverage.since = d_from
+    coverage.save(update_fields=["since", "rebuilt_at"])
+    return True
@@ -0,0 +1,355 @@
+from __future__ import annotations
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.main.models import Product, ProductWebhookOutbox
+from apps.main.services.webhooks import _is_company_allowed, post_payload
+
+logger = logging.getLogger("crm.webhooks")
+
+Outbox = ProductWebhookOutbox
+
+EVENT_CREATED = "product.created"
+EVENT_UPDATED = "product.updated"
+EVENT_DELETED = "product.deleted"
+EVENT_BATCH = "product.batch"
+
+_SCHEDULED_KEY = "webhook_outbox:scheduled"
+_METRICS_KEY = "webhook_outbox:last_run"
+_FETCH_CHUNK = 200
+
+
+def _lease_seconds() -> int:
+    return max(30, int(getattr(settings, "SITE_WEBHOOK_LEASE_SECONDS", 300) or 300))
+
+
+def _coalesce_seconds() -> int:
+    return int(getattr(settings, "SITE_WEBHOOK_COALESCE_SECONDS", 5) or 0)
+
+
+def _batch_size() -> int:
+    """
+    Items per POST. 1 keeps the classic {"event", "data"} body;
+    >1 sends {"event": "product.batch", "items": [{"event", "data"}, ...]}.
+    """
+    return max(1, int(getattr(settings, "SITE_WEBHOOK_BATCH_SIZE", 1) or 1))
+
+
+def _merge_event(old: str, new: str) -> str:
+    # created + updated (до отправки) — для получателя это всё ещё created
+    if old == EVENT_CREATED and new == EVENT_UPDATED:
+        return old
+    return new
+
+
+def enqueue_product_events(company_id, product_ids, event: str, *, payloads: dict | None = None, schedule: bool = True) -> int:
+    """
+    Puts product events into the outbox inside the caller's transaction.
+    Repeated events for a product that is still pending are merged into its row.
+
+    payloads: {product_id: serialized product} — needed only for product.deleted,
+    other events are serialized at delivery time (so the receiver gets fresh data).
+    """
+    if not getattr(settings, "SITE_WEBHOOK_URL", None) or not _is_company_allowed(company_id):
+        return 0
+
+    ids = list(dict.fromkeys(str(pid) for pid in product_ids if pid))
+    if not ids:
+        return 0
+    payloads = {str(k): v for k, v in (payloads or {}).items()}
+
+    with transaction.atomic():
+        pending = {
+            str(row.product_id): row
+            for row in Outbox.objects.select_for_update().filter(product_id__in=ids, status=Outbox.Status.PENDING)
+        }
+        to_update, to_create = [], []
+        for pid in ids:
+            row = pending.get(pid)
+            if row is not None:
+                row.event = _merge_event(row.event, event)
+                row.payload = payloads.get(pid) if row.event == EVENT_DELETED else None
+                to_update.append(row)
+            else:
+                to_create.append(Outbox(
+                    company_id=company_id,
+                    product_id=pid,
+                    event=event,
+                    payload=payloads.get(pid) if event == EVENT_DELETED else None,
+                ))
+        if to_update:
+            Outbox.objects.bulk_update(to_update, ["event", "payload"])
+        if to_create:
+            _insert_pending(to_create)
+
+    if schedule:
+        schedule_dispatch()
+    return len(ids)
+
+
+def _insert_pending(rows) -> None:
+    """
+    Inserts new pending rows. A conflict means a parallel transaction has just
+    committed a pending row for the same product: its event is merged with ours
+    instead of dropping ours (otherwise a product.deleted could be lost).
+    """
+    try:
+        with transaction.atomic():
+            Outbox.objects.bulk_create(rows)
+        return
+    except IntegrityError:
+        pass
+
+    for row in rows:
+        try:
+            with transaction.atomic():
+                row.save(force_insert=True)
+            continue
+        except IntegrityError:
+            pass
+        current = (
+            Outbox.objects.select_for_update()
+            .filter(product_id=row.product_id, status=Outbox.Status.PENDING)
+            .first()
+        )
+        if current is None:
+            # конкурент уже успел забрать запись в отправку — слот снова свободен
+            row.save(force_insert=True)
+            continue
+        current.event = _merge_event(current.event, row.event)
+        current.payload = row.payload if current.event == EVENT_DELETED else None
+        current.save(update_fields=["event", "payload"])
+
+
+def schedule_dispatch() -> None:
+    """
+    After commit: at most one delayed dispatcher run per coalescing window,
+    so a burst of edits becomes one delivery round.
+    """
+    def _schedule():
+        window = _coalesce_seconds()
+        if window and cache.add(_SCHEDULED_KEY, 1, window) is False:
+            return
+        try:
+            from apps.main.tasks import dispatch_product_webhooks
+
+            dispatch_product_webhooks.apply_async(countdown=window)
+        except Exception:
+            cache.delete(_SCHEDULED_KEY)
+            logger.error("Failed to schedule product webhook dispatch", exc_info=True)
+
+    transaction.on_commit(_schedule)
+
+
+def _serialize_products(product_ids) -> dict:
+    from apps.main.serializers import ProductSerializer
+
+    products = list(
+        Product.objects.filter(id__in=product_ids)
+        .select_related("company", "branch", "brand", "category", "client", "created_by", "characteristics")
+        .prefetch_related("images", "packages", "item_make")
+    )
+    data = ProductSerializer(products, many=True, context={"request": None}).data
+    return {str(p.id): item for p, item in zip(products, data)}
+
+
+def _retry_delay(attempts: int) -> timedelta:
+    backoff = float(getattr(settings, "SITE_WEBHOOK_BACKOFF", 2.0) or 2.0)
+    return timedelta(seconds=min(backoff ** attempts, 600))
+
+
+def _deliver(group, *, timeout: float) -> None:
+    if len(group) == 1 and _batch_size() == 1:
+        post_payload(group[0][1], timeout=timeout)
+    else:
+        post_payload({"event": EVENT_BATCH, "items": [body for _, body in group]}, timeout=timeout)
+
+
+def _claim(now, *, lease_until, limit: int) -> list:
+    """
+    Short transaction: takes due pending rows (and sending rows whose lease
+    expired — the worker died mid-delivery) and marks them sending.
+    """
+    with transaction.atomic():
+        rows = list(
+            Outbox.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status=Outbox.Status.PENDING, available_at__lte=now)
+                | Q(status=Outbox.Status.SENDING, leased_until__lt=now)
+            )
+            .order_by("available_at", "id")[:limit]
+        )
+        if rows:
+            Outbox.objects.filter(id__in=[r.id for r in rows]).update(
+                status=Outbox.Status.SENDING, leased_until=lease_until,
+            )
+    for row in rows:
+        row.status = Outbox.Status.SENDING
+        row.leased_until = lease_until
+    return rows
+
+
+def _record(rows, *, lease_until) -> None:
+    """
+    Short transaction: writes delivery results for rows we still hold the lease on.
+    A row returning to pending while a newer pending row for the product exists
+    is folded into that row (one pending row per product).
+    """
+    with transaction.atomic():
+        owned = set(
+            Outbox.objects.select_for_update()
+            .filter(id__in=[r.id for r in rows], status=Outbox.Status.SENDING, leased_until=lease_until)
+            .values_list("id", flat=True)
+        )
+        rows = [r for r in rows if r.id in owned]
+        if not rows:
+            return
+
+        retry = {str(r.product_id): r for r in rows if r.status == Outbox.Status.PENDING}
+        if retry:
+            newer = list(
+                Outbox.objects.select_for_update()
+                .filter(product_id__in=list(retry), status=Outbox.Status.PENDING)
+            )
+            for current in newer:
+                row = retry[str(current.product_id)]
+                current.event = _merge_event(row.event, current.event)
+                if current.event == EVENT_DELETED and current.payload is None:
+                    current.payload = row.payload
+                row.status = Outbox.Status.SENT
+                row.sent_at = timezone.now()
+                row.last_error = f"merged into pending row {current.id}; {row.last_error}"[:500]
+            if newer:
+                Outbox.objects.bulk_update(newer, ["event", "payload"])
+
+        for row in rows:
+            row.leased_until = None
+        Outbox.objects.bulk_update(rows, ["status", "attempts", "available_at", "leased_until", "sent_at", "last_error"])
+
+
+def dispatch_pending(*, timeout: float | None = None, max_attempts: int | None = None, max_rows: int = 0) -> dict:
+    """
+    Delivers due outbox rows. Never sleeps: a failed row gets attempts += 1 and
+    a later available_at (exponential backoff), after max_attempts it becomes FAILED.
+
+    HTTP runs outside any transaction: rows are claimed (sending + lease) and
+    committed first, results are written in a second short transaction, so a
+    slow receiver never holds locks that checkout / Product.save need.
+
+    Returns run stats: sent / failed / retried / skipped counts and delivery lag (seconds).
+    """
+    timeout = float(timeout or getattr(settings, "SITE_WEBHOOK_TIMEOUT", 10))
+    max_attempts = int(max_attempts or getattr(settings, "SITE_WEBHOOK_MAX_ATTEMPTS", 8))
+    batch_size = _batch_size()
+    lease = _lease_seconds()
+    # сколько POST-ов успеваем сделать до истечения аренды (с запасом на один)
+    claim_limit = min(_FETCH_CHUNK, batch_size * max(1, int(lease // timeout) - 1))
+
+    stats = {"sent": 0, "failed": 0, "retried": 0, "skipped": 0, "lag_avg": 0.0, "lag_max": 0.0}
+    lag_total = 0.0
+    processed = 0
+
+    while not max_rows or processed < max_rows:
+        now = timezone.now()
+        lease_until = now + timedelta(seconds=lease)
+        rows = _claim(now, lease_until=lease_until, limit=claim_limit)
+        if not rows:
+            break
+        processed += len(rows)
+
+        fresh = _serialize_products([r.product_id for r in rows if r.event != EVENT_DELETED])
+        items = []
+        for row in rows:
+            data = row.payload if row.event == EVENT_DELETED else fresh.get(str(row.product_id))
+            if data is None:
+                # товар исчез до отправки — его product.deleted придёт отдельной записью
+                row.status = Outbox.Status.SENT
+                row.sent_at = now
+                row.last_error = "product not found"
+                stats["skipped"] += 1
+                continue
+            items.append((row, {"event": row.event, "data": data}))
+
+        for start in range(0, len(items), batch_size):
+            group = items[start:start + batch_size]
+            try:
+                _deliver(group, timeout=timeout)
+            except Exception as exc:
+                logger.error("Product webhook delivery failed. items=%s", len(group), exc_info=True)
+                for row, _ in group:
+                    row.attempts += 1
+                    row.last_error = repr(exc)[:500]
+                    if row.attempts >= max_attempts:
+                        row.status = Outbox.Status.FAILED
+                        stats["failed"] += 1
+                    else:
+                        row.status = Outbox.Status.PENDING
+                        row.available_at = timezone.now() + _retry_delay(row.attempts)
+                        stats["retried"] += 1
+                continue
+
+            sent_at = timezone.now()
+            for row, _ in group:
+                row.status = Outbox.Status.SENT
+                row.sent_at = sent_at
+                row.last_error = ""
+                lag = (sent_at - row.created_at).total_seconds()
+                lag_total += lag
+                stats["lag_max"] = max(stats["lag_max"], lag)
+                stats["sent"] += 1
+
+        _record(rows, lease_until=lease_until)
+
+    if stats["sent"]:
+        stats["lag_avg"] = round(lag_total / stats["sent"], 3)
+    stats["lag_max"] = round(stats["lag_max"], 3)
+    stats["finished_at"] = timezone.now().isoformat()
+    cache.set(_METRICS_KEY, stats, None)
+    return stats
+
+
+def reschedule_retries() -> None:
+    """Schedules the next dispatcher run for rows waiting on backoff."""
+    next_at = (
+        Outbox.objects.filter(status=Outbox.Status.PENDING)
+        .order_by("available_at")
+        .values_list("available_at", flat=True)
+        .first()
+    )
+    if next_at is None:
+        return
+    from apps.main.tasks import dispatch_product_webhooks
+
+    countdown = max(0, int((next_at - timezone.now()).total_seconds()) + 1)
+    dispatch_product_webhooks.apply_async(countdown=countdown)
+
+
+def purge_sent(*, older_than_days: int | None = None) -> int:
+    days = int(older_than_days or getattr(settings, "SITE_WEBHOOK_OUTBOX_RETENTION_DAYS", 7))
+    cutoff = timezone.now() - timedelta(days=days)
+    deleted, _ = Outbox.objects.filter(status=Outbox.Status.SENT, sent_at__lt=cutoff).delete()
+    return deleted
+
+
+def get_delivery_metrics() -> dict:
+    """
+    Delivery health: queue depth, age of the oldest pending event (current lag)
+    and stats of the last dispatcher run.
+    """
+    now = timezone.now()
+    pending = Outbox.objects.filter(status=Outbox.Status.PENDING)
+    oldest = pending.order_by("created_at").values_list("created_at", flat=True).first()
+    return {
+        "pending": pending.count(),
+        "sending": Outbox.objects.filter(status=Outbox.Status.SENDING).count(),
+        "failed": Outbox.objects.filter(status=Outbox.Status.FAILED).count(),
+        "oldest_pending_age": round((now - oldest).total_seconds(), 3) if oldest else 0.0,
+        "last_run": cache.get(_METRICS_KEY),
+    }
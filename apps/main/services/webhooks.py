@@ -4,9 +4,8 @@ import hashlib
 import hmac
 import json
 import logging
+import threading
 import time
-import urllib.error
-import urllib.request
 
 from django.conf import settings
 
@@ -39,7 +38,36 @@ def _is_company_allowed(company_id) -> bool:
     return str(company_id).strip().lower() == allowed
 
 
-def _send_payload(payload: dict, *, retries: int, timeout: int, backoff: float) -> None:
+_session = None
+_session_lock = threading.Lock()
+
+
+def _http_session():
+    """
+    One requests.Session per process: keeps TCP/TLS connections to the receiver alive
+    between deliveries instead of a new handshake per POST.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                pool_size = int(getattr(settings, "SITE_WEBHOOK_POOL_SIZE", 4) or 4)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def post_payload(payload, *, timeout: float) -> None:
+    """
+    Single POST attempt (no retries, no sleeping). Raises on transport errors and non-2xx.
+    Retry scheduling is the caller's job (see services.webhook_outbox).
+    """
     url = getattr(settings, "SITE_WEBHOOK_URL", None)
     if not url:
         return
@@ -52,19 +80,21 @@ def _send_payload(payload: dict, *, retries: int, timeout: int, backoff: float)
         "X-CRM-Signature": _build_signature(secret, body),
     }
 
+    resp = _http_session().post(url, data=body, headers=headers, timeout=timeout)
+    status = int(getattr(resp, "status_code", 0) or 0)
+    if not 200 <= status < 300:
+        raise RuntimeError(f"Unexpected status code: {status}")
+
+
+def _send_payload(payload: dict, *, retries: int, timeout: int, backoff: float) -> None:
     for attempt in range(retries):
         try:
-            req = urllib.request.Request(url=url, data=body, headers=headers, method="POST")
-            with urllib.request.urlopen(req, timeout=timeout) as resp:
-                status = getattr(resp, "status", None) or 0
-                if 200 <= int(status) < 300:
-                    return
-                raise RuntimeError(f"Unexpected status code: {status}")
+            post_payload(payload, timeout=timeout)
+            return
         except Exception:
             logger.error(
-                "Product webhook failed. event=%s url=%s attempt=%s/%s",
+                "Product webhook failed. event=%s attempt=%s/%s",
                 payload.get("event"),
-                url,
                 attempt + 1,
                 retries,
                 exc_info=True,
@@ -76,7 +106,8 @@ def _send_payload(payload: dict, *, retries: int, timeout: int, backoff: float)
 def send_product_webhook_data(data: dict, event: str, *, retries: int = 3, timeout: int = 5, backoff: float = 1.5) -> None:
     """
     Same webhook format as send_product_webhook(), but accepts already-serialized product data.
-    Useful for delete events (when the instance is about to be removed).
+    Synchronous (blocks on retries) — request/transaction code should use
+    services.webhook_outbox.enqueue_product_events() instead.
     """
     try:
         if not _is_company_allowed((data or {}).get("company")):
@@ -91,7 +122,8 @@ def send_product_webhook_data(data: dict, event: str, *, retries: int = 3, timeo
 
 def send_product_webhook(product, event: str, *, retries: int = 3, timeout: int = 5, backoff: float = 1.5) -> None:
     """
-    Sends product webhook. Never raises.
+    Sends product webhook synchronously. Never raises.
+    Request/transaction code should enqueue via services.webhook_outbox instead.
 
     Payload:
       {
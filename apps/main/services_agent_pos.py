@@ -8,6 +8,7 @@ from django.core.exceptions import ValidationError
 from apps.main.models import (
     Sale, SaleItem, ManufactureSubreal, AgentSaleAllocation, ReturnFromAgent, Product
 )
+from apps.main.services import agent_stock
 from apps.construction.models import Cashbox
 
 
@@ -305,6 +306,7 @@ def checkout_agent_cart(
                     if not created:
                         AgentSaleAllocation.objects.filter(pk=alloc.pk).update(qty=models.F("qty") + take)
                 except IntegrityError:
+                    created = False
                     alloc = AgentSaleAllocation.objects.get(
                         company=company,
                         agent=acting_agent,
@@ -314,6 +316,8 @@ def checkout_agent_cart(
                         product=product,
                     )
                     AgentSaleAllocation.objects.filter(pk=alloc.pk).update(qty=models.F("qty") + take)
+                if not created:  # update() мимо сигналов — остаток агента пересчитываем сами
+                    agent_stock.refresh_subreals([subr.pk])
 
                 free -= take
                 left -= take
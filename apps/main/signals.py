@@ -2,37 +2,66 @@ from __future__ import annotations
 
 import logging
 
-from django.db import transaction
+from django.db.models.signals import post_delete
 from django.db.models.signals import pre_delete
+from django.db.models.signals import post_init
 from django.db.models.signals import post_save
+from django.db.models.signals import pre_save
 from django.dispatch import receiver
 
-from apps.main.models import Product, ProductImage
+from apps.main.cache_utils import (
+    CACHE_DOMAIN_CASH,
+    CACHE_DOMAIN_PRODUCTION,
+    CACHE_DOMAIN_PROMO,
+    CACHE_DOMAIN_SALES,
+    CACHE_DOMAIN_WAREHOUSE,
+    bump_cache_generation_on_commit,
+)
+from apps.main.services import agent_stock, balance_checkpoints
+from apps.users.models import Company
+from apps.main.models import (
+    Acceptance,
+    AgentSaleAllocation,
+    ClientDeal,
+    DealInstallment,
+    ManufactureSubreal,
+    Product,
+    ProductImage,
+    PromoRule,
+    ReturnFromAgent,
+    Sale,
+)
 
 logger = logging.getLogger("crm.webhooks")
 
 
-@receiver(post_save, sender=Product)
-def product_webhook_on_save(sender, instance: Product, created: bool, **kwargs):
-    event = "product.created" if created else "product.updated"
+def _enqueue(company_id, product_id, event: str, *, payload=None) -> None:
+    """
+    Events go to the outbox in the same transaction as the change;
+    delivery happens in the background dispatcher (never in the request).
+    """
+    try:
+        from apps.main.services.webhook_outbox import enqueue_product_events
 
-    def _send():
-        try:
-            from apps.main.services.webhooks import send_product_webhook
+        enqueue_product_events(
+            company_id,
+            [product_id],
+            event,
+            payloads={product_id: payload} if payload is not None else None,
+        )
+    except Exception:
+        logger.error(
+            "Failed to enqueue product webhook. product_id=%s event=%s",
+            product_id,
+            event,
+            exc_info=True,
+        )
 
-            send_product_webhook(instance, event)
-        except Exception:
-            logger.error(
-                "Unexpected error while preparing/sending product webhook. product_id=%s event=%s",
-                getattr(instance, "id", None),
-                event,
-                exc_info=True,
-            )
 
-    try:
-        transaction.on_commit(_send)
-    except Exception:
-        _send()
+@receiver(post_save, sender=Product)
+def product_webhook_on_save(sender, instance: Product, created: bool, **kwargs):
+    event = "product.created" if created else "product.updated"
+    _enqueue(instance.company_id, instance.pk, event)
 
 
 @receiver(post_save, sender=ProductImage)
@@ -41,62 +70,23 @@ def product_webhook_on_image_save(sender, instance: ProductImage, created: bool,
     Product images are usually created/updated separately from Product,
     so Product.post_save won't fire for those changes.
     """
-    event = "product.updated"
-    product_id = getattr(instance, "product_id", None)
-    if not product_id:
+    if not getattr(instance, "product_id", None):
         return
-
-    def _send():
-        try:
-            from apps.main.services.webhooks import send_product_webhook
-
-            send_product_webhook(instance.product, event)
-        except Exception:
-            logger.error(
-                "Unexpected error while sending product webhook after image save. product_id=%s",
-                product_id,
-                exc_info=True,
-            )
-
-    try:
-        transaction.on_commit(_send)
-    except Exception:
-        _send()
+    _enqueue(instance.company_id, instance.product_id, "product.updated")
 
 
 @receiver(pre_delete, sender=ProductImage)
 def product_webhook_on_image_delete(sender, instance: ProductImage, **kwargs):
-    event = "product.updated"
-    product_id = getattr(instance, "product_id", None)
-    if not product_id:
+    if not getattr(instance, "product_id", None):
         return
-
-    def _send():
-        try:
-            from apps.main.models import Product as ProductModel
-            from apps.main.services.webhooks import send_product_webhook
-
-            product = ProductModel.objects.filter(pk=product_id).first()
-            if product:
-                send_product_webhook(product, event)
-        except Exception:
-            logger.error(
-                "Unexpected error while sending product webhook after image delete. product_id=%s",
-                product_id,
-                exc_info=True,
-            )
-
-    try:
-        transaction.on_commit(_send)
-    except Exception:
-        _send()
+    _enqueue(instance.company_id, instance.product_id, "product.updated")
 
 
 @receiver(pre_delete, sender=Product)
 def product_webhook_on_delete(sender, instance: Product, **kwargs):
     """
     Send delete event with the same product JSON as in list endpoint.
-    We serialize BEFORE deletion and send AFTER commit.
+    We serialize BEFORE deletion; the outbox keeps the payload until delivery.
     """
     event = "product.deleted"
 
@@ -112,19 +102,145 @@ def product_webhook_on_delete(sender, instance: Product, **kwargs):
         )
         return
 
-    def _send():
-        try:
-            from apps.main.services.webhooks import send_product_webhook_data
+    _enqueue(instance.company_id, instance.pk, event, payload=data)
 
-            send_product_webhook_data(data, event)
-        except Exception:
-            logger.error(
-                "Unexpected error while sending product delete webhook. product_id=%s",
-                getattr(instance, "id", None),
-                exc_info=True,
-            )
 
-    try:
-        transaction.on_commit(_send)
-    except Exception:
-        _send()
+@receiver(post_delete, sender=Product)
+def product_barcode_index_on_delete(sender, instance: Product, **kwargs):
+    from apps.main.barcode_index import invalidate_company_on_commit
+
+    invalidate_company_on_commit(instance.company_id)
+
+
+@receiver(post_delete, sender=Product)
+def product_scale_tombstone_on_delete(sender, instance: Product, origin=None, **kwargs):
+    # удаление всей компании: ни ревизий, ни надгробий (их компания удаляется следом)
+    if not instance.is_weight or isinstance(origin, Company):
+        return
+    from apps.scale import sync
+
+    sync.record_deletion(instance)
+
+
+@receiver(pre_delete, sender=Sale)
+def sale_rollup_on_delete(sender, instance: Sale, **kwargs):
+    """Удаление оплаченной продажи вычитает её вклад из агрегатов (позиции ещё на месте)."""
+    from apps.main.services import sales_rollup
+
+    previous = getattr(instance, "_loaded_rollup_state", None) or sales_rollup.load_state(instance.pk)
+    sales_rollup.apply_sale_change(instance.pk, previous, None)
+
+
+# ─────────────────────────────────────────────────────────────
+# поколения кэша аналитики: изменение данных сразу делает кэш компании неактуальным
+# ─────────────────────────────────────────────────────────────
+@receiver(post_save, sender=Sale)
+@receiver(post_delete, sender=Sale)
+def analytics_cache_on_sale(sender, instance, **kwargs):
+    bump_cache_generation_on_commit(instance.company_id, CACHE_DOMAIN_SALES)
+
+
+@receiver(post_save, sender="construction.CashFlow")
+@receiver(post_delete, sender="construction.CashFlow")
+@receiver(post_save, sender="construction.CashShift")
+@receiver(post_delete, sender="construction.CashShift")
+def analytics_cache_on_cash(sender, instance, **kwargs):
+    bump_cache_generation_on_commit(instance.company_id, CACHE_DOMAIN_CASH)
+
+
+@receiver(post_save, sender="warehouse.Document")
+@receiver(post_delete, sender="warehouse.Document")
+def analytics_cache_on_warehouse_document(sender, instance, **kwargs):
+    from apps.warehouse.services_numbers import document_company_id
+
+    bump_cache_generation_on_commit(document_company_id(instance), CACHE_DOMAIN_WAREHOUSE)
+
+
+@receiver(post_save, sender=ManufactureSubreal)
+@receiver(post_delete, sender=ManufactureSubreal)
+def analytics_cache_on_subreal(sender, instance, **kwargs):
+    bump_cache_generation_on_commit(instance.company_id, CACHE_DOMAIN_PRODUCTION)
+
+
+@receiver(post_save, sender=PromoRule)
+@receiver(post_delete, sender=PromoRule)
+def promo_index_on_rule_change(sender, instance, **kwargs):
+    bump_cache_generation_on_commit(instance.company_id, CACHE_DOMAIN_PROMO)
+
+
+# ─────────────────────────────────────────────────────────────
+# чекпоинты сальдо для актов сверки (services/balance_checkpoints.py)
+# ─────────────────────────────────────────────────────────────
+@receiver(post_init, sender=Sale)
+@receiver(post_init, sender=ClientDeal)
+@receiver(post_init, sender=DealInstallment)
+@receiver(post_init, sender="warehouse.Document")
+@receiver(post_init, sender="warehouse.MoneyDocument")
+def balance_checkpoint_remember(sender, instance, **kwargs):
+    balance_checkpoints.remember(instance)
+
+
+@receiver(pre_save, sender=Sale)
+@receiver(pre_save, sender=ClientDeal)
+@receiver(pre_save, sender=DealInstallment)
+@receiver(pre_save, sender="warehouse.Document")
+@receiver(pre_save, sender="warehouse.MoneyDocument")
+def balance_checkpoint_before_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        balance_checkpoints.before_save(instance)
+
+
+@receiver(post_save, sender=Sale)
+@receiver(post_save, sender=ClientDeal)
+@receiver(post_save, sender=DealInstallment)
+@receiver(post_save, sender="warehouse.Document")
+@receiver(post_save, sender="warehouse.MoneyDocument")
+def balance_checkpoint_after_save(sender, instance, created, raw=False, **kwargs):
+    """Проведение/отмена/правка строки переносит её вклад во все более поздние чекпоинты."""
+    if not raw:
+        balance_checkpoints.after_save(instance, created)
+
+
+@receiver(pre_delete, sender=Sale)
+@receiver(pre_delete, sender=ClientDeal)
+@receiver(pre_delete, sender=DealInstallment)
+@receiver(pre_delete, sender="warehouse.Document")
+@receiver(pre_delete, sender="warehouse.MoneyDocument")
+def balance_checkpoint_before_delete(sender, instance, **kwargs):
+    balance_checkpoints.before_delete(instance)
+
+
+# ─────────────────────────────────────────────────────────────
+# остатки агентов на руках (services/agent_stock.py)
+# ─────────────────────────────────────────────────────────────
+@receiver(post_save, sender=ManufactureSubreal)
+def agent_stock_on_subreal_save(sender, instance, raw=False, update_fields=None, **kwargs):
+    # try_close() меняет только статус — на остаток не влияет
+    if raw or (update_fields and set(update_fields) <= {"status"}):
+        return
+    key = agent_stock.key_of(instance)
+    old = getattr(instance, "_loaded_stock_key", None)
+    # передачу перевесили: старый ключ теряет её остаток
+    agent_stock.refresh_keys([key] if old in (None, key) else [old, key])
+    instance._loaded_stock_key = key
+
+
+@receiver(post_save, sender=AgentSaleAllocation)
+@receiver(post_save, sender=ReturnFromAgent)
+def agent_stock_on_movement_save(sender, instance, raw=False, **kwargs):
+    """Продажа агента и принятый возврат. Приём считает сам Acceptance.save (после update счётчика)."""
+    if raw or (sender is ReturnFromAgent and instance.status != ReturnFromAgent.Status.ACCEPTED):
+        return
+    agent_stock.refresh_subreals([instance.subreal_id])
+
+
+@receiver(post_delete, sender=ManufactureSubreal)
+def agent_stock_on_subreal_delete(sender, instance, **kwargs):
+    agent_stock.refresh_keys([agent_stock.key_of(instance)], create=False)
+
+
+@receiver(post_delete, sender=AgentSaleAllocation)
+@receiver(post_delete, sender=ReturnFromAgent)
+@receiver(post_delete, sender=Acceptance)
+def agent_stock_on_movement_delete(sender, instance, **kwargs):
+    agent_stock.refresh_subreals([instance.subreal_id], create=False)
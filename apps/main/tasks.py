@@ -1,8 +1,13 @@
+import logging
+
 from django.db import transaction
 from celery import shared_task
 from apps.main.models import Task, Notification
 from django.utils.timezone import localtime
 
+logger = logging.getLogger(__name__)
+
+
 @shared_task
 def create_task_notification(task_id):
     try:
@@ -28,6 +33,44 @@ def create_task_notification(task_id):
         print(f"[ERROR] Unexpected error while creating task notification: {e}")
 
 
+@shared_task(ignore_result=True)
+def dispatch_product_webhooks():
+    """
+    Отправка product-вебхуков из outbox (см. apps.main.services.webhook_outbox).
+    Ставится после коммита и раз в минуту по CELERY_BEAT_SCHEDULE.
+    """
+    from apps.main.services.webhook_outbox import dispatch_pending, purge_sent, reschedule_retries
+
+    stats = dispatch_pending()
+    if stats["retried"]:
+        reschedule_retries()
+    purge_sent()
+    return stats
+
+
+@shared_task(ignore_result=True)
+def verify_balance_checkpoints():
+    """
+    Ночная сверка чекпоинтов сальдо (см. apps.main.services.balance_checkpoints):
+    queryset.update()/bulk_create мимо сигналов сдвигают их молча. Компании
+    с расхождениями перестраиваются целиком.
+    """
+    from apps.main.services.balance_checkpoints import ledgers
+
+    rebuilt = {}
+    for ledger in ledgers():
+        companies = {key[0] for key, _, _, _ in ledger.verify()}
+        for company_id in companies:
+            ledger.rebuild(company_id)
+        if companies:
+            logger.warning(
+                "Balance checkpoints drifted, rebuilt %s: companies=%s",
+                type(ledger).__name__, sorted(map(str, companies)),
+            )
+        rebuilt[type(ledger).__name__] = len(companies)
+    return rebuilt
+
+
 # Пример использования транзакции
 from django.db.models.signals import post_save
 from django.dispatch import receiver
@@ -37,3 +80,11 @@ def notify_assigned_user_async(sender, instance, created, **kwargs):
     if created and instance.assigned_to:
         # Убедитесь, что задача сохранена, прежде чем вызывать celery задачу
         transaction.on_commit(lambda: create_task_notification.delay(str(instance.id)))
+
+
+@shared_task(ignore_result=True)
+def import_products_job(job_id):
+    """Импорт товаров из загруженного файла (ProductImportJob, см. apps.main.services.product_import)."""
+    from apps.main.services.product_import import run_import_job
+
+    run_import_job(job_id)
@@ -1,3 +1,1169 @@
-from django.test import TestCase
+import os
+import re
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from apps.construction.models import CashFlow, Cashbox
+from apps.users.models import Company, User
+from apps.main import barcode_index
+from apps.main import cache_utils
+from apps.main.cache_utils import (
+    CACHE_DOMAIN_CASH, CACHE_DOMAIN_PRODUCTION, CACHE_DOMAIN_SALES, bump_cache_generation, cache_stats, cached_result,
+)
+from apps.main.analytics_dashboard import OwnerDashboardAnalyticsAPIView
+from apps.main.analytics_market import AnalyticsView
+from apps.main.views import (
+    AgentMyProductsListAPIView, ManufactureSubrealRetrieveUpdateDestroyAPIView, OwnerAgentsProductsListAPIView,
+)
+from apps.main.pos_views import (
+    CartItemUpdateDestroyAPIView,
+    ClientReconciliationClassicAPIView,
+    ClientReconciliationJSONAPIView,
+    SaleInvoiceDownloadAPIView,
+    _client_act_entries,
+)
+from apps.main.models import (
+    Acceptance, AgentProductBalance, AgentSaleAllocation, ManufactureSubreal, ReturnFromAgent,
+    AgentRequestCart, AgentRequestItem, Cart, CartItem, Client, ClientBalanceCheckpoint, ClientDeal, DealInstallment, ProductBrand, ProductCategory, PromoRule, Product, ProductCodeSequence, ProductWebhookOutbox, Sale, SaleDocSequence, SaleItem,
+    SaleProductRollup, SaleRollup, SaleRollupCoverage,
+)
+from apps.main.services import agent_stock, sales_rollup, webhook_outbox
+from apps.main.tasks import verify_balance_checkpoints
+from apps.main.services.balance_checkpoints import CLIENT_LEDGER, midnight
+from apps.main.services.dashboard_widgets import Widget, run_widgets
+from apps.main.services.product_import import ProductImporter, iter_file_rows
+from apps.main.services.sales_rollup import summarize
+from apps.main.utils_numbers import ensure_sale_doc_number, raise_product_counters
+from apps.utils import compute_gift_qty
+
+
+class BarcodeIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        barcode_index._local.clear()
+        barcode_index._versions.clear()
+
+        self.user = User.objects.create_user(email="owner@example.com", password="pass123", first_name="Owner")
+        self.company = Company.objects.create(name="Market", owner=self.user)
+        # bulk_create: без Product.save() (advisory lock есть только в Postgres)
+        self.piece, self.weight = Product.objects.bulk_create([
+            Product(company=self.company, name="Молоко", barcode="4600000000017", price=Decimal("85.000"), code="0001"),
+            Product(company=self.company, name="Сыр", is_weight=True, plu=12, price=Decimal("900.000"), code="0002"),
+        ])
+
+    def test_barcode_lookup_is_served_from_local_tier(self):
+        entry = barcode_index.lookup_barcode(self.company.id, "4600000000017")
+        self.assertEqual(entry.id, str(self.piece.id))
+        self.assertEqual(entry.price, Decimal("85.000"))
+        self.assertFalse(entry.is_weight)
+
+        with self.assertNumQueries(0):
+            again = barcode_index.lookup_barcode(self.company.id, "4600000000017")
+        self.assertEqual(again, entry)
+
+    def test_plu_lookup_and_negative_cache(self):
+        entry = barcode_index.lookup_plu(self.company.id, 12)
+        self.assertEqual(entry.id, str(self.weight.id))
+        self.assertTrue(entry.is_weight)
+
+        self.assertIsNone(barcode_index.lookup_barcode(self.company.id, "2200012003120"))
+        with self.assertNumQueries(0):
+            self.assertIsNone(barcode_index.lookup_barcode(self.company.id, "2200012003120"))
+
+    def test_invalidate_company_drops_stale_entries(self):
+        barcode_index.lookup_barcode(self.company.id, "4600000000017")
+        Product.objects.filter(pk=self.piece.pk).update(price=Decimal("99.000"))
+
+        barcode_index.invalidate_company(self.company.id)
+        entry = barcode_index.lookup_barcode(self.company.id, "4600000000017")
+        self.assertEqual(entry.price, Decimal("99.000"))
+
+
+class CartIncrementalTotalsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="cashier@example.com", password="pass123", first_name="Cashier")
+        self.company = Company.objects.create(name="Market", owner=self.user)
+        self.cart = Cart.objects.create(company=self.company, user=self.user)
+        self.products = Product.objects.bulk_create([
+            Product(company=self.company, name=f"P{i}", code=f"{i:04d}", price=Decimal("10.500"), purchase_price=Decimal("5"))
+            for i in range(60)
+        ])
+
+    def _add(self, product, qty="1.000", **extra):
+        return CartItem.objects.create(cart=self.cart, product=product, quantity=Decimal(qty), unit_price=product.price, **extra)
+
+    def _assert_matches_full_recalc(self):
+        self.cart.refresh_from_db()
+        incremental = (self.cart.subtotal, self.cart.discount_total, self.cart.total)
+        self.cart.recalc()
+        self.assertEqual(incremental, (self.cart.subtotal, self.cart.discount_total, self.cart.total))
+
+    def test_line_changes_move_totals_by_delta(self):
+        a = self._add(self.products[0], "2.000")
+        b = self._add(self.products[1], "1.500", line_discount=Decimal("3.00"))
+        self.assertEqual(self.cart.subtotal, Decimal("36.75"))
+        self.assertEqual(self.cart.discount_total, Decimal("3.00"))
+
+        item = CartItem.objects.get(pk=a.pk)
+        item.quantity = Decimal("5.000")
+        item.save(update_fields=["quantity"])
+        self._assert_matches_full_recalc()
+
+        CartItem.objects.get(pk=b.pk).delete()
+        self._assert_matches_full_recalc()
+        self.assertEqual(self.cart.total, Decimal("52.50"))
+
+    def test_order_discount_applies_on_refresh(self):
+        self._add(self.products[0], "4.000")
+        self.cart.order_discount_percent = Decimal("10.00")
+        self.cart.save(update_fields=["order_discount_percent", "updated_at"])
+        self.cart.refresh_totals()
+        self.assertEqual(self.cart.discount_total, Decimal("4.20"))
+        self._assert_matches_full_recalc()
+
+    def test_cart_without_raw_sums_falls_back_to_recalc(self):
+        """Корзина, открытая до появления накопленных сумм: итоги не обнуляются."""
+        self._add(self.products[0], "2.000")
+        Cart.objects.filter(pk=self.cart.pk).update(lines_subtotal_raw=None, lines_discount_raw=None)
+
+        self.cart.refresh_totals()
+        self.assertEqual(self.cart.subtotal, Decimal("21.00"))
+        self.assertEqual(self.cart.lines_subtotal_raw, Decimal("21"))
+
+        Cart.objects.filter(pk=self.cart.pk).update(lines_subtotal_raw=None, lines_discount_raw=None)
+        self._add(self.products[1], "1.000")
+        self._assert_matches_full_recalc()
+        self.assertEqual(self.cart.subtotal, Decimal("31.50"))
+
+    def test_cart_build_cost_is_linear(self):
+        """Стоимость добавления строки не зависит от размера корзины."""
+        def queries_for_next_line(product):
+            with CaptureQueriesContext(connection) as ctx:
+                self._add(product)
+            return len(ctx.captured_queries)
+
+        for p in self.products[:5]:
+            self._add(p)
+        small = queries_for_next_line(self.products[5])
+
+        for p in self.products[6:55]:
+            self._add(p)
+        large = queries_for_next_line(self.products[55])
+
+        self.assertEqual(small, large)
+        self._assert_matches_full_recalc()
+
+    def test_product_price_change_keeps_line_base(self):
+        """Скидка строки считается от цены на момент добавления, а не от текущей Product.price."""
+        product = self.products[0]
+        item = self._add(product, "2.000", line_discount=Decimal("1.00"))
+        Product.objects.filter(pk=product.pk).update(price=Decimal("12.000"))
+
+        item = CartItem.objects.select_related("product").get(pk=item.pk)
+        item.quantity = Decimal("3.000")
+        item.save(update_fields=["quantity"])
+        self._assert_matches_full_recalc()
+        self.assertEqual(self.cart.subtotal, Decimal("31.50"))
+
+    def test_line_update_view_refreshes_once(self):
+        self.user.company = self.company
+        self.user.save(update_fields=["company"])
+        item = self._add(self.products[0])
+
+        request = APIRequestFactory().patch("/", {"quantity": "4"}, format="json")
+        force_authenticate(request, user=self.user)
+        with CaptureQueriesContext(connection) as ctx:
+            response = CartItemUpdateDestroyAPIView.as_view()(request, cart_id=self.cart.id, item_id=item.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Decimal(response.data["subtotal"]), Decimal("42.00"))
+        refreshes = [q for q in ctx.captured_queries if q["sql"].startswith('SELECT "main_cart"."id", "main_cart"."lines_subtotal_raw"')]
+        self.assertEqual(len(refreshes), 1)
+
+
+@override_settings(SITE_WEBHOOK_URL="https://example.test/hook", SITE_WEBHOOK_COMPANY_ID=None, SITE_WEBHOOK_BATCH_SIZE=1)
+class ProductWebhookOutboxTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="owner@example.com", password="pass123", first_name="Owner")
+        self.company = Company.objects.create(name="Market", owner=self.user)
+        self.product = Product.objects.bulk_create([
+            Product(company=self.company, name="Чай", code="0001", price=Decimal("120.000")),
+        ])[0]
+
+    def test_repeated_events_are_coalesced(self):
+        webhook_outbox.enqueue_product_events(self.company.id, [self.product.id], "product.created", schedule=False)
+        webhook_outbox.enqueue_product_events(self.company.id, [self.product.id], "product.updated", schedule=False)
+        webhook_outbox.enqueue_product_events(self.company.id, [self.product.id], "product.updated", schedule=False)
+
+        rows = list(ProductWebhookOutbox.objects.all())
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].event, "product.created")
+
+    def test_dispatch_sends_fresh_data_and_records_lag(self):
+        webhook_outbox.enqueue_product_events(self.company.id, [self.product.id], "product.updated", schedule=False)
+
+        with mock.patch.object(webhook_outbox, "post_payload") as post:
+            stats = webhook_outbox.dispatch_pending()
+
+        self.assertEqual(stats["sent"], 1)
+        payload = post.call_args.args[0]
+        self.assertEqual(payload["event"], "product.updated")
+        self.assertEqual(payload["data"]["name"], "Чай")
+        row = ProductWebhookOutbox.objects.get()
+        self.assertEqual(row.status, ProductWebhookOutbox.Status.SENT)
+        self.assertEqual(webhook_outbox.get_delivery_metrics()["pending"], 0)
+
+    def test_failed_delivery_is_rescheduled_without_sleeping(self):
+        webhook_outbox.enqueue_product_events(self.company.id, [self.product.id], "product.updated", schedule=False)
+
+        with mock.patch.object(webhook_outbox, "post_payload", side_effect=RuntimeError("503")):
+            stats = webhook_outbox.dispatch_pending(max_attempts=3)
+
+        self.assertEqual(stats["retried"], 1)
+        row = ProductWebhookOutbox.objects.get()
+        self.assertEqual(row.status, ProductWebhookOutbox.Status.PENDING)
+        self.assertEqual(row.attempts, 1)
+        self.assertGreater(row.available_at, timezone.now())
+
+    def test_changes_during_delivery_get_their_own_pending_row(self):
+        webhook_outbox.enqueue_product_events(self.company.id, [self.product.id], "product.created", schedule=False)
+
+        def receiver(payload, **kwargs):
+            # пока идёт HTTP, запись не держит pending-слот товара
+            self.assertEqual(ProductWebhookOutbox.objects.get().status, ProductWebhookOutbox.Status.SENDING)
+            webhook_outbox.enqueue_product_events(self.company.id, [self.product.id], "product.updated", schedule=False)
+
+        with mock.patch.object(webhook_outbox, "post_payload", side_effect=receiver):
+            stats = webhook_outbox.dispatch_pending(max_rows=1)
+
+        self.assertEqual(stats["sent"], 1)
+        statuses = dict(ProductWebhookOutbox.objects.values_list("event", "status"))
+        self.assertEqual(statuses, {
+            "product.created": ProductWebhookOutbox.Status.SENT,
+            "product.updated": ProductWebhookOutbox.Status.PENDING,
+        })
+
+    def test_failed_row_is_folded_into_newer_pending_row(self):
+        webhook_outbox.enqueue_product_events(self.company.id, [self.product.id], "product.created", schedule=False)
+
+        def receiver(payload, **kwargs):
+            webhook_outbox.enqueue_product_events(self.company.id, [self.product.id], "product.updated", schedule=False)
+            raise RuntimeError("503")
+
+        with mock.patch.object(webhook_outbox, "post_payload", side_effect=receiver):
+            webhook_outbox.dispatch_pending(max_rows=1)
+
+        pending = ProductWebhookOutbox.objects.get(status=ProductWebhookOutbox.Status.PENDING)
+        self.assertEqual(pending.event, "product.created")
+        self.assertEqual(ProductWebhookOutbox.objects.count(), 2)
+
+    def test_expired_lease_is_reclaimed(self):
+        webhook_outbox.enqueue_product_events(self.company.id, [self.product.id], "product.updated", schedule=False)
+        ProductWebhookOutbox.objects.update(
+            status=ProductWebhookOutbox.Status.SENDING, leased_until=timezone.now() - timedelta(seconds=1),
+        )
+
+        with mock.patch.object(webhook_outbox, "post_payload") as post:
+            stats = webhook_outbox.dispatch_pending()
+
+        self.assertEqual((stats["sent"], post.call_count), (1, 1))
+        row = ProductWebhookOutbox.objects.get()
+        self.assertEqual((row.status, row.leased_until), (ProductWebhookOutbox.Status.SENT, None))
+
+    def test_insert_conflict_merges_event_instead_of_dropping_it(self):
+        # параллельная транзакция успела закоммитить pending-запись на тот же товар
+        ProductWebhookOutbox.objects.create(company=self.company, product_id=self.product.id, event="product.updated")
+
+        webhook_outbox._insert_pending([
+            ProductWebhookOutbox(company=self.company, product_id=self.product.id, event="product.deleted", payload={"id": "x"}),
+        ])
+
+        row = ProductWebhookOutbox.objects.get()
+        self.assertEqual((row.event, row.payload), ("product.deleted", {"id": "x"}))
+
+
+class SaleDocNumberTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="cashier@example.com", password="pass123", first_name="Cashier")
+        self.company = Company.objects.create(name="Market", owner=self.user)
+        self.cashbox_a = Cashbox.objects.create(company=self.company, name="A")
+        self.cashbox_b = Cashbox.objects.create(company=self.company, name="B")
+
+    def _sale(self, cashbox=None, **extra):
+        return Sale.objects.create(company=self.company, cashbox=cashbox or self.cashbox_a, **extra)
+
+    def test_numbers_continue_from_history_and_are_stable(self):
+        self._sale(doc_number=41)
+        first, second = self._sale(), self._sale(cashbox=self.cashbox_b)
+
+        self.assertEqual(ensure_sale_doc_number(first), 42)
+        self.assertEqual(ensure_sale_doc_number(second), 43)
+        self.assertEqual(ensure_sale_doc_number(first), 42)
+        self.assertEqual(SaleDocSequence.objects.get(company=self.company, cashbox=None).last_number, 43)
+
+    def test_allocation_cost_does_not_grow_with_history(self):
+        def queries_for_next_number():
+            sale = self._sale()
+            with CaptureQueriesContext(connection) as ctx:
+                ensure_sale_doc_number(sale)
+            return [q["sql"] for q in ctx.captured_queries if "SAVEPOINT" not in q["sql"]]
+
+        ensure_sale_doc_number(self._sale())
+        small = queries_for_next_number()
+
+        Sale.objects.bulk_create([
+            Sale(company=self.company, cashbox=self.cashbox_a, doc_number=n) for n in range(3, 300)
+        ])
+        SaleDocSequence.objects.filter(company=self.company).update(last_number=299)
+        large = queries_for_next_number()
+
+        # продажа под блокировкой, счётчик под блокировкой, +1 счётчику, номер в продажу
+        self.assertEqual(len(small), 4)
+        self.assertEqual(len(large), len(small))
+        self.assertFalse(any("MAX(" in sql.upper() for sql in large))
+
+    @override_settings(SALE_DOC_NUMBER_SCOPE="cashbox")
+    def test_per_cashbox_scope(self):
+        self.assertEqual(ensure_sale_doc_number(self._sale()), 1)
+        self.assertEqual(ensure_sale_doc_number(self._sale()), 2)
+        self.assertEqual(ensure_sale_doc_number(self._sale(cashbox=self.cashbox_b)), 1)
+
+    def test_seed_command_never_moves_counter_back(self):
+        self._sale(doc_number=10)
+        call_command("seed_sale_doc_sequences", stdout=mock.MagicMock())
+        self.assertEqual(SaleDocSequence.objects.get(company=self.company, cashbox=None).last_number, 10)
+
+        SaleDocSequence.objects.filter(company=self.company).update(last_number=25)
+        call_command("seed_sale_doc_sequences", stdout=mock.MagicMock())
+        self.assertEqual(SaleDocSequence.objects.get(company=self.company, cashbox=None).last_number, 25)
+
+        call_command("seed_sale_doc_sequences", "--per-cashbox", stdout=mock.MagicMock())
+        self.assertEqual(SaleDocSequence.objects.get(company=self.company, cashbox=self.cashbox_a).last_number, 10)
+
+
+class SaleRollupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email="owner@example.com", password="pass123", first_name="Owner")
+        self.company = Company.objects.create(name="Market", owner=self.user)
+        self.cashbox = Cashbox.objects.create(company=self.company, name="A")
+        self.products = Product.objects.bulk_create([
+            Product(company=self.company, name=f"P{i}", code=f"{i:04d}", price=Decimal("10"), purchase_price=Decimal("4"))
+            for i in range(3)
+        ])
+        self.yesterday = timezone.now() - timedelta(days=1)
+
+    def _paid_sale(self, lines, paid_at, method=Sale.PaymentMethod.CASH):
+        sale = Sale.objects.create(company=self.company, cashbox=self.cashbox, user=self.user)
+        total = Decimal("0")
+        for product, qty in lines:
+            SaleItem.objects.create(
+                sale=sale, product=product, name_snapshot=product.name, quantity=Decimal(qty), unit_price=product.price
+            )
+            total += product.price * Decimal(qty)
+        sale.total = total
+        sale.save(update_fields=["total"])
+        sale.status, sale.paid_at, sale.payment_method = Sale.Status.PAID, paid_at, method
+        sale.save(update_fields=["status", "paid_at", "payment_method"])
+        return sale
+
+    def _snapshot(self):
+        rows = sorted(
+            (r.day, r.hour, r.payment_method, r.sales_count, r.revenue, r.cogs)
+            for r in SaleRollup.objects.filter(company=self.company) if r.sales_count
+        )
+        products = sorted(
+            (r.day, r.product_id, r.quantity, r.revenue, r.cogs)
+            for r in SaleProductRollup.objects.filter(company=self.company) if r.quantity
+        )
+        return rows, products
+
+    def _get(self, tab, **params):
+        request = APIRequestFactory().get("/analytics/", {"tab": tab, **params})
+        force_authenticate(request, user=self.user)
+        return AnalyticsView.as_view()(request).data
+
+    def test_incremental_rollups_match_rebuild(self):
+        p0, p1, p2 = self.products
+        self._paid_sale([(p0, "2"), (p1, "1")], self.yesterday)
+        self._paid_sale([(p0, "1")], self.yesterday, method=Sale.PaymentMethod.TRANSFER)
+        returned = self._paid_sale([(p2, "3")], self.yesterday)
+
+        returned.status = Sale.Status.CANCELED
+        returned.save(update_fields=["status"])
+        self._paid_sale([(p2, "1")], self.yesterday).delete()
+
+        incremental = self._snapshot()
+        self.assertEqual(sum(r[3] for r in incremental[0]), 2)
+        self.assertEqual(sum(r[4] for r in incremental[0]), Decimal("40.00"))
+        self.assertEqual(sum(r[5] for r in incremental[0]), Decimal("16.00"))
+
+        call_command("backfill_sale_rollups", stdout=mock.MagicMock())
+        self.assertEqual(self._snapshot(), incremental)
+        self.assertTrue(SaleRollupCoverage.objects.filter(company=self.company).exists())
+
+    def test_analytics_reads_rollups_and_matches_raw(self):
+        p0, p1, _ = self.products
+        self._paid_sale([(p0, "2"), (p1, "1")], self.yesterday - timedelta(days=1))
+        self._paid_sale([(p1, "5")], self.yesterday, method=Sale.PaymentMethod.TRANSFER)
+        self._paid_sale([(p0, "1")], timezone.now())
+
+        period = {
+            "date_from": (timezone.localdate() - timedelta(days=5)).isoformat(),
+            "date_to": timezone.localdate().isoformat(),
+        }
+        raw = {tab: self._get(tab, **period) for tab in ("sales", "cashboxes", "users")}
+
+        call_command("backfill_sale_rollups", stdout=mock.MagicMock())
+        cache.clear()
+        summaries = []
+
+        def spy(*args, **kwargs):
+            summaries.append(summarize(*args, **kwargs))
+            return summaries[-1]
+
+        with mock.patch.object(sales_rollup, "summarize", spy):
+            rolled = {tab: self._get(tab, **period) for tab in ("sales", "cashboxes", "users")}
+        self.assertEqual(len(summaries), 3)
+        self.assertTrue(all(summary is not None for summary in summaries))
+
+        self.assertEqual(rolled["sales"]["cards"], raw["sales"]["cards"])
+        self.assertEqual(rolled["sales"]["charts"], raw["sales"]["charts"])
+        self.assertEqual(rolled["sales"]["tables"], raw["sales"]["tables"])
+        self.assertEqual(rolled["cashboxes"]["cards"], raw["cashboxes"]["cards"])
+        self.assertEqual(rolled["cashboxes"]["charts"], raw["cashboxes"]["charts"])
+        self.assertEqual(rolled["users"]["tables"], raw["users"]["tables"])
+
+    def test_cache_key_ignores_empty_params_and_date_aliases(self):
+        day = timezone.localdate().isoformat()
+        self._get("sales", date_from=day, date_to=day)
+        with mock.patch.object(AnalyticsView, "_sales", side_effect=AssertionError("cache miss")):
+            self._get("sales", period_start=day, period_end=day, cashbox="")
+
+
+class CacheGenerationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email="owner@example.com", password="pass123", first_name="Owner")
+        self.company = Company.objects.create(name="Market", owner=self.user)
+        self.cashbox = Cashbox.objects.create(company=self.company, name="A")
+
+    def test_cached_result_is_dropped_by_its_domain_only(self):
+        calls = []
+
+        @cached_result(timeout=3600, key_prefix="test_generations", domains=(CACHE_DOMAIN_SALES,))
+        def payload(*, company_id):
+            calls.append(company_id)
+            return len(calls)
+
+        self.assertEqual(payload(company_id=self.company.id), 1)
+        self.assertEqual(payload(company_id=self.company.id), 1)
+
+        bump_cache_generation(self.company.id, CACHE_DOMAIN_CASH)
+        self.assertEqual(payload(company_id=self.company.id), 1)
+
+        bump_cache_generation(self.company.id, CACHE_DOMAIN_SALES)
+        self.assertEqual(payload(company_id=self.company.id), 2)
+
+    def test_market_analytics_sees_payment_right_after_commit(self):
+        def transactions():
+            request = APIRequestFactory().get("/analytics/", {"tab": "sales"})
+            force_authenticate(request, user=self.user)
+            return AnalyticsView.as_view()(request).data["cards"]["transactions"]
+
+        sale = Sale.objects.create(company=self.company, cashbox=self.cashbox, total=Decimal("10.00"))
+        self.assertEqual(transactions(), 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            sale.mark_paid(payment_method=Sale.PaymentMethod.TRANSFER)
+        self.assertEqual(transactions(), 1)
+
+
+class CachedResultStampedeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.calls = []
+
+    def _payload(self, prefix, delay=0.0):
+        @cached_result(timeout=60, key_prefix=prefix)
+        def payload(*, company_id):
+            time.sleep(delay)
+            self.calls.append(company_id)
+            return len(self.calls)
+
+        return payload
+
+    def test_concurrent_misses_compute_once(self):
+        payload = self._payload("test_single_flight", delay=0.2)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(payload(company_id="c1"))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, [1] * 5)
+
+    def test_stale_value_is_served_while_one_worker_refreshes(self):
+        payload = self._payload("test_swr")
+        self.assertEqual(payload(company_id="c1"), 1)
+
+        refreshes = []
+        later = time.time() + 61
+        with mock.patch.object(cache_utils, "_run_in_background", refreshes.append), \
+                mock.patch.object(cache_utils, "_wall_clock", return_value=later):
+            self.assertEqual(payload(company_id="c1"), 1)
+            self.assertEqual(payload(company_id="c1"), 1)
+            self.assertEqual(len(refreshes), 1)  # второй запрос не запускает ещё один пересчёт
+
+            refreshes[0]()
+            self.assertEqual(payload(company_id="c1"), 2)
+
+        self.assertEqual(len(self.calls), 2)
+        stats = cache_stats("test_swr")
+        self.assertEqual((stats["hit"], stats["stale"], stats["miss"], stats["recompute"]), (1, 2, 1, 2))
+
+
+class ProductCodeAllocationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="owner@example.com", password="pass123", first_name="Owner")
+        self.company = Company.objects.create(name="Market", owner=self.user)
+
+    def _create(self, **extra):
+        return Product.objects.create(company=self.company, name=extra.pop("name", "Товар"), price=Decimal("10"), **extra)
+
+    def _sql(self, fn):
+        with CaptureQueriesContext(connection) as ctx:
+            fn()
+        return [q["sql"] for q in ctx.captured_queries if "SAVEPOINT" not in q["sql"]]
+
+    def test_numbers_continue_from_catalog(self):
+        Product.objects.bulk_create([
+            Product(company=self.company, name="Old", code="0007", plu=12, is_weight=True),
+            Product(company=self.company, name="Manual", code="ABC"),
+        ])
+
+        weighed = self._create(is_weight=True)
+        piece = self._create()
+        self.assertEqual((weighed.code, weighed.plu), ("0008", 13))
+        self.assertEqual((piece.code, piece.plu), ("0009", None))
+
+        self._create(code="0100", plu=50, is_weight=True)
+        self.assertEqual(self._create(is_weight=True).plu, 51)
+        self.assertEqual(self._create().code, "0102")
+        self.assertEqual(ProductCodeSequence.objects.get(company=self.company).last_code, 102)
+
+    def test_create_cost_does_not_grow_with_catalog(self):
+        self._create(name="first")
+        small = self._sql(lambda: self._create(name="small", is_weight=True))
+
+        Product.objects.bulk_create(
+            [Product(company=self.company, name=f"P{i}", code=f"{i + 1000:05d}") for i in range(50_000)],
+            batch_size=5000,
+        )
+        raise_product_counters(self.company.id, code=50_999)
+        large = self._sql(lambda: self._create(name="large", is_weight=True))
+
+        # счётчик под блокировкой, +1 код/ПЛУ, INSERT товара
+        self.assertEqual(len(small), 3)
+        self.assertEqual(len(large), len(small))
+        self.assertFalse(any("MAX(" in sql.upper() or "advisory" in sql for sql in large))
+        self.assertEqual(Product.objects.get(name="large").code, "51000")
+
+    def test_price_edit_does_not_touch_counters_or_index(self):
+        product = Product.objects.get(pk=self._create().pk)
+        product.country = "KG"
+
+        with mock.patch("apps.main.barcode_index.invalidate_company_on_commit") as invalidate:
+            sql = self._sql(lambda: product.save(update_fields=["country"]))
+        self.assertEqual(len(sql), 1)
+        invalidate.assert_not_called()
+
+        product.price = Decimal("12.00")
+        with mock.patch("apps.main.barcode_index.invalidate_company_on_commit") as invalidate:
+            product.save()
+        invalidate.assert_called_once_with(self.company.id)
+
+
+
+@override_settings(SITE_WEBHOOK_URL="https://example.test/hook", SITE_WEBHOOK_COMPANY_ID=None)
+class ProductImportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="owner@example.com", password="pass123", first_name="Owner")
+        self.company = Company.objects.create(name="Market", owner=self.user)
+        Product.objects.bulk_create([
+            Product(company=self.company, name="Старое", code="0005", barcode="4600000000001", price=Decimal("10")),
+        ])
+
+    def _csv(self, lines):
+        fd, path = tempfile.mkstemp(suffix=".csv")
+        with os.fdopen(fd, "w", encoding="cp1251") as f:
+            f.write("\n".join(lines))
+        self.addCleanup(os.unlink, path)
+        return path
+
+    def _rows(self, n, start=2):
+        return [f"46000000{i:05d};Товар {i};A-{i};{i},50;{i}" for i in range(start, start + n)]
+
+    def test_upsert_by_barcode_with_code_blocks_and_batched_events(self):
+        path = self._csv(
+            ["Штрихкод;Наименование;Артикул;Цена;Закупка", "4600000000001;Старое;;99;90", ";Без штрихкода;;1;1"]
+            + self._rows(5)
+            + ["4600000000002;Повтор;;1;1"]
+        )
+        importer = ProductImporter(self.company, update_existing=True, chunk_size=3)
+
+        with mock.patch("apps.main.services.product_import.schedule_dispatch") as schedule:
+            with mock.patch("apps.main.barcode_index.invalidate_company_on_commit") as invalidate:
+                stats = importer.run(iter_file_rows(path))
+
+        self.assertEqual((stats.rows, stats.created, stats.updated), (8, 5, 1))
+        self.assertEqual((stats.skipped_no_barcode, stats.skipped_duplicate, stats.error_count), (1, 1, 0))
+        old = Product.objects.get(barcode="4600000000001")
+        self.assertEqual((old.name, old.price, old.code), ("Старое", Decimal("99.00"), "0005"))
+        new = Product.objects.get(barcode="4600000000003")
+        self.assertEqual((new.name, new.article, new.price, new.quantity), ("Товар 3", "A-3", Decimal("3.50"), Decimal("50")))
+        codes = sorted(Product.objects.exclude(pk=old.pk).values_list("code", flat=True))
+        self.assertEqual(codes, ["0006", "0007", "0008", "0009", "0010"])
+        self.assertEqual(ProductWebhookOutbox.objects.filter(event="product.created").count(), 5)
+        self.assertEqual(ProductWebhookOutbox.objects.filter(event="product.updated").count(), 1)
+        invalidate.assert_called_once_with(self.company.id)
+        schedule.assert_called_once_with()
+
+    def test_query_count_per_chunk_does_not_depend_on_rows(self):
+        def queries(n, start):
+            path = self._csv(["barcode;name;article;price;purchase_price"] + self._rows(n, start))
+            importer = ProductImporter(self.company, chunk_size=n)
+            with CaptureQueriesContext(connection) as ctx:
+                stats = importer.run(iter_file_rows(path))
+            self.assertEqual(stats.created, n)
+            return len([q for q in ctx.captured_queries if "SAVEPOINT" not in q["sql"]])
+
+        queries(1, 50)  # первое обращение заводит счётчик кодов компании
+        # выборка существующих, счётчик (SELECT FOR UPDATE + UPDATE), INSERT товаров, outbox (SELECT + INSERT)
+        self.assertEqual(queries(3, 100), 6)
+        self.assertEqual(queries(30, 1000), 6)
+
+
+class PromoRuleIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email="owner@example.com", password="pass123", first_name="Owner")
+        self.company = Company.objects.create(name="Market", owner=self.user)
+        self.brand = ProductBrand.objects.create(company=self.company, name="Бренд")
+        self.category = ProductCategory.objects.create(company=self.company, name="Напитки")
+        self.branded = self._product("Сок", brand=self.brand, category=self.category, quantity=Decimal("1000"))
+        self.plain = self._product("Вода", quantity=Decimal("1000"))
+
+    def _product(self, name, **extra):
+        return Product.objects.create(company=self.company, name=name, price=Decimal("10"), **extra)
+
+    def _rule(self, min_qty, gift_qty, **extra):
+        return PromoRule.objects.create(company=self.company, min_qty=min_qty, gift_qty=gift_qty, **extra)
+
+    def _gift(self, product, qty, **kwargs):
+        return compute_gift_qty(product, qty, company=self.company, **kwargs)
+
+    def test_most_specific_rule_wins(self):
+        self._rule(10, 1)
+        self._rule(10, 2, category=self.category)
+        self._rule(10, 3, brand=self.brand)
+        self._rule(20, 5, brand=self.brand, inclusive=True)
+        self._rule(10, 4, product=self.plain, active_to=timezone.localdate() - timedelta(days=1))
+
+        self.assertEqual(self._gift(self.branded, 10), 0)
+        self.assertEqual(self._gift(self.branded, 11), 3)
+        self.assertEqual(self._gift(self.branded, 20), 5)
+        self.assertEqual(self._gift(self.branded, 20, stacking=True), 5 + 3 + 2 + 1)
+        # правило товара просрочено; чужие правила бренда/категории сюда не попадают
+        self.assertEqual(self._gift(self.plain, 11), 1)
+
+    def test_rule_change_invalidates_index(self):
+        rule = self._rule(5, 1)
+        self.assertEqual(self._gift(self.plain, 6), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(self._gift(self.plain, 6), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            rule.gift_qty = 2
+            rule.save()
+        self.assertEqual(self._gift(self.plain, 6), 2)
+
+    def test_cart_gifts_use_one_bulk_update(self):
+        self._rule(5, 1)
+        self._rule(5, 2, brand=self.brand)
+        products = [self.branded, self.plain] + [self._product(f"P{i}") for i in range(8)]
+        cart = AgentRequestCart.objects.create(company=self.company, agent=self.user)
+        for product in products:
+            AgentRequestItem.objects.create(cart=cart, product=product, quantity_requested=6)
+        cart = AgentRequestCart.objects.get(pk=cart.pk)
+
+        # позиции, правила (промах кэша), один UPDATE позиций; остальное — full_clean/save корзины
+        with CaptureQueriesContext(connection) as ctx:
+            cart.submit()
+        sql = [q["sql"] for q in ctx.captured_queries if "SAVEPOINT" not in q["sql"]]
+        self.assertFalse(any("main_promorule" in q and "CASE" in q.upper() for q in sql))
+        self.assertEqual(len(sql), 8)
+        self.assertEqual(sum(q.startswith("UPDATE \"main_agentrequestitem\"") for q in sql), 1)
+
+        gifts = dict(cart.items.values_list("product_id", "gift_quantity"))
+        self.assertEqual(gifts[self.branded.pk], 2)
+        self.assertEqual(gifts[self.plain.pk], 1)
+        self.assertEqual(set(cart.items.values_list("total_quantity", flat=True)), {7, 8})
+
+
+class ClientBalanceCheckpointTests(TestCase):
+    """Начальное сальдо акта сверки = чекпоинт месяца + хвост, а не вся история клиента."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(email="owner@example.com", password="pass123", first_name="Owner")
+        self.company = Company.objects.create(name="Market", owner=self.user)
+        self.user.company = self.company
+        self.user.save(update_fields=["company"])
+        self.cashbox = Cashbox.objects.create(company=self.company, name="A")
+        self.client_obj = Client.objects.create(company=self.company, full_name="Клиент", phone="+996")
+        self.now = timezone.now()
+
+        # история за полтора года: created_at задаём update(), как при импорте
+        self.sales = []
+        for months_ago in range(18, 0, -1):
+            sale = Sale.objects.create(company=self.company, cashbox=self.cashbox, client=self.client_obj, total=Decimal("100.00"))
+            Sale.objects.filter(pk=sale.pk).update(created_at=self.now - timedelta(days=30 * months_ago))
+            self.sales.append(Sale.objects.get(pk=sale.pk))
+        self.deal = ClientDeal.objects.create(
+            company=self.company, client=self.client_obj, title="Д", kind=ClientDeal.Kind.DEBT,
+            amount=Decimal("900.00"), prepayment=Decimal("300.00"), debt_months=3,
+        )
+        ClientDeal.objects.filter(pk=self.deal.pk).update(created_at=self.now - timedelta(days=200))
+        inst = self.deal.installments.order_by("number").first()
+        DealInstallment.objects.filter(pk=inst.pk).update(paid_on=(self.now - timedelta(days=100)).date(), paid_amount=inst.amount)
+        call_command("rebuild_balance_checkpoints", only="clients", stdout=StringIO())
+
+    def _brute(self, start, source="both"):
+        """Прежний расчёт: агрегаты по всей истории."""
+        debit = credit = Decimal("0")
+        if source in ("both", "sales"):
+            debit += sum(s.total for s in Sale.objects.filter(client=self.client_obj, created_at__lt=start))
+        if source in ("both", "deals"):
+            for d in ClientDeal.objects.filter(client=self.client_obj, created_at__lt=start):
+                debit += d.amount if d.kind != ClientDeal.Kind.PREPAYMENT else 0
+                credit += d.prepayment
+            credit += sum(
+                i.amount for i in DealInstallment.objects.filter(
+                    deal__client=self.client_obj, paid_on__isnull=False, paid_on__lt=start.date()
+                )
+            )
+        return debit - credit
+
+    def _opening(self, start, source="both"):
+        return CLIENT_LEDGER.opening(self.company.id, self.client_obj.id, start, source)
+
+    def test_opening_matches_full_history_and_reads_one_checkpoint(self):
+        self.assertGreaterEqual(ClientBalanceCheckpoint.objects.filter(client=self.client_obj).count(), 17)
+        for days_ago in (500, 250, 101, 45, 3):
+            start = self.now - timedelta(days=days_ago)
+            for source in ("both", "sales", "deals"):
+                self.assertEqual(self._opening(start, source), self._brute(start, source), (days_ago, source))
+
+        # чекпоинт + хвост месяца по продажам, сделкам и рассрочке
+        with self.assertNumQueries(4):
+            self._opening(self.now - timedelta(days=45))
+
+    def test_edits_and_deletes_move_checkpoints(self):
+        start = self.now - timedelta(days=20)
+        old_sale = self.sales[2]
+        old_sale.total = Decimal("250.00")
+        old_sale.save(update_fields=["total"])
+        self.sales[5].delete()
+        inst = self.deal.installments.order_by("number")[1]
+        inst.paid_on = (self.now - timedelta(days=90)).date()
+        inst.save(update_fields=["paid_on"])
+
+        self.assertEqual(self._opening(start), self._brute(start))
+        checkpoint = ClientBalanceCheckpoint.objects.filter(client=self.client_obj).order_by("-period_start").first()
+        fresh = CLIENT_LEDGER.period_sums((self.company.id, self.client_obj.id), None, midnight(checkpoint.period_start))
+        self.assertEqual(checkpoint.sales_debit, fresh["sales_debit"])
+        self.assertEqual(checkpoint.deals_credit, fresh["deals_credit"])
+
+    def test_missing_checkpoint_is_built_from_previous_one(self):
+        ClientBalanceCheckpoint.objects.filter(client=self.client_obj, period_start__gt=(self.now - timedelta(days=150)).date()).delete()
+        start = self.now - timedelta(days=10)
+        self.assertEqual(self._opening(start), self._brute(start))
+        month = timezone.localtime(start).date().replace(day=1)
+        self.assertTrue(ClientBalanceCheckpoint.objects.filter(client=self.client_obj, period_start=month).exists())
+
+        request = APIRequestFactory().get(
+            "/", {"start": timezone.localtime(start).date().isoformat(), "end": timezone.localdate().isoformat()}
+        )
+        force_authenticate(request, user=self.user)
+        response = ClientReconciliationJSONAPIView.as_view()(request, client_id=self.client_obj.id)
+        self.assertEqual(response.status_code, 200)
+        expected = self._brute(midnight(timezone.localtime(start).date()))
+        self.assertEqual(response.data["opening_balance"], f"{expected:.2f}")
+
+    def test_unchanged_installment_save_does_no_lookups(self):
+        inst = self.deal.installments.order_by("number").first()
+        with CaptureQueriesContext(connection) as ctx:
+            inst.save(update_fields=["paid_amount"])
+        sql = " ".join(q["sql"] for q in ctx.captured_queries)
+        self.assertNotIn('"main_clientdeal"."client_id"', sql)
+        self.assertNotIn("main_clientbalancecheckpoint", sql)
+
+    def test_drift_past_signals_is_verified_and_rebuilt(self):
+        self.assertEqual(CLIENT_LEDGER.verify(self.company.id), [])
+        Sale.objects.filter(pk=self.sales[0].pk).update(total=Decimal("170.00"))  # мимо сигналов
+        self.assertTrue(CLIENT_LEDGER.verify(self.company.id))
+        with self.assertRaises(CommandError):
+            call_command("rebuild_balance_checkpoints", only="clients", verify=True, stdout=StringIO())
+
+        verify_balance_checkpoints()
+        self.assertEqual(CLIENT_LEDGER.verify(self.company.id), [])
+
+
+class ReconciliationPdfTests(TestCase):
+    """Классический акт сверки рисуется за один проход по курсорам и отдаётся потоком."""
+
+    ROWS = 250
+
+    def setUp(self):
+        self.user = User.objects.create_user(email="pdf@example.com", password="pass123", first_name="Owner")
+        self.company = Company.objects.create(name="Market", owner=self.user)
+        self.user.company = self.company
+        self.user.save(update_fields=["company"])
+        cashbox = Cashbox.objects.create(company=self.company, name="A")
+        self.client_obj = Client.objects.create(company=self.company, full_name="Клиент", phone="+996")
+        Sale.objects.bulk_create(
+            Sale(company=self.company, cashbox=cashbox, client=self.client_obj, total=Decimal("10.50") + i)
+            for i in range(self.ROWS)
+        )
+        ClientDeal.objects.create(
+            company=self.company, client=self.client_obj, title="Д" * 70, kind=ClientDeal.Kind.DEBT,
+            amount=Decimal("900.00"), prepayment=Decimal("300.00"), debt_months=3,
+        )
+        # дата без времени в end парсится как полночь — берём с запасом
+        today = timezone.localdate()
+        self.params = {"start": (today - timedelta(days=1)).isoformat(), "end": (today + timedelta(days=1)).isoformat()}
+
+    def _get(self, view, **kwargs):
+        request = APIRequestFactory().get("/", self.params)
+        force_authenticate(request, user=self.user)
+        return view.as_view()(request, **kwargs)
+
+    def test_classic_act_streams_multipage_pdf_with_json_totals(self):
+        response = self._get(ClientReconciliationClassicAPIView, client_id=self.client_obj.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        pdf = b"".join(response.streaming_content)
+        self.assertTrue(pdf.startswith(b"%PDF"))
+        self.assertGreater(len(re.findall(rb"/Type /Page\b(?!s)", pdf)), 5)
+
+        # строки акта идут генератором в том же порядке и с теми же суммами, что и JSON
+        start = midnight(timezone.localdate() - timedelta(days=1))
+        entries = _client_act_entries(self.company, self.client_obj, start, start + timedelta(days=2), "both")
+        self.assertNotIsInstance(entries, list)
+        rows = list(entries)
+        data = self._get(ClientReconciliationJSONAPIView, client_id=self.client_obj.id).data
+        self.assertEqual([r["title"] for r in rows], [r["title"] for r in data["entries"]])
+        self.assertEqual(f"{sum(r['a_debit'] for r in rows):.2f}", data["totals"]["a_debit"])
+        self.assertEqual(f"{sum(r['a_credit'] for r in rows):.2f}", data["totals"]["a_credit"])
+
+    def test_invoice_and_error_pdf(self):
+        sale = Sale.objects.filter(client=self.client_obj).first()
+        response = self._get(SaleInvoiceDownloadAPIView, pk=sale.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"%PDF"))
+        self.assertIn("invoice_", response["Content-Disposition"])
+
+        self.params = {"start": "bad", "end": "dates"}
+        response = self._get(ClientReconciliationClassicAPIView, client_id=self.client_obj.id)
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"%PDF"))
+
+
+class AgentStockBalanceTests(TestCase):
+    """Остатки агентов на руках ведутся строкой на ключ и читаются списками без пересчёта истории."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(email="stock@example.com", password="pass123", first_name="Owner")
+        self.company = Company.objects.create(name="Market", owner=self.user)
+        self.user.company = self.company
+        self.user.save(update_fields=["company"])
+        self.agent = User.objects.create_user(email="agent@example.com", password="pass123", first_name="Agent")
+        self.agent.company = self.company
+        self.agent.save(update_fields=["company"])
+        self.cashbox = Cashbox.objects.create(company=self.company, name="A")
+        self.products = [
+            Product.objects.create(company=self.company, name=f"Товар {i}", price=Decimal("10")) for i in range(3)
+        ]
+
+    def _transfer(self, product, qty, accept=None):
+        subreal = ManufactureSubreal.objects.create(
+            company=self.company, user=self.user, agent=self.agent, product=product, qty_transferred=qty
+        )
+        if accept:
+            Acceptance.objects.create(subreal=subreal, accepted_by=self.agent, qty=accept)
+        return subreal
+
+    def _sell(self, subreal, qty):
+        sale = Sale.objects.create(company=self.company, cashbox=self.cashbox, user=self.agent)
+        item = SaleItem.objects.create(
+            sale=sale, product=subreal.product, name_snapshot=subreal.product.name,
+            quantity=Decimal(qty), unit_price=subreal.product.price,
+        )
+        return AgentSaleAllocation.objects.create(
+            company=self.company, agent=self.agent, subreal=subreal, sale=sale, sale_item=item,
+            product=subreal.product, qty=qty,
+        )
+
+    def _stored(self, product):
+        row = AgentProductBalance.objects.filter(agent=self.agent, product=product).first()
+        return row.qty_on_hand if row else None
+
+    def _get(self, view, user):
+        request = APIRequestFactory().get("/")
+        force_authenticate(request, user=user)
+        response = view.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_movements_keep_balance_in_sync(self):
+        p0, p1 = self.products[:2]
+        first = self._transfer(p0, 10, accept=8)
+        second = self._transfer(p0, 5, accept=5)
+        self.assertEqual(self._stored(p0), 13)
+
+        self._sell(first, 3)
+        self.assertEqual(self._stored(p0), 10)
+
+        ret = ReturnFromAgent.objects.create(subreal=second, returned_by=self.agent, qty=2)
+        self.assertEqual(self._stored(p0), 10)  # ожидающий возврат остаток не меняет
+        ret.accept(self.user)
+        self.assertEqual(self._stored(p0), 8)
+
+        other = self._transfer(p1, 4, accept=4)
+        request = APIRequestFactory().patch("/", {"subreals": [{"id": str(other.id), "qty_returned": 1}]}, format="json")
+        force_authenticate(request, user=self.agent)
+        response = AgentMyProductsListAPIView.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._stored(p1), 3)
+
+        ret.delete()
+        other.delete()
+        self.assertFalse(AgentProductBalance.objects.filter(product=p1).exists())
+        self.assertEqual(agent_stock.verify(self.company.id), [])
+
+    def test_reassigned_transfer_moves_balance_to_new_key(self):
+        p0, p1 = self.products[:2]
+        other = User.objects.create_user(email="agent2@example.com", password="pass123", first_name="Agent2")
+        other.company = self.company
+        other.save(update_fields=["company"])
+        subreal = self._transfer(p0, 5, accept=5)
+        self.assertEqual(self._stored(p0), 5)
+
+        request = APIRequestFactory().patch(
+            "/", {"agent": str(other.id), "product": str(p1.id)}, format="json",
+        )
+        force_authenticate(request, user=self.user)
+        response = ManufactureSubrealRetrieveUpdateDestroyAPIView.as_view()(request, pk=subreal.pk)
+        self.assertEqual(response.status_code, 200, response.data)
+
+        self.assertIsNone(self._stored(p0))
+        self.assertEqual(AgentProductBalance.objects.get(agent=other, product=p1).qty_on_hand, 5)
+        self.assertEqual(agent_stock.verify(self.company.id), [])
+
+    def test_acceptance_and_return_reset_on_hand_cache(self):
+        subreal = self._transfer(self.products[0], 5)
+
+        def generation():
+            return cache_utils.cache_generations(self.company.id, [CACHE_DOMAIN_PRODUCTION])
+
+        before = generation()
+        with self.captureOnCommitCallbacks(execute=True):
+            Acceptance.objects.create(subreal=subreal, accepted_by=self.agent, qty=3)
+        self.assertNotEqual(generation(), before)
+
+        ret = ReturnFromAgent.objects.create(subreal=subreal, returned_by=self.agent, qty=2)
+        before = generation()
+        with self.captureOnCommitCallbacks(execute=True):
+            ret.accept(self.user)
+        self.assertNotEqual(generation(), before)
+
+    def test_lists_read_balances_with_bounded_queries(self):
+        for product in self.products:
+            for _ in range(4):
+                self._sell(self._transfer(product, 6, accept=6), 2)
+        self._transfer(self.products[0], 3)  # не принята — на руках 0
+
+        with CaptureQueriesContext(connection) as ctx:
+            mine = self._get(AgentMyProductsListAPIView, self.agent)
+        self.assertLessEqual(len(ctx.captured_queries), 6)
+        self.assertEqual([row["qty_on_hand"] for row in mine], [16, 16, 16])
+        self.assertEqual(len(mine[0]["subreals"]) + len(mine[1]["subreals"]) + len(mine[2]["subreals"]), 13)
+
+        with CaptureQueriesContext(connection) as ctx:
+            owner = self._get(OwnerAgentsProductsListAPIView, self.user)
+        self.assertLessEqual(len(ctx.captured_queries), 6)
+        self.assertEqual(len(owner), 1)
+        self.assertEqual(owner[0]["products"], mine)
+
+    def test_rebuild_and_verify_command(self):
+        subreal = self._transfer(self.products[0], 7, accept=7)
+        ManufactureSubreal.objects.filter(pk=subreal.pk).update(qty_returned=2)  # мимо сигналов
+        with self.assertRaises(CommandError):
+            call_command("rebuild_agent_balances", verify=True, stdout=StringIO())
+
+        out = StringIO()
+        call_command("rebuild_agent_balances", company=str(self.company.id), stdout=out)
+        self.assertIn("rows=1", out.getvalue())
+        self.assertEqual(self._stored(self.products[0]), 5)
+        call_command("rebuild_agent_balances", verify=True, stdout=StringIO())
+
+
+class DashboardPayloadTests(TestCase):
+    """Дашборд собирается из виджетов; повторный запрос читает их из кэша."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email="dash@example.com", password="pass123", first_name="Owner", role="owner")
+        self.company = Company.objects.create(name="Market", owner=self.user)
+        self.user.company = self.company
+        self.user.save(update_fields=["company"])
+        self.cashbox = Cashbox.objects.create(company=self.company, name="Касса")
+        for total in ("100.00", "50.50"):
+            Sale.objects.create(
+                company=self.company, cashbox=self.cashbox, user=self.user, total=Decimal(total),
+                status=Sale.Status.PAID, paid_at=timezone.now(),
+            )
+        for kind, amount in ((CashFlow.Type.INCOME, "20.00"), (CashFlow.Type.EXPENSE, "30.00")):
+            CashFlow.objects.create(
+                company=self.company, cashbox=self.cashbox, type=kind, amount=Decimal(amount),
+                status=CashFlow.Status.APPROVED,
+            )
+
+    def _get(self):
+        today = timezone.localdate()
+        request = APIRequestFactory().get("/", {
+            "period": "custom",
+            "date_from": (today - timedelta(days=3)).isoformat(),
+            "date_to": today.isoformat(),
+        })
+        force_authenticate(request, user=self.user)
+        response = OwnerDashboardAnalyticsAPIView.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_payload_and_widget_cache(self):
+        data = self._get()
+        self.assertEqual(data["sales"]["revenue"], "150.50")
+        self.assertEqual(data["sales"]["transactions"], 2)
+        self.assertEqual(data["finance"]["income_month"], "170.50")
+        self.assertEqual(data["finance"]["expense_month"], "30.00")
+        rows = {row["cashbox_id"]: row for row in data["cashboxes"]["rows"]}
+        self.assertEqual(rows[str(self.cashbox.id)]["operations"], 4)
+        # дни без движений не роняют динамику
+        self.assertEqual(len(data["dynamics"]), 4)
+        self.assertEqual(data["dynamics"][0]["income"], "0.00")
+        self.assertEqual(data["dynamics"][-1]["profit"], "140.50")
+        self.assertEqual(len(data["barber"]["appointments_by_weekday"]), 7)
+        self.assertFalse(data["meta"]["partial"])
+        self.assertFalse(any(t["cached"] for t in data["meta"]["widgets"].values()))
+
+        with CaptureQueriesContext(connection) as ctx:
+            again = self._get()
+        self.assertTrue(all(t["cached"] for t in again["meta"]["widgets"].values()))
+        self.assertLessEqual(len(ctx.captured_queries), 3)
+        again.pop("meta")
+        data.pop("meta")
+        self.assertEqual(again, data)
+
+
+@override_settings(DASHBOARD_WIDGET_WORKERS=4)
+class DashboardWidgetEngineTests(SimpleTestCase):
+    """Виджеты без БД: параллельность, бюджет и таймзона запроса в потоках пула."""
+
+    def setUp(self):
+        cache.clear()
+
+    @staticmethod
+    def _sleepy(value, seconds):
+        def compute(ctx):
+            time.sleep(seconds)
+            return value
+        return compute
+
+    def test_widgets_run_concurrently_and_report_timings(self):
+        widgets = [Widget(f"w{i}", self._sleepy(i, 0.3)) for i in range(3)]
+        started = time.monotonic()
+        run = run_widgets(widgets, None, ctx_key=("engine", 1))
+        self.assertLess(time.monotonic() - started, 0.75)
+        self.assertEqual(run.results, {"w0": 0, "w1": 1, "w2": 2})
+        self.assertTrue(all(t["ms"] >= 250 and not t["cached"] for t in run.timings.values()))
+
+        run = run_widgets(widgets, None, ctx_key=("engine", 1))
+        self.assertTrue(all(t["cached"] for t in run.timings.values()))
+
+    def test_slow_widget_yields_partial_result_and_fills_cache_later(self):
+        slow = Widget("slow", self._sleepy("late", 0.4), budget=0.1, default=lambda: "empty")
+        fast = Widget("fast", self._sleepy("ok", 0.0))
+        run = run_widgets([slow, fast], None, ctx_key=("engine", 2))
+        self.assertEqual(run.timed_out, ["slow"])
+        self.assertEqual((run.get(slow), run.get(fast)), ("empty", "ok"))
+
+        time.sleep(0.5)
+        run = run_widgets([slow, fast], None, ctx_key=("engine", 2))
+        self.assertEqual(run.results["slow"], "late")
+        self.assertEqual(run.timed_out, [])
+
+    def test_queued_widgets_are_cancelled_on_timeout(self):
+        calls = []
+
+        def compute(ctx):
+            calls.append(ctx)
+            time.sleep(0.3)
+            return "late"
+
+        widgets = [Widget(f"q{i}", compute, budget=0.1) for i in range(6)]
+        run = run_widgets(widgets, "q", ctx_key=("engine", 4))
+        self.assertEqual(len(run.timed_out), 6)
+
+        time.sleep(0.5)
+        self.assertEqual(len(calls), 4)  # двое стояли в очереди пула из 4 потоков — отменены
+        run = run_widgets(widgets, "q", ctx_key=("engine", 4))
+        self.assertEqual(sum(t["cached"] for t in run.timings.values()), 4)
+
+    def test_widget_in_flight_is_not_queued_again(self):
+        calls = []
+
+        def compute(ctx):
+            calls.append(ctx)
+            time.sleep(0.3)
+            return "done"
+
+        widgets = [Widget("shared", compute, budget=0.05), Widget("other", self._sleepy("ok", 0.0))]
+        first = run_widgets(widgets, "a", ctx_key=("engine", 5))
+        second = run_widgets(widgets, "b", ctx_key=("engine", 5))
+        self.assertEqual((first.timed_out, second.timed_out), (["shared"], ["shared"]))
+
+        time.sleep(0.4)
+        self.assertEqual(calls, ["a"])
+        self.assertEqual(run_widgets(widgets, "c", ctx_key=("engine", 5)).results["shared"], "done")
+
+    def test_pool_threads_use_request_timezone(self):
+        widgets = [Widget(f"tz{i}", lambda ctx: timezone.get_current_timezone_name()) for i in range(2)]
+        with timezone.override("Asia/Tokyo"):
+            run = run_widgets(widgets, None, ctx_key=("engine", 3))
+        self.assertEqual(set(run.results.values()), {"Asia/Tokyo"})
@@ -44,6 +44,8 @@ urlpatterns = [
     path('products/create-manual/', ProductCreateManualAPIView.as_view(), name='product-create-manual'),
     path('products/<uuid:pk>/', ProductRetrieveUpdateDestroyAPIView.as_view(), name='product-detail'),
     path("products/bulk-delete/", ProductBulkDeleteAPIView.as_view(), name="product-bulk-delete"),
+    path('products/import/', ProductImportJobCreateAPIView.as_view(), name='product-import'),
+    path('products/import/<uuid:pk>/', ProductImportJobRetrieveAPIView.as_view(), name='product-import-detail'),
     path('products/barcode/<str:barcode>/', ProductByBarcodeAPIView.as_view(), name='product-by-barcode'),
     path('products/global-barcode/<str:barcode>/', ProductByGlobalBarcodeAPIView.as_view(), name='product-by-barcode'),
     
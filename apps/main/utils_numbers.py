@@ -1,17 +1,172 @@
 # например apps/main/utils_numbers.py
-from django.db import transaction
-from django.db.models import Max
-from apps.main.models import Sale
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import IntegerField, Max, Q, Value
+from django.db.models.functions import Cast, Greatest
+from apps.main.models import Product, ProductCodeSequence, Sale, SaleDocSequence, ScaleProductTombstone
+
+
+def _sequence_cashbox_id(sale: Sale):
+    """Касса счётчика: только если включена нумерация по кассам."""
+    if getattr(settings, "SALE_DOC_NUMBER_SCOPE", "company") != "cashbox":
+        return None
+    if sale.cashbox_id:
+        return sale.cashbox_id
+    return getattr(sale.shift, "cashbox_id", None) if sale.shift_id else None
+
+
+def seed_value(company_id, cashbox_id=None) -> int:
+    """Стартовое значение счётчика — максимум уже выданных номеров компании (кассы)."""
+    qs = Sale.objects.filter(company_id=company_id)
+    if cashbox_id:
+        qs = qs.filter(Q(cashbox_id=cashbox_id) | Q(cashbox__isnull=True, shift__cashbox_id=cashbox_id))
+    return qs.aggregate(m=Max("doc_number"))["m"] or 0
+
+
+def allocate_sale_doc_number(company_id, cashbox_id=None) -> int:
+    """
+    Следующий номер из счётчика (company[, cashbox]).
+    Блокируется одна строка SaleDocSequence; номер без пропусков, т.к. выдаётся
+    в транзакции вызывающего кода и откатывается вместе с ней.
+    """
+    with transaction.atomic():
+        seq = (
+            SaleDocSequence.objects.select_for_update()
+            .filter(company_id=company_id, cashbox_id=cashbox_id)
+            .first()
+        )
+        if seq is None:
+            # счётчика ещё нет (новая компания/касса или не прогнали seed_sale_doc_sequences)
+            try:
+                with transaction.atomic():
+                    seq = SaleDocSequence.objects.create(
+                        company_id=company_id,
+                        cashbox_id=cashbox_id,
+                        last_number=seed_value(company_id, cashbox_id),
+                    )
+            except IntegrityError:
+                # параллельно создали — берём существующий под блокировкой
+                seq = SaleDocSequence.objects.select_for_update().get(company_id=company_id, cashbox_id=cashbox_id)
+
+        seq.last_number += 1
+        seq.save(update_fields=["last_number"])
+        return seq.last_number
+
 
 def ensure_sale_doc_number(sale: Sale) -> int:
     """Присваивает doc_number, если он ещё не установлен. Возвращает номер."""
     if sale.doc_number:
         return sale.doc_number
     with transaction.atomic():
-        # блокируем выборку по компании, чтобы номер не задвоился при гонке
-        last = (Sale.objects.select_for_update()
-                .filter(company=sale.company)
-                .aggregate(m=Max("doc_number"))["m"] or 0)
-        sale.doc_number = last + 1
-        sale.save(update_fields=["doc_number"])
+        # перечитываем под блокировкой строки продажи: два параллельных принта не выдадут два номера
+        current = Sale.objects.select_for_update().filter(pk=sale.pk).values_list("doc_number", flat=True).first()
+        if current:
+            sale.doc_number = current
+            return current
+        sale.doc_number = allocate_sale_doc_number(sale.company_id, _sequence_cashbox_id(sale))
+        # без Sale.save(): full_clean() тянет связанные объекты, а меняется одно поле
+        Sale.objects.filter(pk=sale.pk).update(doc_number=sale.doc_number)
     return sale.doc_number
+
+
+# ─────────────────────────────────────────────────────────────
+# Код товара и ПЛУ
+# ─────────────────────────────────────────────────────────────
+def seed_product_code(company_id) -> int:
+    """Максимальный числовой код товаров компании (разовый проход при создании счётчика)."""
+    return (
+        Product.objects.filter(company_id=company_id, code__regex=r"^\d+$")
+        .annotate(code_int=Cast("code", IntegerField()))
+        .aggregate(m=Max("code_int"))["m"]
+        or 0
+    )
+
+
+def seed_product_plu(company_id) -> int:
+    return Product.objects.filter(company_id=company_id, plu__isnull=False).aggregate(m=Max("plu"))["m"] or 0
+
+
+def seed_product_revision(company_id) -> int:
+    product_max = Product.objects.filter(company_id=company_id).aggregate(m=Max("scale_revision"))["m"] or 0
+    tombstone_max = ScaleProductTombstone.objects.filter(company_id=company_id).aggregate(m=Max("revision"))["m"] or 0
+    return max(product_max, tombstone_max)
+
+
+def _product_sequence_for_update(company_id) -> ProductCodeSequence:
+    seq = ProductCodeSequence.objects.select_for_update().filter(company_id=company_id).first()
+    if seq is not None:
+        return seq
+    try:
+        with transaction.atomic():
+            return ProductCodeSequence.objects.create(
+                company_id=company_id,
+                last_code=seed_product_code(company_id),
+                last_plu=seed_product_plu(company_id),
+                last_revision=seed_product_revision(company_id),
+            )
+    except IntegrityError:
+        # параллельно создали — берём существующий под блокировкой
+        return ProductCodeSequence.objects.select_for_update().get(company_id=company_id)
+
+
+def allocate_product_counters(company_id, *, code=0, plu=0, revision=0):
+    """
+    Резервирует code и/или plu номеров (True = 1) и ревизии каталога весов одним
+    обращением к счётчику компании. Возвращает первые номера блоков
+    (code | None, plu | None, revision | None); резерв откатывается вместе с
+    транзакцией вызывающего.
+    """
+    code, plu, revision = int(code), int(plu), int(revision)
+    with transaction.atomic():
+        seq = _product_sequence_for_update(company_id)
+        fields = []
+        if code:
+            seq.last_code += code
+            fields.append("last_code")
+        if plu:
+            seq.last_plu += plu
+            fields.append("last_plu")
+        if revision:
+            seq.last_revision += revision
+            fields.append("last_revision")
+        if fields:
+            seq.save(update_fields=fields)
+    return (
+        seq.last_code - code + 1 if code else None,
+        seq.last_plu - plu + 1 if plu else None,
+        seq.last_revision - revision + 1 if revision else None,
+    )
+
+
+def allocate_product_numbers(company_id, *, code=0, plu=0):
+    """Первые номера блоков кодов/ПЛУ (code | None, plu | None)."""
+    return allocate_product_counters(company_id, code=code, plu=plu)[:2]
+
+
+def allocate_product_revision(company_id) -> int:
+    """Следующая ревизия каталога весов; строка счётчика заблокирована до коммита вызывающего."""
+    return allocate_product_counters(company_id, revision=1)[2]
+
+
+def current_product_revision(company_id) -> int:
+    """Последняя закоммиченная ревизия каталога весов (без блокировки)."""
+    return (
+        ProductCodeSequence.objects.filter(company_id=company_id).values_list("last_revision", flat=True).first()
+        or 0
+    )
+
+
+def raise_product_counters(company_id, *, code=None, plu=None) -> None:
+    """
+    Код/ПЛУ заданы вручную: счётчик не должен выдать их повторно (только вверх).
+    bulk_create минует Product.save — после вставки товаров с заданными кодами
+    вызывать с максимальными из них.
+    """
+    updates = {}
+    if code is not None:
+        updates["last_code"] = Greatest("last_code", Value(code))
+    if plu is not None:
+        updates["last_plu"] = Greatest("last_plu", Value(plu))
+    if updates:
+        # нет строки — не страшно: при создании её засеет максимум из товаров
+        ProductCodeSequence.objects.filter(company_id=company_id).update(**updates)
@@ -2,20 +2,18 @@ from decimal import Decimal, ROUND_HALF_UP
 from uuid import UUID
 
 from django.db import transaction, IntegrityError
-from django.db.models import Sum, Count, Avg, F, Q, Prefetch, Value as V
+from django.db.models import Sum, Count, Avg, F, Q, Prefetch
 from django.utils.dateparse import parse_date, parse_datetime
 from django.utils import timezone
-from itertools import groupby
 from typing import List, Optional, Dict, Any
-from operator import attrgetter
-from datetime import datetime, date as _date
+from datetime import date as _date
 from django.db.models.functions import Coalesce
-import logging
 
 from rest_framework import generics, permissions, filters, status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
 from django.shortcuts import get_object_or_404
 from rest_framework import serializers
@@ -26,6 +24,7 @@ from rest_framework.pagination import CursorPagination
 
 
 from apps.users.models import Branch, User
+from apps.users.tenancy import get_tenancy, query_branch
 
 from apps.main.models import (
     Contact, Pipeline, Deal, Task, Integration, Analytics,
@@ -33,9 +32,9 @@ from apps.main.models import (
     ProductBrand, ProductCategory, Warehouse, WarehouseEvent, Client,
     GlobalProduct, GlobalBrand, GlobalCategory, ClientDeal, Bid, SocialApplications, TransactionRecord,
     ContractorWork, DealInstallment, DebtPayment, Debt, ObjectSaleItem, ObjectSale, ObjectItem, ItemMake,
-    ManufactureSubreal, Acceptance, ReturnFromAgent, AgentSaleAllocation, ProductImage,
+    ManufactureSubreal, Acceptance, ReturnFromAgent, AgentProductBalance, ProductImage,
     AgentRequestCart, AgentRequestItem, ProductPackage, ProductCharacteristics, DealPayment,
-    ProductRecipeItem,
+    ProductRecipeItem, ProductImportJob,
 )
 from apps.main.serializers import (
     ContactSerializer, PipelineSerializer, DealSerializer, TaskSerializer,
@@ -51,7 +50,7 @@ from apps.main.serializers import (
     ManufactureSubrealSerializer, AcceptanceCreateSerializer, ReturnCreateSerializer,
     BulkSubrealCreateSerializer, AcceptanceReadSerializer, ReturnApproveSerializer, ReturnRejectSerializer, ReturnReadSerializer,
     AgentProductOnHandSerializer, AgentWithProductsSerializer, GlobalProductReadSerializer,
-    ProductImageSerializer,
+    ProductImageSerializer, ProductImportJobSerializer,
     AgentRequestCartApproveSerializer, AgentRequestCartRejectSerializer,
     AgentRequestCartSerializer, AgentRequestCartSubmitSerializer, AgentRequestItemSerializer, DealPayInputSerializer, DealRefundInputSerializer
 )
@@ -59,6 +58,8 @@ from django.db.models import ProtectedError
 from apps.utils import product_images_prefetch, _is_owner_like
 from apps.main.analytics_agent import build_agent_analytics_payload, _parse_period
 from apps.main.analytics_owner_production import build_owner_analytics_payload
+from apps.main.services import agent_stock
+from apps.main.services.webhook_outbox import enqueue_product_events
 from apps.main.services import _parse_bool_like, _parse_date_to_aware_datetime, _parse_kind, _parse_int_nonneg, _parse_decimal
     
 
@@ -150,9 +151,7 @@ class CompanyBranchRestrictedMixin:
     Активный филиал:
 
         1) «жёсткий» филиал сотрудника:
-            - user.primary_branch() / user.primary_branch
-            - первый филиал из branch_ids
-            - первая запись из user.branch_memberships / user.branches (если есть такие связи)
+            - основной филиал (primary) или первый филиал компании из членств
             - request.branch (если мидлварь уже положила)
         2) ?branch=<uuid> в запросе (если филиал принадлежит компании,
            И у пользователя нет жёстко назначенного филиала)
@@ -173,38 +172,29 @@ class CompanyBranchRestrictedMixin:
         req = self._request()
         return getattr(req, "user", None) if req else None
 
+    def _tenancy(self):
+        return get_tenancy(self._request())
+
     def _company(self):
         """
         Компания текущего пользователя.
         Для суперюзера -> None (без ограничения по company).
 
-        Если у юзера нет company, но есть филиал с company — берём её.
+        owned_company / company / компания филиала — из контекста арендатора
+        (apps.users.tenancy: один раз на запрос, между запросами — из кэша).
         """
         u = self._user()
         if not u or not getattr(u, "is_authenticated", False):
             return None
         if getattr(u, "is_superuser", False):
             return None
-
-        company = getattr(u, "owned_company", None) or getattr(u, "company", None)
-        if company:
-            return company
-
-        # fallback: пробуем достать компанию из его филиала (если есть связь)
-        br = getattr(u, "branch", None)
-        if br is not None:
-            return getattr(br, "company", None)
-
-        return None
+        return self._tenancy().company
 
     def _fixed_branch_from_user(self, company) -> Optional[Branch]:
         """
         «Жёстко» назначенный филиал сотрудника (который нельзя менять через ?branch):
 
-         - user.primary_branch() или user.primary_branch
-         - user.branch (если есть такое поле)
-         - первый филиал из branch_ids (как в /me)
-         - первая связь из user.branches / user.branch_memberships (если такие есть)
+         - основной филиал (primary) или первый филиал компании из членств
          - request.branch (если мидлварь уже положила)
         """
         req = self._request()
@@ -213,71 +203,11 @@ class CompanyBranchRestrictedMixin:
             return None
 
         company_id = getattr(company, "id", None)
+        tenancy = self._tenancy()
+        if tenancy.company_id == company_id and tenancy.member_branch is not None:
+            return tenancy.member_branch
 
-        # 1) user.primary_branch как метод
-        primary = getattr(user, "primary_branch", None)
-        if callable(primary):
-            try:
-                val = primary()
-                if val and getattr(val, "company_id", None) == company_id:
-                    return val
-            except Exception:
-                pass
-
-        # 1b) user.primary_branch как атрибут
-        if primary and not callable(primary) and getattr(primary, "company_id", None) == company_id:
-            return primary
-
-        # 1c) user.branch (если так хранится)
-        if hasattr(user, "branch"):
-            b = getattr(user, "branch")
-            if b and getattr(b, "company_id", None) == company_id:
-                return b
-
-        # 1d) если у пользователя есть M2M/through связи на филиалы: user.branches
-        try:
-            if hasattr(user, "branches"):
-                qs = user.branches.all()
-                if company_id:
-                    qs = qs.filter(company_id=company_id)
-                b = qs.first()
-                if b:
-                    return b
-        except Exception:
-            pass
-
-        # 1e) если есть user.branch_memberships -> branch
-        try:
-            if hasattr(user, "branch_memberships"):
-                ms = (
-                    user.branch_memberships
-                    .select_related("branch")
-                )
-                if company_id:
-                    ms = ms.filter(branch__company_id=company_id)
-                m = ms.first()
-                if m and getattr(m, "branch", None):
-                    return m.branch
-        except Exception:
-            pass
-
-        # 1f) если на модели User есть поле/свойство branch_ids (как в /me)
-        #     выбираем первый филиал этой компании
-        branch_ids = getattr(user, "branch_ids", None)
-        if branch_ids:
-            try:
-                b = (
-                    Branch.objects
-                    .filter(id__in=list(branch_ids), company_id=company_id)
-                    .first()
-                )
-                if b:
-                    return b
-            except Exception:
-                # на всякий случай не роняем
-                pass
-
-        # 2) request.branch как результат работы middleware
+        # request.branch как результат работы middleware
         if req and hasattr(req, "branch"):
             b = getattr(req, "branch")
             if b and getattr(b, "company_id", None) == company_id:
@@ -288,7 +218,7 @@ class CompanyBranchRestrictedMixin:
     def _auto_branch(self) -> Optional[Branch]:
         """
         Активный филиал:
-          1) «Жёсткий» филиал сотрудника (primary / branch / branch_ids / memberships / request.branch)
+          1) «Жёсткий» филиал сотрудника (primary / членство / request.branch)
           2) ?branch=<uuid> в запросе (если принадлежит компании и НЕТ жёсткого филиала)
           3) None (нет филиала — глобальный режим по всей компании, но только записи без branch)
         """
@@ -298,12 +228,10 @@ class CompanyBranchRestrictedMixin:
             return None
 
         # чтобы не дергать логику по несколько раз на один запрос
-        cached = getattr(req, "_cached_auto_branch", None)
-        if cached is not None:
-            return cached
+        if hasattr(req, "_cached_auto_branch"):
+            return req._cached_auto_branch
 
         company = self._company()
-        company_id = getattr(company, "id", None)
 
         # 1) сначала ищем жёстко назначенный филиал
         fixed_branch = self._fixed_branch_from_user(company)
@@ -313,21 +241,13 @@ class CompanyBranchRestrictedMixin:
             return fixed_branch
 
         # 2) если у пользователя НЕТ назначенного филиала — позволяем выбирать через ?branch
-        branch_id = None
-        if hasattr(req, "query_params"):
-            branch_id = req.query_params.get("branch")
-        elif hasattr(req, "GET"):
-            branch_id = req.GET.get("branch")
-
-        if branch_id and company_id:
-            try:
-                br = Branch.objects.get(id=branch_id, company_id=company_id)
+        #    (чужой/битый UUID — игнорируем)
+        if company is not None:
+            br = query_branch(req, self._tenancy())
+            if br is not None:
                 setattr(req, "branch", br)
                 setattr(req, "_cached_auto_branch", br)
                 return br
-            except (Branch.DoesNotExist, ValueError):
-                # чужой/битый UUID — игнорируем
-                pass
 
         # 3) никакого филиала → None (работаем по компании, но без филиалов)
         setattr(req, "_cached_auto_branch", None)
@@ -2429,26 +2349,8 @@ class ManufactureSubrealListCreateAPIView(CompanyBranchRestrictedMixin, generics
         # минусуем склад (в той же транзакции)
         if qty and locked_qs is not None:
             locked_qs.update(quantity=F("quantity") - qty)
-            prod_model = type(product)
-            prod_id = product.pk
-
-            def _send_webhook():
-                from apps.main.services.webhooks import send_product_webhook
-
-                try:
-                    p = prod_model.objects.get(pk=prod_id)
-                    send_product_webhook(p, "product.updated")
-                except Exception:
-                    logging.getLogger("crm.webhooks").error(
-                        "Failed to send product.updated webhook after subreal create. product_id=%s",
-                        prod_id,
-                        exc_info=True,
-                    )
-
-            try:
-                transaction.on_commit(_send_webhook)
-            except Exception:
-                _send_webhook()
+            # вебхук уйдёт из outbox после коммита (фоновый диспетчер)
+            enqueue_product_events(product.company_id, [product.pk], "product.updated")
 
         # идемпотентный авто-приём, если is_sawmill=True
         if is_sawmill:
@@ -2788,26 +2690,8 @@ class ManufactureSubrealBulkCreateAPIView(APIView, CompanyBranchRestrictedMixin)
 
             # списываем со склада
             locked_qs.update(quantity=F("quantity") - qty)
-            prod_model = type(product)
-            prod_id = product.pk
-
-            def _send_webhook():
-                from apps.main.services.webhooks import send_product_webhook
-
-                try:
-                    p = prod_model.objects.get(pk=prod_id)
-                    send_product_webhook(p, "product.updated")
-                except Exception:
-                    logging.getLogger("crm.webhooks").error(
-                        "Failed to send product.updated webhook after subreal bulk create. product_id=%s",
-                        prod_id,
-                        exc_info=True,
-                    )
-
-            try:
-                transaction.on_commit(_send_webhook)
-            except Exception:
-                _send_webhook()
+            # вебхук уйдёт из outbox после коммита (фоновый диспетчер)
+            enqueue_product_events(product.company_id, [product.pk], "product.updated")
 
             sub = ManufactureSubreal.objects.create(
                 company=company,
@@ -2842,6 +2726,72 @@ class ManufactureSubrealBulkCreateAPIView(APIView, CompanyBranchRestrictedMixin)
         return Response(out, status=status.HTTP_201_CREATED)
 
 
+def _search_agent_balances(balances, request):
+    term = (request.query_params.get("search") or "").strip()
+    if not term:
+        return balances
+    q = (
+        Q(product__name__icontains=term)
+        | Q(product__barcode__icontains=term)
+        | Q(product__article__icontains=term)
+        | Q(product__code__icontains=term)
+    )
+    if term.isdigit():
+        q |= Q(product__plu=int(term))
+    return balances.filter(q)
+
+
+def _agent_products_payload(balances, subreals_qs) -> Dict[Any, List[Dict[str, Any]]]:
+    """
+    {agent_id: [товар на руках с его передачами]} по строкам AgentProductBalance
+    (services/agent_stock.py). Передачи читаются только для товаров, которые сейчас
+    на руках, проданное — подзапросом, без prefetch приёмов/возвратов/продаж.
+    """
+    balances = list(balances.filter(qty_on_hand__gt=0).select_related("product"))
+    if not balances:
+        return {}
+
+    pairs = {(b.agent_id, b.product_id) for b in balances}
+    subreals_by_pair: Dict[Any, List[Dict[str, Any]]] = {}
+    rows = (
+        agent_stock.with_sold(
+            subreals_qs.filter(
+                agent_id__in={a for a, _ in pairs},
+                product_id__in={p for _, p in pairs},
+            )
+        )
+        .order_by("agent_id", "product_id", "-created_at")
+        .values(
+            "id", "agent_id", "product_id", "created_at",
+            "qty_transferred", "qty_accepted", "qty_returned", "sold",
+        )
+    )
+    for s in rows:
+        pair = (s["agent_id"], s["product_id"])
+        if pair not in pairs:
+            continue
+        subreals_by_pair.setdefault(pair, []).append({
+            "id": s["id"],
+            "created_at": s["created_at"],
+            "qty_transferred": int(s["qty_transferred"] or 0),
+            "qty_accepted": int(s["qty_accepted"] or 0),
+            "qty_returned": int(s["qty_returned"] or 0),
+            "qty_sold": int(s["sold"] or 0),
+            "qty_on_hand": agent_stock.on_hand(s["qty_accepted"], s["qty_returned"], s["sold"]),
+        })
+
+    out: Dict[Any, List[Dict[str, Any]]] = {}
+    for b in balances:
+        out.setdefault(b.agent_id, []).append({
+            "product": b.product_id,
+            "product_name": b.product.name if b.product else "",
+            "qty_on_hand": b.qty_on_hand,
+            "last_movement_at": b.last_movement_at,
+            "subreals": subreals_by_pair.get((b.agent_id, b.product_id), []),
+        })
+    return out
+
+
 # ===========================
 #  Agent: my products (GET/PATCH)
 # ===========================
@@ -2854,115 +2804,13 @@ class AgentMyProductsListAPIView(APIView, CompanyBranchRestrictedMixin):
     permission_classes = [permissions.IsAuthenticated]
 
     # -------- Helpers --------
-    def _build_queryset(self, request):
-        accepted_returns_qs = ReturnFromAgent.objects.filter(
-            status=ReturnFromAgent.Status.ACCEPTED
-        )
-        alloc_qs = AgentSaleAllocation.objects.only("id", "subreal_id", "qty")
-
-        base = (
-            ManufactureSubreal.objects
-            .filter(agent_id=request.user.id)
-            .select_related("product")
-            .prefetch_related(
-                "acceptances",
-                Prefetch(
-                    "returns",
-                    queryset=accepted_returns_qs,
-                    to_attr="accepted_returns",
-                ),
-                Prefetch(
-                    "sale_allocations",
-                    queryset=alloc_qs,
-                    to_attr="prefetched_allocs",
-                ),
-            )
-            .annotate(sold_qty=Coalesce(Sum("sale_allocations__qty"), V(0)))
-            .order_by("product_id", "-created_at")
+    def _products_on_hand(self, request) -> List[Dict[str, Any]]:
+        balances = self._filter_qs_company_branch(
+            AgentProductBalance.objects.filter(agent_id=request.user.id)
         )
-        base = self._filter_qs_company_branch(base)
-
-        term = (request.query_params.get("search") or "").strip()
-        if term:
-            q = (
-                Q(product__name__icontains=term)
-                | Q(product__barcode__icontains=term)
-                | Q(product__article__icontains=term)
-                | Q(product__code__icontains=term)
-            )
-            if term.isdigit():
-                q |= Q(product__plu=int(term))
-            base = base.filter(q)
-
-        return base
-
-    @staticmethod
-    def _nz(v: Optional[int]) -> int:
-        return int(v or 0)
-
-    def _serialize_products(self, qs) -> List[Dict[str, Any]]:
-        def _sold_for_sub(s):
-            ann = self._nz(getattr(s, "sold_qty", 0))
-            if ann:
-                return ann
-            return sum(self._nz(a.qty) for a in getattr(s, "prefetched_allocs", []))
-
-        data = []
-
-        for product_id, subreals_iter in groupby(qs, key=attrgetter("product_id")):
-            subreals = list(subreals_iter)
-
-            qty_on_hand = 0
-            for s in subreals:
-                accepted = self._nz(s.qty_accepted)
-                returned = self._nz(s.qty_returned)
-                sold = _sold_for_sub(s)
-                qty_on_hand += max(accepted - returned - sold, 0)
-
-            if qty_on_hand <= 0:
-                continue
-
-            movement_dates: List[datetime] = []
-            for s in subreals:
-                if s.created_at:
-                    movement_dates.append(s.created_at)
-                for acc in s.acceptances.all():
-                    if getattr(acc, "accepted_at", None):
-                        movement_dates.append(acc.accepted_at)
-                for ret in getattr(s, "accepted_returns", []):
-                    if getattr(ret, "accepted_at", None):
-                        movement_dates.append(ret.accepted_at)
-
-            last_movement_at = max(movement_dates) if movement_dates else None
-
-            subreals_payload = []
-            for s in subreals:
-                accepted = self._nz(s.qty_accepted)
-                returned = self._nz(s.qty_returned)
-                sold = _sold_for_sub(s)
-                subreals_payload.append({
-                    "id": s.id,
-                    "created_at": s.created_at,
-                    "qty_transferred": self._nz(s.qty_transferred),
-                    "qty_accepted": accepted,
-                    "qty_returned": returned,
-                    "qty_sold": sold,
-                    "qty_on_hand": max(accepted - returned - sold, 0),
-                })
-
-            data.append({
-                "product": product_id,
-                "product_name": (
-                    subreals[0].product.name
-                    if (subreals and getattr(subreals[0], "product", None))
-                    else ""
-                ),
-                "qty_on_hand": qty_on_hand,
-                "last_movement_at": last_movement_at,
-                "subreals": subreals_payload,
-            })
-
-        return data
+        balances = _search_agent_balances(balances, request)
+        subreals = self._filter_qs_company_branch(ManufactureSubreal.objects.all())
+        return _agent_products_payload(balances.order_by("product_id"), subreals).get(request.user.id, [])
 
     # -------- GET --------
     def get(self, request, *args, **kwargs):
@@ -2970,8 +2818,7 @@ class AgentMyProductsListAPIView(APIView, CompanyBranchRestrictedMixin):
         if not company_id:
             return Response([], status=status.HTTP_200_OK)
 
-        qs = self._build_queryset(request)
-        data = self._serialize_products(qs)
+        data = self._products_on_hand(request)
         return Response(
             AgentProductOnHandSerializer(data, many=True).data,
             status=status.HTTP_200_OK,
@@ -3089,9 +2936,10 @@ class AgentMyProductsListAPIView(APIView, CompanyBranchRestrictedMixin):
                     to_update,
                     ["qty_accepted", "qty_returned"],
                 )
+                # bulk_update мимо сигналов — остатки на руках пересчитываем сами
+                agent_stock.refresh_subreals([sub.pk for sub in to_update])
 
-        qs = self._build_queryset(request)
-        data = self._serialize_products(qs)
+        data = self._products_on_hand(request)
         return Response(
             AgentProductOnHandSerializer(data, many=True).data,
             status=status.HTTP_200_OK,
@@ -3110,142 +2958,16 @@ class OwnerAgentsProductsListAPIView(APIView, CompanyBranchRestrictedMixin):
     """
     permission_classes = [permissions.IsAuthenticated]
 
-    @staticmethod
-    def _nz(v: Optional[int]) -> int:
-        return int(v or 0)
-
-    def _build_queryset(self, request):
-        accepted_returns_qs = ReturnFromAgent.objects.filter(
-            status=ReturnFromAgent.Status.ACCEPTED
-        )
-        alloc_qs = AgentSaleAllocation.objects.only(
-            "id", "subreal_id", "qty"
-        )
-
-        base = (
-            ManufactureSubreal.objects
-            .select_related("product", "agent")
-            .prefetch_related(
-                "acceptances",
-                Prefetch(
-                    "returns",
-                    queryset=accepted_returns_qs,
-                    to_attr="accepted_returns",
-                ),
-                Prefetch(
-                    "sale_allocations",
-                    queryset=alloc_qs,
-                    to_attr="prefetched_allocs",
-                ),
-            )
-            .annotate(sold_qty=Coalesce(Sum("sale_allocations__qty"), V(0)))
-            .order_by("agent_id", "product_id", "-created_at")
-        )
-        base = self._filter_qs_company_branch(base)
-
-        term = (request.query_params.get("search") or "").strip()
-        if term:
-            q = (
-                Q(product__name__icontains=term)
-                | Q(product__barcode__icontains=term)
-                | Q(product__article__icontains=term)
-                | Q(product__code__icontains=term)
-            )
-            if term.isdigit():
-                q |= Q(product__plu=int(term))
-            base = base.filter(q)
-
-        return base
-
-    def _serialize_products_for_agent(self, subreals_qs) -> List[Dict[str, Any]]:
-        def _sold_for_sub(s):
-            ann = self._nz(getattr(s, "sold_qty", 0))
-            if ann:
-                return ann
-            return sum(
-                self._nz(a.qty)
-                for a in getattr(s, "prefetched_allocs", [])
-            )
-
-        data: List[Dict[str, Any]] = []
-
-        for product_id, subreals_iter in groupby(
-            subreals_qs,
-            key=attrgetter("product_id"),
-        ):
-            subreals = list(subreals_iter)
-
-            qty_on_hand = 0
-            for s in subreals:
-                accepted = self._nz(s.qty_accepted)
-                returned = self._nz(s.qty_returned)
-                sold = _sold_for_sub(s)
-                qty_on_hand += max(accepted - returned - sold, 0)
-
-            if qty_on_hand <= 0:
-                continue
-
-            movement_dates: List[datetime] = []
-            for s in subreals:
-                if s.created_at:
-                    movement_dates.append(s.created_at)
-                for acc in s.acceptances.all():
-                    if getattr(acc, "accepted_at", None):
-                        movement_dates.append(acc.accepted_at)
-                for ret in getattr(s, "accepted_returns", []):
-                    if getattr(ret, "accepted_at", None):
-                        movement_dates.append(ret.accepted_at)
-
-            last_movement_at = max(movement_dates) if movement_dates else None
-
-            subreals_payload = []
-            for s in subreals:
-                accepted = self._nz(s.qty_accepted)
-                returned = self._nz(s.qty_returned)
-                sold = _sold_for_sub(s)
-                subreals_payload.append({
-                    "id": s.id,
-                    "created_at": s.created_at,
-                    "qty_transferred": self._nz(s.qty_transferred),
-                    "qty_accepted": accepted,
-                    "qty_returned": returned,
-                    "qty_sold": sold,
-                    "qty_on_hand": max(accepted - returned - sold, 0),
-                })
-
-            data.append({
-                "product": product_id,
-                "product_name": (
-                    subreals[0].product.name
-                    if (subreals and getattr(subreals[0], "product", None))
-                    else ""
-                ),
-                "qty_on_hand": qty_on_hand,
-                "last_movement_at": last_movement_at,
-                "subreals": subreals_payload,
-            })
-
-        return data
-
     def get(self, request, *args, **kwargs):
         # если надо, можно тут навесить owner-only check
-        qs = self._build_queryset(request)
+        balances = _search_agent_balances(self._filter_qs_company_branch(AgentProductBalance.objects.all()), request)
+        subreals = self._filter_qs_company_branch(ManufactureSubreal.objects.all())
+        products_by_agent = _agent_products_payload(balances.order_by("agent_id", "product_id"), subreals)
+        agents = User.objects.in_bulk(list(products_by_agent))
 
         out: List[Dict[str, Any]] = []
-        for agent_id, agent_subreals_iter in groupby(
-            qs,
-            key=attrgetter("agent_id"),
-        ):
-            agent_subreals = list(agent_subreals_iter)
-            if not agent_subreals:
-                continue
-
-            agent = agent_subreals[0].agent  # select_related("agent")
-
-            products_payload = self._serialize_products_for_agent(agent_subreals)
-            if not products_payload:
-                continue
-
+        for agent_id, products_payload in products_by_agent.items():
+            agent = agents[agent_id]
             out.append({
                 "agent": {
                     "id": agent.id,
@@ -3262,6 +2984,54 @@ class OwnerAgentsProductsListAPIView(APIView, CompanyBranchRestrictedMixin):
         )
 
 
+# ===========================
+#  Product import jobs (Excel)
+# ===========================
+class ProductImportJobCreateAPIView(CompanyBranchRestrictedMixin, generics.ListCreateAPIView):
+    """
+    GET  /api/main/products/import/       — последние импорты компании/филиала
+    POST /api/main/products/import/
+      form-data:
+        file=<.xlsx|.csv>,
+        options={"columns": {"barcode": 0}, "update_existing": false}   (JSON, опционально)
+    Импорт выполняется в фоне (Celery import_products_job); статус — products/import/<id>/.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = ProductImportJobSerializer
+    parser_classes = [MultiPartParser, FormParser]
+    queryset = ProductImportJob.objects.all()
+
+    def get_serializer(self, *args, **kwargs):
+        data = kwargs.get("data")
+        if data is not None and isinstance(data.get("options"), str):
+            # multipart: options приходит строкой
+            import json
+
+            try:
+                options = json.loads(data["options"] or "{}")
+            except ValueError:
+                raise ValidationError({"options": "Некорректный JSON."})
+            kwargs["data"] = {"file": data.get("file"), "options": options}
+        return super().get_serializer(*args, **kwargs)
+
+    def perform_create(self, serializer):
+        company = self._company()
+        if company is None:
+            raise PermissionDenied("Нет компании.")
+        job = serializer.save(company=company, branch=self._auto_branch(), created_by=self.request.user)
+
+        from apps.main.tasks import import_products_job
+
+        transaction.on_commit(lambda: import_products_job.delay(str(job.id)))
+
+
+class ProductImportJobRetrieveAPIView(CompanyBranchRestrictedMixin, generics.RetrieveAPIView):
+    """GET /api/main/products/import/<uuid:pk>/ — прогресс и итог импорта."""
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = ProductImportJobSerializer
+    queryset = ProductImportJob.objects.all()
+
+
 # ===========================
 #  Product images
 # ===========================
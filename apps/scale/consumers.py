@@ -2,9 +2,11 @@
 import json
 from urllib.parse import parse_qs
 
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
-from apps.main.models import Company
+
+from apps.scale import sync
+from apps.users.ws_auth import company_id_by_scale_token
 
 
 class AgentScaleConsumer(AsyncWebsocketConsumer):
@@ -18,16 +20,13 @@ class AgentScaleConsumer(AsyncWebsocketConsumer):
             await self.close(code=4001)
             return
 
-        # ищем компанию по токену (через sync_to_async)
-        try:
-            company = await sync_to_async(Company.objects.get)(
-                scale_api_token=token
-            )
-        except Company.DoesNotExist:
+        # компания по токену (кэш по токену, сверяется с поколением компании)
+        company_id = await database_sync_to_async(company_id_by_scale_token)(token)
+        if company_id is None:
             await self.close(code=4002)
             return
 
-        self.company_id = str(company.id)
+        self.company_id = str(company_id)
         self.group_name = f"scale_company_{self.company_id}"
 
         await self.channel_layer.group_add(self.group_name, self.channel_name)
@@ -59,9 +58,11 @@ class AgentScaleConsumer(AsyncWebsocketConsumer):
 
         action = data.get("action")
 
-        # агент прислал результат загрузки ПЛУ
+        # агент прислал результат загрузки ПЛУ (кадра batch_id/chunk, если отправка порционная)
         if action == "plu_batch_result":
             items = data.get("items") or []
+            batch_id = data.get("batch_id")
+            chunk = data.get("chunk")
 
             # тут можно:
             # - сохранить результат в БД
@@ -74,10 +75,17 @@ class AgentScaleConsumer(AsyncWebsocketConsumer):
                     "type": "plu_batch_result_event",
                     "payload": {
                         "company_id": self.company_id,
+                        "batch_id": batch_id,
+                        "chunk": chunk,
                         "items": items,
                     },
                 },
             )
+
+            # подтверждение кадра — этому агенту следующий кадр пачки
+            frame = await database_sync_to_async(sync.next_frame)(self.company_id, batch_id, chunk)
+            if frame is not None:
+                await self.send(json.dumps(frame))
             return
 
         # остальные action пока игнорируем
@@ -0,0 +1,177 @@
+"""
+Синхронизация каталога весов (агенты весов: HTTP scales/products/…, WS ws/agents/).
+
+Раньше агент на каждом опросе получал все товары полным ProductSerializer, а
+send_products_to_scale отправлял весь каталог одним кадром plu_batch. Теперь:
+
+  - у компании монотонная ревизия каталога весов (ProductCodeSequence.last_revision);
+    изменение весового товара получает новую ревизию (Product.scale_revision),
+    удаление — надгробие ScaleProductTombstone со своей ревизией;
+  - snapshot(): полный каталог страницами по id + ревизия, с которой потом
+    читать изменения; changes(since): только изменённое и удалённое после since,
+    компактными строками (как в plu_batch), страницами по ревизии;
+  - push: кадры plu_batch по SCALE_PUSH_CHUNK товаров. Первый кадр уходит группе
+    компании, следующий агент получает, подтвердив предыдущий plu_batch_result
+    с batch_id/chunk (AgentScaleConsumer). Кадры лежат в кэше SCALE_PUSH_TTL секунд.
+"""
+
+from __future__ import annotations
+
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from apps.main.models import Product, ScaleProductTombstone
+from apps.main.utils_numbers import allocate_product_revision, current_product_revision
+
+ITEM_FIELDS = ("id", "plu", "name", "price", "barcode", "scale_revision")
+
+
+def page_limit(raw) -> int:
+    default = int(getattr(settings, "SCALE_SYNC_PAGE_SIZE", 500))
+    try:
+        value = int(raw) if raw not in (None, "") else default
+    except (TypeError, ValueError):
+        value = default
+    return min(max(value, 1), int(getattr(settings, "SCALE_SYNC_PAGE_MAX", 2000)))
+
+
+def catalog(company_id):
+    """Товары, которые уходят на весы."""
+    return Product.objects.filter(company_id=company_id, kind=Product.Kind.PRODUCT, is_weight=True)
+
+
+def scale_item(row: dict) -> dict:
+    """Строка values(*ITEM_FIELDS) -> позиция plu_batch."""
+    plu = int(row["plu"])
+    return {
+        "product_uuid": str(row["id"]),
+        "plu_number": plu,
+        "code": plu,
+        "name": row["name"] or "",
+        "price": float(row["price"] or 0),
+        "shelf_life_days": 0,
+        "is_piece": False,  # на весы уходят только весовые
+        "barcode": str(row["barcode"]) if row["barcode"] else None,
+        "revision": row["scale_revision"],
+    }
+
+
+def record_deletion(product) -> ScaleProductTombstone:
+    return ScaleProductTombstone.objects.create(
+        company_id=product.company_id,
+        product_id=product.pk,
+        plu=product.plu,
+        revision=allocate_product_revision(product.company_id),
+    )
+
+
+# ---------- HTTP: полный каталог и изменения ----------
+def snapshot(company_id, *, after=None, limit: int) -> dict:
+    """
+    Страница полного каталога (по id). revision читается до строк: всё, что
+    изменится во время выгрузки, получит ревизию больше и придёт в changes().
+    """
+    revision = current_product_revision(company_id)
+    qs = catalog(company_id).filter(plu__isnull=False).order_by("id")
+    if after:
+        qs = qs.filter(id__gt=after)
+    rows = list(qs.values(*ITEM_FIELDS)[: limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "revision": revision,
+        "items": [scale_item(r) for r in rows],
+        "next": str(rows[-1]["id"]) if has_more else None,
+    }
+
+
+def changes(company_id, since: int, *, limit: int) -> dict:
+    """
+    Изменения после ревизии since. Товар, переставший быть весовым, и удалённый
+    товар приходят в deleted. Следующий запрос — с since=revision, пока has_more.
+    """
+    products = list(
+        Product.objects.filter(company_id=company_id, scale_revision__gt=since)
+        .order_by("scale_revision")
+        .values(*ITEM_FIELDS, "kind", "is_weight")[: limit + 1]
+    )
+    tombstones = list(
+        ScaleProductTombstone.objects.filter(company_id=company_id, revision__gt=since)
+        .order_by("revision")
+        .values("product_id", "plu", "revision")[: limit + 1]
+    )
+    events = sorted(
+        [(row["scale_revision"], "product", row) for row in products]
+        + [(row["revision"], "tombstone", row) for row in tombstones],
+        key=lambda event: event[0],
+    )
+    has_more = len(events) > limit
+    events = events[:limit]
+
+    items, deleted = [], []
+    for revision, source, row in events:
+        if source == "tombstone":
+            deleted.append({"product_uuid": str(row["product_id"]), "plu_number": row["plu"], "revision": revision})
+        elif row["is_weight"] and row["kind"] == Product.Kind.PRODUCT and row["plu"] is not None:
+            items.append(scale_item(row))
+        else:
+            deleted.append({"product_uuid": str(row["id"]), "plu_number": row["plu"], "revision": revision})
+    return {
+        "since": since,
+        "revision": events[-1][0] if events else since,
+        "has_more": has_more,
+        "items": items,
+        "deleted": deleted,
+    }
+
+
+# ---------- WS: порционная отправка с подтверждением ----------
+def _push_key(batch_id: str, suffix) -> str:
+    return f"nurcrm:scale:push:{batch_id}:{suffix}"
+
+
+def start_push(company_id, items: list) -> dict:
+    """Разложить items по кадрам в кэш; вернуть первый кадр (его шлёт вызывающий)."""
+    size = max(int(getattr(settings, "SCALE_PUSH_CHUNK", 200)), 1)
+    ttl = int(getattr(settings, "SCALE_PUSH_TTL", 3600))
+    batch_id = uuid.uuid4().hex
+    chunks = [items[i:i + size] for i in range(0, len(items), size)] or [[]]
+    head = {
+        "batch_id": batch_id,
+        "company_id": str(company_id),
+        "chunks": len(chunks),
+        "revision": current_product_revision(company_id),
+    }
+    values = {_push_key(batch_id, "meta"): head}
+    values.update({_push_key(batch_id, i): chunk for i, chunk in enumerate(chunks)})
+    cache.set_many(values, ttl)
+    return _frame(head, 0, chunks[0])
+
+
+def _frame(head: dict, index: int, items: list) -> dict:
+    return {
+        "action": "plu_batch",
+        "batch_id": head["batch_id"],
+        "chunk": index,
+        "chunks": head["chunks"],
+        "revision": head["revision"],
+        "items": items,
+    }
+
+
+def next_frame(company_id, batch_id, acked_chunk) -> dict | None:
+    """Кадр после подтверждённого; None — пачка закончилась, устарела или чужая."""
+    if not batch_id or not isinstance(acked_chunk, int):
+        return None
+    head = cache.get(_push_key(batch_id, "meta"))
+    if not head or head["company_id"] != str(company_id):
+        return None
+    index = acked_chunk + 1
+    if not 0 < index < head["chunks"]:
+        return None
+    items = cache.get(_push_key(batch_id, index))
+    if items is None:
+        return None
+    return _frame(head, index, items)
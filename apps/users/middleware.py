@@ -0,0 +1,18 @@
+from django.utils.functional import SimpleLazyObject
+
+from apps.users.tenancy import get_tenancy
+
+
+class TenancyMiddleware:
+    """
+    request.tenancy — контекст арендатора (компания, филиалы, owner-like), см.
+    apps.users.tenancy. Считается лениво при первом обращении: JWT-пользователя
+    DRF подставляет уже во view, после middleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.tenancy = SimpleLazyObject(lambda: get_tenancy(request))
+        return self.get_response(request)
@@ -7,15 +7,14 @@ from rest_framework import status
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from apps.users.models import Company, ScaleDevice
-from apps.main.models import Product
-from apps.main.serializers import ProductSerializer
-from apps.main.views import CompanyBranchRestrictedMixin
-from apps.utils import product_images_prefetch
+from apps.main.utils_numbers import raise_product_counters
 from rest_framework.permissions import IsAuthenticated, AllowAny
+from apps.scale import sync
 from apps.scale.auth import ScaleAgentAuthentication 
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
-from django.db import transaction, connection, IntegrityError
+from django.db import transaction
+import uuid
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
@@ -77,28 +76,49 @@ def register_scale(request):
 @permission_classes([AllowAny])  # потому что аутентификация своя
 def scale_products_list(request):
     """
-    Вернуть список только весовых/штучных товаров для компании агента.
+    Полный каталог весов компании агента (первичная загрузка / пересинхронизация).
     Авторизация: Authorization: Bearer <scale_api_token>
+
+    ?after=<uuid>&limit=N — страницы по id; "next" — курсор следующей страницы.
+    "revision" первой страницы запомнить: дальше scales/products/changes/?since=<revision>.
     """
     company = getattr(request.user, "company", None)
     if not company:
-        return Response([])
+        return Response({"revision": 0, "items": [], "next": None})
 
-    qs = Product.objects.filter(
-        company=company,
-        scale_type__in=["weight", "piece"],
-        is_active=True,
-    ).order_by("name")
+    after = request.query_params.get("after") or None
+    if after:
+        try:
+            after = uuid.UUID(after)
+        except ValueError:
+            return Response({"after": "Ожидается UUID."}, status=status.HTTP_400_BAD_REQUEST)
+
+    limit = sync.page_limit(request.query_params.get("limit"))
+    return Response(sync.snapshot(company.id, after=after, limit=limit))
+
+
+@api_view(["GET"])
+@authentication_classes([ScaleAgentAuthentication])
+@permission_classes([AllowAny])
+def scale_product_changes(request):
+    """
+    Изменения каталога весов после ревизии: ?since=N&limit=M.
+    items — новые/изменённые позиции, deleted — ПЛУ, которые надо стереть;
+    пока has_more, повторять с since=revision.
+    """
+    company = getattr(request.user, "company", None)
+    if not company:
+        return Response({"since": 0, "revision": 0, "has_more": False, "items": [], "deleted": []})
 
-    data = ProductSerializer(qs, many=True).data
-    return Response(data)
+    try:
+        since = int(request.query_params.get("since", ""))
+    except ValueError:
+        since = -1
+    if since < 0:
+        return Response({"since": "Ожидается целое число >= 0."}, status=status.HTTP_400_BAD_REQUEST)
 
-def _pg_lock_company(company_id):
-    if connection.vendor != "postgresql" or not company_id:
-        return
-    key = int(str(company_id).replace("-", "")[:16], 16) & 0x7FFFFFFFFFFFFFFF
-    with connection.cursor() as cur:
-        cur.execute("SELECT pg_advisory_xact_lock(%s::bigint);", [key])
+    limit = sync.page_limit(request.query_params.get("limit"))
+    return Response(sync.changes(company.id, since, limit=limit))
 
 
 @api_view(["POST"])
@@ -112,86 +132,35 @@ def send_products_to_scale(request):
     product_ids = request.data.get("product_ids") or []
     plu_start = int(request.data.get("plu_start") or 1)
 
-    qs = Product.objects.filter(company=company, kind=Product.Kind.PRODUCT)
-
+    qs = sync.catalog(company.id)
     if product_ids:
         qs = qs.filter(id__in=product_ids)
 
-    # ВАЖНО: если по твоей модели PLU нужен только весовым
-    # (у тебя там auto_generate_plu завязан на is_weight)
-    qs = qs.filter(is_weight=True).order_by("id")
-
-    items = []
-
     with transaction.atomic():
-        _pg_lock_company(company.id)
-
-        # занятые PLU в компании
-        used = set(
-            Product.objects
-            .filter(company=company, plu__isnull=False)
-            .values_list("plu", flat=True)
-        )
-
-        cur_plu = max(plu_start, 1)
-
-        def next_free_plu(start):
-            x = int(start)
-            while x in used:
-                x += 1
-            return x
-
-        for p in qs:
-            name = p.name or ""
-            price = float(p.price or 0)
-            shelf = int(getattr(p, "shelf_life_days", 0) or 0)
-
-            plu_value = p.plu
-            if plu_value is None:
-                plu_value = next_free_plu(cur_plu)
-
-                # сохраняем и сразу отмечаем как занятый
-                p.plu = int(plu_value)
-
-                # на всякий: если вдруг гонка/уникальность — поднимем PLU и повторим
-                while True:
-                    try:
-                        p.save(update_fields=["plu"])
-                        break
-                    except IntegrityError:
-                        # кто-то успел занять этот PLU — берём следующий
-                        used.add(int(plu_value))
-                        plu_value = next_free_plu(int(plu_value) + 1)
-                        p.plu = int(plu_value)
-
-                used.add(int(plu_value))
-                cur_plu = int(plu_value) + 1
-            else:
-                used.add(int(plu_value))
-                cur_plu = max(cur_plu, int(plu_value) + 1)
-
-            items.append(
-                {
-                    "product_uuid": str(p.id),
-                    "plu_number": int(plu_value),
-                    "code": int(plu_value),
-                    "name": name,
-                    "price": price,
-                    "shelf_life_days": shelf,
-                    "is_piece": False,  # раз фильтруем is_weight=True
-                    "barcode": str(p.barcode) if p.barcode else None,
-                }
-            )
-
+        missing = list(qs.filter(plu__isnull=True).order_by("id"))
+        if missing and plu_start > 1:
+            # новые ПЛУ — не ниже plu_start
+            raise_product_counters(company.id, plu=plu_start - 1)
+        for p in missing:
+            # ПЛУ выдаёт счётчик компании (Product.save), он же поднимает ревизию весов
+            p.save(update_fields=["plu"])
+
+    items = [sync.scale_item(row) for row in qs.order_by("plu").values(*sync.ITEM_FIELDS)]
     if not items:
         return Response({"detail": "Нет весовых товаров для отправки"}, status=status.HTTP_400_BAD_REQUEST)
 
+    # первый кадр — всем агентам компании; следующие каждый агент получает,
+    # подтвердив предыдущий (plu_batch_result с batch_id/chunk)
+    frame = sync.start_push(company.id, items)
     channel_layer = get_channel_layer()
     group_name = f"scale_company_{company.id}"
 
     async_to_sync(channel_layer.group_send)(
         group_name,
-        {"type": "send_scale_payload", "payload": {"action": "plu_batch", "items": items}},
+        {"type": "send_scale_payload", "payload": frame},
     )
 
-    return Response({"sent": len(items), "items": items}, status=status.HTTP_200_OK)
\ No newline at end of file
+    return Response(
+        {"sent": len(items), "batch_id": frame["batch_id"], "chunks": frame["chunks"], "items": items},
+        status=status.HTTP_200_OK,
+    )
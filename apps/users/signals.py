@@ -0,0 +1,40 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.main.cache_utils import CACHE_DOMAIN_TENANCY, bump_cache_generation_on_commit
+from apps.users.models import Branch, BranchMembership, Company, User
+from apps.users.tenancy import invalidate_user
+
+
+def _invalidate_user_on_commit(user_id) -> None:
+    from django.db import transaction
+
+    if user_id:
+        transaction.on_commit(lambda: invalidate_user(user_id))
+
+
+@receiver(post_save, sender=User, dispatch_uid="tenancy_user_saved")
+@receiver(post_delete, sender=User, dispatch_uid="tenancy_user_deleted")
+def tenancy_on_user_change(sender, instance, **kwargs):
+    # роль, компания, is_staff/is_superuser — всё, что влияет на контекст
+    _invalidate_user_on_commit(instance.pk)
+
+
+@receiver(post_save, sender=BranchMembership, dispatch_uid="tenancy_membership_saved")
+@receiver(post_delete, sender=BranchMembership, dispatch_uid="tenancy_membership_deleted")
+def tenancy_on_membership_change(sender, instance, **kwargs):
+    _invalidate_user_on_commit(instance.user_id)
+
+
+@receiver(post_save, sender=Branch, dispatch_uid="tenancy_branch_saved")
+@receiver(post_delete, sender=Branch, dispatch_uid="tenancy_branch_deleted")
+def tenancy_on_branch_change(sender, instance, **kwargs):
+    bump_cache_generation_on_commit(instance.company_id, CACHE_DOMAIN_TENANCY)
+
+
+@receiver(post_save, sender=Company, dispatch_uid="tenancy_company_saved")
+@receiver(post_delete, sender=Company, dispatch_uid="tenancy_company_deleted")
+def tenancy_on_company_change(sender, instance, **kwargs):
+    bump_cache_generation_on_commit(instance.pk, CACHE_DOMAIN_TENANCY)
+    # новый владелец мог быть закэширован ещё без компании
+    _invalidate_user_on_commit(instance.owner_id)
@@ -0,0 +1,177 @@
+"""
+Контекст арендатора запроса: компания пользователя, его филиалы и флаг «владелец/админ».
+
+Раньше каждый миксин (main, documents, cafe, booking, barber, education,
+storehouse, consalting, construction) сам ходил по owned_company / company /
+primary_branch / branches / branch_memberships — 2–5 запросов до основного
+запроса списка. Теперь это вычисляется один раз:
+
+  - на пользователя — в кэше (TENANCY_CACHE_TTL), ключ сбрасывается при
+    сохранении пользователя и изменении его членств в филиалах, а поколение
+    CACHE_DOMAIN_TENANCY компании — при изменении компании и её филиалов
+    (apps.users.signals);
+  - на запрос — get_tenancy(request) мемоизирует результат на HttpRequest
+    (TenancyMiddleware кладёт ленивый request.tenancy).
+
+Правила выбора «жёсткого» филиала у модулей разные и остаются в миксинах:
+кому-то нужен только основной филиал (primary_branch), кому-то — основной
+или первый филиал компании из членств (member_branch).
+"""
+
+from __future__ import annotations
+
+import uuid
+from dataclasses import dataclass, field
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from apps.main.cache_utils import CACHE_DOMAIN_TENANCY, generation_tag
+from apps.utils import _is_owner_like
+
+
+@dataclass(frozen=True)
+class Tenancy:
+    user_id: object
+    company: object = None              # owned_company, иначе user.company, иначе компания филиала
+    owns_company: bool = False
+    primary_branch: object = None       # основной филиал (is_primary) в этой компании
+    member_branch: object = None        # основной или первый филиал компании из членств
+    branches: dict = field(default_factory=dict)  # {str(id): Branch} — все филиалы компании
+    owner_like: bool = False
+
+    @property
+    def company_id(self):
+        return getattr(self.company, "id", None)
+
+    def branch(self, branch_id) -> Optional[object]:
+        """Филиал компании по id (например из ?branch=); чужой или битый id -> None."""
+        if not branch_id:
+            return None
+        try:
+            return self.branches.get(str(uuid.UUID(str(branch_id))))
+        except (TypeError, ValueError, AttributeError):
+            return None
+
+
+_ANONYMOUS = Tenancy(user_id=None)
+
+
+def _ttl() -> int:
+    return int(getattr(settings, "TENANCY_CACHE_TTL", 300))
+
+
+def user_cache_key(user_id) -> str:
+    return f"nurcrm:tenancy:{user_id}"
+
+
+def _compute(user) -> Tenancy:
+    """Не больше трёх запросов: компании пользователя, его членства, филиалы компании."""
+    from apps.users.models import Branch, BranchMembership, Company
+
+    cond = Q(owner_id=user.pk)
+    if getattr(user, "company_id", None):
+        cond |= Q(pk=user.company_id)
+    companies = list(Company.objects.filter(cond))
+    owned = next((c for c in companies if c.owner_id == user.pk), None)
+    company = owned or next((c for c in companies if c.pk == getattr(user, "company_id", None)), None)
+
+    memberships = list(
+        BranchMembership.objects.filter(user_id=user.pk)
+        .select_related("branch__company" if company is None else "branch")
+        .order_by("-is_primary", "branch_id")
+    )
+    if company is None and memberships:
+        company = memberships[0].branch.company
+
+    primary = member = None
+    branches = {}
+    if company is not None:
+        branches = {str(b.pk): b for b in Branch.objects.filter(company_id=company.pk)}
+        own = [m for m in memberships if m.branch.company_id == company.pk]
+        if own:
+            member = branches.get(str(own[0].branch_id), own[0].branch)
+            primary = member if own[0].is_primary else None
+
+    return Tenancy(
+        user_id=user.pk,
+        company=company,
+        owns_company=owned is not None,
+        primary_branch=primary,
+        member_branch=member,
+        branches=branches,
+        owner_like=_is_owner_like(user),
+    )
+
+
+def resolve_user_tenancy(user) -> Tenancy:
+    """Контекст пользователя из кэша (или вычислить и положить)."""
+    if not user or not getattr(user, "is_authenticated", False):
+        return _ANONYMOUS
+
+    key = user_cache_key(user.pk)
+    entry = cache.get(key)
+    if entry is not None:
+        tenancy, tag = entry
+        if tenancy.company_id is None or tag == generation_tag(tenancy.company_id, (CACHE_DOMAIN_TENANCY,)):
+            return tenancy
+
+    tenancy = _compute(user)
+    tag = generation_tag(tenancy.company_id, (CACHE_DOMAIN_TENANCY,)) if tenancy.company_id else None
+    cache.set(key, (tenancy, tag), _ttl())
+    return tenancy
+
+
+def _prime_user(user, tenancy: Tenancy) -> None:
+    """
+    Кладёт компанию в кэш связей пользователя: user.company / user.owned_company
+    дальше (сериализаторы, проверки прав) не ходят в БД.
+    """
+    cache_ = user._state.fields_cache
+    company = tenancy.company
+    if tenancy.owns_company:
+        cache_.setdefault("owned_company", company)
+    else:
+        cache_.setdefault("owned_company", None)
+    if company is not None and getattr(user, "company_id", None) == company.pk:
+        cache_.setdefault("company", company)
+
+
+def get_tenancy(request) -> Tenancy:
+    """
+    Контекст текущего запроса (DRF Request или HttpRequest). Считается один раз на
+    запрос и пользователя: DRF аутентифицирует позже middleware, поэтому ключом
+    служит id пользователя на момент обращения.
+    """
+    if request is None:
+        return _ANONYMOUS
+    http_request = getattr(request, "_request", request)
+    user = getattr(request, "user", None)
+    user_id = getattr(user, "pk", None) if getattr(user, "is_authenticated", False) else None
+
+    memo = getattr(http_request, "_tenancy_memo", None)
+    if memo is not None and memo.user_id == user_id:
+        return memo
+
+    tenancy = resolve_user_tenancy(user) if user_id is not None else _ANONYMOUS
+    if user_id is not None:
+        _prime_user(user, tenancy)
+    http_request._tenancy_memo = tenancy
+    return tenancy
+
+
+def query_branch(request, tenancy: Tenancy):
+    """Филиал из ?branch=<uuid>, если он принадлежит компании пользователя."""
+    branch_id = None
+    if hasattr(request, "query_params"):
+        branch_id = request.query_params.get("branch")
+    elif hasattr(request, "GET"):
+        branch_id = request.GET.get("branch")
+    return tenancy.branch(branch_id)
+
+
+def invalidate_user(user_id) -> None:
+    if user_id:
+        cache.delete(user_cache_key(user_id))
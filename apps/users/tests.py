@@ -1,3 +1,301 @@
-from django.test import TestCase
+import logging
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from apps.cafe import routing as cafe_routing
+from apps.cafe.models import Zone
+from apps.instagram.ws_jwt import JWTAuthMiddleware
+from apps.main.models import Product
+from apps.main.services.product_import import ProductImporter
+from apps.scale import ws_routing as scale_ws_routing
+from apps.users.models import Branch, BranchMembership, Company, User
+from apps.users.tenancy import get_tenancy, query_branch, resolve_user_tenancy
+from apps.users.ws_auth import authenticate_ws_token
+
+
+class TenancyResolverTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user(email="owner@tenancy.test", password="x")
+        self.company = Company.objects.create(name="Tenancy Co", owner=self.owner)
+        self.branch_a = Branch.objects.create(name="A", company=self.company)
+        self.branch_b = Branch.objects.create(name="B", company=self.company)
+
+        self.staff = User.objects.create_user(email="staff@tenancy.test", password="x", company=self.company)
+        BranchMembership.objects.create(user=self.staff, branch=self.branch_b, is_primary=True)
+        BranchMembership.objects.create(user=self.staff, branch=self.branch_a)
+        self.factory = RequestFactory()
+
+    def _request(self, user, **params):
+        request = self.factory.get("/", params)
+        request.user = user
+        return request
+
+    def test_resolves_company_branches_and_owner_flag(self):
+        staff = resolve_user_tenancy(self.staff)
+        self.assertEqual(staff.company, self.company)
+        self.assertEqual(staff.primary_branch, self.branch_b)
+        self.assertEqual(staff.member_branch, self.branch_b)
+        self.assertFalse(staff.owns_company)
+
+        owner = resolve_user_tenancy(self.owner)
+        self.assertEqual(owner.company, self.company)
+        self.assertTrue(owner.owns_company)
+        self.assertIsNone(owner.primary_branch)
+        self.assertEqual(set(owner.branches), {str(self.branch_a.pk), str(self.branch_b.pk)})
+
+    def test_cached_between_requests_and_memoized_per_request(self):
+        resolve_user_tenancy(self.owner)  # прогрев кэша
+
+        user = User.objects.get(pk=self.owner.pk)
+        request = self._request(user, branch=str(self.branch_a.pk))
+        with self.assertNumQueries(0):
+            tenancy = get_tenancy(request)
+            self.assertIs(get_tenancy(request), tenancy)
+            self.assertEqual(query_branch(request, tenancy), self.branch_a)
+            # компания положена в кэш связей пользователя
+            self.assertEqual(user.owned_company, self.company)
+            self.assertEqual(user.company_id, None)
+
+        bad = self._request(user, branch="not-a-uuid")
+        self.assertIsNone(query_branch(bad, get_tenancy(bad)))
+
+    def test_membership_and_branch_changes_invalidate(self):
+        self.assertEqual(resolve_user_tenancy(self.staff).primary_branch, self.branch_b)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            BranchMembership.objects.filter(user=self.staff, branch=self.branch_b).delete()
+            BranchMembership.objects.filter(user=self.staff, branch=self.branch_a).update(is_primary=True)
+            # update() сигналов не шлёт — инвалидирует сохранение пользователя (смена роли и т.п.)
+            self.staff.save()
+        self.assertEqual(resolve_user_tenancy(self.staff).primary_branch, self.branch_a)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            branch_c = Branch.objects.create(name="C", company=self.company)
+        self.assertIn(str(branch_c.pk), resolve_user_tenancy(self.owner).branches)
+
+    def test_list_endpoint_pays_no_tenancy_queries_when_warm(self):
+        """Бенчмарк: после прогрева список зон = только запросы самого списка."""
+        Zone.objects.create(company=self.company, branch=self.branch_b, title="Z1")
+        client = APIClient()
+        client.force_authenticate(self.staff)
+        url = reverse("cafe:zone-list")
+
+        client.get(url)  # прогрев
+        with CaptureQueriesContext(connection) as ctx:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), 1)
+        sql = [q["sql"] for q in ctx.captured_queries]
+        # COUNT + страница + company зоны в сериализаторе; до контекста было ещё 2–3 запроса
+        self.assertEqual(len(sql), 3, sql)
+        self.assertFalse([q for q in sql if "users_branchmembership" in q or 'FROM "users_branch"' in q])
+
+
+class WebSocketAuthCacheTests(TestCase):
+    """Рукопожатия WS: пользователь, tenancy и токен весов берутся из кэша."""
+
+    TABLETS = 20
+    RECONNECTS = 3
+
+    def setUp(self):
+        cache.clear()
+        logging.disable(logging.INFO)  # консьюмеры пишут INFO на каждое подключение
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.owner = User.objects.create_user(email="owner@ws-auth.test", password="x")
+        self.company = Company.objects.create(name="WS Auth Co", owner=self.owner)
+        self.branch_a = Branch.objects.create(name="A", company=self.company)
+        self.branch_b = Branch.objects.create(name="B", company=self.company)
+        self.tablets = []
+        for i in range(self.TABLETS):
+            user = User.objects.create_user(email=f"tablet{i}@ws-auth.test", password="x", company=self.company)
+            BranchMembership.objects.create(user=user, branch=self.branch_a, is_primary=True)
+            self.tablets.append((user, str(AccessToken.for_user(user))))
+        self.app = JWTAuthMiddleware(URLRouter(cafe_routing.websocket_urlpatterns + scale_ws_routing.websocket_urlpatterns))
+
+    def _handshake(self, path):
+        async def run():
+            communicator = WebsocketCommunicator(self.app, path)
+            connected, code = await communicator.connect()
+            hello = await communicator.receive_json_from() if connected else None
+            await communicator.disconnect()
+            return connected, code, hello
+
+        return async_to_sync(run)()
+
+    def test_reconnect_storm_hits_db_only_on_first_handshake(self):
+        """Бенчмарк: TABLETS планшетов переподключаются RECONNECTS раз."""
+        with CaptureQueriesContext(connection) as cold:
+            for _, token in self.tablets:
+                connected, _, hello = self._handshake(f"/ws/cafe/orders/?token={token}")
+                self.assertTrue(connected)
+                self.assertEqual(hello["branch_id"], str(self.branch_a.pk))
+        # пользователь + компании + членства + филиалы; раньше ещё 3-4 запроса в консьюмере
+        self.assertLessEqual(len(cold), 4 * self.TABLETS)
+
+        with CaptureQueriesContext(connection) as warm:
+            for _ in range(self.RECONNECTS):
+                for _, token in self.tablets:
+                    for path in ("orders", "tables", "kitchen"):
+                        connected, _, _ = self._handshake(f"/ws/cafe/{path}/?token={token}")
+                        self.assertTrue(connected)
+        self.assertEqual(len(warm), 0, [q["sql"] for q in warm.captured_queries])
+
+    def test_user_change_and_branch_override(self):
+        user, token = self.tablets[0]
+        authenticate_ws_token(token)  # прогрев
+
+        with self.captureOnCommitCallbacks(execute=True):
+            BranchMembership.objects.filter(user=user).update(is_primary=False)
+            BranchMembership.objects.create(user=user, branch=self.branch_b, is_primary=True)
+        _, hello = self._handshake(f"/ws/cafe/tables/?token={token}")[1:]
+        self.assertEqual(hello["branch_id"], str(self.branch_b.pk))
+
+        # сотрудник не выбирает филиал через query, владелец — может
+        _, hello = self._handshake(f"/ws/cafe/kitchen/?token={token}&branch_id={self.branch_a.pk}")[1:]
+        self.assertEqual(hello["branch_id"], str(self.branch_b.pk))
+        owner_token = str(AccessToken.for_user(self.owner))
+        _, hello = self._handshake(f"/ws/cafe/kitchen/?token={owner_token}&branch_id={self.branch_a.pk}")[1:]
+        self.assertEqual(hello["branch_id"], str(self.branch_a.pk))
+
+        self.assertEqual(self._handshake("/ws/cafe/orders/?token=garbage")[:2], (False, 4003))
+
+    def test_scale_token_cached_until_rotation(self):
+        token = self.company.ensure_scale_api_token()
+        self.assertEqual(self._handshake(f"/ws/agents/?token={token}")[2]["company_id"], str(self.company.pk))
+        with CaptureQueriesContext(connection) as warm:
+            self._handshake(f"/ws/agents/?token={token}")
+        self.assertEqual(len(warm), 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.company.scale_api_token = "rotated"
+            self.company.save(update_fields=["scale_api_token"])
+        self.assertEqual(self._handshake(f"/ws/agents/?token={token}")[:2], (False, 4002))
+
+
+class ScaleSyncTests(TestCase):
+    """Весы: полный каталог + изменения после ревизии; отправка кадрами с подтверждением."""
+
+    def setUp(self):
+        cache.clear()
+        logging.disable(logging.INFO)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.owner = User.objects.create_user(email="owner@scale.test", password="x")
+        self.company = Company.objects.create(name="Scale Co", owner=self.owner)
+        self.owner.company = self.company
+        self.owner.save(update_fields=["company"])
+        self.token = self.company.ensure_scale_api_token()
+        self.products = [
+            Product.objects.create(company=self.company, name=f"Весовой {i}", price=10 + i, is_weight=True)
+            for i in range(5)
+        ]
+        Product.objects.create(company=self.company, name="Штучный", price=5)
+        self.agent = APIClient()
+        self.agent.credentials(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+
+    def _changes(self, since, limit=100):
+        response = self.agent.get(reverse("scale-products-changes"), {"since": since, "limit": limit})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_snapshot_then_only_changes(self):
+        page = self.agent.get(reverse("scale-products"), {"limit": 3}).json()
+        revision = page["revision"]
+        self.assertEqual(len(page["items"]), 3)
+        rest = self.agent.get(reverse("scale-products"), {"after": page["next"]}).json()
+        self.assertIsNone(rest["next"])
+        self.assertEqual(len(page["items"]) + len(rest["items"]), 5)
+        self.assertEqual(self._changes(revision), {"since": revision, "revision": revision, "has_more": False, "items": [], "deleted": []})
+
+        changed, deleted, unweighted = self.products[:3]
+        changed.price = 99
+        changed.save()
+        deleted_id, deleted_plu = str(deleted.pk), deleted.plu
+        deleted.delete()
+        unweighted.is_weight = False
+        unweighted.save()
+        self.products[3].save(update_fields=["quantity"])  # не то, что уходит на весы
+
+        feed = self._changes(revision)
+        self.assertEqual([item["product_uuid"] for item in feed["items"]], [str(changed.pk)])
+        self.assertEqual(feed["items"][0]["price"], 99.0)
+        self.assertEqual(
+            {(d["product_uuid"], d["plu_number"]) for d in feed["deleted"]},
+            {(deleted_id, deleted_plu), (str(unweighted.pk), unweighted.plu)},
+        )
+        self.assertEqual(self._changes(feed["revision"])["items"], [])
+
+        # страницами по ревизии — то же самое
+        seen, since = [], revision
+        while True:
+            page = self._changes(since, limit=1)
+            seen += [i["product_uuid"] for i in page["items"]] + [d["product_uuid"] for d in page["deleted"]]
+            since = page["revision"]
+            if not page["has_more"]:
+                break
+        self.assertEqual(seen, [str(changed.pk), deleted_id, str(unweighted.pk)])
+
+    def test_import_price_update_reaches_changes_feed(self):
+        repriced, same = self.products[:2]
+        for i, product in enumerate((repriced, same)):
+            product.barcode = f"200000000{i:04d}"
+            product.save()
+        revision = self.agent.get(reverse("scale-products")).json()["revision"]
+
+        rows = [
+            ["barcode", "name", "price"],
+            [repriced.barcode, repriced.name, "55"],
+            [same.barcode, same.name, str(same.price)],
+        ]
+        stats = ProductImporter(self.company, update_existing=True).run(iter(rows))
+        self.assertEqual(stats.updated, 2)
+
+        feed = self._changes(revision)
+        self.assertEqual([item["product_uuid"] for item in feed["items"]], [str(repriced.pk)])
+        self.assertEqual(feed["items"][0]["price"], 55.0)
+
+        self.assertEqual(self.agent.get(reverse("scale-products-changes"), {"since": "x"}).status_code, 400)
+
+    @override_settings(SCALE_PUSH_CHUNK=2)
+    def test_push_is_chunked_and_acknowledged(self):
+        Product.objects.filter(pk=self.products[0].pk).update(plu=None)  # старый товар без ПЛУ
+        owner = APIClient()
+        owner.force_authenticate(self.owner)
+        app = URLRouter(scale_ws_routing.websocket_urlpatterns)
+
+        async def run():
+            communicator = WebsocketCommunicator(app, f"/ws/agents/?token={self.token}")
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_json_from()  # hello
+
+            response = await sync_to_async(owner.post)(reverse("scale-send-products"), {}, format="json")
+            frames = [await communicator.receive_json_from()]
+            while frames[-1]["chunk"] + 1 < frames[-1]["chunks"]:
+                await communicator.send_json_to(
+                    {"action": "plu_batch_result", "batch_id": frames[-1]["batch_id"], "chunk": frames[-1]["chunk"], "items": []}
+                )
+                message = await communicator.receive_json_from()
+                while message.get("action") != "plu_batch":  # эхо результата группе
+                    message = await communicator.receive_json_from()
+                frames.append(message)
+            await communicator.disconnect()
+            return response, frames
+
+        response, frames = async_to_sync(run)()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data["sent"], response.data["chunks"]), (5, 3))
+        self.assertEqual([len(f["items"]) for f in frames], [2, 2, 1])
+        plus = [item["plu_number"] for f in frames for item in f["items"]]
+        self.assertEqual(len(set(plus)), 5)
+        self.products[0].refresh_from_db()
+        self.assertIsNotNone(self.products[0].plu)
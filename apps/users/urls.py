@@ -26,7 +26,9 @@ from .views import (
     CompanySubscriptionAdminAPIView,
 )
 
-from apps.users.scale_views import send_products_to_scale, get_scale_api_token, register_scale
+from apps.users.scale_views import (
+    send_products_to_scale, get_scale_api_token, register_scale, scale_products_list, scale_product_changes,
+)
 
 urlpatterns = [
     # 🔐 Авторизация / регистрация
@@ -36,6 +38,8 @@ urlpatterns = [
     
     path("scales/token/", get_scale_api_token, name="scale-api-token"),
     path("scales/register/", register_scale, name="scale-api-register"),
+    path("scales/products/", scale_products_list, name="scale-products"),
+    path("scales/products/changes/", scale_product_changes, name="scale-products-changes"),
     
 
     # ⚙️ Настройки
@@ -67,7 +71,7 @@ urlpatterns = [
     path('roles/custom/<uuid:pk>/', CustomRoleDetailAPIView.as_view(), name='custom-role-detail'),
     
     
-    path("scales/send-products/", send_products_to_scale),
+    path("scales/send-products/", send_products_to_scale, name="scale-send-products"),
 
     path('companies/', CompanyListAPIView.as_view(), name='company-list'),#Список всех компаний для Админа
     path('companies/<uuid:pk>/subscription/', CompanySubscriptionAdminAPIView.as_view(), name='company-subscription',
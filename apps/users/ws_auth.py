@@ -0,0 +1,118 @@
+"""
+Идентификация WebSocket-подключений: JWT -> пользователь + Tenancy, токен весов -> компания.
+
+После обрыва Wi-Fi планшеты кафе и операторы переподключаются разом — раньше
+каждое рукопожатие делало User.objects.get, а консьюмер ещё 2–4 отдельных
+database_sync_to_async (компания, филиал, «владелец?», филиал из query).
+
+Теперь всё считается за один переход в sync-поток:
+  - пользователь кэшируется по sha256 токена на WS_AUTH_CACHE_TTL секунд, но не
+    дольше срока жизни самого токена (без поля password);
+  - запись считается свежей, пока жив кэш Tenancy пользователя: сохранение
+    пользователя / его членств сбрасывает его (apps.users.signals), и следующее
+    рукопожатие перечитает пользователя из БД;
+  - Tenancy берётся из resolve_user_tenancy (общий кэш с HTTP-запросами).
+
+Токен весов (scale_api_token) -> id компании с тем же TTL; запись сверяется с
+поколением CACHE_DOMAIN_TENANCY компании, которое растёт при её сохранении
+(в т.ч. при смене токена).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from apps.main.cache_utils import CACHE_DOMAIN_TENANCY, generation_tag
+from apps.users.tenancy import _ANONYMOUS, Tenancy, _prime_user, resolve_user_tenancy, user_cache_key
+
+
+def _ttl() -> int:
+    return int(getattr(settings, "WS_AUTH_CACHE_TTL", 60))
+
+
+def _digest(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def jwt_cache_key(token: str) -> str:
+    return f"nurcrm:ws_auth:jwt:{_digest(token)}"
+
+
+def scale_cache_key(token: str) -> str:
+    return f"nurcrm:ws_auth:scale:{_digest(token)}"
+
+
+def _load_user(token: str):
+    """Проверка подписи/срока и пользователь из БД. None — токен невалиден или пользователя нет."""
+    from django.contrib.auth import get_user_model
+    from rest_framework_simplejwt.tokens import AccessToken
+
+    try:
+        access = AccessToken(token)
+        user_id = access["user_id"]
+    except Exception:
+        return None, 0
+
+    user = get_user_model().objects.defer("password").filter(pk=user_id).first()
+    ttl = min(_ttl(), int(access.get("exp", 0) - time.time()))
+    return user, ttl
+
+
+def authenticate_ws_token(token: str):
+    """
+    (user, tenancy) по access-токену; (None, пустой Tenancy) — аноним.
+    Синхронная: вызывать одним database_sync_to_async.
+    """
+    if not token:
+        return None, _ANONYMOUS
+
+    key = jwt_cache_key(token)
+    user = cache.get(key)
+    if user is not None and cache.get(user_cache_key(user.pk)) is None:
+        user = None  # пользователь или его членства менялись — перечитать
+
+    if user is None:
+        user, ttl = _load_user(token)
+        if user is None:
+            return None, _ANONYMOUS
+        if ttl > 0:
+            cache.set(key, user, ttl)
+
+    tenancy = resolve_user_tenancy(user)
+    _prime_user(user, tenancy)
+    return user, tenancy
+
+
+def ws_tenancy(scope) -> Tenancy:
+    """Tenancy из scope (положил JWTAuthMiddleware) или посчитать заново — тоже sync."""
+    tenancy = scope.get("tenancy")
+    user = scope.get("user")
+    if tenancy is not None and tenancy.user_id == getattr(user, "pk", None):
+        return tenancy
+    tenancy = resolve_user_tenancy(user)
+    if tenancy.user_id is not None:
+        _prime_user(user, tenancy)
+    return tenancy
+
+
+def company_id_by_scale_token(token: str):
+    """id компании по scale_api_token или None."""
+    if not token:
+        return None
+    from apps.users.models import Company
+
+    key = scale_cache_key(token)
+    entry = cache.get(key)
+    if entry is not None:
+        company_id, tag = entry
+        if tag == generation_tag(company_id, (CACHE_DOMAIN_TENANCY,)):
+            return company_id
+
+    company_id = Company.objects.filter(scale_api_token=token).values_list("pk", flat=True).first()
+    if company_id is not None:
+        cache.set(key, (company_id, generation_tag(company_id, (CACHE_DOMAIN_TENANCY,))), _ttl())
+    return company_id
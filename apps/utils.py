@@ -1,6 +1,5 @@
 from django.db.models import Prefetch
 from apps.main.models import ProductImage
-from django.db.models import Q, Case, When, IntegerField, Value as V
 from django.utils import timezone
 
 def get_filtered_contacts(queryset, params):
@@ -39,61 +38,22 @@ def compute_gift_qty(product, qty: int, *, company, branch=None, date=None, stac
       - Фильтруем по порогу min_qty (>, либо ≥ если inclusive=True).
       - Выбираем самое специфичное правило (product > brand > category > общее).
         Если stacking=True — суммируем все правила (но по умолчанию выключено).
+    Правила берутся из скомпилированного индекса компании (apps.main.services.promo_index);
+    для целой корзины — gift_quantities().
     """
     if not qty or qty <= 0 or company is None:
         return 0
 
-    from apps.main.models import PromoRule  # импорт тут, чтобы не ловить циклический импорт
+    from apps.main.services.promo_index import get_promo_index  # импорт тут, чтобы не ловить циклический импорт
 
-    today = (date or timezone.localdate())
-
-    qs = PromoRule.objects.filter(company=company, is_active=True).filter(
-        Q(active_from__isnull=True) | Q(active_from__lte=today),
-        Q(active_to__isnull=True)   | Q(active_to__gte=today),
-    )
-
-    # либо глобальные (branch is null), либо наш branch
-    if branch is not None:
-        qs = qs.filter(Q(branch__isnull=True) | Q(branch=branch))
-    else:
-        qs = qs.filter(branch__isnull=True)
-
-    # проходим по порогу
-    qs = qs.filter(
-        Q(inclusive=True,  min_qty__lte=qty) |
-        Q(inclusive=False, min_qty__lt=qty)
+    index = get_promo_index(getattr(company, "pk", company))
+    return index.gift_qty(
+        product, qty,
+        branch_id=getattr(branch, "pk", branch),
+        day=date or timezone.localdate(),
+        stacking=stacking,
     )
 
-    prod_id = getattr(product, "id", None)
-    brand_id = getattr(product, "brand_id", None)
-    cat_id = getattr(product, "category_id", None)
-
-    # scope по продукту/бренду/категории/общие
-    qs = qs.filter(
-        Q(product__isnull=True, brand__isnull=True, category__isnull=True) |
-        Q(product_id=prod_id) |
-        Q(brand_id=brand_id) |
-        Q(category_id=cat_id)
-    )
-
-    # чем уже правило, тем выше специфичность
-    qs = qs.annotate(
-        specificity=Case(
-            When(product_id=prod_id, then=V(3)),
-            When(brand_id=brand_id,   then=V(2)),
-            When(category_id=cat_id,  then=V(1)),
-            default=V(0),
-            output_field=IntegerField(),
-        )
-    ).order_by("-specificity", "-priority", "-min_qty", "-id")
-
-    if stacking:
-        return sum(r.gift_qty for r in qs)
-
-    top = qs.first()
-    return top.gift_qty if top else 0
-
-
 
 def _is_owner_like(user) -> bool:
     """
@@ -8,7 +8,7 @@ from django.db.models import Sum, Count, Value as V, F, DecimalField, Q, Express
 from django.db.models.functions import Coalesce, TruncDate, TruncWeek, TruncMonth
 from django.utils import timezone
 
-from apps.main.cache_utils import cached_result
+from apps.main.cache_utils import CACHE_DOMAIN_WAREHOUSE, cached_result
 from apps.users.models import User, Company, Branch
 from apps.warehouse import models as wm
 
@@ -129,7 +129,11 @@ def _build_sales_by_group(*, sales_items_qs, limit: int = 100):
     return rows, top
 
 
-@cached_result(timeout=settings.CACHE_TIMEOUT_ANALYTICS, key_prefix="warehouse_analytics_agent")
+@cached_result(
+    timeout=settings.CACHE_TIMEOUT_ANALYTICS,
+    key_prefix="warehouse_analytics_agent",
+    domains=(CACHE_DOMAIN_WAREHOUSE,),
+)
 def build_agent_warehouse_analytics_payload(
     *,
     company_id: str,
@@ -352,7 +356,11 @@ def build_agent_warehouse_analytics_payload(
     }
 
 
-@cached_result(timeout=settings.CACHE_TIMEOUT_ANALYTICS, key_prefix="warehouse_analytics_owner")
+@cached_result(
+    timeout=settings.CACHE_TIMEOUT_ANALYTICS,
+    key_prefix="warehouse_analytics_owner",
+    domains=(CACHE_DOMAIN_WAREHOUSE,),
+)
 def build_owner_warehouse_analytics_payload(
     *,
     company_id: str,
@@ -599,7 +607,11 @@ def build_owner_warehouse_analytics_payload(
     }
 
 
-@cached_result(timeout=settings.CACHE_TIMEOUT_ANALYTICS, key_prefix="warehouse_analytics_owner_agents_sales")
+@cached_result(
+    timeout=settings.CACHE_TIMEOUT_ANALYTICS,
+    key_prefix="warehouse_analytics_owner_agents_sales",
+    domains=(CACHE_DOMAIN_WAREHOUSE,),
+)
 def build_owner_agents_sales_analytics_payload(
     *,
     company_id: str,
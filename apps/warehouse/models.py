@@ -268,6 +268,16 @@ def q_qty(x: Decimal) -> Decimal:
     return (x or Decimal("0")).quantize(QTY3, rounding=ROUND_HALF_UP)
 
 
+def calc_line_total(qty, price, discount_percent, discount_amount) -> Decimal:
+    """Итого по строке документа: price * qty * (1 - discount_percent) - discount_amount, не меньше 0."""
+    q = Decimal(qty or 0)
+    p = Decimal(price or 0)
+    dp = Decimal(discount_percent or 0) / Decimal("100")
+    da = Decimal(discount_amount or 0)
+    subtotal = (p * q * (Decimal("1") - dp)).quantize(Decimal("0.01"))
+    return max(Decimal("0.00"), (subtotal - da).quantize(Decimal("0.01")))
+
+
 class WarehouseProduct(BaseModelId, BaseModelDate, BaseModelCompanyBranch):
     class Status(models.TextChoices):
         PENDING = "pending", "Ожидание"
@@ -864,6 +874,36 @@ class Counterparty(models.Model):
             raise ValidationError({"agent": "Агент должен быть сотрудником или активным агентом этой компании."})
 
 
+class CounterpartyBalanceCheckpoint(models.Model):
+    """
+    Сальдо контрагента на начало месяца по проведённым документам и денежным документам.
+    branch = NULL — по всей компании, иначе — только по документам филиала
+    (так же, как фильтрует акт сверки). См. services_checkpoints.py.
+    """
+    company = models.ForeignKey("users.Company", on_delete=models.CASCADE, related_name="counterparty_balance_checkpoints")
+    branch = models.ForeignKey(
+        "users.Branch", on_delete=models.CASCADE, null=True, blank=True, related_name="counterparty_balance_checkpoints"
+    )
+    counterparty = models.ForeignKey(Counterparty, on_delete=models.CASCADE, related_name="balance_checkpoints")
+    period_start = models.DateField()
+
+    debit = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal("0.00"))
+    credit = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal("0.00"))
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Сальдо контрагента (чекпоинт)"
+        verbose_name_plural = "Сальдо контрагентов (чекпоинты)"
+        constraints = [
+            models.UniqueConstraint(
+                fields=("company", "branch", "counterparty", "period_start"),
+                name="uq_counterparty_balance_checkpoint",
+                nulls_distinct=False,
+            ),
+        ]
+
+
 class CompanyWarehouseAgent(models.Model):
     """
     Заявка/членство: пользователь как агент склада компании.
@@ -947,14 +987,22 @@ class CompanyWarehouseAgent(models.Model):
 
 
 class DocumentSequence(models.Model):
+    """
+    Счётчик номеров документов на (тип, день, шард).
+    shard=0 — общий счётчик дня, остальные шарды раздают номера из взятых у него
+    диапазонов: пока шард занят чужой транзакцией, номер берётся из свободного
+    (см. services_numbers).
+    """
     doc_type = models.CharField(max_length=32, verbose_name="Тип документа")
     date = models.DateField(verbose_name="Дата")
+    shard = models.PositiveSmallIntegerField(default=0, verbose_name="Шард")
     seq = models.PositiveIntegerField(default=0, verbose_name="Последовательность")
+    seq_limit = models.PositiveIntegerField(default=0, verbose_name="Конец диапазона шарда")
 
     class Meta:
         verbose_name = "Последовательность документов"
         verbose_name_plural = "Последовательности документов"
-        unique_together = (("doc_type", "date"),)
+        unique_together = (("doc_type", "date", "shard"),)
 
 
 class Document(models.Model):
@@ -1042,6 +1090,8 @@ class Document(models.Model):
 
     comment = models.TextField(blank=True, verbose_name="Комментарий")
     total = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal("0.00"), verbose_name="Итого")
+    # отпечаток строк и скидок, по которым посчитан total (см. services.recalc_document_totals)
+    totals_hash = models.CharField(max_length=32, blank=True, default="", editable=False)
     discount_percent = models.DecimalField(
         max_digits=5, decimal_places=2, default=Decimal("0.00"),
         verbose_name="Общая скидка, %", help_text="Скидка на весь документ в процентах"
@@ -1216,13 +1266,7 @@ class DocumentItem(models.Model):
                 raise ValidationError({"qty": "Quantity must be integer for piece items"})
 
     def save(self, *args, **kwargs):
-        # compute line total: price * qty * (1 - discount_percent) - discount_amount
-        q = Decimal(self.qty or 0)
-        p = Decimal(self.price or 0)
-        dp = Decimal(self.discount_percent or 0) / Decimal("100")
-        da = Decimal(self.discount_amount or 0)
-        subtotal = (p * q * (Decimal("1") - dp)).quantize(Decimal("0.01"))
-        self.line_total = max(Decimal("0.00"), (subtotal - da).quantize(Decimal("0.01")))
+        self.line_total = calc_line_total(self.qty, self.price, self.discount_percent, self.discount_amount)
         super().save(*args, **kwargs)
 
 
@@ -1,9 +1,10 @@
+import hashlib
 from decimal import Decimal
 from django.db import transaction
 from django.utils import timezone
 from django.conf import settings
 
-from . import models
+from . import models, services_numbers, services_stock
 from .models import q_qty
 
 
@@ -23,78 +24,59 @@ def agent_has_common_access_to_warehouse(*, user, warehouse, company=None) -> bo
 
 
 def _ensure_number(document: models.Document):
-    # generate number like TYPE-YYYYMMDD-0001 per day+type
-    today = timezone.now().date()
-    with transaction.atomic():
-        seq, created = models.DocumentSequence.objects.select_for_update().get_or_create(
-            doc_type=document.doc_type, date=today, defaults={"seq": 0}
-        )
-        seq.seq += 1
-        seq.save()
-        document.number = f"{document.doc_type}-{today.strftime('%Y%m%d')}-{seq.seq:04d}"
-        document.save()
+    # TYPE-YYYYMMDD-0001 per day+type; счётчик шардирован, без общей "горячей" строки
+    document.number = services_numbers.allocate_number(document.doc_type)
+    document.save(update_fields=["number", "updated_at"])
+
+
+_TOTALS_LINE_FIELDS = ("id", "qty", "price", "discount_percent", "discount_amount", "line_total")
+
+
+def _totals_hash(document: models.Document, rows) -> str:
+    """Отпечаток всего, от чего зависит total: строки (по id) + общая скидка + сам total."""
+    def norm(value):
+        return str(Decimal(value or 0).normalize())
+
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{norm(document.discount_percent)}|{norm(document.discount_amount)}|{norm(document.total)}".encode())
+    for pk, *values in rows:
+        h.update(f"\n{pk}|{'|'.join(norm(v) for v in values)}".encode())
+    return h.hexdigest()
 
 
 def recalc_document_totals(document: models.Document) -> models.Document:
-    # Пересчитываем line_total для каждого item (скидка на товар: percent + amount)
-    for item in document.items.select_related("product").all():
-        q = Decimal(item.qty or 0)
-        p = Decimal(item.price or 0)
-        dp = Decimal(item.discount_percent or 0) / Decimal("100")
-        da = Decimal(item.discount_amount or 0)
-        subtotal = (p * q * (Decimal("1") - dp)).quantize(Decimal("0.01"))
-        new_line_total = max(Decimal("0.00"), (subtotal - da).quantize(Decimal("0.01")))
-        if item.line_total != new_line_total:
-            item.line_total = new_line_total
-            item.save(update_fields=["line_total"])
-
-    # Сумма по строкам (суммарная стоимость товаров до общей скидки)
-    subtotal = sum(
-        (item.line_total or Decimal("0.00"))
-        for item in document.items.all()
-    )
-    subtotal = subtotal.quantize(Decimal("0.01"))
+    """
+    Один проход по строкам (values_list, без моделей): line_total считаются в памяти,
+    изменившиеся пишутся одним bulk_update, total — из того же прохода.
+    Если отпечаток строк совпал с сохранённым — документ уже посчитан, ничего не пишем.
+    """
+    rows = list(document.items.order_by("id").values_list(*_TOTALS_LINE_FIELDS))
+    if document.totals_hash and document.totals_hash == _totals_hash(document, rows):
+        return document
+
+    subtotal = Decimal("0.00")
+    changed = []
+    fresh_rows = []
+    for pk, qty, price, discount_percent, discount_amount, line_total in rows:
+        new_line_total = models.calc_line_total(qty, price, discount_percent, discount_amount)
+        if line_total != new_line_total:
+            changed.append(models.DocumentItem(pk=pk, line_total=new_line_total))
+        subtotal += new_line_total
+        fresh_rows.append((pk, qty, price, discount_percent, discount_amount, new_line_total))
+
+    if changed:
+        models.DocumentItem.objects.bulk_update(changed, ["line_total"], batch_size=500)
 
     # Общая скидка на документ: percent + amount
+    subtotal = subtotal.quantize(Decimal("0.01"))
     doc_dp = Decimal(document.discount_percent or 0) / Decimal("100")
     doc_da = Decimal(document.discount_amount or 0)
-    total = max(Decimal("0.00"), (subtotal * (Decimal("1") - doc_dp) - doc_da).quantize(Decimal("0.01")))
-    document.total = total
-    document.save(update_fields=["total"])
+    document.total = max(Decimal("0.00"), (subtotal * (Decimal("1") - doc_dp) - doc_da).quantize(Decimal("0.01")))
+    document.totals_hash = _totals_hash(document, fresh_rows)
+    document.save(update_fields=["total", "totals_hash"])
     return document
 
 
-def _apply_move(move: models.StockMove):
-    # apply qty_delta to StockBalance
-    # Оптимизация: используем select_related если warehouse и product уже загружены
-    bal, created = models.StockBalance.objects.select_for_update().get_or_create(
-        warehouse=move.warehouse, product=move.product, defaults={"qty": Decimal("0.000")}
-    )
-    # Если StockBalance только что создан и товар принадлежит этому складу, инициализируем из quantity
-    if created and move.product.warehouse_id == move.warehouse_id:
-        initial_qty = Decimal(move.product.quantity) if move.product.quantity else Decimal("0.000")
-        bal.qty = initial_qty
-    bal.qty = Decimal(bal.qty or 0) + Decimal(move.qty_delta or 0)
-    bal.save()
-    if move.product.warehouse_id == move.warehouse_id:
-        type(move.product).objects.filter(pk=move.product_id).update(quantity=q_qty(bal.qty))
-
-
-def _apply_agent_move(move: models.AgentStockMove):
-    bal, _ = models.AgentStockBalance.objects.select_for_update().get_or_create(
-        agent=move.agent,
-        warehouse=move.warehouse,
-        product=move.product,
-        defaults={
-            "qty": Decimal("0.000"),
-            "company": move.warehouse.company,
-            "branch": move.warehouse.branch,
-        },
-    )
-    bal.qty = Decimal(bal.qty or 0) + Decimal(move.qty_delta or 0)
-    bal.save()
-
-
 def _resolve_money_doc_type(doc_type: str):
     """
     Для каждой складской операции определяем, какой денежный документ нужен.
@@ -262,6 +244,7 @@ def post_document(document: models.Document, allow_negative: bool = None) -> mod
     
     # Валидация всех items
     for item in document.items.select_related("product").all():
+        item.document = document  # иначе clean() подгружает документ на каждую строку
         try:
             item.clean()
         except Exception as e:
@@ -302,19 +285,12 @@ def post_document(document: models.Document, allow_negative: bool = None) -> mod
             if sign is None:
                 raise ValueError("Unsupported document type for agent posting")
 
+            warehouse = document.warehouse_from
+            ledger = services_stock.AgentStockLedger(document, document.agent_id)
+            ledger.lock((warehouse, item.product) for item in items)
             for item in items:
                 delta = sign * Decimal(item.qty)
-                bal, _ = models.AgentStockBalance.objects.select_for_update().get_or_create(
-                    agent_id=document.agent_id,
-                    warehouse=document.warehouse_from,
-                    product=item.product,
-                    defaults={
-                        "qty": Decimal("0.000"),
-                        "company": document.warehouse_from.company,
-                        "branch": document.warehouse_from.branch,
-                    },
-                )
-                cur = Decimal(bal.qty or 0)
+                cur = ledger.qty(warehouse, item.product)
                 if not allow_negative and cur + delta < 0:
                     product_display = item.product.article if item.product.article else item.product.name
                     if not product_display:
@@ -322,17 +298,8 @@ def post_document(document: models.Document, allow_negative: bool = None) -> mod
                     raise ValueError(
                         f"Недостаточно у агента для товара '{product_display}'. Доступно: {cur}, требуется: {abs(delta)}"
                     )
-
-                move_kind = models.AgentStockMove.MoveKind.RECEIPT if delta > 0 else models.AgentStockMove.MoveKind.EXPENSE
-                mv = models.AgentStockMove.objects.create(
-                    document=document,
-                    agent_id=document.agent_id,
-                    warehouse=document.warehouse_from,
-                    product=item.product,
-                    qty_delta=delta,
-                    move_kind=move_kind,
-                )
-                _apply_agent_move(mv)
+                ledger.move(warehouse, item.product, delta)
+            ledger.flush()
 
         # create moves according to type
         elif document.doc_type == document.DocType.TRANSFER:
@@ -392,89 +359,56 @@ def post_document(document: models.Document, allow_negative: bool = None) -> mod
                     quantity=Decimal("0.000"),
                 )
 
+            wh_from, wh_to = document.warehouse_from, document.warehouse_to
+            dest_products = {}
             for item in items:
                 if item.product.warehouse_id != document.warehouse_from_id:
                     raise ValueError("Transfer requires product from warehouse_from")
+                if item.product_id not in dest_products:
+                    dest_products[item.product_id] = _get_or_create_transfer_product(item.product, wh_to)
+
+            ledger = services_stock.StockLedger(document)
+            ledger.lock(
+                [(wh_from, item.product) for item in items]
+                + [(wh_to, dest_products[item.product_id]) for item in items]
+            )
+            for item in items:
+                qty_to_move = Decimal(item.qty)
                 # Проверка остатков перед созданием moves
                 if not allow_negative:
-                    bal_from = models.StockBalance.objects.select_for_update().filter(
-                        warehouse=document.warehouse_from, product=item.product
-                    ).first()
-                    if bal_from:
-                        cur_from = Decimal(bal_from.qty) if bal_from.qty else Decimal("0")
-                    else:
-                        # Если StockBalance нет, проверяем quantity товара (если товар принадлежит этому складу)
-                        if item.product.warehouse_id == document.warehouse_from_id:
-                            cur_from = Decimal(item.product.quantity) if item.product.quantity else Decimal("0")
-                        else:
-                            cur_from = Decimal("0")
-                    qty_to_move = Decimal(item.qty)
+                    cur_from = ledger.qty(wh_from, item.product)
                     if cur_from - qty_to_move < 0:
                         # Формируем информативное название товара: артикул или имя
-                        if item.product:
-                            product_display = item.product.article if item.product.article else item.product.name
-                            if not product_display:
-                                product_display = f"ID {item.product_id}"
-                        else:
+                        product_display = item.product.article if item.product.article else item.product.name
+                        if not product_display:
                             product_display = f"ID {item.product_id}"
-                        warehouse_name = document.warehouse_from.name if document.warehouse_from else "не указан"
+                        warehouse_name = wh_from.name if wh_from else "не указан"
                         raise ValueError(f"Недостаточно товара '{product_display}' на складе '{warehouse_name}'. Доступно: {cur_from}, требуется: {qty_to_move}")
-                
-                # from — расход со склада-источника
-                mv1 = models.StockMove.objects.create(
-                    document=document,
-                    warehouse=document.warehouse_from,
-                    product=item.product,
-                    qty_delta=-(item.qty),
-                    move_kind=models.StockMove.MoveKind.EXPENSE,
-                )
-                # to — приход на склад-приёмник (product in destination warehouse)
-                dest_product = _get_or_create_transfer_product(item.product, document.warehouse_to)
-                mv2 = models.StockMove.objects.create(
-                    document=document,
-                    warehouse=document.warehouse_to,
-                    product=dest_product,
-                    qty_delta=(item.qty),
-                    move_kind=models.StockMove.MoveKind.RECEIPT,
-                )
-                # apply moves
-                _apply_move(mv1)
-                _apply_move(mv2)
+
+                # from — расход со склада-источника, to — приход на склад-приёмник
+                ledger.move(wh_from, item.product, -qty_to_move)
+                ledger.move(wh_to, dest_products[item.product_id], qty_to_move)
+            ledger.flush()
 
         elif document.doc_type == document.DocType.INVENTORY:
+            warehouse = document.warehouse_from
+            ledger = services_stock.StockLedger(document)
+            ledger.lock((warehouse, item.product) for item in items)
             for item in items:
                 # fact = item.qty, compare with current
-                bal = models.StockBalance.objects.select_for_update().filter(warehouse=document.warehouse_from, product=item.product).first()
-                if bal:
-                    cur = Decimal(bal.qty) if bal.qty else Decimal("0")
-                else:
-                    # Если StockBalance нет, проверяем quantity товара (если товар принадлежит этому складу)
-                    if item.product.warehouse_id == document.warehouse_from_id:
-                        cur = Decimal(item.product.quantity) if item.product.quantity else Decimal("0")
-                    else:
-                        cur = Decimal("0")
+                cur = ledger.qty(warehouse, item.product)
                 delta = Decimal(item.qty) - cur
                 if delta == 0:
                     continue
                 if not allow_negative and cur + delta < 0:
                     # Формируем информативное название товара: артикул или имя
-                    if item.product:
-                        product_display = item.product.article if item.product.article else item.product.name
-                        if not product_display:
-                            product_display = f"ID {item.product_id}"
-                    else:
+                    product_display = item.product.article if item.product.article else item.product.name
+                    if not product_display:
                         product_display = f"ID {item.product_id}"
-                    warehouse_name = document.warehouse_from.name if document.warehouse_from else "не указан"
+                    warehouse_name = warehouse.name if warehouse else "не указан"
                     raise ValueError(f"Инвентаризация приведет к отрицательному остатку для товара '{product_display}' на складе '{warehouse_name}'. Текущий остаток: {cur}, устанавливается: {item.qty}")
-                move_kind = models.StockMove.MoveKind.RECEIPT if delta > 0 else models.StockMove.MoveKind.EXPENSE
-                mv = models.StockMove.objects.create(
-                    document=document,
-                    warehouse=document.warehouse_from,
-                    product=item.product,
-                    qty_delta=delta,
-                    move_kind=move_kind,
-                )
-                _apply_move(mv)
+                ledger.move(warehouse, item.product, delta)
+            ledger.flush()
 
         else:
             # other single-warehouse operations
@@ -489,38 +423,23 @@ def post_document(document: models.Document, allow_negative: bool = None) -> mod
             sign = sign_map.get(document.doc_type)
             if sign is None:
                 raise ValueError("Unsupported document type for posting")
+            warehouse = document.warehouse_from
+            ledger = services_stock.StockLedger(document)
+            ledger.lock((warehouse, item.product) for item in items)
             for item in items:
                 delta = sign * Decimal(item.qty)
                 if not allow_negative:
-                    # Проверяем остатки: сначала в StockBalance, если нет - используем WarehouseProduct.quantity
-                    bal = models.StockBalance.objects.select_for_update().filter(warehouse=document.warehouse_from, product=item.product).first()
-                    if bal:
-                        cur = Decimal(bal.qty) if bal.qty else Decimal("0")
-                    else:
-                        # Если StockBalance нет, проверяем quantity товара (если товар принадлежит этому складу)
-                        if item.product.warehouse_id == document.warehouse_from_id:
-                            cur = Decimal(item.product.quantity) if item.product.quantity else Decimal("0")
-                        else:
-                            cur = Decimal("0")
+                    # Остаток: StockBalance, а для нового остатка своего склада — WarehouseProduct.quantity
+                    cur = ledger.qty(warehouse, item.product)
                     if cur + delta < 0:
                         # Формируем информативное название товара: артикул или имя
-                        if item.product:
-                            product_display = item.product.article if item.product.article else item.product.name
-                            if not product_display:
-                                product_display = f"ID {item.product_id}"
-                        else:
+                        product_display = item.product.article if item.product.article else item.product.name
+                        if not product_display:
                             product_display = f"ID {item.product_id}"
-                        warehouse_name = document.warehouse_from.name if document.warehouse_from else "не указан"
+                        warehouse_name = warehouse.name if warehouse else "не указан"
                         raise ValueError(f"Недостаточно товара '{product_display}' на складе '{warehouse_name}'. Доступно: {cur}, требуется: {abs(delta)}")
-                move_kind = models.StockMove.MoveKind.RECEIPT if delta > 0 else models.StockMove.MoveKind.EXPENSE
-                mv = models.StockMove.objects.create(
-                    document=document,
-                    warehouse=document.warehouse_from,
-                    product=item.product,
-                    qty_delta=delta,
-                    move_kind=move_kind,
-                )
-                _apply_move(mv)
+                ledger.move(warehouse, item.product, delta)
+            ledger.flush()
 
         # Предоплата для credit-документов: создаём и сразу проводим денежный документ на сумму предоплаты.
         prepayment = Decimal(getattr(document, "prepayment_amount", None) or 0).quantize(Decimal("0.01"))
@@ -0,0 +1,160 @@
+"""
+Чекпоинты сальдо контрагентов для актов сверки (views_reconciliation).
+
+Механика общая с клиентами — apps/main/services/balance_checkpoints.py. Ключ:
+(компания, филиал, контрагент), где филиал NULL — вся компания. Документ
+филиала попадает в оба чекпоинта, документ без филиала — только в общий.
+Компания/филиал товарного документа — со склада-источника, денежного — свои.
+"""
+
+from __future__ import annotations
+
+from decimal import Decimal
+
+from apps.main.services.balance_checkpoints import (
+    Z_MONEY,
+    CheckpointLedger,
+    local_day,
+    midnight,
+    money_sum,
+    month_of,
+)
+from apps.warehouse import models
+
+DOC_DEBIT = {
+    models.Document.DocType.SALE,
+    models.Document.DocType.PURCHASE_RETURN,
+}
+DOC_CREDIT = {
+    models.Document.DocType.PURCHASE,
+    models.Document.DocType.SALE_RETURN,
+}
+DOC_TYPES = DOC_DEBIT | DOC_CREDIT
+
+MONEY_DEBIT = {models.MoneyDocument.DocType.MONEY_EXPENSE}
+MONEY_CREDIT = {models.MoneyDocument.DocType.MONEY_RECEIPT}
+MONEY_TYPES = MONEY_DEBIT | MONEY_CREDIT
+
+
+def _scopes(company_id, branch_id, counterparty_id) -> list:
+    keys = [(company_id, None, counterparty_id)]
+    if branch_id:
+        keys.append((company_id, branch_id, counterparty_id))
+    return keys
+
+
+class CounterpartyLedger(CheckpointLedger):
+    model = models.CounterpartyBalanceCheckpoint
+    owner_model = models.Counterparty
+    owner_field = "counterparty_id"
+    key_fields = ("company_id", "branch_id", "counterparty_id")
+    amount_fields = ("debit", "credit")
+
+    def sources(self) -> dict:
+        return {
+            models.Document: ("status", "doc_type", "counterparty_id", "warehouse_from_id", "date", "total"),
+            models.MoneyDocument: ("status", "doc_type", "counterparty_id", "company_id", "branch_id", "date", "amount"),
+        }
+
+    def contributions(self, sender, state, lookups: dict) -> list:
+        if sender is models.Document:
+            status, doc_type, counterparty_id, warehouse_id, date, total = state
+            if status != models.Document.Status.POSTED or doc_type not in DOC_TYPES:
+                return []
+            if not (counterparty_id and warehouse_id and date):
+                return []
+            if ("warehouse", warehouse_id) not in lookups:
+                lookups[("warehouse", warehouse_id)] = (
+                    models.Warehouse.objects.filter(pk=warehouse_id).values_list("company_id", "branch_id").first()
+                )
+            wh = lookups[("warehouse", warehouse_id)]
+            if wh is None:
+                return []
+            company_id, branch_id = wh
+            side = "debit" if doc_type in DOC_DEBIT else "credit"
+            amount = total
+        else:
+            status, doc_type, counterparty_id, company_id, branch_id, date, amount = state
+            if status != models.MoneyDocument.Status.POSTED or doc_type not in MONEY_TYPES:
+                return []
+            if not (counterparty_id and company_id and date):
+                return []
+            side = "debit" if doc_type in MONEY_DEBIT else "credit"
+
+        day = local_day(date)
+        return [(key, day, {side: amount}) for key in _scopes(company_id, branch_id, counterparty_id)]
+
+    def period_sums(self, key: tuple, since, until) -> dict:
+        company_id, branch_id, counterparty_id = key
+        date_range = {"date__lt": until}
+        if since is not None:
+            date_range["date__gte"] = midnight(since)
+
+        docs = models.Document.objects.filter(
+            counterparty_id=counterparty_id,
+            status=models.Document.Status.POSTED,
+            doc_type__in=DOC_TYPES,
+            warehouse_from__company_id=company_id,
+            **date_range,
+        )
+        money = models.MoneyDocument.objects.filter(
+            counterparty_id=counterparty_id,
+            status=models.MoneyDocument.Status.POSTED,
+            doc_type__in=MONEY_TYPES,
+            company_id=company_id,
+            **date_range,
+        )
+        if branch_id is not None:
+            docs = docs.filter(warehouse_from__branch_id=branch_id)
+            money = money.filter(branch_id=branch_id)
+
+        d = docs.aggregate(debit=money_sum("total", doc_type__in=DOC_DEBIT), credit=money_sum("total", doc_type__in=DOC_CREDIT))
+        m = money.aggregate(debit=money_sum("amount", doc_type__in=MONEY_DEBIT), credit=money_sum("amount", doc_type__in=MONEY_CREDIT))
+        return {"debit": d["debit"] + m["debit"], "credit": d["credit"] + m["credit"]}
+
+    def monthly_sums(self, company_id=None):
+        doc_scope = {"warehouse_from__company_id": company_id} if company_id else {}
+        for r in (
+            models.Document.objects.filter(
+                status=models.Document.Status.POSTED,
+                doc_type__in=DOC_TYPES,
+                counterparty__isnull=False,
+                warehouse_from__isnull=False,
+                **doc_scope,
+            )
+            .annotate(m=month_of("date"))
+            .values("warehouse_from__company_id", "warehouse_from__branch_id", "counterparty_id", "m")
+            .annotate(debit=money_sum("total", doc_type__in=DOC_DEBIT), credit=money_sum("total", doc_type__in=DOC_CREDIT))
+            .order_by()
+        ):
+            amounts = {"debit": r["debit"], "credit": r["credit"]}
+            for key in _scopes(r["warehouse_from__company_id"], r["warehouse_from__branch_id"], r["counterparty_id"]):
+                yield key, local_day(r["m"]), amounts
+
+        money_scope = {"company_id": company_id} if company_id else {}
+        for r in (
+            models.MoneyDocument.objects.filter(
+                status=models.MoneyDocument.Status.POSTED,
+                doc_type__in=MONEY_TYPES,
+                counterparty__isnull=False,
+                **money_scope,
+            )
+            .annotate(m=month_of("date"))
+            .values("company_id", "branch_id", "counterparty_id", "m")
+            .annotate(debit=money_sum("amount", doc_type__in=MONEY_DEBIT), credit=money_sum("amount", doc_type__in=MONEY_CREDIT))
+            .order_by()
+        ):
+            amounts = {"debit": r["debit"], "credit": r["credit"]}
+            for key in _scopes(r["company_id"], r["branch_id"], r["counterparty_id"]):
+                yield key, local_day(r["m"]), amounts
+
+    def opening(self, company_id, branch_id, counterparty_id, start_dt):
+        """(сальдо, дебет до start, кредит до start) — как _opening_balance акта сверки."""
+        if company_id is None:
+            return Z_MONEY, Z_MONEY, Z_MONEY
+        sums = self.balance_before((company_id, branch_id, counterparty_id), start_dt)
+        debit, credit = Decimal(sums["debit"]), Decimal(sums["credit"])
+        return debit - credit, debit, credit
+
+
+COUNTERPARTY_LEDGER = CounterpartyLedger()
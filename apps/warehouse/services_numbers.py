@@ -0,0 +1,151 @@
+"""
+Нумерация складских и денежных документов: TYPE-YYYYMMDD-0001.
+
+Серия одна на (тип, день) — как и раньше, Document.number уникален глобально.
+Счётчик разбит на строки DocumentSequence:
+- shard 0 — "голова": seq — сколько номеров дня уже роздано шардам диапазонами;
+- shard 1..N — раздают номера подряд из своего диапазона [seq+1, seq_limit],
+  исчерпав его, берут у головы следующий (WAREHOUSE_DOC_NUMBER_RANGE номеров).
+Транзакция берёт свободный шард (SKIP LOCKED), поэтому параллельные проведения
+не ждут друг друга на одной строке, а голова блокируется раз на диапазон.
+Без конкуренции работает один шард и номера идут подряд, как раньше;
+при параллельных проведениях номера дня идут не строго по порядку.
+
+Вне транзакции (autocommit) номера выдаются блоками: процесс резервирует
+WAREHOUSE_DOC_NUMBER_BLOCK номеров одним UPDATE и раздаёт их из памяти.
+Внутри транзакции блоки не используются: при откате резерв вернулся бы в БД,
+а в памяти остался бы — и номера задвоились бы.
+"""
+
+from __future__ import annotations
+
+import random
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from . import models
+
+HEAD_SHARD = 0
+
+
+def _shard_count() -> int:
+    return max(1, int(getattr(settings, "WAREHOUSE_DOC_NUMBER_SHARDS", 4) or 1))
+
+
+def _block_size() -> int:
+    return max(1, int(getattr(settings, "WAREHOUSE_DOC_NUMBER_BLOCK", 20) or 1))
+
+
+def _range_size() -> int:
+    return max(1, int(getattr(settings, "WAREHOUSE_DOC_NUMBER_RANGE", 100) or 1))
+
+
+_blocks_lock = threading.Lock()
+_blocks: dict = {}  # (doc_type, day) -> [next_seq, last_seq]
+
+
+def format_number(doc_type: str, day, seq: int) -> str:
+    return f"{doc_type}-{day.strftime('%Y%m%d')}-{seq:04d}"
+
+
+def _get_or_create_locked(scope, doc_type: str, day, shard: int) -> models.DocumentSequence:
+    try:
+        with transaction.atomic():
+            models.DocumentSequence.objects.get_or_create(doc_type=doc_type, date=day, shard=shard)
+    except IntegrityError:
+        # строку параллельно создал другой процесс
+        pass
+    return scope.select_for_update().get(shard=shard)
+
+
+def _lock_shard(scope, doc_type: str, day) -> models.DocumentSequence:
+    """
+    Раздающий шард под блокировкой текущей транзакции.
+    Сначала — свободный шард с меньшим номером (обычно 1), затем — создание недостающего,
+    и только если заняты все — ожидание случайного.
+    """
+    shards = _shard_count()
+    row = (
+        scope.select_for_update(skip_locked=True)
+        .filter(shard__gt=HEAD_SHARD, shard__lte=shards)
+        .order_by("shard")
+        .first()
+    )
+    if row is not None:
+        return row
+
+    existing = set(scope.values_list("shard", flat=True))
+    for shard in range(HEAD_SHARD + 1, shards + 1):
+        if shard in existing:
+            continue
+        try:
+            with transaction.atomic():
+                return models.DocumentSequence.objects.create(doc_type=doc_type, date=day, shard=shard)
+        except IntegrityError:
+            continue
+
+    return scope.select_for_update().get(shard=random.randint(HEAD_SHARD + 1, shards))
+
+
+def _reserve(doc_type: str, day, count: int):
+    """Резервирует count номеров подряд. Возвращает (first_seq, last_seq)."""
+    scope = models.DocumentSequence.objects.filter(doc_type=doc_type, date=day)
+    with transaction.atomic():
+        row = _lock_shard(scope, doc_type, day)
+        update_fields = ["seq"]
+        if row.seq + count > row.seq_limit:
+            # диапазон исчерпан — остаток (если блок в него не влез) пропускаем
+            head = _get_or_create_locked(scope, doc_type, day, HEAD_SHARD)
+            size = max(count, _range_size())
+            row.seq, row.seq_limit = head.seq, head.seq + size
+            head.seq += size
+            head.save(update_fields=["seq"])
+            update_fields.append("seq_limit")
+        first = row.seq + 1
+        row.seq += count
+        row.save(update_fields=update_fields)
+    return first, row.seq
+
+
+def _take_from_block(key):
+    with _blocks_lock:
+        block = _blocks.get(key)
+        if not block or block[0] > block[1]:
+            return None
+        seq = block[0]
+        block[0] += 1
+        return seq
+
+
+def allocate_number(doc_type: str, *, day=None) -> str:
+    """
+    Следующий номер документа типа doc_type.
+    Номера уникальны в пределах (тип, день), но могут идти не по порядку и с пропусками.
+    """
+    day = day or timezone.now().date()
+    block = _block_size()
+
+    if block == 1 or connection.in_atomic_block:
+        seq, _last = _reserve(doc_type, day, 1)
+        return format_number(doc_type, day, seq)
+
+    key = (doc_type, day)
+    seq = _take_from_block(key)
+    if seq is None:
+        first, last = _reserve(doc_type, day, block)
+        with _blocks_lock:
+            # блоки прошлых дней больше не понадобятся
+            for stale in [k for k in _blocks if k[1] != day]:
+                del _blocks[stale]
+            _blocks[key] = [first + 1, last]
+        seq = first
+
+    return format_number(doc_type, day, seq)
+
+
+def document_company_id(document: models.Document):
+    warehouse = document.warehouse_from or document.warehouse_to
+    return getattr(warehouse, "company_id", None)
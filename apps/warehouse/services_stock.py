@@ -0,0 +1,194 @@
+"""
+Пакетное проведение остатков для post_document.
+
+Вместо get_or_create + INSERT + UPDATE на каждую строку документа:
+  1) все затронутые остатки блокируются одним запросом с ORDER BY
+     (одинаковый порядок блокировок у всех транзакций — без взаимных блокировок);
+  2) проверки и изменения идут в памяти в порядке строк документа;
+  3) движения пишутся bulk_create, остатки и WarehouseProduct.quantity — bulk_update.
+"""
+
+from __future__ import annotations
+
+from decimal import Decimal
+
+from django.db.models import Q
+
+from . import models
+from .models import q_qty
+
+_CHUNK = 500
+
+
+class StockLedger:
+    """Остатки склада (StockBalance) в рамках проведения одного документа."""
+
+    balance_model = models.StockBalance
+    move_model = models.StockMove
+
+    def __init__(self, document: models.Document):
+        self.document = document
+        self._balances = {}  # (warehouse_id, product_id) -> balance
+        self._products = {}  # product_id -> WarehouseProduct
+        self._dirty = set()
+        self._moves = []
+
+    # --- блокировка ---
+
+    def _initial_qty(self, warehouse, product) -> Decimal:
+        # как в прежнем _apply_move: новый остаток "своего" склада начинается с quantity товара
+        if product.warehouse_id == warehouse.pk:
+            return Decimal(product.quantity) if product.quantity else Decimal("0.000")
+        return Decimal("0.000")
+
+    def _new_balance(self, warehouse, product):
+        return self.balance_model(
+            warehouse=warehouse,
+            product=product,
+            qty=self._initial_qty(warehouse, product),
+        )
+
+    def _scope_filter(self):
+        return {}
+
+    def _chunk_filters(self, keys):
+        keys = sorted(keys, key=lambda k: (str(k[0]), str(k[1])))
+        for start in range(0, len(keys), _CHUNK):
+            by_warehouse = {}
+            for warehouse_id, product_id in keys[start:start + _CHUNK]:
+                by_warehouse.setdefault(warehouse_id, []).append(product_id)
+            cond = Q()
+            for warehouse_id, product_ids in by_warehouse.items():
+                cond |= Q(warehouse_id=warehouse_id, product_id__in=product_ids)
+            yield cond
+
+    def _existing_keys(self, keys) -> set:
+        found = set()
+        for cond in self._chunk_filters(keys):
+            found.update(
+                self.balance_model.objects.filter(cond, **self._scope_filter()).values_list("warehouse_id", "product_id")
+            )
+        return found
+
+    def _select_for_update(self, keys) -> dict:
+        found = {}
+        for cond in self._chunk_filters(keys):
+            qs = (
+                self.balance_model.objects.select_for_update()
+                .filter(cond, **self._scope_filter())
+                .order_by("warehouse_id", "product_id")
+            )
+            for bal in qs:
+                found[(bal.warehouse_id, bal.product_id)] = bal
+        return found
+
+    def lock(self, pairs) -> None:
+        """
+        pairs: [(warehouse, product), ...]. Недостающие остатки сначала
+        создаются (конфликт с параллельной транзакцией игнорируется), затем
+        все строки блокируются одним упорядоченным SELECT ... FOR UPDATE —
+        порядок блокировок один и тот же у всех транзакций.
+        """
+        wanted = {}
+        for warehouse, product in pairs:
+            key = (warehouse.pk, product.pk)
+            if key in self._balances:
+                continue
+            wanted[key] = (warehouse, product)
+            self._products.setdefault(product.pk, product)
+        if not wanted:
+            return
+
+        existing = self._existing_keys(wanted)
+        missing = sorted((key for key in wanted if key not in existing), key=lambda k: (str(k[0]), str(k[1])))
+        if missing:
+            self.balance_model.objects.bulk_create(
+                [self._new_balance(*wanted[key]) for key in missing],
+                ignore_conflicts=True,
+                batch_size=_CHUNK,
+            )
+        self._balances.update(self._select_for_update(wanted))
+
+    # --- операции ---
+
+    def qty(self, warehouse, product) -> Decimal:
+        bal = self._balances[(warehouse.pk, product.pk)]
+        return Decimal(bal.qty or 0)
+
+    def _make_move(self, warehouse, product, delta, move_kind):
+        return self.move_model(
+            document=self.document,
+            warehouse=warehouse,
+            product=product,
+            qty_delta=delta,
+            move_kind=move_kind,
+        )
+
+    def move(self, warehouse, product, delta: Decimal) -> None:
+        key = (warehouse.pk, product.pk)
+        bal = self._balances[key]
+        bal.qty = Decimal(bal.qty or 0) + Decimal(delta or 0)
+        self._dirty.add(key)
+        move_kind = self.move_model.MoveKind.RECEIPT if delta > 0 else self.move_model.MoveKind.EXPENSE
+        self._moves.append(self._make_move(warehouse, product, delta, move_kind))
+
+    # --- запись ---
+
+    def _product_quantities(self):
+        out = []
+        for warehouse_id, product_id in self._dirty:
+            product = self._products[product_id]
+            if product.warehouse_id == warehouse_id:
+                qty = q_qty(self._balances[(warehouse_id, product_id)].qty)
+                out.append(models.WarehouseProduct(pk=product_id, quantity=qty))
+        return out
+
+    def flush(self) -> None:
+        if self._moves:
+            self.move_model.objects.bulk_create(self._moves, batch_size=_CHUNK)
+        if self._dirty:
+            self.balance_model.objects.bulk_update(
+                [self._balances[key] for key in self._dirty], ["qty"], batch_size=_CHUNK
+            )
+            products = self._product_quantities()
+            if products:
+                models.WarehouseProduct.objects.bulk_update(products, ["quantity"], batch_size=_CHUNK)
+        self._moves = []
+        self._dirty = set()
+
+
+class AgentStockLedger(StockLedger):
+    """Остатки на руках агента (AgentStockBalance); WarehouseProduct.quantity не трогаем."""
+
+    balance_model = models.AgentStockBalance
+    move_model = models.AgentStockMove
+
+    def __init__(self, document: models.Document, agent_id):
+        super().__init__(document)
+        self.agent_id = agent_id
+
+    def _scope_filter(self):
+        return {"agent_id": self.agent_id}
+
+    def _new_balance(self, warehouse, product):
+        return self.balance_model(
+            agent_id=self.agent_id,
+            warehouse=warehouse,
+            product=product,
+            qty=Decimal("0.000"),
+            company_id=warehouse.company_id,
+            branch_id=warehouse.branch_id,
+        )
+
+    def _make_move(self, warehouse, product, delta, move_kind):
+        return self.move_model(
+            document=self.document,
+            agent_id=self.agent_id,
+            warehouse=warehouse,
+            product=product,
+            qty_delta=delta,
+            move_kind=move_kind,
+        )
+
+    def _product_quantities(self):
+        return []
@@ -1,9 +1,17 @@
-from django.test import TestCase
+import threading
+from unittest import mock, skipIf
+
+from django.test import TestCase, TransactionTestCase, override_settings
 from decimal import Decimal
 from django.contrib.auth import get_user_model
+from django.db import connection
 
 from apps.warehouse import models
 from apps.warehouse import services
+from apps.warehouse import services_numbers
+from apps.warehouse.services_checkpoints import COUNTERPARTY_LEDGER
+from apps.main.services.balance_checkpoints import midnight, next_month as month_after
+from django.utils import timezone
 from django.apps import apps
 
 
@@ -74,6 +82,39 @@ class DocumentsTests(TestCase):
         doc.refresh_from_db()
         self.assertEqual(doc.status, models.Document.Status.DRAFT)
 
+    def test_posting_and_unposting_maintain_counterparty_checkpoints(self):
+        models.StockBalance.objects.create(warehouse=self.wh, product=self.prod, qty=Decimal("10.000"))
+        cp = models.Counterparty.objects.create(
+            name="C1", phone="+996700000003", type=models.Counterparty.Type.CLIENT,
+            company=self.company, branch=self.branch,
+        )
+        # чекпоинты следующего месяца (компания и филиал) уже существуют
+        next_month = midnight(month_after(timezone.localdate().replace(day=1)))
+        for branch_id in (None, self.branch.id):
+            COUNTERPARTY_LEDGER.opening(self.company.id, branch_id, cp.id, next_month)
+
+        def assert_checkpoints_fresh(expected_opening):
+            for branch_id in (None, self.branch.id):
+                key = (self.company.id, branch_id, cp.id)
+                row = models.CounterpartyBalanceCheckpoint.objects.get(
+                    company=self.company, branch_id=branch_id, counterparty=cp
+                )
+                fresh = COUNTERPARTY_LEDGER.period_sums(key, None, next_month)
+                self.assertEqual((row.debit, row.credit), (fresh["debit"], fresh["credit"]))
+                self.assertEqual(COUNTERPARTY_LEDGER.opening(*key, next_month)[0], expected_opening)
+
+        doc = models.Document.objects.create(doc_type=models.Document.DocType.SALE, warehouse_from=self.wh, counterparty=cp)
+        models.DocumentItem.objects.create(document=doc, product=self.prod, qty=Decimal("3"), price=Decimal("15"))
+        services.post_document(doc)
+        services.approve_cash_request(doc)  # продажа (дебет 45) + приход денег (кредит 45)
+        assert_checkpoints_fresh(Decimal("0.00"))
+
+        services.unpost_document(doc)  # продажа и её приход денег распроводятся вместе
+        self.assertFalse(
+            models.MoneyDocument.objects.filter(counterparty=cp, status=models.MoneyDocument.Status.POSTED).exists()
+        )
+        assert_checkpoints_fresh(Decimal("0.00"))
+
     def test_reject_cash_request_sets_document_rejected(self):
         models.StockBalance.objects.create(warehouse=self.wh, product=self.prod, qty=Decimal("10.000"))
         cp = models.Counterparty.objects.create(
@@ -213,3 +254,196 @@ class DocumentsTests(TestCase):
                 services.post_document(doc)
         finally:
             settings.ALLOW_NEGATIVE_STOCK = old
+
+    def _purchase_with_lines(self, count, prefix):
+        cp = models.Counterparty.objects.create(
+            name=f"S-{prefix}",
+            phone=f"+99670{count:07d}",
+            type=models.Counterparty.Type.SUPPLIER,
+            company=self.company,
+            branch=self.branch,
+        )
+        doc = models.Document.objects.create(
+            doc_type=models.Document.DocType.PURCHASE,
+            warehouse_from=self.wh,
+            counterparty=cp,
+            payment_kind=models.Document.PaymentKind.CREDIT,
+            number=f"P-{prefix}",
+        )
+        for i in range(count):
+            prod = models.WarehouseProduct.objects.create(
+                company=self.company, branch=self.branch, warehouse=self.wh, category=self.prod.category,
+                name=f"{prefix}{i}", code=f"{prefix}{i}", unit="pcs", quantity=Decimal("2"),
+                purchase_price=Decimal("10.00"), price=Decimal("15.00"),
+            )
+            models.DocumentItem.objects.create(document=doc, product=prod, qty=Decimal("3"), price=Decimal("10"))
+        return doc
+
+    def test_post_cost_does_not_grow_with_lines(self):
+        """Бенчмарк: прежний построчный цикл давал ~4 запроса на строку."""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        def post_queries(doc):
+            doc = models.Document.objects.select_related("warehouse_from", "counterparty").get(pk=doc.pk)
+            with CaptureQueriesContext(connection) as ctx:
+                services.post_document(doc)
+            return len(ctx.captured_queries)
+
+        small = post_queries(self._purchase_with_lines(3, "a"))
+        large = post_queries(self._purchase_with_lines(60, "b"))
+        self.assertEqual(small, large)
+
+        prod = models.WarehouseProduct.objects.get(code="b59")
+        self.assertEqual(prod.quantity, Decimal("5.000"))
+        self.assertEqual(models.StockBalance.objects.get(warehouse=self.wh, product=prod).qty, Decimal("5.000"))
+        self.assertEqual(models.StockMove.objects.filter(document__counterparty__name="S-b").count(), 60)
+
+    def test_repeated_product_lines_are_checked_against_running_balance(self):
+        models.StockBalance.objects.create(warehouse=self.wh, product=self.prod, qty=Decimal("5.000"))
+        cp = models.Counterparty.objects.create(
+            name="C1",
+            phone="+996700000009",
+            type=models.Counterparty.Type.CLIENT,
+            company=self.company,
+            branch=self.branch,
+        )
+        doc = models.Document.objects.create(
+            doc_type=models.Document.DocType.SALE,
+            warehouse_from=self.wh,
+            counterparty=cp,
+        )
+        models.DocumentItem.objects.create(document=doc, product=self.prod, qty=Decimal("3"), price=Decimal("15"))
+        models.DocumentItem.objects.create(document=doc, product=self.prod, qty=Decimal("3"), price=Decimal("15"))
+
+        with self.assertRaisesMessage(ValueError, "Доступно: 2.000"):
+            services.post_document(doc, allow_negative=False)
+        self.assertFalse(models.StockMove.objects.filter(document=doc).exists())
+
+    def test_recalc_totals_single_pass_and_skips_unchanged(self):
+        doc = self._purchase_with_lines(4, "r")
+        doc.discount_amount = Decimal("5.00")
+        doc.save(update_fields=["discount_amount"])
+        # строку правим в обход DocumentItem.save(), line_total устарел
+        item = doc.items.order_by("id").first()
+        models.DocumentItem.objects.filter(pk=item.pk).update(qty=Decimal("10"))
+
+        # выборка строк + bulk_update одной строки + сохранение документа
+        with self.assertNumQueries(3):
+            services.recalc_document_totals(doc)
+        self.assertEqual(doc.total, Decimal("185.00"))
+        item.refresh_from_db()
+        self.assertEqual(item.line_total, Decimal("100.00"))
+
+        with self.assertNumQueries(1):
+            services.recalc_document_totals(doc)
+
+        doc.discount_percent = Decimal("10.00")
+        services.recalc_document_totals(doc)
+        doc.refresh_from_db()
+        self.assertEqual(doc.total, Decimal("166.00"))
+
+
+class DocumentNumberingConcurrencyTests(TransactionTestCase):
+    """Параллельные проведения не получают одинаковых номеров."""
+
+    THREADS = 8
+    PER_THREAD = 25
+    NUMBER_RE = r"^INVENTORY-\d{8}-\d{4}$"
+
+    def setUp(self):
+        user = User.objects.create(email="n@example.com", password="x", first_name="N", last_name="N")
+        Company = apps.get_model("users", "Company")
+        Branch = apps.get_model("users", "Branch")
+        self.company = Company.objects.create(name="C", owner=user)
+        branch = Branch.objects.create(company=self.company, name="Main")
+        self.wh = models.Warehouse.objects.create(name="W1", company=self.company, branch=branch, location="loc")
+        cat = models.WarehouseProductCategory.objects.create(name="Cat1", company=self.company, branch=branch)
+        self.prod = models.WarehouseProduct.objects.create(
+            company=self.company, branch=branch, warehouse=self.wh, category=cat,
+            name="P1", code="P1", unit="pcs", quantity=Decimal("0"), purchase_price=Decimal("10.00"), price=Decimal("15.00")
+        )
+        services_numbers._blocks.clear()
+
+    def _post_inventory(self, qty="1"):
+        doc = models.Document.objects.create(doc_type=models.Document.DocType.INVENTORY, warehouse_from=self.wh)
+        models.DocumentItem.objects.create(document=doc, product=self.prod, qty=Decimal(qty), price=Decimal("0"))
+        services.post_document(doc)
+        return doc.number
+
+    def _run_parallel(self, work):
+        errors, numbers = [], []
+        barrier = threading.Barrier(self.THREADS)
+
+        def worker():
+            try:
+                barrier.wait()
+                numbers.extend(work())
+            except Exception as exc:  # pragma: no cover - покажем в assert
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        return numbers
+
+    @skipIf(connection.vendor == "sqlite", "SQLite не допускает параллельной записи из потоков")
+    @override_settings(WAREHOUSE_DOC_NUMBER_BLOCK=7, WAREHOUSE_DOC_NUMBER_RANGE=10)
+    def test_parallel_block_allocation_has_no_duplicates(self):
+        def work():
+            return [services_numbers.allocate_number("SALE") for _ in range(self.PER_THREAD)]
+
+        numbers = self._run_parallel(work)
+        self.assertEqual(len(numbers), self.THREADS * self.PER_THREAD)
+        self.assertEqual(len(set(numbers)), len(numbers))
+
+    @skipIf(connection.vendor == "sqlite", "SQLite не допускает параллельной записи из потоков")
+    @override_settings(WAREHOUSE_DOC_NUMBER_RANGE=10)
+    def test_parallel_post_document_has_no_duplicates(self):
+        def work():
+            return [self._post_inventory() for _ in range(self.PER_THREAD)]
+
+        numbers = self._run_parallel(work)
+        self.assertEqual(len(set(numbers)), self.THREADS * self.PER_THREAD)
+
+    @override_settings(WAREHOUSE_DOC_NUMBER_SHARDS=3, WAREHOUSE_DOC_NUMBER_RANGE=4)
+    def test_post_document_across_busy_shards_keeps_numbers_unique(self):
+        """
+        Проведения, которым достаются разные шарды (как при параллельной работе),
+        получают уникальные номера в прежнем формате — и выше номеров, выданных
+        до шардирования (строка shard=0 со старым счётчиком).
+        """
+        today = timezone.now().date()
+        models.DocumentSequence.objects.create(doc_type="INVENTORY", date=today, seq=5)
+        real_lock = services_numbers._get_or_create_locked
+        shards = iter([1, 2, 3, 1, 1, 2, 3, 3, 3, 1, 2, 2] * 3)
+
+        def busy_lock(scope, doc_type, day):
+            return real_lock(scope, doc_type, day, next(shards))
+
+        with mock.patch.object(services_numbers, "_lock_shard", side_effect=busy_lock):
+            numbers = [self._post_inventory(str(i + 1)) for i in range(36)]
+
+        self.assertEqual(len(set(numbers)), len(numbers))
+        for number in numbers:
+            self.assertRegex(number, self.NUMBER_RE)
+        self.assertGreater(min(int(n.rsplit("-", 1)[1]) for n in numbers), 5)
+        self.assertEqual(models.Document.objects.filter(number__in=numbers).count(), 36)
+
+    def test_uncontended_numbers_are_consecutive(self):
+        numbers = [self._post_inventory() for _ in range(3)]
+        self.assertEqual([int(n.rsplit("-", 1)[1]) for n in numbers], [1, 2, 3])
+
+    @override_settings(WAREHOUSE_DOC_NUMBER_BLOCK=5)
+    def test_block_is_reserved_with_one_write(self):
+        numbers = [services_numbers.allocate_number("RECEIPT") for _ in range(12)]
+
+        self.assertEqual([int(n.split("-")[-1]) for n in numbers], list(range(1, 13)))
+        # 3 блока по 5: в счётчике учтены и нерозданные номера
+        seq = models.DocumentSequence.objects.get(doc_type="RECEIPT", shard=1)
+        self.assertEqual(seq.seq, 15)
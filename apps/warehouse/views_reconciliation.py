@@ -1,61 +1,22 @@
-import io
-import os
 from decimal import Decimal, ROUND_HALF_UP
 from datetime import datetime, date, time as dtime, timedelta
 
-from django.http import FileResponse
 from django.shortcuts import get_object_or_404
 from django.utils.dateparse import parse_datetime, parse_date
 from django.utils import timezone
 from django.utils.timezone import is_aware, make_aware, get_current_timezone
-from django.db.models import Sum
 
 from rest_framework import permissions, status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import mm
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
+from apps.main import pdf_render
 
 from . import models
+from .services_checkpoints import COUNTERPARTY_LEDGER, DOC_DEBIT, DOC_TYPES, MONEY_CREDIT, MONEY_DEBIT
 from .views import CompanyBranchRestrictedMixin
 
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-FONTS_DIR = os.path.join(os.path.dirname(BASE_DIR), "main", "fonts")
-
-try:
-    pdfmetrics.registerFont(TTFont("DejaVu", os.path.join(FONTS_DIR, "DejaVuSans.ttf")))
-    pdfmetrics.registerFont(TTFont("DejaVu-Bold", os.path.join(FONTS_DIR, "DejaVuSans-Bold.ttf")))
-except Exception:
-    # если шрифтов нет в окружении — PDF всё равно сгенерится на Helvetica
-    pass
-
-
-DOC_DEBIT = {
-    models.Document.DocType.SALE,
-    models.Document.DocType.PURCHASE_RETURN,
-}
-DOC_CREDIT = {
-    models.Document.DocType.PURCHASE,
-    models.Document.DocType.SALE_RETURN,
-}
-DOC_TYPES = DOC_DEBIT | DOC_CREDIT
-
-MONEY_DEBIT = {models.MoneyDocument.DocType.MONEY_EXPENSE}
-MONEY_CREDIT = {models.MoneyDocument.DocType.MONEY_RECEIPT}
-
-
-def _set_font(p, name: str, size: int, fallback: str = "Helvetica"):
-    try:
-        p.setFont(name, size)
-    except Exception:
-        p.setFont(fallback, size)
-
-
 def _aware(dt_or_date, end=False):
     tz = get_current_timezone()
     if isinstance(dt_or_date, datetime):
@@ -78,13 +39,6 @@ def fmt(x: Decimal) -> str:
     return f"{q2(x):.2f}"
 
 
-def _as_decimal(v, default=Decimal("0.00")) -> Decimal:
-    try:
-        return Decimal(str(v).replace(",", "."))
-    except Exception:
-        return default
-
-
 class _CounterpartyReconciliationBase(CompanyBranchRestrictedMixin, APIView):
     permission_classes = [permissions.IsAuthenticated]
 
@@ -163,89 +117,53 @@ class _CounterpartyReconciliationBase(CompanyBranchRestrictedMixin, APIView):
 
         return self._filter_docs_qs(docs_qs), self._filter_money_qs(money_qs)
 
-    def _sum_amount(self, qs, field_name: str) -> Decimal:
-        val = qs.aggregate(s=Sum(field_name)).get("s")
-        return q2(val or Decimal("0.00"))
-
-    def _opening_balance(self, docs_qs, money_qs, start_dt):
-        debit_before = self._sum_amount(
-            docs_qs.filter(doc_type__in=DOC_DEBIT, date__lt=start_dt),
-            "total",
-        )
-        credit_before = self._sum_amount(
-            docs_qs.filter(doc_type__in=DOC_CREDIT, date__lt=start_dt),
-            "total",
-        )
-
-        debit_before += self._sum_amount(
-            money_qs.filter(doc_type__in=MONEY_DEBIT, date__lt=start_dt),
-            "amount",
-        )
-        credit_before += self._sum_amount(
-            money_qs.filter(doc_type__in=MONEY_CREDIT, date__lt=start_dt),
-            "amount",
+    def _opening_balance(self, counterparty, start_dt):
+        # чекпоинт на начало месяца + обороты до start (services_checkpoints)
+        company = self._company()
+        branch = self._auto_branch()
+        opening, debit_before, credit_before = COUNTERPARTY_LEDGER.opening(
+            getattr(company, "id", None), getattr(branch, "id", None), counterparty.id, start_dt
         )
-
-        opening = q2(debit_before - credit_before)
-        return opening, debit_before, credit_before
-
-    def _build_entries(self, docs_qs, money_qs, start_dt, end_dt):
-        entries = []
-
-        docs = docs_qs.filter(date__gte=start_dt, date__lte=end_dt).order_by("date")
-        for doc in docs:
-            amt = q2(doc.total or Decimal("0.00"))
-            if amt <= 0:
-                continue
-            is_debit = doc.doc_type in DOC_DEBIT
-            a_debit = amt if is_debit else Decimal("0.00")
-            a_credit = Decimal("0.00") if is_debit else amt
-            entries.append(
-                {
+        return q2(opening), q2(debit_before), q2(credit_before)
+
+    def _iter_entries(self, docs_qs, money_qs, start_dt, end_dt):
+        """Строки акта по дате: оба источника читаются курсором и сливаются без общего списка."""
+        chunk = pdf_render.rows_chunk()
+
+        def rows(qs, amount_field, debit_types, ref_prefix):
+            qs = qs.filter(date__gte=start_dt, date__lte=end_dt).order_by("date")
+            for doc in qs.iterator(chunk_size=chunk):
+                amt = q2(getattr(doc, amount_field) or Decimal("0.00"))
+                if amt <= 0:
+                    continue
+                is_debit = doc.doc_type in debit_types
+                a_debit = amt if is_debit else Decimal("0.00")
+                a_credit = Decimal("0.00") if is_debit else amt
+                yield {
                     "date": doc.date,
                     "title": f"{doc.get_doc_type_display()} {doc.number or doc.id}",
                     "a_debit": a_debit,
                     "a_credit": a_credit,
                     "b_debit": a_credit,
                     "b_credit": a_debit,
-                    "ref_type": f"document:{doc.doc_type}",
+                    "ref_type": f"{ref_prefix}:{doc.doc_type}",
                     "ref_id": str(doc.id),
                 }
-            )
 
-        money_docs = money_qs.filter(date__gte=start_dt, date__lte=end_dt).order_by("date")
-        for doc in money_docs:
-            amt = q2(doc.amount or Decimal("0.00"))
-            if amt <= 0:
-                continue
-            is_debit = doc.doc_type in MONEY_DEBIT
-            a_debit = amt if is_debit else Decimal("0.00")
-            a_credit = Decimal("0.00") if is_debit else amt
-            entries.append(
-                {
-                    "date": doc.date,
-                    "title": f"{doc.get_doc_type_display()} {doc.number or doc.id}",
-                    "a_debit": a_debit,
-                    "a_credit": a_credit,
-                    "b_debit": a_credit,
-                    "b_credit": a_debit,
-                    "ref_type": f"money:{doc.doc_type}",
-                    "ref_id": str(doc.id),
-                }
-            )
+        return pdf_render.merge_by_date(
+            rows(docs_qs, "total", DOC_DEBIT, "document"),
+            rows(money_qs, "amount", MONEY_DEBIT, "money"),
+        )
 
-        entries.sort(key=lambda x: x["date"])
-        return entries
+    def _build_entries(self, docs_qs, money_qs, start_dt, end_dt):
+        return list(self._iter_entries(docs_qs, money_qs, start_dt, end_dt))
 
     def _totals_from_entries(self, entries):
-        totals = {"a_debit": Decimal("0.00"), "a_credit": Decimal("0.00"), "b_debit": Decimal("0.00"), "b_credit": Decimal("0.00")}
+        totals = dict.fromkeys(pdf_render.AMOUNT_KEYS, Decimal("0.00"))
         for r in entries:
-            totals["a_debit"] += _as_decimal(r.get("a_debit"), Decimal("0.00"))
-            totals["a_credit"] += _as_decimal(r.get("a_credit"), Decimal("0.00"))
-            totals["b_debit"] += _as_decimal(r.get("b_debit"), Decimal("0.00"))
-            totals["b_credit"] += _as_decimal(r.get("b_credit"), Decimal("0.00"))
-        totals = {k: q2(v) for k, v in totals.items()}
-        return totals
+            for key in pdf_render.AMOUNT_KEYS:
+                totals[key] += r[key]
+        return {k: q2(v) for k, v in totals.items()}
 
 
 class CounterpartyReconciliationJSONAPIView(_CounterpartyReconciliationBase):
@@ -259,7 +177,7 @@ class CounterpartyReconciliationJSONAPIView(_CounterpartyReconciliationBase):
             return Response({"detail": error}, status=status.HTTP_400_BAD_REQUEST)
 
         docs_qs, money_qs = self._get_qs(counterparty)
-        opening, _deb_before, _cred_before = self._opening_balance(docs_qs, money_qs, start_dt)
+        opening, _deb_before, _cred_before = self._opening_balance(counterparty, start_dt)
         entries = self._build_entries(docs_qs, money_qs, start_dt, end_dt)
 
         totals = self._totals_from_entries(entries)
@@ -349,192 +267,25 @@ class CounterpartyReconciliationClassicAPIView(_CounterpartyReconciliationBase):
             return self._error_pdf(error)
 
         docs_qs, money_qs = self._get_qs(counterparty)
-        opening, _deb_before, _cred_before = self._opening_balance(docs_qs, money_qs, start_dt)
-        entries = self._build_entries(docs_qs, money_qs, start_dt, end_dt)
-
-        totals = self._totals_from_entries(entries)
-        closing = q2(opening + totals["a_debit"] - totals["a_credit"])
-        on_date = (end_dt + timedelta(days=1)).date()
-
-        buf = io.BytesIO()
-        p = canvas.Canvas(buf, pagesize=A4)
-        W, H = A4
-
-        _set_font(p, "DejaVu-Bold", 14, fallback="Helvetica-Bold")
-        p.drawCentredString(W / 2, H - 20 * mm, "АКТ СВЕРКИ ВЗАИМНЫХ РАСЧЁТОВ")
-        _set_font(p, "DejaVu", 11, fallback="Helvetica")
-        p.drawCentredString(
-            W / 2,
-            H - 27 * mm,
-            f"Период: {start_dt.strftime('%d.%m.%Y')} — {end_dt.strftime('%d.%m.%Y')}   валюта сверки {currency}",
-        )
-
-        company_name = getattr(company, "llc", None) or getattr(company, "name", None) or str(company) if company else "—"
-        counterparty_name = getattr(counterparty, "name", None) or "—"
-
-        _set_font(p, "DejaVu-Bold", 10, fallback="Helvetica-Bold")
-        p.drawString(20 * mm, H - 38 * mm, "КОМПАНИЯ")
-        p.drawString(110 * mm, H - 38 * mm, "КОНТРАГЕНТ")
-        _set_font(p, "DejaVu", 11, fallback="Helvetica")
-        p.drawString(20 * mm, H - 44 * mm, _safe(company_name))
-        p.drawString(110 * mm, H - 44 * mm, _safe(counterparty_name))
-        _set_font(p, "DejaVu", 9, fallback="Helvetica")
-        p.drawString(
-            20 * mm,
-            H - 50 * mm,
-            f"ИНН: {_safe(getattr(company,'inn',None))}    ОКПО: {_safe(getattr(company,'okpo',None))}",
-        )
-        p.drawString(
-            110 * mm,
-            H - 50 * mm,
-            f"ИНН: {_safe(getattr(counterparty,'inn',None))}    ОКПО: {_safe(getattr(counterparty,'okpo',None))}",
-        )
-        p.drawString(
-            20 * mm,
-            H - 56 * mm,
-            f"Р/с: {_safe(getattr(company,'score',None))}    БИК: {_safe(getattr(company,'bik',None))}",
-        )
-        p.drawString(
-            110 * mm,
-            H - 56 * mm,
-            f"Р/с: {_safe(getattr(counterparty,'score',None))}    БИК: {_safe(getattr(counterparty,'bik',None))}",
-        )
-        p.drawString(20 * mm, H - 62 * mm, f"Адрес: {_safe(getattr(company,'address',None))}")
-        p.drawString(110 * mm, H - 62 * mm, f"Адрес: {_safe(getattr(counterparty,'address',None))}")
-        p.drawString(
-            20 * mm,
-            H - 68 * mm,
-            f"Тел.: {_safe(getattr(company,'phone',None))}    E-mail: {_safe(getattr(company,'email',None))}",
-        )
-        p.drawString(
-            110 * mm,
-            H - 68 * mm,
-            f"Тел.: {_safe(getattr(counterparty,'phone',None))}    E-mail: {_safe(getattr(counterparty,'email',None))}",
-        )
-
-        y = H - 78 * mm
-        _set_font(p, "DejaVu-Bold", 9, fallback="Helvetica-Bold")
-        p.drawString(20 * mm, y, "№")
-        p.drawString(28 * mm, y, "Содержание записи")
-        p.drawString(100 * mm, y, _safe(company_name))
-        p.drawString(148 * mm, y, _safe(counterparty_name))
-
-        y -= 5 * mm
-        _set_font(p, "DejaVu-Bold", 9, fallback="Helvetica-Bold")
-        p.drawString(100 * mm, y, "Дт")
-        p.drawString(118 * mm, y, "Кт")
-        p.drawString(148 * mm, y, "Дт")
-        p.drawString(166 * mm, y, "Кт")
-        p.line(20 * mm, y - 1 * mm, 190 * mm, y - 1 * mm)
-        y -= 6 * mm
-
-        _set_font(p, "DejaVu", 9, fallback="Helvetica")
-        a_dt = opening if opening > 0 else Decimal("0.00")
-        a_kt = -opening if opening < 0 else Decimal("0.00")
-        b_dt = a_kt
-        b_kt = a_dt
-
-        p.drawString(28 * mm, y, "Сальдо начальное")
-        p.drawRightString(115 * mm, y, fmt(a_dt))
-        p.drawRightString(133 * mm, y, fmt(a_kt))
-        p.drawRightString(163 * mm, y, fmt(b_dt))
-        p.drawRightString(181 * mm, y, fmt(b_kt))
-        y -= 7 * mm
-
-        def ensure_page_space(current_y: float) -> float:
-            if current_y < 40 * mm:
-                p.showPage()
-                _set_font(p, "DejaVu-Bold", 10, fallback="Helvetica-Bold")
-                p.drawString(20 * mm, H - 20 * mm, "Продолжение акта сверки")
-                yy = H - 30 * mm
-                _set_font(p, "DejaVu-Bold", 9, fallback="Helvetica-Bold")
-                p.drawString(20 * mm, yy, "№")
-                p.drawString(28 * mm, yy, "Содержание записи")
-                p.drawString(100 * mm, yy, _safe(company_name))
-                p.drawString(148 * mm, yy, _safe(counterparty_name))
-                yy -= 5 * mm
-                p.drawString(100 * mm, yy, "Дт")
-                p.drawString(118 * mm, yy, "Кт")
-                p.drawString(148 * mm, yy, "Дт")
-                p.drawString(166 * mm, yy, "Кт")
-                p.line(20 * mm, yy - 1 * mm, 190 * mm, yy - 1 * mm)
-                return yy - 6 * mm
-            return current_y
-
-        num = 0
-        for row in entries:
-            y = ensure_page_space(y)
-            num += 1
-            p.drawString(20 * mm, y, str(num))
-            desc = row["title"]
-            line1 = desc[:52]
-            line2 = desc[52:104] if len(desc) > 52 else ""
-            p.drawString(28 * mm, y, line1)
-            p.drawRightString(115 * mm, y, fmt(row["a_debit"]))
-            p.drawRightString(133 * mm, y, fmt(row["a_credit"]))
-            p.drawRightString(163 * mm, y, fmt(row["b_debit"]))
-            p.drawRightString(181 * mm, y, fmt(row["b_credit"]))
-            y -= 6 * mm
-            if line2:
-                y = ensure_page_space(y)
-                p.drawString(28 * mm, y, line2)
-                y -= 6 * mm
-
-        y -= 4 * mm
-        p.line(20 * mm, y, 190 * mm, y)
-        y -= 7 * mm
-        _set_font(p, "DejaVu-Bold", 10, fallback="Helvetica-Bold")
-        p.drawString(28 * mm, y, "Итого обороты:")
-        p.drawRightString(115 * mm, y, fmt(totals["a_debit"]))
-        p.drawRightString(133 * mm, y, fmt(totals["a_credit"]))
-        p.drawRightString(163 * mm, y, fmt(totals["b_debit"]))
-        p.drawRightString(181 * mm, y, fmt(totals["b_credit"]))
-        y -= 10 * mm
-
-        debtor, creditor, amount = None, None, abs(closing)
-        if closing > 0:
-            debtor = counterparty_name
-            creditor = company_name
-        elif closing < 0:
-            debtor = company_name
-            creditor = counterparty_name
-
-        _set_font(p, "DejaVu", 10, fallback="Helvetica")
-        if amount == 0:
-            phrase = f"Задолженность отсутствует на {on_date.strftime('%d.%m.%Y')}."
-        else:
-            phrase = (
-                f"Задолженность {debtor} перед {creditor} на {on_date.strftime('%d.%m.%Y')} "
-                f"составляет {fmt(amount)} {currency}"
+        opening, _deb_before, _cred_before = self._opening_balance(counterparty, start_dt)
+
+        def draw(p):
+            pdf_render.draw_reconciliation_act(
+                p,
+                company=company,
+                company_name=getattr(company, "llc", None) or getattr(company, "name", None) or str(company) if company else "—",
+                party=counterparty,
+                party_name=getattr(counterparty, "name", None) or "—",
+                party_title="КОНТРАГЕНТ",
+                start_dt=start_dt,
+                end_dt=end_dt,
+                currency=currency,
+                opening=opening,
+                entries=self._iter_entries(docs_qs, money_qs, start_dt, end_dt),
             )
-        p.drawString(20 * mm, y, phrase)
-        y -= 8 * mm
-        if amount == 0:
-            p.drawString(20 * mm, y, "(Ноль сом 00 тыйын)")
-        y -= 16 * mm
-
-        _set_font(p, "DejaVu-Bold", 10, fallback="Helvetica-Bold")
-        p.drawString(20 * mm, y, _safe(company_name))
-        p.drawString(110 * mm, y, _safe(counterparty_name))
-        y -= 8 * mm
-        _set_font(p, "DejaVu", 10, fallback="Helvetica")
-        p.drawString(20 * mm, y, "Главный бухгалтер: __________________")
-        p.drawString(110 * mm, y, "Главный бухгалтер: __________________")
-
-        p.showPage()
-        p.save()
-        buf.seek(0)
+
         filename = f"counterparty_reconciliation_{counterparty.id}_{start_dt.date()}_{end_dt.date()}.pdf"
-        return FileResponse(buf, as_attachment=True, filename=filename)
+        return pdf_render.pdf_response(draw, filename)
 
     def _error_pdf(self, message: str):
-        buf = io.BytesIO()
-        p = canvas.Canvas(buf, pagesize=A4)
-        _set_font(p, "DejaVu-Bold", 14, fallback="Helvetica-Bold")
-        p.drawString(30 * mm, 260 * mm, "Невозможно сформировать акт сверки")
-        _set_font(p, "DejaVu", 11, fallback="Helvetica")
-        p.drawString(30 * mm, 248 * mm, message)
-        p.showPage()
-        p.save()
-        buf.seek(0)
-        return FileResponse(buf, as_attachment=False, filename="reconciliation_error.pdf", status=400)
+        return pdf_render.error_pdf(message)
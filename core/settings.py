@@ -14,6 +14,8 @@ from pathlib import Path
 from datetime import timedelta
 import os
 
+from celery.schedules import crontab
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -71,6 +73,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'apps.users.middleware.TenancyMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -231,6 +234,19 @@ CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
+# Периодический проход по outbox product-вебхуков: подбирает записи, чей
+# отложенный запуск съело окно схлопывания, и sending-записи с истёкшей арендой.
+CELERY_BEAT_SCHEDULE = {
+    'dispatch-product-webhooks': {
+        'task': 'apps.main.tasks.dispatch_product_webhooks',
+        'schedule': 60.0,
+    },
+    # чекпоинты сальдо: правки мимо сигналов (queryset.update/bulk_create) — сверка и перестройка
+    'verify-balance-checkpoints': {
+        'task': 'apps.main.tasks.verify_balance_checkpoints',
+        'schedule': crontab(hour=3, minute=30),
+    },
+}
 
 # ===========================
 # Кэширование (Redis)